@@ -0,0 +1,246 @@
+"""
+Nombre de requêtes MongoDB par query GraphQL (régression N+1)
+
+Crée N devices (avec logs et anomalies) pour un utilisateur, exécute des
+queries GraphQL de liste qui demandent les champs calculés, et compte les
+opérations envoyées à MongoDB. Compare au chemin par device
+(get_device_metrics dans une boucle).
+
+Le nombre de requêtes d'une query GraphQL doit rester constant quand N
+augmente. Code de sortie 1 si une query dépasse --max-queries, renvoie des
+erreurs, journalise une erreur, ou si les métriques résolues (heartbeats,
+anomalies, uptime) diffèrent de celles de la boucle par device.
+
+Les métriques groupées utilisent $lookup avec let, que mongomock n'implémente
+pas : --mongomock s'arrête alors avec le code 2 au lieu de rapporter un
+comptage sans valeurs, et le test demande un vrai mongod.
+
+Usage:
+    python benchmarks/graphql_query_count.py --devices 1000
+    python benchmarks/graphql_query_count.py --devices 200 --mongomock
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+from services.device_service import DeviceService
+from services.graphql_service import GraphQLService
+
+try:
+    from mongomock_motor import AsyncMongoMockClient
+    MONGOMOCK_AVAILABLE = True
+except ImportError:
+    MONGOMOCK_AVAILABLE = False
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"))
+
+COUNTED_OPERATIONS = ("find", "find_one", "aggregate", "count_documents")
+
+QUERIES = {
+    "devicesByUser": """
+        query ($userId: String!) {
+            devicesByUser(userId: $userId) { deviceId status uptimePercentage totalHeartbeats anomaliesCount }
+        }
+    """,
+    "topTokenHolders": """
+        { topTokenHolders(limit: 50) { id username totalDevices activeStakes } }
+    """,
+}
+
+
+class CountingCollection:
+    """Compte les opérations de lecture envoyées à une collection"""
+
+    def __init__(self, collection, counter: Counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name in COUNTED_OPERATIONS:
+            def counted(*args, **kwargs):
+                self._counter[f"{self._collection.name}.{name}"] += 1
+                return attribute(*args, **kwargs)
+            return counted
+        return attribute
+
+
+class CountingDatabase:
+    def __init__(self, db):
+        self._db = db
+        self.counter = Counter()
+
+    def __getattr__(self, name):
+        return CountingCollection(getattr(self._db, name), self.counter)
+
+    def __getitem__(self, name):
+        return CountingCollection(self._db[name], self.counter)
+
+
+class ErrorCounter(logging.Handler):
+    """Compte les erreurs journalisées (les services les absorbent et renvoient un défaut)"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+async def supports_lookup_let(db) -> bool:
+    try:
+        await db.devices.aggregate([
+            {"$limit": 1},
+            {"$lookup": {"from": "device_logs", "let": {"device_id": "$device_id"}, "pipeline": [], "as": "probe"}}
+        ]).to_list(length=None)
+        return True
+    except NotImplementedError:
+        return False
+
+
+def compare_metrics(expected, resolved):
+    """Écarts entre les métriques de la boucle par device et celles résolues par GraphQL"""
+    mismatches = []
+    for device in resolved:
+        reference = expected.get(device["deviceId"])
+        if not reference:
+            mismatches.append(f"{device['deviceId']}: absent de la boucle")
+            continue
+        for field, key in (("totalHeartbeats", "total_heartbeats"), ("anomaliesCount", "anomalies_detected")):
+            if device[field] != reference[key]:
+                mismatches.append(f"{device['deviceId']}.{field}: {device[field]} != {reference[key]}")
+        uptime = device["uptimePercentage"]
+        if uptime is None or not math.isclose(uptime, reference["uptime_percentage"], rel_tol=1e-3):
+            mismatches.append(f"{device['deviceId']}.uptimePercentage: {uptime} != {reference['uptime_percentage']}")
+    return mismatches
+
+
+async def seed(db, user_id: str, devices: int):
+    now = datetime.utcnow()
+    await db.users.delete_many({"id": {"$regex": "^graphql-bench"}})
+    await db.devices.delete_many({"owner_id": user_id})
+    await db.users.insert_many([{
+        "id": f"{user_id}-{i}" if i else user_id,
+        "username": f"bench{i}",
+        "qs_balance": 1000 - i,
+        "created_at": now
+    } for i in range(50)])
+    await db.devices.insert_many([{
+        "id": f"graphql-bench-{i}",
+        "device_id": f"graphql-bench-{i}",
+        "device_name": f"Device {i}",
+        "device_type": "sensor",
+        "owner_id": user_id,
+        "status": "active",
+        "firmware_hash": "bench",
+        "public_key": "bench",
+        "capabilities": [],
+        "created_at": now - timedelta(hours=2),
+        "last_heartbeat": now
+    } for i in range(devices)])
+    await db.device_logs.insert_many([{
+        "device_id": f"graphql-bench-{i % devices}",
+        "activity_type": "heartbeat_received",
+        "timestamp": now - timedelta(seconds=i)
+    } for i in range(devices * 5)])
+    await db.anomalies.insert_many([{
+        "device_id": f"graphql-bench-{i % devices}",
+        "anomaly_type": "bench",
+        "timestamp": now
+    } for i in range(devices)])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Régression N+1 des resolvers GraphQL")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--max-queries", type=int, default=6)
+    parser.add_argument("--mongomock", action="store_true", help="base en mémoire (mongomock_motor)")
+    args = parser.parse_args()
+
+    if args.mongomock:
+        if not MONGOMOCK_AVAILABLE:
+            sys.exit("mongomock_motor non installé")
+        client = AsyncMongoMockClient()
+        db = client["graphql_bench"]
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+        db = client[os.environ.get("DB_NAME", "quantumshield") + "_graphql_bench"]
+
+    user_id = "graphql-bench-user"
+    await seed(db, user_id, args.devices)
+    if not await supports_lookup_let(db):
+        print("mongomock n'implémente pas $lookup avec let (métriques groupées) : lancer le test sur un vrai mongod")
+        client.close()
+        sys.exit(2)
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+
+    counting_db = CountingDatabase(db)
+    device_service = DeviceService(counting_db)
+    graphql_service = GraphQLService(counting_db, {"device_service": device_service})
+
+    print(f"{args.devices} devices")
+    print(f"{'query':<26} | {'requêtes':>9} | {'durée':>9} | détail")
+    failed = False
+
+    counting_db.counter.clear()
+    start = time.perf_counter()
+    devices = await device_service.get_user_devices(user_id)
+    expected = {}
+    for device in devices:
+        expected[device.device_id] = await device_service.get_device_metrics(device.device_id)
+    elapsed = time.perf_counter() - start
+    print(f"{'boucle get_device_metrics':<26} | {sum(counting_db.counter.values()):>9} | {elapsed:>7.2f} s |")
+
+    for name, query in QUERIES.items():
+        counting_db.counter.clear()
+        start = time.perf_counter()
+        result = await graphql_service.execute_query(query, {"userId": user_id})
+        elapsed = time.perf_counter() - start
+        total = sum(counting_db.counter.values())
+        detail = ", ".join(f"{key}={value}" for key, value in sorted(counting_db.counter.items()))
+        print(f"{name:<26} | {total:>9} | {elapsed:>7.2f} s | {detail}")
+        if result["errors"]:
+            print(f"  {len(result['errors'])} erreur(s), ex. {str(result['errors'][0]).splitlines()[0]}")
+            failed = True
+        if total > args.max_queries:
+            print(f"  <-- plus de {args.max_queries} requêtes")
+            failed = True
+
+    # Valeurs : mêmes métriques que la boucle par device, non nulles (données semées)
+    result = await graphql_service.execute_query(QUERIES["devicesByUser"], {"userId": user_id})
+    resolved = (result.get("data") or {}).get("devicesByUser") or []
+    if len(resolved) != args.devices or not any(device["totalHeartbeats"] for device in resolved):
+        print(f"  métriques vides ou nulles : {len(resolved)} devices résolus")
+        failed = True
+    mismatches = compare_metrics(expected, resolved)
+    if mismatches:
+        print(f"  {len(mismatches)} métriques différentes de la boucle, ex. {mismatches[:3]}")
+        failed = True
+    if errors.messages:
+        print(f"  {len(errors.messages)} erreur(s) journalisée(s), ex. {errors.messages[:3]}")
+        failed = True
+
+    if not args.mongomock:
+        await db.client.drop_database(db.name)
+    client.close()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,131 @@
+"""
+Profil du coût de démarrage de l'API
+
+Importe `server` dans un sous-processus avec `python -X importtime`, puis
+agrège le temps cumulé par module de l'application (services.*, routes.*,
+middleware.*) et par paquet tiers de premier niveau. Avec --build-all, mesure
+aussi le temps de construction de chaque service du conteneur.
+
+Sans base MongoDB : le client motor ne se connecte qu'à la première requête.
+Avec --budget-ms, le script échoue (code 1) si l'import dépasse le budget,
+ce qui permet de suivre la régression du démarrage sans infrastructure de CI.
+
+Usage:
+    python benchmarks/import_profile.py --top 15
+    python benchmarks/import_profile.py --budget-ms 2500 --json profile.json
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_PARTY = ("services", "routes", "middleware", "models")
+
+BUILD_SCRIPT = """
+import json, server
+server.services.build(*server.services.get_statistics()["deferred"])
+print("SERVICES_JSON=" + json.dumps(server.services.get_statistics()["build_times_ms"]))
+"""
+
+
+def run_import(build_all: bool):
+    env = dict(os.environ)
+    env.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    env.setdefault("DB_NAME", "quantumshield_profile")
+    code = BUILD_SCRIPT if build_all else "import server"
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        raise SystemExit(f"Échec de l'import de server:\n{process.stderr[-2000:]}")
+    return process.stderr, process.stdout
+
+
+def parse_importtime(output: str):
+    """Retourne {module: (temps propre µs, temps cumulé µs)} et le total de `server`"""
+    modules = {}
+    total = 0
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            self_us, cumulative_us = int(self_us), int(cumulative_us)
+        except ValueError:
+            continue  # ligne d'en-tête
+        name = name.rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name = name.strip()
+        modules[name] = (self_us, cumulative_us, depth)
+        if name == "server":
+            total = cumulative_us
+    return modules, total
+
+
+def aggregate(modules):
+    """Coût cumulé des modules de l'application et propre par paquet tiers"""
+    first_party = {
+        name: cumulative for name, (_, cumulative, _) in modules.items()
+        if name.split(".")[0] in FIRST_PARTY and "." in name
+    }
+    packages = {}
+    for name, (self_us, _, _) in modules.items():
+        root = name.split(".")[0]
+        if root in FIRST_PARTY or root == "server":
+            continue
+        packages[root] = packages.get(root, 0) + self_us
+    return first_party, packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profil d'import de l'API QuantumShield")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--build-all", action="store_true", help="construit aussi tous les services")
+    parser.add_argument("--budget-ms", type=float, default=None)
+    parser.add_argument("--json", dest="json_path", default=None, help="écrit le profil en JSON")
+    args = parser.parse_args()
+
+    stderr, stdout = run_import(args.build_all)
+    modules, total = parse_importtime(stderr)
+    first_party, packages = aggregate(modules)
+
+    print(f"Import de server : {total / 1000:.0f} ms ({len(modules)} modules)")
+    print()
+    print(f"{'module applicatif':<50} | {'cumulé ms':>10}")
+    for name, cumulative in sorted(first_party.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<50} | {cumulative / 1000:>10.1f}")
+    print()
+    print(f"{'paquet tiers':<50} | {'propre ms':>10}")
+    for name, self_us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<50} | {self_us / 1000:>10.1f}")
+
+    build_times = {}
+    if args.build_all:
+        for line in stdout.splitlines():
+            if line.startswith("SERVICES_JSON="):
+                build_times = json.loads(line[len("SERVICES_JSON="):])
+        print()
+        print(f"{'construction du service':<50} | {'ms':>10}")
+        for name, milliseconds in sorted(build_times.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"{name:<50} | {milliseconds:>10.1f}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as handle:
+            json.dump({
+                "total_ms": total / 1000,
+                "first_party_ms": {name: value / 1000 for name, value in first_party.items()},
+                "packages_ms": {name: value / 1000 for name, value in packages.items()},
+                "service_build_ms": build_times
+            }, handle, indent=2, sort_keys=True)
+
+    if args.budget_ms is not None and total / 1000 > args.budget_ms:
+        print(f"\nBudget dépassé : {total / 1000:.0f} ms > {args.budget_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Audit des plans de requête MongoDB
+
+Collecte les index (INDEXES) et requêtes représentatives (QUERY_PROBES)
+déclarés par chaque module de service, applique les index si demandé, puis
+passe chaque requête à explain() et signale :
+  - COLLSCAN : parcours complet de la collection (index manquant) ;
+  - SORT     : tri en mémoire (index ne couvrant pas l'ordre demandé).
+
+Nécessite une base MongoDB (MONGO_URL, DB_NAME). Code de sortie 1 si une
+requête représentative parcourt une collection, ce qui permet d'en faire un
+test de couverture des index.
+
+Usage:
+    python benchmarks/index_audit.py --apply
+    python benchmarks/index_audit.py --json audit.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from services.index_registry import IndexRegistry
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"))
+
+# Modules déclarant INDEXES / QUERY_PROBES (les services du conteneur de server.py)
+SERVICE_MODULES = [
+    "services.advanced_blockchain_service",
+    "services.advanced_crypto_service",
+    "services.advanced_economy_service",
+    "services.ai_analytics_service",
+    "services.api_gateway_service",
+    "services.auth_service",
+    "services.blockchain_service",
+    "services.device_service",
+    "services.geolocation_service",
+    "services.graphql_execution",
+    "services.hsm_service",
+    "services.marketplace_service",
+    "services.mining_service",
+    "services.ota_update_service",
+    "services.security_service",
+    "services.session_store_service",
+    "services.token_leaderboard_service",
+    "services.token_service",
+    "services.webhook_outbox_service",
+    "services.webhook_service",
+    "services.x509_service",
+]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Audit des index et plans de requête MongoDB")
+    parser.add_argument("--apply", action="store_true", help="crée les index déclarés avant l'audit")
+    parser.add_argument("--json", dest="json_path", default=None, help="écrit le rapport complet en JSON")
+    args = parser.parse_args()
+
+    client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    db = client[os.environ.get("DB_NAME", "quantumshield")]
+
+    registry = IndexRegistry(db)
+    for module_name in SERVICE_MODULES:
+        registry.declare_module(module_name)
+    statistics = registry.get_statistics()
+    print(f"{statistics['indexes']} index déclarés sur {statistics['collections']} collections, "
+          f"{statistics['probes']} requêtes représentatives")
+
+    if args.apply:
+        result = await registry.apply()
+        print(f"Index appliqués : {result['indexes']}, conflits : {len(result['conflicts'])}")
+        for conflict in result["conflicts"]:
+            print(f"  conflit : {conflict}")
+
+    audit = await registry.audit()
+    print()
+    print(f"{'service':<28} | {'collection':<24} | {'plan':<28} | requête")
+    for report in audit["reports"]:
+        if "error" in report:
+            plan = f"ERREUR {report['error'][:20]}"
+        else:
+            plan = " > ".join(reversed(report["stages"]))
+        flag = "  <-- COLLSCAN" if report.get("collection_scan") else ""
+        print(f"{report['owner']:<28} | {report['collection']:<24} | {plan:<28} | {report['description']}{flag}")
+
+    print()
+    print(f"Parcours de collection : {len(audit['collection_scans'])}, "
+          f"tris en mémoire : {len(audit['in_memory_sorts'])}, erreurs : {len(audit['errors'])}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as handle:
+            json.dump(audit, handle, indent=2, default=str)
+
+    client.close()
+    if audit["collection_scans"] or audit["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+"""
+Benchmark du classement $QS matérialisé
+
+Crée N utilisateurs (soldes, récompenses étalées sur un an, devices), puis :
+  - compte les requêtes MongoDB et mesure la latence de get_leaderboard ;
+  - compare le score matérialisé (forme close) au score recalculé depuis
+    l'historique des récompenses avec la même décroissance ;
+  - mesure le coût des mises à jour incrémentales du classement en mémoire.
+
+Usage:
+    python benchmarks/leaderboard_benchmark.py --users 5000 --mongomock
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+from benchmarks.graphql_query_count import CountingDatabase
+from services.token_leaderboard_service import SCORE_FLOOR
+from services.token_service import TokenService
+
+try:
+    from mongomock_motor import AsyncMongoMockClient
+    MONGOMOCK_AVAILABLE = True
+except ImportError:
+    MONGOMOCK_AVAILABLE = False
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"))
+
+
+async def seed(db, users: int, rewards_per_user: int):
+    rng = random.Random(7)
+    now = datetime.utcnow()
+    await db.token_balances.insert_many([{
+        "user_id": f"lb-user-{i}",
+        "balance": rng.uniform(1, 100000),
+        "last_updated": now
+    } for i in range(users)])
+    await db.reward_claims.insert_many([{
+        "user_id": f"lb-user-{i % users}",
+        "device_id": "system",
+        "reward_type": rng.choice(["anomaly_detection", "data_sharing", "network_participation"]),
+        "amount": rng.choice([5.0, 15.0, 25.0]),
+        "timestamp": now - timedelta(days=rng.uniform(0, 365))
+    } for i in range(users * rewards_per_user)])
+    await db.devices.insert_many([{
+        "device_id": f"lb-device-{i}",
+        "owner_id": f"lb-user-{i % users}"
+    } for i in range(users)])
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Classement $QS matérialisé")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--rewards-per-user", type=int, default=10)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--updates", type=int, default=100000)
+    parser.add_argument("--mongomock", action="store_true", help="base en mémoire (mongomock_motor)")
+    args = parser.parse_args()
+
+    if args.mongomock:
+        if not MONGOMOCK_AVAILABLE:
+            sys.exit("mongomock_motor non installé")
+        client = AsyncMongoMockClient()
+        db = client["leaderboard_bench"]
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+        db = client[os.environ.get("DB_NAME", "quantumshield") + "_leaderboard_bench"]
+
+    await seed(db, args.users, args.rewards_per_user)
+    counting_db = CountingDatabase(db)
+    token_service = TokenService(counting_db)
+
+    start = time.perf_counter()
+    await token_service.leaderboard.refresh()
+    print(f"chargement initial ({args.users} utilisateurs) : {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    counting_db.counter.clear()
+    start = time.perf_counter()
+    leaderboard = await token_service.get_leaderboard(args.limit)
+    elapsed = time.perf_counter() - start
+    print(f"get_leaderboard({args.limit}) : {sum(counting_db.counter.values())} requête(s), {elapsed * 1000:.2f} ms")
+
+    # Score matérialisé vs recalcul depuis l'historique
+    scores = token_service.leaderboard.scores
+    now = datetime.utcnow()
+    max_error = 0.0
+    for entry in leaderboard[:10]:
+        rewards = await db.reward_claims.find({"user_id": entry["user_id"]}).to_list(length=None)
+        expected = sum(
+            reward["amount"] * (SCORE_FLOOR + (1 - SCORE_FLOOR) * 2 ** (-(now - reward["timestamp"]).total_seconds() / scores.half_life))
+            for reward in rewards
+        )
+        max_error = max(max_error, abs(scores.score(entry["user_id"], now)["total_score"] - expected))
+    print(f"écart maximal score matérialisé / historique : {max_error:.2e}")
+
+    rng = random.Random(11)
+    ranking = token_service.leaderboard.ranking
+    start = time.perf_counter()
+    for _ in range(args.updates):
+        ranking.update(f"lb-user-{rng.randrange(args.users)}", rng.uniform(1, 100000))
+    elapsed = time.perf_counter() - start
+    print(f"{args.updates} mises à jour du classement : {elapsed / args.updates * 1e6:.2f} µs/mise à jour")
+
+    if not args.mongomock:
+        await client.drop_database(db.name)
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+"""
+Benchmark des connexions concurrentes (vérification bcrypt)
+
+Lance une rafale de N vérifications de mot de passe concurrentes pendant
+qu'une tâche « témoin » mesure le retard de la boucle asyncio toutes les 5 ms
+(ce que subissent les autres endpoints) :
+  - inline : bcrypt.checkpw appelé directement dans la coroutine (ancien comportement) ;
+  - pool   : AuthService.verify_password (pool de threads borné, rejet rapide).
+
+Usage:
+    python benchmarks/login_hash_benchmark.py --logins 64 --rounds 12
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt
+
+from services.auth_service import AuthService, PasswordHashingBusyError
+
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))] if values else 0.0
+
+
+async def watch_loop(stop: asyncio.Event, lags: list):
+    """Mesure le retard de réveil de la boucle (latence ajoutée aux autres requêtes)"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.005)
+        lags.append(time.perf_counter() - start - 0.005)
+
+
+async def run(mode: str, auth: AuthService, password_hash: str, logins: int):
+    lags, latencies = [], []
+    rejected = 0
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(watch_loop(stop, lags))
+    await asyncio.sleep(0.02)
+
+    async def login():
+        # Latence mesurée depuis l'arrivée de la rafale (attente de la boucle incluse)
+        nonlocal rejected
+        try:
+            if mode == "inline":
+                bcrypt.checkpw(b"correct horse", password_hash.encode())
+            else:
+                await auth.verify_password("correct horse", password_hash)
+            latencies.append(time.perf_counter() - burst_start)
+        except PasswordHashingBusyError:
+            rejected += 1
+
+    burst_start = time.perf_counter()
+    await asyncio.gather(*[login() for _ in range(logins)])
+    elapsed = time.perf_counter() - burst_start
+    stop.set()
+    await watcher
+
+    print(f"{mode:>7} | {elapsed:>7.2f} s | {percentile(latencies, 0.5) * 1000:>9.0f} | "
+          f"{percentile(latencies, 0.99) * 1000:>9.0f} | {max(lags) * 1000 if lags else 0:>12.0f} | {rejected:>7}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark bcrypt sous charge")
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--rounds", type=int, default=12)
+    args = parser.parse_args()
+
+    os.environ["BCRYPT_ROUNDS"] = str(args.rounds)
+    auth = AuthService(SimpleNamespace(users=None, sessions=None))
+    password_hash = bcrypt.hashpw(b"correct horse", bcrypt.gensalt(rounds=args.rounds)).decode()
+
+    print(f"{args.logins} connexions simultanées, coût bcrypt {args.rounds}, "
+          f"{auth.hash_workers} threads, file max {auth.max_pending_hashes}")
+    print(f"{'mode':>7} | {'total':>9} | {'p50 ms':>9} | {'p99 ms':>9} | {'lag max ms':>12} | {'rejets':>7}")
+    await run("inline", auth, password_hash, args.logins)
+    await run("pool", auth, password_hash, args.logins)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+"""
+Benchmark de latence du middleware de l'API Gateway
+
+Compare, sur une application FastAPI minimale servie en ASGI direct (httpx) :
+  - sans middleware ;
+  - "avant" : deux BaseHTTPMiddleware empilés (sécurité + rate limiting),
+    reproduisant la structure des anciens SecurityMiddleware/RateLimitMiddleware ;
+  - "après" : la pile réelle de server.py, setup_api_gateway_middleware
+    (APIGatewayMiddleware en ASGI pur) puis le CORSMiddleware de Starlette.
+Le service de rate limiting est un APIGatewayService en mémoire, sans base.
+
+Usage:
+    python benchmarks/middleware_benchmark.py --requests 5000
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+
+from middleware.api_gateway_middleware import APIGatewayMiddleware, setup_api_gateway_middleware
+from services.api_gateway_service import APIGatewayService, APITier, RateLimitType
+
+
+class LegacySecurityMiddleware(BaseHTTPMiddleware):
+    """Structure de l'ancien SecurityMiddleware : recherche de sous-chaînes sur l'URL complète"""
+
+    patterns = ["script", "javascript:", "<script>", "eval(", "document.cookie", "window.location"]
+
+    async def dispatch(self, request, call_next):
+        text = str(request.url).lower()
+        if any(pattern in text for pattern in self.patterns):
+            return JSONResponse(status_code=400, content={"error": "Requête suspecte détectée"})
+        response = await call_next(request)
+        for key, value in APIGatewayMiddleware.SECURITY_HEADERS:
+            response.headers[key.decode()] = value.decode()
+        return response
+
+
+class LegacyRateLimitMiddleware(BaseHTTPMiddleware):
+    """Structure de l'ancien RateLimitMiddleware : call_next puis réécriture des headers"""
+
+    def __init__(self, app, api_gateway_service=None):
+        super().__init__(app)
+        self.api_gateway_service = api_gateway_service
+        self.helper = APIGatewayMiddleware(app, api_gateway_service)
+
+    async def dispatch(self, request, call_next):
+        start_time = time.time()
+        if self.helper._should_bypass(request.scope):
+            return await call_next(request)
+        allowed, result = await self.api_gateway_service.check_rate_limit(request=request, api_key=None)
+        if not allowed:
+            return JSONResponse(status_code=429, content={"error": result.get("error")})
+        response = await call_next(request)
+        for key, value in self.helper._build_rate_limit_headers(result["rate_limit_info"]).items():
+            response.headers[key] = value
+        response.headers["X-Process-Time"] = str(time.time() - start_time)
+        return response
+
+
+def build_app(mode: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/api/bench/items")
+    async def items():
+        return {"items": [1, 2, 3]}
+
+    gateway = APIGatewayService(None)
+    # Limites hautes : on mesure le coût du chemin autorisé
+    gateway.tier_limits[APITier.FREE] = {limit_type: 10 ** 9 for limit_type in RateLimitType}
+
+    if mode == "before":
+        app.add_middleware(LegacySecurityMiddleware)
+        app.add_middleware(LegacyRateLimitMiddleware, api_gateway_service=gateway)
+    elif mode == "after":
+        # Même ordre d'ajout que server.py
+        setup_api_gateway_middleware(app, gateway)
+        app.add_middleware(
+            CORSMiddleware,
+            allow_credentials=True,
+            allow_origins=["*"],
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+    return app
+
+
+async def measure(mode: str, requests: int):
+    transport = httpx.ASGITransport(app=build_app(mode), client=("127.0.0.1", 50000))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for _ in range(200):
+            await client.get("/api/bench/items?page=1")
+        latencies = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = await client.get("/api/bench/items?page=1")
+            latencies.append(time.perf_counter() - start)
+            assert response.status_code == 200
+    latencies.sort()
+    return (
+        statistics.mean(latencies) * 1e6,
+        latencies[int(len(latencies) * 0.5)] * 1e6,
+        latencies[int(len(latencies) * 0.99)] * 1e6
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark du middleware de l'API Gateway")
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    print(f"{'configuration':>14} | {'moyenne µs':>10} | {'p50 µs':>8} | {'p99 µs':>8}")
+    for mode in ("none", "before", "after"):
+        mean, p50, p99 = await measure(mode, args.requests)
+        print(f"{mode:>14} | {mean:>10.1f} | {p50:>8.1f} | {p99:>8.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
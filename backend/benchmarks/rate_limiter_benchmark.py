@@ -0,0 +1,74 @@
+"""
+Benchmark du rate limiter de l'API Gateway
+
+Mesure le coût moyen d'un appel à SlidingWindowRateLimiter.acquire (4 fenêtres,
+comme APIGatewayService.check_rate_limit) après N requêtes déjà comptées pour
+une même clé : le coût doit rester constant quel que soit N, et la mémoire
+bornée par le nombre de clés suivies.
+
+Usage:
+    python benchmarks/rate_limiter_benchmark.py --requests 1000000 --keys 50000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.rate_limiter_service import SlidingWindowRateLimiter
+
+WINDOWS = (60, 3600, 86400, 2592000)
+LIMIT = 10 ** 9
+
+
+def checks_for(identifier: str):
+    return [(f"{identifier}:/api/bench:{window}", LIMIT, window) for window in WINDOWS]
+
+
+def bench_single_key(total: int, sample: int):
+    """Coût par requête après 0, total/10, ..., total requêtes sur une seule clé"""
+    limiter = SlidingWindowRateLimiter()
+    checks = checks_for("enterprise-key")
+    now = time.time()
+    step = max(1, total // 10)
+    done = 0
+    print(f"{'requêtes déjà comptées':>24} | {'µs / requête':>12}")
+    while done <= total:
+        start = time.perf_counter()
+        for i in range(sample):
+            limiter.acquire(checks, now + (done + i) * 0.0001)
+        elapsed = time.perf_counter() - start
+        print(f"{done:>24} | {elapsed / sample * 1e6:>12.2f}")
+        for i in range(step):
+            limiter.acquire(checks, now + (done + sample + i) * 0.0001)
+        done += step + sample
+
+
+def bench_many_keys(keys: int, max_keys: int):
+    """Débit et mémoire suivie avec beaucoup d'identifiants distincts"""
+    limiter = SlidingWindowRateLimiter(max_keys=max_keys)
+    start = time.perf_counter()
+    for i in range(keys):
+        limiter.acquire(checks_for(f"ip-{i}"))
+    elapsed = time.perf_counter() - start
+    stats = limiter.get_statistics()
+    print(f"\n{keys} identifiants: {elapsed / keys * 1e6:.2f} µs / requête, "
+          f"{stats['tracked_keys']} clés suivies (plafond {max_keys}), {stats['evicted_keys']} évincées")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du rate limiter")
+    parser.add_argument("--requests", type=int, default=1000000)
+    parser.add_argument("--sample", type=int, default=20000)
+    parser.add_argument("--keys", type=int, default=50000)
+    parser.add_argument("--max-keys", type=int, default=100000)
+    args = parser.parse_args()
+
+    bench_single_key(args.requests, args.sample)
+    bench_many_keys(args.keys, args.max_keys)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Serveur local minimal parlant le protocole Redis (RESP2)
+
+Remplaçant de Redis pour tester RedisRateLimiterBackend sans dépendance
+externe. Commandes supportées : PING, GET, SET, DEL, INCRBY, EXPIRE,
+HSET, HDEL, HGETALL (expiration vérifiée à la lecture).
+
+Usage:
+    python benchmarks/resp_stand_in.py --port 6390
+"""
+
+import argparse
+import asyncio
+import time
+
+
+class RESPStandIn:
+    """Store clé/valeur en mémoire servi en RESP2"""
+
+    def __init__(self):
+        self.values = {}
+        self.hashes = {}
+        self.expiry = {}
+        self.commands = 0
+
+    def _alive(self, key: str) -> bool:
+        deadline = self.expiry.get(key)
+        if deadline is not None and deadline <= time.time():
+            self.values.pop(key, None)
+            self.hashes.pop(key, None)
+            del self.expiry[key]
+            return False
+        return key in self.values or key in self.hashes
+
+    def execute(self, command, *args):
+        self.commands += 1
+        command = command.upper()
+        if command == "PING":
+            return "+PONG"
+        if command == "GET":
+            return self.values.get(args[0]) if self._alive(args[0]) else None
+        if command == "SET":
+            self.values[args[0]] = args[1]
+            self.expiry.pop(args[0], None)
+            if len(args) >= 4 and args[2].upper() == "EX":
+                self.expiry[args[0]] = time.time() + int(args[3])
+            return "+OK"
+        if command == "DEL":
+            removed = sum(1 for key in args if self._alive(key))
+            for key in args:
+                self.values.pop(key, None)
+                self.hashes.pop(key, None)
+                self.expiry.pop(key, None)
+            return removed
+        if command == "INCRBY":
+            value = (int(self.values[args[0]]) if self._alive(args[0]) else 0) + int(args[1])
+            self.values[args[0]] = str(value)
+            return value
+        if command == "EXPIRE":
+            if not self._alive(args[0]):
+                return 0
+            self.expiry[args[0]] = time.time() + int(args[1])
+            return 1
+        if command == "HSET":
+            fields = self.hashes.setdefault(args[0], {})
+            added = 0
+            for field, value in zip(args[1::2], args[2::2]):
+                added += field not in fields
+                fields[field] = value
+            return added
+        if command == "HDEL":
+            fields = self.hashes.get(args[0], {})
+            return sum(1 for field in args[1:] if fields.pop(field, None) is not None)
+        if command == "HGETALL":
+            fields = self.hashes.get(args[0], {}) if self._alive(args[0]) else {}
+            return [item for pair in fields.items() for item in pair]
+        raise ValueError(f"ERR unknown command '{command}'")
+
+
+def encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+    if isinstance(value, str) and value.startswith("+"):
+        return value.encode() + b"\r\n"
+    data = str(value).encode()
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+async def read_command(reader: asyncio.StreamReader):
+    line = await reader.readline()
+    if not line:
+        return None
+    count = int(line[1:-2])
+    arguments = []
+    for _ in range(count):
+        length = int((await reader.readline())[1:-2])
+        arguments.append((await reader.readexactly(length + 2))[:-2].decode())
+    return arguments
+
+
+async def serve(host: str, port: int, store: RESPStandIn = None):
+    """Démarre le serveur et retourne (serveur asyncio, store)"""
+    store = store or RESPStandIn()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                command = await read_command(reader)
+                if command is None:
+                    break
+                try:
+                    writer.write(encode(store.execute(*command)))
+                except Exception as e:
+                    writer.write(f"-{e}\r\n".encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    return server, store
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Stand-in local du protocole Redis")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    server, _ = await serve(args.host, args.port)
+    print(f"Stand-in RESP en écoute sur {args.host}:{args.port}")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,149 @@
+"""
+Benchmark du pipeline de réponse (sérialisation + compression)
+
+Sert en ASGI direct (httpx) des payloads représentatifs des endpoints :
+  - devices   : liste de dispositifs (datetime, UUID, métriques) ;
+  - dashboard : statistiques agrégées imbriquées ;
+  - analytics : séries NumPy (détection d'anomalies) ;
+  - health    : petite réponse (sous le seuil de compression).
+Compare JSONResponse standard et QSJSONResponse (orjson), puis mesure les
+octets transmis selon Accept-Encoding (identity, gzip, br).
+
+Usage:
+    python benchmarks/response_benchmark.py --requests 300 --devices 500
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import numpy as np
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+from middleware.response_middleware import QSJSONResponse, setup_response_pipeline
+
+
+def build_payloads(device_count: int):
+    rng = random.Random(42)
+    now = datetime.utcnow()
+    devices = [{
+        "id": str(uuid.uuid4()),
+        "device_id": f"sensor-{i:05d}",
+        "device_name": f"Capteur {i}",
+        "device_type": rng.choice(["temperature", "humidity", "camera", "gateway"]),
+        "owner_id": str(uuid.uuid4()),
+        "status": rng.choice(["online", "offline", "maintenance"]),
+        "capabilities": ["ntru", "heartbeat", "ota"],
+        "location": {"lat": rng.uniform(-90, 90), "lon": rng.uniform(-180, 180)},
+        "created_at": now - timedelta(days=rng.randint(0, 365)),
+        "last_heartbeat": now - timedelta(seconds=rng.randint(0, 3600)),
+        "metrics": {"cpu": rng.random(), "memory": rng.random(), "battery": rng.randint(0, 100)}
+    } for i in range(device_count)]
+
+    dashboard = {
+        "user_id": str(uuid.uuid4()),
+        "generated_at": now,
+        "devices": {"total": device_count, "online": device_count // 2, "by_type": {"temperature": 120, "camera": 40}},
+        "tokens": {"balance": 1523.75, "history": [{"date": now - timedelta(days=d), "amount": d * 1.5} for d in range(30)]},
+        "security": {"alerts": [{"id": str(uuid.uuid4()), "severity": "medium", "at": now} for _ in range(20)]}
+    }
+
+    series = np.random.default_rng(42).normal(size=(24, 60))
+    analytics = {
+        "model": "isolation_forest",
+        "generated_at": now,
+        "scores": series,
+        "anomaly_count": np.int64((series > 2).sum()),
+        "threshold": np.float64(2.0),
+        "hourly_mean": series.mean(axis=1)
+    }
+
+    return {
+        "devices": {"devices": devices, "count": device_count},
+        "dashboard": dashboard,
+        "analytics": analytics,
+        "health": {"status": "healthy", "timestamp": now}
+    }
+
+
+def build_app(mode: str, payloads) -> FastAPI:
+    response_class = QSJSONResponse if mode == "orjson" else JSONResponse
+    app = FastAPI(default_response_class=response_class)
+
+    for name, payload in payloads.items():
+        # Sans le pipeline, jsonable_encoder ne sait pas sérialiser NumPy : conversion préalable
+        content = payload
+        if mode == "stdlib" and name == "analytics":
+            content = {k: (v.tolist() if isinstance(v, np.ndarray) else v.item() if isinstance(v, np.generic) else v)
+                       for k, v in payload.items()}
+
+        def endpoint(content=content):
+            return content
+        app.add_api_route(f"/api/bench/{name}", endpoint, methods=["GET"])
+
+    if mode == "orjson":
+        setup_response_pipeline(app)
+    return app
+
+
+async def measure_latency(app: FastAPI, path: str, requests: int, encoding: str = "identity") -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        headers = {"Accept-Encoding": encoding}
+        for _ in range(10):
+            await client.get(path, headers=headers)
+        start = time.perf_counter()
+        for _ in range(requests):
+            response = await client.get(path, headers=headers)
+            assert response.status_code == 200
+        return (time.perf_counter() - start) / requests * 1e6
+
+
+async def wire_size(app: FastAPI, path: str, encoding: str) -> int:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.get(path, headers={"Accept-Encoding": encoding})
+        assert response.status_code == 200
+        return int(response.headers.get("content-length", len(response.content)))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark du pipeline de réponse")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--devices", type=int, default=500)
+    args = parser.parse_args()
+
+    payloads = build_payloads(args.devices)
+    stdlib_app = build_app("stdlib", payloads)
+    orjson_app = build_app("orjson", payloads)
+
+    print("Temps de réponse (µs/requête, sans compression)")
+    print(f"{'endpoint':>10} | {'stdlib':>10} | {'orjson':>10} | {'gain':>6}")
+    for name in payloads:
+        path = f"/api/bench/{name}"
+        before = await measure_latency(stdlib_app, path, args.requests)
+        after = await measure_latency(orjson_app, path, args.requests)
+        print(f"{name:>10} | {before:>10.0f} | {after:>10.0f} | {before / after:>5.2f}x")
+
+    print()
+    print("Octets transmis et temps avec compression (pipeline orjson)")
+    print(f"{'endpoint':>10} | {'identity':>10} | {'gzip':>10} | {'br':>10} | {'gzip µs':>8} | {'br µs':>8}")
+    for name in payloads:
+        path = f"/api/bench/{name}"
+        sizes = [await wire_size(orjson_app, path, encoding) for encoding in ("identity", "gzip", "br")]
+        gzip_time = await measure_latency(orjson_app, path, args.requests, "gzip")
+        br_time = await measure_latency(orjson_app, path, args.requests, "br")
+        print(f"{name:>10} | {sizes[0]:>10} | {sizes[1]:>10} | {sizes[2]:>10} | {gzip_time:>8.0f} | {br_time:>8.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""
+Vérification du rate limiting partagé entre plusieurs workers
+
+Lance le stand-in RESP local, crée W backends RedisRateLimiterBackend
+indépendants (un par worker simulé) et envoie R requêtes réparties entre eux
+sur une même clé. Le total autorisé doit rester sous la limite globale
+(et non W fois la limite), avec un nombre d'appels au store divisé par la
+taille des lots de jetons.
+
+Le même scénario est rejoué en rafales concurrentes (asyncio.gather) : les
+lots loués en parallèle pour une même clé ne doivent pas s'écraser, le total
+autorisé doit donc rester proche de la limite (au plus un lot non consommé
+par worker) sans la dépasser.
+
+Usage:
+    python benchmarks/shared_limiter_benchmark.py --workers 4 --requests 20000 --limit 5000 --lease 50
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.resp_stand_in import serve
+from services.rate_limiter_service import RedisRateLimiterBackend, InMemoryRateLimiterBackend
+
+
+async def run(backends, requests: int, limit: int):
+    checks = [("bench-key:/api/bench:per_minute", limit, 60)]
+    allowed = 0
+    start = time.perf_counter()
+    for _ in range(requests):
+        backend = random.choice(backends)
+        ok, _ = await backend.acquire(checks)
+        allowed += ok
+    return allowed, time.perf_counter() - start
+
+
+async def run_concurrent(backends, requests: int, limit: int, concurrency: int):
+    checks = [("bench-key:/api/bench:per_minute", limit, 60)]
+    allowed = 0
+    start = time.perf_counter()
+    for offset in range(0, requests, concurrency):
+        results = await asyncio.gather(*[
+            random.choice(backends).acquire(checks)
+            for _ in range(min(concurrency, requests - offset))
+        ])
+        allowed += sum(ok for ok, _ in results)
+    return allowed, time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark du rate limiting partagé")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--limit", type=int, default=5000)
+    parser.add_argument("--lease", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=50, help="taille des rafales concurrentes")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+
+    server, store = await serve("127.0.0.1", args.port)
+    url = f"redis://127.0.0.1:{args.port}/0"
+
+    local = [InMemoryRateLimiterBackend() for _ in range(args.workers)]
+    allowed, elapsed = await run(local, args.requests, args.limit)
+    print(f"mémoire locale : {allowed} autorisées (limite {args.limit}, {args.workers} workers), "
+          f"{elapsed / args.requests * 1e6:.1f} µs / requête")
+
+    for lease in (1, args.lease):
+        shared = [RedisRateLimiterBackend(url, prefix=f"bench{lease}:", lease_size=lease) for _ in range(args.workers)]
+        before = store.commands
+        allowed, elapsed = await run(shared, args.requests, args.limit)
+        print(f"partagé lot={lease:<4}: {allowed} autorisées (limite {args.limit}), "
+              f"{store.commands - before} commandes store, {elapsed / args.requests * 1e6:.1f} µs / requête")
+        for backend in shared:
+            await backend.client.close()
+
+    # Rafales concurrentes : aucune perte de jetons loués, aucun dépassement
+    shared = [RedisRateLimiterBackend(url, prefix="bench-concurrent:", lease_size=args.lease) for _ in range(args.workers)]
+    before = store.commands
+    allowed, elapsed = await run_concurrent(shared, args.requests, args.limit, args.concurrency)
+    expected = min(args.requests, args.limit)
+    slack = args.workers * max(1, min(args.lease, args.limit // 10))
+    print(f"concurrent x{args.concurrency} lot={args.lease:<4}: {allowed} autorisées (attendu {expected - slack}..{expected}), "
+          f"{store.commands - before} commandes store, {elapsed / args.requests * 1e6:.1f} µs / requête")
+    for backend in shared:
+        await backend.client.close()
+    assert expected - slack <= allowed <= expected, "jetons loués perdus ou limite dépassée en concurrence"
+
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,172 @@
+"""
+Benchmark des transferts de tokens $QS
+
+  - débit : transferts séquentiels par seconde (TokenLedger.transfer) ;
+  - contention : N transferts concurrents depuis un compte qui n'en couvre
+    que K ; compare l'ancien schéma lecture-puis-$inc (découvert possible) au
+    débit conditionnel (exactement K succès, solde jamais négatif) ;
+  - paiements groupés : M récompenses réglées par reward_users_batch contre
+    M appels à reward_user.
+
+La contention passe par YieldingDatabase, qui rend la main à la boucle avant
+chaque opération (comme un aller-retour réseau) : les transferts concurrents
+s'entrelacent donc aussi sous mongomock, qui sinon exécute chaque coroutine
+d'un trait. Le benchmark échoue si l'ancien schéma ne met pas le compte à
+découvert ou si le registre en accorde plus que le solde.
+
+Usage:
+    python benchmarks/token_transfer_benchmark.py --transfers 2000 --payouts 5000
+    python benchmarks/token_transfer_benchmark.py --mongomock
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+
+from services.token_ledger_service import InsufficientBalance, TokenLedger
+from services.token_service import TokenService
+
+try:
+    from mongomock_motor import AsyncMongoMockClient
+    MONGOMOCK_AVAILABLE = True
+except ImportError:
+    MONGOMOCK_AVAILABLE = False
+
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".env"))
+
+
+# Opérations de collection précédées d'un point de suspension
+YIELDING_OPERATIONS = {
+    "find_one", "find_one_and_update", "update_one", "insert_one", "insert_many", "bulk_write"
+}
+
+
+class YieldingCollection:
+    """Rend la main à la boucle avant chaque opération, comme une requête réseau"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name in YIELDING_OPERATIONS:
+            async def yielding(*args, **kwargs):
+                await asyncio.sleep(0)
+                return await attribute(*args, **kwargs)
+            return yielding
+        return attribute
+
+
+class YieldingDatabase:
+    def __init__(self, db):
+        self._db = db
+
+    def __getattr__(self, name):
+        return YieldingCollection(getattr(self._db, name))
+
+
+async def legacy_transfer(db, from_user: str, to_user: str, amount: float) -> bool:
+    """Ancien transfer_tokens : lecture du solde, comparaison, puis deux $inc"""
+    balance = await db.token_balances.find_one({"user_id": from_user})
+    if not balance or balance["balance"] < amount:
+        return False
+    await db.token_balances.update_one({"user_id": from_user}, {"$inc": {"balance": -amount}})
+    await db.token_balances.update_one({"user_id": to_user}, {"$inc": {"balance": amount}}, upsert=True)
+    return True
+
+
+async def ledger_transfer(ledger: TokenLedger, from_user: str, to_user: str, amount: float) -> bool:
+    try:
+        await ledger.transfer(from_user, to_user, amount)
+        return True
+    except InsufficientBalance:
+        return False
+
+
+async def contention(db, name: str, transfer, concurrency: int, covered: int):
+    account = f"bench-contended-{name}"
+    await db.token_balances.delete_many({"user_id": account})
+    await db.token_balances.insert_one({"user_id": account, "balance": float(covered), "last_updated": datetime.utcnow()})
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        transfer(account, f"bench-sink-{i % 10}", 1.0) for i in range(concurrency)
+    ])
+    elapsed = time.perf_counter() - start
+    final = (await db.token_balances.find_one({"user_id": account}))["balance"]
+    print(f"{name:<8} | {sum(results):>7} succès / {covered} couverts | solde final {final:>8.1f} | {elapsed * 1000:>8.1f} ms")
+    return sum(results), final
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Transferts de tokens $QS")
+    parser.add_argument("--transfers", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--covered", type=int, default=100)
+    parser.add_argument("--payouts", type=int, default=5000)
+    parser.add_argument("--mongomock", action="store_true", help="base en mémoire (mongomock_motor)")
+    args = parser.parse_args()
+
+    if args.mongomock:
+        if not MONGOMOCK_AVAILABLE:
+            sys.exit("mongomock_motor non installé")
+        client = AsyncMongoMockClient()
+        db = client["token_transfer_bench"]
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+        db = client[os.environ.get("DB_NAME", "quantumshield") + "_token_transfer_bench"]
+
+    token_service = TokenService(db)
+    await token_service.initialize_token_system()
+
+    # Débit séquentiel
+    await db.token_balances.insert_one({"user_id": "bench-payer", "balance": float(args.transfers), "last_updated": datetime.utcnow()})
+    start = time.perf_counter()
+    for i in range(args.transfers):
+        await token_service.transfer_tokens("bench-payer", f"bench-payee-{i % 100}", 1.0)
+    elapsed = time.perf_counter() - start
+    print(f"transferts séquentiels : {args.transfers / elapsed:.0f} /s")
+
+    # Contention
+    print(f"{args.concurrency} transferts concurrents de 1 QS")
+    yielding_db = YieldingDatabase(db)
+    ledger = TokenLedger(yielding_db)
+    legacy_successes, legacy_final = await contention(
+        db, "legacy", lambda *a: legacy_transfer(yielding_db, *a), args.concurrency, args.covered
+    )
+    ledger_successes, ledger_final = await contention(
+        db, "ledger", lambda *a: ledger_transfer(ledger, *a), args.concurrency, args.covered
+    )
+    if args.concurrency > args.covered:
+        assert legacy_successes > args.covered and legacy_final < 0, "l'ancien schéma aurait dû mettre le compte à découvert"
+    assert ledger_successes == min(args.concurrency, args.covered) and ledger_final >= 0, "découvert avec le registre"
+
+    # Paiements groupés
+    rewards = [{"user_id": f"bench-rewarded-{i}", "reward_type": "data_sharing"} for i in range(args.payouts)]
+    start = time.perf_counter()
+    result = await token_service.reward_users_batch(rewards)
+    batch_elapsed = time.perf_counter() - start
+    print(f"reward_users_batch({args.payouts}) : {batch_elapsed * 1000:.0f} ms, {result}")
+
+    sample = min(args.payouts, 500)
+    start = time.perf_counter()
+    for i in range(sample):
+        await token_service.reward_user(f"bench-single-{i}", "data_sharing")
+    single_elapsed = (time.perf_counter() - start) / sample * args.payouts
+    print(f"reward_user x {args.payouts} (extrapolé de {sample}) : {single_elapsed * 1000:.0f} ms")
+
+    if not args.mongomock:
+        await client.drop_database(db.name)
+    client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
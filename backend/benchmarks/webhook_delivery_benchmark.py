@@ -0,0 +1,162 @@
+"""
+Benchmark de livraison des webhooks (puits HTTP local)
+
+Démarre un serveur aiohttp local qui accepte les POST (latence simulée
+optionnelle) et émet une rafale d'événements vers N webhooks :
+  - before : une ClientSession par livraison et une tâche par livraison
+    (structure de l'ancien _deliver_webhook / emit_event) ;
+  - after  : WebhookDeliveryEngine (session partagée, workers bornés, file) ;
+  - batched : moteur + WebhookBatcher (un POST par lot de --batch événements).
+Mesure les livraisons/s, le pic de tâches asyncio et les connexions TCP
+ouvertes côté puits.
+
+Usage:
+    python benchmarks/webhook_delivery_benchmark.py --events 2000 --webhooks 5 --latency-ms 5
+    python benchmarks/webhook_delivery_benchmark.py --events 20000 --skip-before --batch 100 --gzip
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import aiohttp
+from aiohttp import web
+
+from services.webhook_batch_service import WebhookBatcher, normalize_batching
+from services.webhook_delivery_service import WebhookDeliveryEngine
+
+
+class Sink:
+    """Puits HTTP local : compte les requêtes et les connexions (port client distinct)"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.received = 0
+        self.events = 0
+        self.bytes = 0
+        self.peers = set()
+
+    async def handle(self, request: web.Request):
+        await request.read()
+        # Taille sur le réseau (aiohttp décompresse le corps gzip à la lecture)
+        self.bytes += request.content_length or 0
+        self.events += int(request.headers.get("X-Webhook-Batch-Size", "1"))
+        self.peers.add(request.transport.get_extra_info("peername"))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.received += 1
+        return web.Response(text="ok")
+
+    async def start(self, port: int):
+        app = web.Application()
+        app.router.add_post("/hook/{webhook_id}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+    @property
+    def connections(self) -> int:
+        return len(self.peers)
+
+    def reset(self):
+        self.received = 0
+        self.events = 0
+        self.bytes = 0
+        self.peers = set()
+
+
+def make_webhooks(count: int, port: int):
+    return [{
+        "webhook_id": f"wh-{i}",
+        "url": f"http://127.0.0.1:{port}/hook/wh-{i}",
+        "secret": "bench-secret",
+        "headers": {}
+    } for i in range(count)]
+
+
+async def legacy_deliver(webhook, payload):
+    """Ancien chemin : nouvelle session (donc nouvelle connexion) par livraison"""
+    engine = WebhookDeliveryEngine()
+    body, headers = engine.build_request(webhook, payload)
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
+        async with session.post(webhook["url"], data=body, headers=headers) as response:
+            await response.read()
+
+
+async def run(mode: str, sink: Sink, webhooks, events: int, batching=None):
+    sink.reset()
+    peak_tasks = 0
+    payload = {"event": "device.heartbeat", "timestamp": time.time(), "data": {"device_id": "bench"}}
+    engine = None
+
+    start = time.perf_counter()
+    if mode == "before":
+        tasks = []
+        for _ in range(events):
+            for webhook in webhooks:
+                tasks.append(asyncio.create_task(legacy_deliver(webhook, payload)))
+            peak_tasks = max(peak_tasks, len(asyncio.all_tasks()))
+        await asyncio.gather(*tasks, return_exceptions=True)
+    elif mode == "after":
+        engine = WebhookDeliveryEngine(workers=32, max_pending=2000, per_endpoint_concurrency=8)
+        await engine.start()
+        for _ in range(events):
+            for webhook in webhooks:
+                await engine.submit(webhook, payload)
+            peak_tasks = max(peak_tasks, len(asyncio.all_tasks()))
+        await engine.join()
+    else:
+        engine = WebhookDeliveryEngine(workers=32, max_pending=2000, per_endpoint_concurrency=8)
+        await engine.start()
+        batcher = WebhookBatcher(flush=engine.submit)
+        batched_webhooks = [{**webhook, "batching": batching} for webhook in webhooks]
+        for _ in range(events):
+            for webhook in batched_webhooks:
+                await batcher.add(webhook, payload)
+            peak_tasks = max(peak_tasks, len(asyncio.all_tasks()))
+        await batcher.flush_all()
+        await engine.join()
+
+    elapsed = time.perf_counter() - start
+    if engine:
+        await engine.stop()
+    total = events * len(webhooks)
+    print(f"{mode:>7} | {total:>8} | {elapsed:>7.2f} s | {total / elapsed:>9.0f} | {peak_tasks:>10} | "
+          f"{sink.connections:>11} | {sink.received:>7} | {sink.events:>9} | {sink.bytes / 1024:>8.0f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark de livraison des webhooks")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--webhooks", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--skip-before", action="store_true", help="n'exécute que le moteur (rafales très grandes)")
+    parser.add_argument("--batch", type=int, default=0, help="taille de lot du mode batched (0 : désactivé)")
+    parser.add_argument("--window-ms", type=int, default=1000)
+    parser.add_argument("--gzip", action="store_true", help="corps des lots compressés")
+    args = parser.parse_args()
+
+    sink = Sink(args.latency_ms / 1000)
+    runner = await sink.start(args.port)
+    webhooks = make_webhooks(args.webhooks, args.port)
+
+    print(f"{args.events} événements x {args.webhooks} webhooks, latence du puits {args.latency_ms} ms")
+    print(f"{'mode':>7} | {'envois':>8} | {'durée':>9} | {'envois/s':>9} | {'pic tâches':>10} | "
+          f"{'connexions':>11} | {'reçus':>7} | {'événements':>9} | {'Kio':>8}")
+    if not args.skip_before:
+        await run("before", sink, webhooks, args.events)
+    await run("after", sink, webhooks, args.events)
+    if args.batch:
+        batching = normalize_batching({"max_batch": args.batch, "window_ms": args.window_ms, "gzip": args.gzip})
+        await run("batched", sink, webhooks, args.events, batching)
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+"""
+Générateur de charge local pour la passerelle WebSocket des devices
+
+Ouvre N connexions persistantes sur /api/iot-protocol/ws/{device_id}, les garde
+inactives (heartbeats espacés) puis interroge /api/iot-protocol/websocket/statistics
+pour estimer la mémoire par connexion côté serveur.
+
+Usage:
+    python benchmarks/ws_load_generator.py --connections 50000 --hold 120
+
+Au-delà de ~28 000 connexions depuis une seule IP source, utiliser plusieurs
+adresses locales (--source-ips 127.0.0.2,127.0.0.3) pour ne pas épuiser les
+ports éphémères, et relever `ulimit -n` des deux côtés.
+Les device_id utilisés (loadgen-00000...) doivent exister dans la collection devices.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import urllib.request
+
+import websockets
+
+
+async def open_connection(url: str, subprotocol: str, source_ip: str, heartbeat_interval: float, stop: asyncio.Event, counters: dict):
+    """Ouvre une connexion et envoie des heartbeats jusqu'à l'arrêt"""
+    try:
+        kwargs = {"subprotocols": [subprotocol], "ping_interval": None}
+        if source_ip:
+            kwargs["local_addr"] = (source_ip, 0)
+        async with websockets.connect(url, **kwargs) as websocket:
+            counters["connected"] += 1
+            frame = encode_heartbeat(websocket.subprotocol or "qs.json")
+            while not stop.is_set():
+                await websocket.send(frame)
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=heartbeat_interval)
+                except asyncio.TimeoutError:
+                    pass
+            counters["connected"] -= 1
+    except Exception:
+        counters["failed"] += 1
+
+
+def encode_heartbeat(subprotocol: str):
+    message = {"type": "heartbeat"}
+    if subprotocol == "qs.msgpack":
+        import msgpack
+        return msgpack.packb(message)
+    if subprotocol == "qs.cbor":
+        import cbor2
+        return cbor2.dumps(message)
+    return json.dumps(message)
+
+
+def fetch_statistics(base_url: str) -> dict:
+    with urllib.request.urlopen(f"{base_url}/api/iot-protocol/websocket/statistics") as response:
+        return json.loads(response.read())["statistics"]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Charge WebSocket QuantumShield")
+    parser.add_argument("--host", default="127.0.0.1:8001")
+    parser.add_argument("--connections", type=int, default=50000)
+    parser.add_argument("--ramp", type=int, default=1000, help="connexions ouvertes par seconde")
+    parser.add_argument("--hold", type=float, default=60, help="durée de maintien en secondes")
+    parser.add_argument("--heartbeat-interval", type=float, default=30)
+    parser.add_argument("--subprotocol", default="qs.msgpack")
+    parser.add_argument("--source-ips", default="", help="adresses locales séparées par des virgules")
+    parser.add_argument("--device-prefix", default="loadgen-")
+    args = parser.parse_args()
+
+    base_url = f"http://{args.host}"
+    source_ips = [ip for ip in args.source_ips.split(",") if ip] or [None]
+
+    baseline = fetch_statistics(base_url)
+    baseline_rss = baseline.get("process_max_rss_bytes", 0)
+
+    stop = asyncio.Event()
+    counters = {"connected": 0, "failed": 0}
+    tasks = []
+    start = time.perf_counter()
+
+    for i in range(args.connections):
+        url = f"ws://{args.host}/api/iot-protocol/ws/{args.device_prefix}{i:05d}"
+        source_ip = source_ips[i % len(source_ips)]
+        tasks.append(asyncio.create_task(
+            open_connection(url, args.subprotocol, source_ip, args.heartbeat_interval, stop, counters)
+        ))
+        if (i + 1) % args.ramp == 0:
+            await asyncio.sleep(1)
+            print(f"{i + 1} lancées, {counters['connected']} connectées, {counters['failed']} échecs")
+
+    ramp_time = time.perf_counter() - start
+    await asyncio.sleep(args.hold)
+
+    stats = fetch_statistics(base_url)
+    rss_delta = stats.get("process_max_rss_bytes", 0) - baseline_rss
+    active = stats.get("active_connections", 0)
+
+    print(f"Montée en charge: {ramp_time:.1f}s")
+    print(f"Connexions actives (serveur): {active}")
+    print(f"Échecs (client): {counters['failed']}")
+    print(f"Heartbeats reçus: {stats.get('heartbeats_received')}, flushs: {stats.get('heartbeat_flushes')}")
+    if active:
+        print(f"Mémoire par connexion: {rss_delta / active / 1024:.1f} KiB (delta RSS max)")
+
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -3,54 +3,132 @@ Middleware de rate limiting pour QuantumShield
 Applique automatiquement les limites de taux sur toutes les requêtes
 """
 
+import re
 import time
 import logging
 from typing import Callable
-from fastapi import FastAPI, Request, Response, HTTPException, status
+from urllib.parse import unquote_plus
+from fastapi import FastAPI, Request, Response, status
 from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, QueryParams
 from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 logger = logging.getLogger(__name__)
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
-    """Middleware pour appliquer le rate limiting automatiquement"""
+class PathTrie:
+    """Trie de segments de chemin : correspondances exactes et préfixes en O(profondeur)"""
     
-    def __init__(self, app: ASGIApp, api_gateway_service=None):
-        super().__init__(app)
+    def __init__(self, exact_paths=(), prefixes=()):
+        self.root = {}
+        for path in exact_paths:
+            self.add(path)
+        for prefix in prefixes:
+            self.add(prefix, prefix=True)
+    
+    def add(self, path: str, prefix: bool = False):
+        node = self.root
+        for segment in path.strip("/").split("/"):
+            node = node.setdefault(segment, {})
+        node["*" if prefix else "$"] = True
+    
+    def match(self, path: str) -> bool:
+        node = self.root
+        for segment in path.strip("/").split("/"):
+            if "*" in node:
+                return True
+            node = node.get(segment)
+            if node is None:
+                return False
+        return "$" in node or "*" in node
+
+class APIGatewayMiddleware:
+    """Middleware ASGI unique : contrôles de sécurité puis rate limiting
+    
+    Implémenté directement en ASGI (sans BaseHTTPMiddleware) : pas de tâche ni
+    de flux intermédiaire par requête, les réponses streamées passent telles
+    quelles et les headers sont ajoutés au message http.response.start.
+    """
+    
+    SECURITY_HEADERS = [
+        (b"x-content-type-options", b"nosniff"),
+        (b"x-frame-options", b"DENY"),
+        (b"x-xss-protection", b"1; mode=block"),
+        (b"strict-transport-security", b"max-age=31536000; includeSubDomains"),
+        (b"referrer-policy", b"strict-origin-when-cross-origin")
+    ]
+    
+    def __init__(self, app: ASGIApp, api_gateway_service=None, max_body_size: int = 10 * 1024 * 1024):
+        self.app = app
         self.api_gateway_service = api_gateway_service
+        self.max_body_size = max_body_size
         self.bypass_paths = {
             "/docs",
             "/redoc", 
             "/openapi.json",
             "/api/health",
-            "/api/api-gateway/health"
+            "/api/api-gateway/health",
+            # Endpoints publics de crypto
+            "/api/advanced-crypto/supported-algorithms",
+            "/api/advanced-crypto/performance-comparison",
+            "/api/advanced-crypto/algorithm-recommendations"
         }
+        self.bypass_trie = PathTrie(self.bypass_paths, prefixes=["/static/", "/assets/"])
+        self.suspicious_patterns = [
+            "script",
+            "javascript:",
+            "<script>",
+            "eval(",
+            "document.cookie",
+            "window.location"
+        ]
+        # Une seule passe regex pour tous les patterns suspects
+        self.suspicious_regex = re.compile(
+            "|".join(re.escape(pattern) for pattern in self.suspicious_patterns),
+            re.IGNORECASE
+        )
     
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        """Traite chaque requête avec rate limiting"""
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
         start_time = time.time()
         
-        try:
-            # Vérifier si on doit bypass le rate limiting
-            if self._should_bypass(request):
-                response = await call_next(request)
-                return response
-            
-            # Vérifier si le service est disponible
-            if not self.api_gateway_service or not self.api_gateway_service.is_ready():
-                # Passer la requête sans rate limiting si le service n'est pas disponible
-                response = await call_next(request)
-                return response
-            
-            # Extraire la clé API depuis les headers
-            api_key = self._extract_api_key(request)
+        # Vérifier les patterns suspects dans le chemin et la query string
+        query_string = scope.get("query_string", b"")
+        target = scope["path"]
+        if query_string:
+            target = f"{target}?{unquote_plus(query_string.decode('latin-1'))}"
+        if self.suspicious_regex.search(target):
+            await self._reject(scope, receive, send, status.HTTP_400_BAD_REQUEST,
+                               {"error": "Requête suspecte détectée"})
+            return
+        
+        headers = Headers(scope=scope)
+        
+        # Vérifier la taille de la requête
+        content_length = headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_body_size:
+            await self._reject(scope, receive, send, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                               {"error": "Requête trop volumineuse"})
+            return
+        
+        extra_headers = list(self.SECURITY_HEADERS)
+        rate_limited = not self._should_bypass(scope) and self.api_gateway_service and self.api_gateway_service.is_ready()
+        
+        if rate_limited:
+            try:
+                allowed, result = await self.api_gateway_service.check_rate_limit(
+                    request=Request(scope),
+                    api_key=self._extract_api_key(scope, headers)
+                )
+            except Exception as e:
+                # En cas d'erreur, passer la requête sans rate limiting
+                logger.error(f"Erreur middleware rate limiting: {e}")
+                allowed, result = True, {}
             
-            # Vérifier le rate limiting
-            allowed, result = await self.api_gateway_service.check_rate_limit(
-                request=request,
-                api_key=api_key
-            )
+            rate_limit_headers = self._build_rate_limit_headers(result.get("rate_limit_info", {}))
             
             if not allowed:
                 # Rate limit dépassé
@@ -61,75 +139,57 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
                     "rate_limit_info": result.get("rate_limit_info"),
                     "timestamp": time.time()
                 }
-                
-                # Headers de rate limiting
-                headers = self._build_rate_limit_headers(result.get("rate_limit_info", {}))
-                
-                return JSONResponse(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    content=error_response,
-                    headers=headers
-                )
-            
-            # Requête autorisée, continuer
-            response = await call_next(request)
-            
-            # Ajouter les headers de rate limiting à la réponse
-            if "rate_limit_info" in result:
-                rate_limit_headers = self._build_rate_limit_headers(result["rate_limit_info"])
-                for key, value in rate_limit_headers.items():
-                    response.headers[key] = value
+                await self._reject(scope, receive, send, status.HTTP_429_TOO_MANY_REQUESTS,
+                                   error_response, rate_limit_headers)
+                return
             
-            # Calculer le temps de réponse
-            process_time = time.time() - start_time
-            response.headers["X-Process-Time"] = str(process_time)
-            
-            return response
-            
-        except Exception as e:
-            logger.error(f"Erreur middleware rate limiting: {e}")
-            # En cas d'erreur, passer la requête sans rate limiting
-            response = await call_next(request)
-            return response
+            extra_headers.extend(
+                (key.lower().encode("latin-1"), value.encode("latin-1"))
+                for key, value in rate_limit_headers.items()
+            )
+        
+        async def send_with_headers(message: Message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + extra_headers
+                if rate_limited:
+                    message["headers"].append((b"x-process-time", str(time.time() - start_time).encode()))
+            await send(message)
+        
+        await self.app(scope, receive, send_with_headers)
+    
+    async def _reject(self, scope: Scope, receive: Receive, send: Send, status_code: int,
+                      content: dict, headers: dict = None):
+        response = JSONResponse(status_code=status_code, content=content, headers=headers)
+        response.raw_headers.extend(self.SECURITY_HEADERS)
+        await response(scope, receive, send)
     
-    def _should_bypass(self, request: Request) -> bool:
+    def _should_bypass(self, scope: Scope) -> bool:
         """Détermine si on doit bypasser le rate limiting"""
-        path = request.url.path
+        path = scope["path"]
         
-        # Bypass pour les chemins statiques et de documentation
-        if path in self.bypass_paths:
-            return True
-        
-        # Bypass pour les fichiers statiques
-        if path.startswith("/static/") or path.startswith("/assets/"):
+        # Chemins de documentation, statiques et endpoints publics
+        if self.bypass_trie.match(path):
             return True
         
         # Bypass pour les health checks internes
-        if path.endswith("/health") and request.method == "GET":
-            return True
-        
-        # Bypass pour les endpoints publics de crypto
-        public_crypto_endpoints = [
-            "/api/advanced-crypto/supported-algorithms",
-            "/api/advanced-crypto/performance-comparison",
-            "/api/advanced-crypto/algorithm-recommendations"
-        ]
-        if path in public_crypto_endpoints:
+        if path.endswith("/health") and scope["method"] == "GET":
             return True
         
         return False
     
-    def _extract_api_key(self, request: Request) -> str:
+    def _extract_api_key(self, scope: Scope, headers: Headers) -> str:
         """Extrait la clé API de la requête (pas les JWT tokens)"""
         # Essayer l'header X-API-Key (clés API dédiées)
-        api_key = request.headers.get("X-API-Key")
+        api_key = headers.get("x-api-key")
         if api_key:
             return api_key
         
         # Essayer le paramètre de query
-        api_key = request.query_params.get("api_key")
-        if api_key:
-            return api_key
+        query_string = scope.get("query_string", b"")
+        if b"api_key=" in query_string:
+            api_key = QueryParams(query_string).get("api_key")
+            if api_key:
+                return api_key
         
         # NE PAS traiter les JWT tokens comme des clés API
         # Les JWT tokens dans Authorization: Bearer sont gérés par l'auth service
@@ -147,29 +207,14 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
         reset_times = rate_limit_info.get("reset_times", {})
         
         # Headers standards de rate limiting
-        if "per_minute" in limits:
-            headers["X-RateLimit-Limit-Minute"] = str(limits["per_minute"])
-            headers["X-RateLimit-Remaining-Minute"] = str(
-                max(0, limits["per_minute"] - current_usage.get("per_minute", 0))
-            )
-            if "per_minute" in reset_times:
-                headers["X-RateLimit-Reset-Minute"] = str(reset_times["per_minute"])
-        
-        if "per_hour" in limits:
-            headers["X-RateLimit-Limit-Hour"] = str(limits["per_hour"])
-            headers["X-RateLimit-Remaining-Hour"] = str(
-                max(0, limits["per_hour"] - current_usage.get("per_hour", 0))
-            )
-            if "per_hour" in reset_times:
-                headers["X-RateLimit-Reset-Hour"] = str(reset_times["per_hour"])
-        
-        if "per_day" in limits:
-            headers["X-RateLimit-Limit-Day"] = str(limits["per_day"])
-            headers["X-RateLimit-Remaining-Day"] = str(
-                max(0, limits["per_day"] - current_usage.get("per_day", 0))
-            )
-            if "per_day" in reset_times:
-                headers["X-RateLimit-Reset-Day"] = str(reset_times["per_day"])
+        for limit_type, suffix in (("per_minute", "Minute"), ("per_hour", "Hour"), ("per_day", "Day")):
+            if limit_type in limits:
+                headers[f"X-RateLimit-Limit-{suffix}"] = str(limits[limit_type])
+                headers[f"X-RateLimit-Remaining-{suffix}"] = str(
+                    max(0, limits[limit_type] - current_usage.get(limit_type, 0))
+                )
+                if limit_type in reset_times:
+                    headers[f"X-RateLimit-Reset-{suffix}"] = str(reset_times[limit_type])
         
         # Tier d'API
         tier = rate_limit_info.get("tier", "free")
@@ -177,114 +222,14 @@ class RateLimitMiddleware(BaseHTTPMiddleware):
         
         return headers
 
-class SecurityMiddleware(BaseHTTPMiddleware):
-    """Middleware de sécurité pour l'API Gateway"""
-    
-    def __init__(self, app: ASGIApp, api_gateway_service=None):
-        super().__init__(app)
-        self.api_gateway_service = api_gateway_service
-        self.suspicious_patterns = [
-            "script",
-            "javascript:",
-            "<script>",
-            "eval(",
-            "document.cookie",
-            "window.location"
-        ]
-    
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        """Applique les vérifications de sécurité"""
-        try:
-            # Vérifier les patterns suspects dans l'URL
-            if self._contains_suspicious_patterns(str(request.url)):
-                return JSONResponse(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    content={"error": "Requête suspecte détectée"}
-                )
-            
-            # Vérifier la taille de la requête
-            content_length = request.headers.get("content-length")
-            if content_length and int(content_length) > 10 * 1024 * 1024:  # 10MB
-                return JSONResponse(
-                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                    content={"error": "Requête trop volumineuse"}
-                )
-            
-            # Ajouter des headers de sécurité
-            response = await call_next(request)
-            
-            # Headers de sécurité
-            security_headers = {
-                "X-Content-Type-Options": "nosniff",
-                "X-Frame-Options": "DENY",
-                "X-XSS-Protection": "1; mode=block",
-                "Strict-Transport-Security": "max-age=31536000; includeSubDomains",
-                "Referrer-Policy": "strict-origin-when-cross-origin"
-            }
-            
-            for key, value in security_headers.items():
-                response.headers[key] = value
-            
-            return response
-            
-        except Exception as e:
-            logger.error(f"Erreur middleware sécurité: {e}")
-            response = await call_next(request)
-            return response
-    
-    def _contains_suspicious_patterns(self, text: str) -> bool:
-        """Vérifie si le texte contient des patterns suspects"""
-        text_lower = text.lower()
-        return any(pattern in text_lower for pattern in self.suspicious_patterns)
-
-class CORSMiddleware(BaseHTTPMiddleware):
-    """Middleware CORS personnalisé avec rate limiting"""
-    
-    def __init__(self, app: ASGIApp, allow_origins=None, allow_methods=None, allow_headers=None):
-        super().__init__(app)
-        self.allow_origins = allow_origins or ["*"]
-        self.allow_methods = allow_methods or ["GET", "POST", "PUT", "DELETE", "OPTIONS"]
-        self.allow_headers = allow_headers or ["*"]
-    
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
-        """Gère les requêtes CORS"""
-        try:
-            # Gérer les requêtes OPTIONS (preflight)
-            if request.method == "OPTIONS":
-                return Response(
-                    status_code=200,
-                    headers={
-                        "Access-Control-Allow-Origin": "*",
-                        "Access-Control-Allow-Methods": ", ".join(self.allow_methods),
-                        "Access-Control-Allow-Headers": ", ".join(self.allow_headers),
-                        "Access-Control-Max-Age": "86400"
-                    }
-                )
-            
-            response = await call_next(request)
-            
-            # Ajouter les headers CORS
-            response.headers["Access-Control-Allow-Origin"] = "*"
-            response.headers["Access-Control-Allow-Credentials"] = "true"
-            
-            return response
-            
-        except Exception as e:
-            logger.error(f"Erreur middleware CORS: {e}")
-            response = await call_next(request)
-            return response
-
 def setup_api_gateway_middleware(app: FastAPI, api_gateway_service):
-    """Configure tous les middlewares de l'API Gateway"""
-    
-    # Middleware de sécurité (en premier)
-    app.add_middleware(SecurityMiddleware, api_gateway_service=api_gateway_service)
+    """Configure tous les middlewares de l'API Gateway
     
-    # Middleware CORS
-    app.add_middleware(CORSMiddleware)
+    Le CORS est géré par le CORSMiddleware de Starlette ajouté dans server.py.
+    """
     
-    # Middleware de rate limiting (en dernier pour traiter les requêtes valides)
-    app.add_middleware(RateLimitMiddleware, api_gateway_service=api_gateway_service)
+    # Sécurité puis rate limiting, en un seul middleware ASGI (ajouté en dernier = exécuté en premier)
+    app.add_middleware(APIGatewayMiddleware, api_gateway_service=api_gateway_service)
     
     logger.info("Middlewares API Gateway configurés")
 
@@ -0,0 +1,218 @@
+"""
+Pipeline de réponse de l'API QuantumShield
+Sérialisation JSON rapide (orjson) et compression négociée brotli/gzip
+"""
+
+import gzip
+import logging
+import zlib
+from typing import Any, Optional
+
+from fastapi import FastAPI
+from fastapi.encoders import ENCODERS_BY_TYPE, encoders_by_class_tuples
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+    logging.warning("orjson non disponible - sérialisation JSON standard")
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+    logging.warning("brotli non disponible - compression gzip uniquement")
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+def _default(obj: Any) -> Any:
+    """Types non gérés nativement par orjson"""
+    if hasattr(obj, "dict") and callable(obj.dict):
+        return obj.dict()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", errors="replace")
+    if NUMPY_AVAILABLE and isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+def _register_numpy_encoders():
+    """Apprend les scalaires et tableaux NumPy à jsonable_encoder
+
+    jsonable_encoder (appelé par FastAPI avant le rendu) cherche d'abord le type
+    exact dans ENCODERS_BY_TYPE, puis teste isinstance sur les classes de
+    encoders_by_class_tuples (construit à l'import de FastAPI) : les types de
+    base sont enregistrés dans les deux, ce qui couvre np.bool_ (sans
+    sous-classe) comme tous les entiers et flottants concrets.
+    """
+    for numpy_type, cast in ((np.bool_, bool), (np.integer, int), (np.floating, float)):
+        ENCODERS_BY_TYPE[numpy_type] = cast
+        encoders_by_class_tuples[cast] += (numpy_type,)
+    ENCODERS_BY_TYPE[np.ndarray] = lambda value: value.tolist()
+
+
+if NUMPY_AVAILABLE:
+    _register_numpy_encoders()
+
+
+class QSJSONResponse(JSONResponse):
+    """Réponse JSON rendue par orjson (datetime, UUID, NumPy natifs)"""
+
+    if ORJSON_AVAILABLE:
+        def render(self, content: Any) -> bytes:
+            return orjson.dumps(
+                content,
+                default=_default,
+                option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            )
+
+
+class CompressionMiddleware:
+    """Compression brotli/gzip négociée via Accept-Encoding, au-delà d'un seuil
+
+    Réponses complètes : compressées d'un bloc si elles dépassent minimum_size.
+    Réponses streamées : compressées au fil de l'eau, chaque fragment étant
+    vidé immédiatement pour ne pas retarder le client.
+    """
+
+    COMPRESSIBLE_TYPES = (
+        "application/json", "application/x-ndjson", "application/graphql-response+json",
+        "text/", "application/javascript", "application/xml", "image/svg+xml"
+    )
+
+    def __init__(self, app: ASGIApp, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _negotiate(self, accept_encoding: str) -> Optional[str]:
+        encodings = {}
+        for part in accept_encoding.lower().split(","):
+            name, _, params = part.strip().partition(";")
+            quality = 1.0
+            if params.strip().startswith("q="):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+            encodings[name.strip()] = quality
+        if BROTLI_AVAILABLE and encodings.get("br", 0) > 0:
+            return "br"
+        if encodings.get("gzip", 0) > 0:
+            return "gzip"
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self._negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        responder = _CompressionResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+
+
+class _CompressionResponder:
+    """État de compression d'une réponse"""
+
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start_message: Optional[Message] = None
+        self.compressor = None
+        self.passthrough = False
+
+    def _compress_all(self, body: bytes) -> bytes:
+        if self.encoding == "br":
+            return brotli.compress(body, quality=self.middleware.brotli_quality)
+        return gzip.compress(body, compresslevel=self.middleware.gzip_level)
+
+    def _stream_chunk(self, body: bytes, final: bool) -> bytes:
+        if self.encoding == "br":
+            data = self.compressor.process(body)
+            return data + (self.compressor.finish() if final else self.compressor.flush())
+        data = self.compressor.compress(body)
+        return data + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message.get("headers", []))
+            content_type = headers.get("content-type", "")
+            self.passthrough = (
+                "content-encoding" in headers
+                or not content_type.startswith(CompressionMiddleware.COMPRESSIBLE_TYPES)
+            )
+            if self.passthrough:
+                await self._send(message)
+            else:
+                # Retenu jusqu'au premier fragment : la décision dépend de la taille
+                self.start_message = message
+            return
+
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start.setdefault("headers", []))
+
+            if not more_body and len(body) < self.middleware.minimum_size:
+                self.passthrough = True
+                await self._send(start)
+                await self._send(message)
+                return
+
+            headers["content-encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+
+            if not more_body:
+                compressed = self._compress_all(body)
+                headers["content-length"] = str(len(compressed))
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": compressed})
+                return
+
+            # Réponse streamée
+            if "content-length" in headers:
+                del headers["content-length"]
+            if self.encoding == "br":
+                self.compressor = brotli.Compressor(quality=self.middleware.brotli_quality)
+            else:
+                self.compressor = zlib.compressobj(self.middleware.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            await self._send(start)
+
+        await self._send({
+            "type": "http.response.body",
+            "body": self._stream_chunk(body, final=not more_body),
+            "more_body": more_body
+        })
+
+
+def setup_response_pipeline(app: FastAPI, minimum_size: int = 1024):
+    """Ajoute la compression des réponses (le rendu orjson passe par default_response_class)"""
+    app.add_middleware(CompressionMiddleware, minimum_size=minimum_size)
+    logger.info(f"Compression des réponses activée (seuil {minimum_size} octets, brotli: {BROTLI_AVAILABLE})")
@@ -8,7 +8,7 @@ from pydantic import BaseModel
 from typing import Optional
 
 from models.quantum_models import User, UserCreate, UserLogin
-from services.auth_service import AuthService
+from services.auth_service import AuthService, PasswordHashingBusyError
 
 router = APIRouter()
 security = HTTPBearer()
@@ -29,11 +29,7 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
             detail="Service d'authentification non initialisé"
         )
     
-    token = credentials.credentials
-    print(f"DEBUG: Token reçu: {token[:50]}...")
-    
-    auth_result = await auth_service.verify_token(token)
-    print(f"DEBUG: Auth result: {auth_result is not None}")
+    auth_result = await auth_service.verify_token(credentials.credentials)
     
     if not auth_result:
         raise HTTPException(
@@ -59,6 +55,12 @@ async def register(user_data: UserCreate):
     try:
         user = await auth_service.register_user(user_data)
         return user
+    except PasswordHashingBusyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "1"}
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -68,7 +70,14 @@ async def register(user_data: UserCreate):
 @router.post("/login")
 async def login(login_data: UserLogin):
     """Connecte un utilisateur"""
-    auth_result = await auth_service.authenticate_user(login_data)
+    try:
+        auth_result = await auth_service.authenticate_user(login_data)
+    except PasswordHashingBusyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "1"}
+        )
     
     if not auth_result:
         raise HTTPException(
@@ -82,6 +91,22 @@ async def login(login_data: UserLogin):
         "expires_at": auth_result["expires_at"]
     }
 
+@router.get("/public-key")
+async def get_public_key():
+    """Clé publique de vérification des tokens (signature EdDSA/ES256 uniquement)"""
+    public_key = auth_service.get_public_key_pem()
+    if not public_key:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Tokens signés en HS256 : aucune clé publique"
+        )
+    
+    return {
+        "algorithm": auth_service.jwt_algorithm,
+        "kid": auth_service.jwt_key_id,
+        "public_key": public_key
+    }
+
 @router.post("/logout")
 async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Déconnecte un utilisateur"""
@@ -96,6 +121,12 @@ async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
     
     return {"message": "Déconnecté avec succès"}
 
+@router.post("/sessions/revoke-all")
+async def revoke_all_sessions(current_user: User = Depends(get_current_user)):
+    """Révoque toutes les sessions de l'utilisateur (déconnexion de tous les appareils)"""
+    revoked = await auth_service.revoke_all_sessions(current_user.id)
+    return {"message": "Sessions révoquées", "revoked_sessions": revoked}
+
 @router.get("/profile", response_model=User)
 async def get_profile(current_user: User = Depends(get_current_user)):
     """Récupère le profil de l'utilisateur actuel"""
@@ -120,11 +151,18 @@ async def update_profile(profile_data: ProfileUpdate, current_user: User = Depen
 @router.post("/change-password")
 async def change_password(password_data: PasswordChange, current_user: User = Depends(get_current_user)):
     """Change le mot de passe de l'utilisateur"""
-    success = await auth_service.change_password(
-        current_user.id,
-        password_data.old_password,
-        password_data.new_password
-    )
+    try:
+        success = await auth_service.change_password(
+            current_user.id,
+            password_data.old_password,
+            password_data.new_password
+        )
+    except PasswordHashingBusyError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(e),
+            headers={"Retry-After": "1"}
+        )
     
     if not success:
         raise HTTPException(
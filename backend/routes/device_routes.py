@@ -2,7 +2,10 @@
 Routes de gestion des devices IoT
 """
 
-from fastapi import APIRouter, HTTPException, Depends, status
+import json
+
+from fastapi import APIRouter, HTTPException, Depends, Request, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 
@@ -12,6 +15,11 @@ from services.device_service import DeviceService
 
 router = APIRouter()
 
+# Helper pour vérifier les droits admin
+def is_admin_user(user) -> bool:
+    """Vérifie si l'utilisateur a les droits admin"""
+    return getattr(user, 'is_admin', False)
+
 # Modèles de requête
 class DeviceMetricsRequest(BaseModel):
     device_id: str
@@ -21,6 +29,9 @@ class FirmwareUpdateRequest(BaseModel):
     device_id: str
     firmware_hash: str
 
+class AnomalyRulesUpdate(BaseModel):
+    rules: List[Dict[str, Any]]
+
 # Routes
 @router.post("/register", response_model=Device)
 async def register_device(device_data: DeviceCreate, current_user = Depends(get_current_user)):
@@ -46,6 +57,49 @@ async def register_device(device_data: DeviceCreate, current_user = Depends(get_
             detail=f"Erreur lors de l'enregistrement: {str(e)}"
         )
 
+@router.post("/bulk/register")
+async def bulk_register_devices(
+    request: Request,
+    issue_certificates: bool = False,
+    chunk_size: int = 500,
+    current_user = Depends(get_current_user)
+):
+    """Enregistre un lot de devices depuis un manifeste CSV ou NDJSON (résultats streamés en NDJSON)"""
+    from server import device_service, x509_service
+    
+    if chunk_size < 1 or chunk_size > 5000:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="chunk_size doit être compris entre 1 et 5000"
+        )
+    
+    try:
+        content = (await request.body()).decode("utf-8-sig")
+        rows = device_service.parse_device_manifest(content, request.headers.get("content-type", "text/csv"))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Manifeste invalide: {str(e)}"
+        )
+    
+    if not rows:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Manifeste vide"
+        )
+    
+    async def stream_results():
+        async for result in device_service.bulk_register_devices(
+            rows,
+            current_user.id,
+            x509_service=x509_service,
+            issue_certificates=issue_certificates,
+            chunk_size=chunk_size
+        ):
+            yield json.dumps(result, default=str) + "\n"
+    
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
 @router.get("/", response_model=List[Device])
 async def get_user_devices(current_user = Depends(get_current_user)):
     """Récupère tous les devices de l'utilisateur"""
@@ -277,21 +331,64 @@ async def get_offline_devices(current_user = Depends(get_current_user)):
     from server import device_service
     
     try:
-        # Récupérer tous les devices hors ligne
-        offline_devices = await device_service.get_offline_devices()
+        # Récupérer les devices hors ligne du propriétaire
+        return await device_service.get_offline_devices(owner_id=current_user.id)
         
-        # Filtrer par propriétaire
-        user_offline_devices = [
-            device for device in offline_devices 
-            if device.owner_id == current_user.id
-        ]
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la récupération: {str(e)}"
+        )
+
+@router.get("/presence/summary")
+async def get_presence_summary(current_user = Depends(get_current_user)):
+    """Récupère les compteurs online/offline des devices de l'utilisateur"""
+    from server import device_presence_service
+    
+    try:
+        summary = device_presence_service.get_summary(owner_id=current_user.id)
+        summary["online_device_ids"] = device_presence_service.get_online_device_ids(current_user.id)
+        summary["offline_device_ids"] = device_presence_service.get_offline_device_ids(current_user.id)
+        return summary
         
-        return user_offline_devices
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors de la récupération de la présence: {str(e)}"
+        )
+
+@router.get("/anomaly-rules/definitions")
+async def get_anomaly_rules(current_user = Depends(get_current_user)):
+    """Récupère les règles d'anomalies actives par type de device"""
+    from server import device_service
+    
+    return device_service.anomaly_rules.get_rules()
+
+@router.put("/anomaly-rules/{device_type}")
+async def update_anomaly_rules(device_type: str, update: AnomalyRulesUpdate, current_user = Depends(get_current_user)):
+    """Remplace les règles d'anomalies d'un type de device (rechargement à chaud, admin uniquement)"""
+    from server import device_service
+    
+    try:
+        if not is_admin_user(current_user):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Accès administrateur requis"
+            )
+        
+        return await device_service.anomaly_rules.set_rules(device_type, update.rules)
         
+    except HTTPException:
+        raise
+    except (KeyError, ValueError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Règle invalide: {str(e)}"
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Erreur lors de la récupération: {str(e)}"
+            detail=f"Erreur lors de la mise à jour des règles: {str(e)}"
         )
 
 @router.get("/stats/overview")
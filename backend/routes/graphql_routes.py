@@ -3,35 +3,40 @@ Routes GraphQL pour QuantumShield
 Expose les endpoints GraphQL pour les queries complexes
 """
 
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, WebSocket, WebSocketDisconnect
 from starlette_graphene3 import GraphQLApp, make_graphiql_handler
 from pydantic import BaseModel
 from typing import Dict, Any, Optional
+import asyncio
 import logging
 import json
 
 from services.graphql_service import GraphQLService
+from services.graphql_subscription_service import PROTOCOL
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/graphql", tags=["GraphQL"])
 
 class GraphQLRequest(BaseModel):
-    query: str
+    # Absente pour une requête persistée (extensions.persistedQuery.sha256Hash)
+    query: Optional[str] = None
     variables: Optional[Dict[str, Any]] = None
     operation_name: Optional[str] = None
+    extensions: Optional[Dict[str, Any]] = None
 
 class GraphQLResponse(BaseModel):
     data: Optional[Dict[str, Any]] = None
     errors: Optional[list] = None
+    extensions: Optional[Dict[str, Any]] = None
 
 # Variables globales pour les services
 _graphql_service = None
 
-def init_graphql_service(db, services_dict):
-    """Initialise le service GraphQL"""
+def init_graphql_service(db, services_dict, graphql_service=None):
+    """Initialise le service GraphQL (réutilise l'instance du serveur si fournie)"""
     global _graphql_service
-    _graphql_service = GraphQLService(db, services_dict)
+    _graphql_service = graphql_service or GraphQLService(db, services_dict)
     logger.info("Service GraphQL initialisé pour les routes")
 
 @router.post("/query", response_model=GraphQLResponse)
@@ -43,12 +48,15 @@ async def execute_graphql_query(request: GraphQLRequest):
         
         result = await _graphql_service.execute_query(
             query=request.query,
-            variables=request.variables
+            variables=request.variables,
+            operation_name=request.operation_name,
+            extensions=request.extensions
         )
         
         return GraphQLResponse(
             data=result.get("data"),
-            errors=result.get("errors")
+            errors=result.get("errors"),
+            extensions=result.get("extensions")
         )
         
     except Exception as e:
@@ -58,6 +66,39 @@ async def execute_graphql_query(request: GraphQLRequest):
             errors=[str(e)]
         )
 
+@router.websocket("/ws")
+async def graphql_subscriptions(websocket: WebSocket):
+    """Subscriptions GraphQL (protocole graphql-transport-ws)"""
+    if _graphql_service is None:
+        await websocket.close(code=1013)
+        return
+    
+    if PROTOCOL not in websocket.scope.get("subprotocols", []):
+        await websocket.close(code=4406)
+        return
+    await websocket.accept(subprotocol=PROTOCOL)
+    
+    manager = _graphql_service.subscriptions
+    connection = manager.register_connection(websocket)
+    init_timer = asyncio.create_task(manager.wait_for_init(connection))
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            
+            data = message.get("text")
+            if data is None:
+                data = (message.get("bytes") or b"").decode("utf-8", errors="replace")
+            await manager.handle_message(connection, data)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Erreur connexion subscriptions GraphQL: {str(e)}")
+    finally:
+        init_timer.cancel()
+        manager.unregister_connection(connection)
+
 @router.get("/schema")
 async def get_graphql_schema():
     """Retourne le schema GraphQL"""
@@ -159,7 +200,11 @@ async def get_graphql_examples():
                         activeStakes
                         totalEarned
                     }
-                    userPortfolio(userId: $userId)
+                    userPortfolio(userId: $userId) {
+                        devices { totalDevices devicesByType { deviceType count } }
+                        staking { totalStaked totalRewards activePositions }
+                        netWorth
+                    }
                 }
                 """,
                 "variables": {
@@ -222,7 +267,11 @@ async def get_graphql_examples():
                 "description": "Récupère un overview complet du système",
                 "query": """
                 query GetSystemOverview {
-                    systemOverview
+                    systemOverview {
+                        devices { totalDevices activeDevices offlineDevices uptimePercentage }
+                        users { totalUsers }
+                        security { anomalies24h }
+                    }
                 }
                 """
             },
@@ -272,7 +321,11 @@ async def get_graphql_examples():
                 "description": "Récupère l'analytique avancée d'un device",
                 "query": """
                 query GetDeviceAnalytics($deviceId: String!) {
-                    deviceAnalytics(deviceId: $deviceId)
+                    deviceAnalytics(deviceId: $deviceId) {
+                        deviceInfo { deviceName status }
+                        performance { uptimePercentage totalHeartbeats uptimeHours }
+                        security { anomaliesCount lastAnomaly anomalyTypes }
+                    }
                 }
                 """,
                 "variables": {
@@ -296,6 +349,21 @@ async def get_graphql_examples():
                 "variables": {
                     "minReputation": 50.0
                 }
+            },
+            "device_status_subscription": {
+                "description": "Suit les passages online/offline des devices d'un utilisateur (WebSocket)",
+                "query": """
+                subscription OnDeviceStatus($ownerId: String) {
+                    deviceStatusChanged(ownerId: $ownerId) {
+                        deviceId
+                        status
+                        timestamp
+                    }
+                }
+                """,
+                "variables": {
+                    "ownerId": "USER_123"
+                }
             }
         }
         
@@ -303,6 +371,7 @@ async def get_graphql_examples():
             "examples": examples,
             "description": "Exemples de queries GraphQL pour QuantumShield",
             "endpoint": "/api/graphql/query",
+            "subscriptions": "/api/graphql/ws",
             "playground": "/api/graphql/playground"
         }
         
@@ -324,7 +393,11 @@ async def get_graphql_stats():
                 "UserType", 
                 "TransactionType",
                 "ServiceType",
-                "Query"
+                "SystemOverviewType",
+                "UserPortfolioType",
+                "DeviceAnalyticsType",
+                "Query",
+                "Subscription"
             ],
             "available_queries": [
                 "device",
@@ -341,7 +414,20 @@ async def get_graphql_stats():
                 "userPortfolio",
                 "deviceAnalytics"
             ],
+            "available_subscriptions": [
+                "deviceStatusChanged",
+                "blockMined",
+                "anomalyDetected",
+                "tokenTransferred"
+            ],
+            "execution": _graphql_service.executor.get_statistics(),
+            "subscriptions": _graphql_service.subscriptions.get_statistics(),
+            "stats_cache": _graphql_service.stats_cache.get_statistics(),
             "features": [
+                "Persisted queries (sha256)",
+                "Subscriptions over WebSocket (graphql-transport-ws)",
+                "Query cost and depth limits",
+                "Cursor pagination (first/after)",
                 "Complex aggregations",
                 "Real-time device metrics",
                 "User portfolio analysis",
@@ -370,7 +456,7 @@ async def graphql_health_check():
         # Test d'exécution d'une query simple
         test_query = """
         query HealthCheck {
-            systemOverview
+            systemOverview { devices { totalDevices } }
         }
         """
         
@@ -2,7 +2,7 @@
 Routes pour le service de protocoles IoT
 """
 
-from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
@@ -19,6 +19,9 @@ security = HTTPBearer()
 # Instance du service IoT Protocol (sera injectée par le serveur principal)
 iot_protocol_service = None
 
+# Passerelle WebSocket des devices (sera injectée par le serveur principal)
+websocket_gateway_service = None
+
 # Modèles Pydantic
 class MQTTConfigModel(BaseModel):
     host: str = "localhost"
@@ -42,6 +45,15 @@ class MQTTPublishModel(BaseModel):
     topic: str
     payload: dict
     qos: int = 1
+    codec: str = "json"
+
+class CodecNegotiationModel(BaseModel):
+    device_id: str
+    accepted_codecs: List[str]
+
+class PayloadSchemaModel(BaseModel):
+    schema_id: int
+    sensors: List[Dict[str, Any]]
 
 class LoRaWANDownlinkModel(BaseModel):
     device_id: str
@@ -52,6 +64,10 @@ class DeviceCommandModel(BaseModel):
     command: str
     parameters: Optional[dict] = None
 
+class WebSocketPublishModel(BaseModel):
+    topic: str
+    payload: dict
+
 class SensorDataModel(BaseModel):
     device_id: str
     sensor_type: str
@@ -165,7 +181,8 @@ async def publish_mqtt_message(message: MQTTPublishModel):
         result = await service.publish_mqtt_message(
             message.topic, 
             message.payload, 
-            message.qos
+            message.qos,
+            message.codec
         )
         return result
     except Exception as e:
@@ -316,9 +333,18 @@ async def send_device_command(command: DeviceCommandModel):
         # Traiter la commande via le handler
         await service._handle_command(command_data, IoTProtocol.MQTT)
         
+        # Pousser directement la commande si le device est connecté à la passerelle WebSocket
+        delivered_websocket = False
+        if websocket_gateway_service:
+            delivered_websocket = websocket_gateway_service.send_to_device(
+                command.device_id,
+                {"type": MessageType.COMMAND.value, "payload": command_data}
+            )
+        
         return {
             "success": True,
             "message": f"Commande {command.command} envoyée au device {command.device_id}",
+            "delivered_websocket": delivered_websocket,
             "timestamp": datetime.utcnow().isoformat()
         }
     except Exception as e:
@@ -352,6 +378,157 @@ async def receive_sensor_data(sensor_data: SensorDataModel):
         logger.error(f"Erreur réception données capteur: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# ===================
+# Payload Codecs
+# ===================
+
+@router.get("/codecs")
+async def get_payload_codecs():
+    """Retourne les codecs de payload et les schémas binaires disponibles"""
+    try:
+        service = get_iot_protocol_service()
+        if not service:
+            raise HTTPException(status_code=503, detail="Service non disponible")
+        
+        codecs = service.payload_codecs
+        return {
+            "success": True,
+            "codecs": codecs.available_codecs(),
+            "schemas": [schema.to_dict() for schema in codecs.fixed_layout.schemas.values()]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erreur récupération codecs: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/codecs/negotiate")
+async def negotiate_payload_codec(negotiation: CodecNegotiationModel):
+    """Négocie le codec de payload d'un device"""
+    try:
+        service = get_iot_protocol_service()
+        if not service:
+            raise HTTPException(status_code=503, detail="Service non disponible")
+        
+        codec = await service.payload_codecs.negotiate(
+            negotiation.device_id,
+            negotiation.accepted_codecs
+        )
+        return {
+            "success": True,
+            "device_id": negotiation.device_id,
+            "codec": codec
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erreur négociation codec: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/codecs/schemas")
+async def register_payload_schema(schema: PayloadSchemaModel):
+    """Enregistre un schéma de trame binaire à disposition fixe"""
+    try:
+        service = get_iot_protocol_service()
+        if not service:
+            raise HTTPException(status_code=503, detail="Service non disponible")
+        
+        registered = await service.payload_codecs.register_schema(schema.schema_id, schema.sensors)
+        return {
+            "success": True,
+            "schema": registered,
+            "max_samples_lorawan": service.payload_codecs.fixed_layout.schemas[schema.schema_id].max_samples(
+                service.protocol_configs[IoTProtocol.LORAWAN]["max_payload"]
+            )
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Erreur enregistrement schéma: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# ===================
+# WebSocket Gateway
+# ===================
+
+@router.websocket("/ws/{device_id}")
+async def device_websocket(websocket: WebSocket, device_id: str):
+    """Connexion persistante d'un device via la passerelle WebSocket"""
+    gateway = websocket_gateway_service
+    if not gateway or not gateway.is_ready():
+        await websocket.close(code=1013)
+        return
+    
+    if not gateway.can_accept():
+        gateway.stats["rejected_connections"] += 1
+        await websocket.close(code=1013)
+        return
+    
+    # Vérifier que le device est enregistré
+    device = await gateway.db.devices.find_one({"device_id": device_id}, {"_id": 1})
+    if not device:
+        await websocket.close(code=4404)
+        return
+    
+    requested = websocket.scope.get("subprotocols", [])
+    subprotocol = gateway.negotiate_subprotocol(requested)
+    await websocket.accept(subprotocol=subprotocol)
+    
+    connection = gateway.register_connection(device_id, websocket, subprotocol or "qs.json")
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            
+            data = message.get("bytes")
+            if data is None:
+                data = message.get("text")
+            
+            reply = await gateway.handle_frame(connection, data)
+            if reply is not None:
+                gateway.send_to_device(device_id, reply)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Erreur connexion WebSocket {device_id}: {str(e)}")
+    finally:
+        gateway.unregister_connection(connection)
+
+@router.post("/websocket/publish")
+async def publish_websocket_message(message: WebSocketPublishModel):
+    """Publie un message aux devices abonnés à un topic via la passerelle WebSocket"""
+    try:
+        if not websocket_gateway_service:
+            raise HTTPException(status_code=503, detail="Passerelle WebSocket non disponible")
+        
+        return await websocket_gateway_service.publish_message(message.topic, message.payload)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erreur publication WebSocket: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.get("/websocket/statistics")
+async def get_websocket_statistics():
+    """Retourne les statistiques de la passerelle WebSocket"""
+    try:
+        if not websocket_gateway_service:
+            raise HTTPException(status_code=503, detail="Passerelle WebSocket non disponible")
+        
+        return {
+            "success": True,
+            "statistics": websocket_gateway_service.get_statistics(),
+            "timestamp": datetime.utcnow().isoformat()
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erreur récupération statistiques WebSocket: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 # ===================
 # Configuration
 # ===================
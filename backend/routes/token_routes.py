@@ -9,6 +9,7 @@ from typing import List, Optional, Dict, Any
 from models.quantum_models import TokenBalance, TokenTransaction, RewardClaim, TransactionType
 from routes.auth_routes import get_current_user
 from services.token_service import TokenService
+from services.token_ledger_service import Payout
 
 router = APIRouter()
 
@@ -18,6 +19,9 @@ class TransferRequest(BaseModel):
     amount: float
     description: str = ""
 
+class BatchTransferRequest(BaseModel):
+    transfers: List[TransferRequest]
+
 class RewardRequest(BaseModel):
     user_id: str
     reward_type: str
@@ -100,6 +104,77 @@ async def transfer_tokens(transfer_data: TransferRequest, current_user = Depends
             detail=f"Erreur lors du transfert: {str(e)}"
         )
 
+@router.post("/transfer/batch")
+async def transfer_tokens_batch(batch: BatchTransferRequest, current_user = Depends(get_current_user)):
+    """Transfère des tokens vers plusieurs destinataires en une opération (tout ou rien)"""
+    from server import token_service
+    
+    try:
+        if not batch.transfers or len(batch.transfers) > 10000:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Un paiement groupé contient entre 1 et 10000 transferts"
+            )
+        if any(transfer.amount <= 0 for transfer in batch.transfers):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Les montants doivent être positifs"
+            )
+        if any(transfer.to_user == current_user.id for transfer in batch.transfers):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Impossible de transférer des tokens vers soi-même"
+            )
+        
+        # Vérifier que les destinataires existent (une requête)
+        from server import db
+        recipients = {transfer.to_user for transfer in batch.transfers}
+        found = await db.users.count_documents({"id": {"$in": list(recipients)}})
+        if found != len(recipients):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Utilisateur destinataire non trouvé"
+            )
+        
+        result = await token_service.transfer_batch(
+            current_user.id,
+            [Payout(transfer.to_user, transfer.amount, transfer.description) for transfer in batch.transfers],
+            TransactionType.REWARD
+        )
+        
+        if result.get("error") == "partial_settlement":
+            # Des jambes ont été créditées : le paiement n'est pas un échec, le détail est renvoyé
+            return {
+                "message": "Paiement groupé partiel",
+                "from_user": current_user.id,
+                "transactions": result["transactions"],
+                "total_amount": result["total_amount"],
+                "failed": result["failed"],
+                "unresolved": result["unresolved"]
+            }
+        
+        if not result["success"]:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Paiement groupé échoué - solde insuffisant"
+                if result.get("error") == "insufficient_balance" else "Paiement groupé échoué"
+            )
+        
+        return {
+            "message": "Paiement groupé effectué avec succès",
+            "from_user": current_user.id,
+            "transactions": result["transactions"],
+            "total_amount": result["total_amount"]
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Erreur lors du paiement groupé: {str(e)}"
+        )
+
 @router.get("/transactions", response_model=List[TokenTransaction])
 async def get_transactions(limit: int = 100, current_user = Depends(get_current_user)):
     """Récupère les transactions de l'utilisateur"""
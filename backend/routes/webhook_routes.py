@@ -4,7 +4,7 @@ Gestion des webhooks et notifications temps réel
 """
 
 from fastapi import APIRouter, HTTPException, Depends, Query
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl
 from typing import Dict, Any, List, Optional
 import logging
 from datetime import datetime
@@ -18,21 +18,35 @@ router = APIRouter(prefix="/webhooks", tags=["Webhooks"])
 # Variables globales pour les services
 _webhook_service = None
 
-def init_webhook_service(db):
-    """Initialise le service de webhooks"""
+def init_webhook_service(db, webhook_service=None):
+    """Initialise le service de webhooks (réutilise l'instance du serveur si fournie)"""
     global _webhook_service
-    _webhook_service = WebhookService(db)
+    _webhook_service = webhook_service or WebhookService(db)
     logger.info("Service Webhooks initialisé pour les routes")
 
 # ==============================
 # Modèles Pydantic
 # ==============================
 
+class WebhookBatching(BaseModel):
+    enabled: bool = True
+    max_batch: int = Field(100, ge=1, le=1000)
+    window_ms: int = Field(1000, ge=10, le=60000)
+    gzip: bool = False
+    events: Optional[List[WebhookEvent]] = None
+
+class WebhookFilters(BaseModel):
+    device_id: Optional[List[str]] = None
+    user_id: Optional[List[str]] = None
+    severity: Optional[List[str]] = None
+
 class WebhookCreate(BaseModel):
     url: HttpUrl
     events: List[WebhookEvent]
     name: Optional[str] = None
     headers: Optional[Dict[str, str]] = None
+    batching: Optional[WebhookBatching] = None
+    filters: Optional[WebhookFilters] = None
 
 class WebhookUpdate(BaseModel):
     url: Optional[HttpUrl] = None
@@ -40,6 +54,8 @@ class WebhookUpdate(BaseModel):
     status: Optional[WebhookStatus] = None
     name: Optional[str] = None
     headers: Optional[Dict[str, str]] = None
+    batching: Optional[WebhookBatching] = None
+    filters: Optional[WebhookFilters] = None
 
 class WebhookResponse(BaseModel):
     webhook_id: str
@@ -73,7 +89,9 @@ async def create_webhook(webhook_data: WebhookCreate, user_id: str = Query(...))
             events=webhook_data.events,
             user_id=user_id,
             name=webhook_data.name,
-            headers=webhook_data.headers
+            headers=webhook_data.headers,
+            batching=webhook_data.batching.dict() if webhook_data.batching else None,
+            filters=webhook_data.filters.dict() if webhook_data.filters else None
         )
         
         if not result["success"]:
@@ -142,6 +160,41 @@ async def webhook_health_check():
             "error": str(e)
         }
 
+@router.get("/dead-letters")
+async def list_dead_letters(webhook_id: Optional[str] = None, limit: int = Query(100, ge=1, le=1000)):
+    """Liste les livraisons abandonnées après épuisement des tentatives"""
+    try:
+        if _webhook_service is None:
+            raise HTTPException(status_code=500, detail="Service webhooks non initialisé")
+        
+        dead_letters = await _webhook_service.list_dead_letters(webhook_id, limit)
+        return {"dead_letters": dead_letters, "count": len(dead_letters)}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erreur récupération lettres mortes: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/dead-letters/{delivery_id}/replay")
+async def replay_dead_letter(delivery_id: str):
+    """Relance une livraison abandonnée"""
+    try:
+        if _webhook_service is None:
+            raise HTTPException(status_code=500, detail="Service webhooks non initialisé")
+        
+        result = await _webhook_service.replay_dead_letter(delivery_id)
+        if not result["success"]:
+            raise HTTPException(status_code=404, detail=result["error"])
+        
+        return result
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Erreur relance lettre morte: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/{webhook_id}")
 async def get_webhook(webhook_id: str):
     """Récupère un webhook spécifique"""
@@ -255,7 +308,9 @@ async def update_webhook(webhook_id: str, webhook_data: WebhookUpdate):
             events=webhook_data.events,
             status=webhook_data.status,
             name=webhook_data.name,
-            headers=webhook_data.headers
+            headers=webhook_data.headers,
+            batching=webhook_data.batching.dict() if webhook_data.batching else None,
+            filters=webhook_data.filters.dict() if webhook_data.filters else None
         )
         
         if not result["success"]:
@@ -7,10 +7,13 @@ from pathlib import Path
 import os
 import logging
 import asyncio
+import time
 from datetime import datetime, timedelta
 from typing import List, Optional
 import json
 
+from middleware.response_middleware import QSJSONResponse, setup_response_pipeline
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
@@ -23,7 +26,8 @@ db = client[os.environ['DB_NAME']]
 app = FastAPI(
     title="QuantumShield API",
     description="Cryptographie post-quantique pour l'IoT",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=QSJSONResponse
 )
 
 # Create API router
@@ -33,55 +37,45 @@ api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
 # Initialize services
-from services.ntru_service import NTRUService
-from services.blockchain_service import BlockchainService
-from services.advanced_blockchain_service import AdvancedBlockchainService
-from services.device_service import DeviceService
-from services.token_service import TokenService
-from services.auth_service import AuthService
-from services.mining_service import MiningService
-from services.advanced_crypto_service import AdvancedCryptoService
-from services.security_service import SecurityService
-from services.ai_analytics_service import AIAnalyticsService
-from services.advanced_economy_service import AdvancedEconomyService
-from services.iot_protocol_service import IoTProtocolService
-from services.ota_update_service import OTAUpdateService
-from services.geolocation_service import GeolocationService
-from services.x509_service import X509Service
-from services.marketplace_service import MarketplaceService
-from services.hsm_service import HSMService
-from services.graphql_service import GraphQLService
-from services.webhook_service import WebhookService
-from services.personalized_recommendations_service import PersonalizedRecommendationsService
-from services.personalizable_dashboard_service import PersonalizableDashboardService
-from services.cloud_integrations_service import CloudIntegrationsService
-from services.erp_crm_connectors_service import ERPCRMConnectorsService
-from services.compliance_service import ComplianceService
-from services.api_gateway_service import APIGatewayService
+# Construction paresseuse : chaque service est importé et instancié au premier
+# usage ; ceux qui portent des tâches de fond sont construits au démarrage
+from services.service_container import ServiceContainer
+
+services = ServiceContainer()
+services.register_instance("db", db)
+
+# Bus d'événements interne : alimente les subscriptions GraphQL
+from services.event_bus_service import EventBus
 
-ntru_service = NTRUService()
-blockchain_service = BlockchainService(db)
-advanced_blockchain_service = AdvancedBlockchainService(db, blockchain_service)
-device_service = DeviceService(db)
-token_service = TokenService(db)
-auth_service = AuthService(db)
-mining_service = MiningService(db, blockchain_service)
-advanced_crypto_service = AdvancedCryptoService(db)
-security_service = SecurityService(db)
-ai_analytics_service = AIAnalyticsService(db)
-advanced_economy_service = AdvancedEconomyService(db)
-iot_protocol_service = IoTProtocolService(db)
-ota_update_service = OTAUpdateService(db)
-geolocation_service = GeolocationService(db)
-x509_service = X509Service(db)
-marketplace_service = MarketplaceService(db)
-hsm_service = HSMService(db)
-personalized_recommendations_service = PersonalizedRecommendationsService(db)
-personalizable_dashboard_service = PersonalizableDashboardService(db)
-cloud_integrations_service = CloudIntegrationsService(db)
-erp_crm_service = ERPCRMConnectorsService(db)
-compliance_service = ComplianceService(db)
-api_gateway_service = APIGatewayService(db)
+event_bus = EventBus()
+services.register_instance("event_bus", event_bus)
+
+ntru_service = services.register("ntru_service", "services.ntru_service:NTRUService")
+device_presence_service = services.register("device_presence_service", "services.device_presence_service:DevicePresenceService", "db", "event_bus")
+blockchain_service = services.register("blockchain_service", "services.blockchain_service:BlockchainService", "db", "event_bus")
+advanced_blockchain_service = services.register("advanced_blockchain_service", "services.advanced_blockchain_service:AdvancedBlockchainService", "db", "blockchain_service")
+device_service = services.register("device_service", "services.device_service:DeviceService", "db", "device_presence_service", "event_bus")
+token_service = services.register("token_service", "services.token_service:TokenService", "db", "event_bus")
+auth_service = services.register("auth_service", "services.auth_service:AuthService", "db")
+mining_service = services.register("mining_service", "services.mining_service:MiningService", "db", "blockchain_service")
+advanced_crypto_service = services.register("advanced_crypto_service", "services.advanced_crypto_service:AdvancedCryptoService", "db")
+security_service = services.register("security_service", "services.security_service:SecurityService", "db")
+ai_analytics_service = services.register("ai_analytics_service", "services.ai_analytics_service:AIAnalyticsService", "db")
+advanced_economy_service = services.register("advanced_economy_service", "services.advanced_economy_service:AdvancedEconomyService", "db")
+iot_protocol_service = services.register("iot_protocol_service", "services.iot_protocol_service:IoTProtocolService", "db", "device_presence_service")
+websocket_gateway_service = services.register("websocket_gateway_service", "services.websocket_gateway_service:WebSocketGatewayService", "db", "iot_protocol_service")
+ota_update_service = services.register("ota_update_service", "services.ota_update_service:OTAUpdateService", "db")
+geolocation_service = services.register("geolocation_service", "services.geolocation_service:GeolocationService", "db")
+x509_service = services.register("x509_service", "services.x509_service:X509Service", "db")
+marketplace_service = services.register("marketplace_service", "services.marketplace_service:MarketplaceService", "db")
+hsm_service = services.register("hsm_service", "services.hsm_service:HSMService", "db")
+personalized_recommendations_service = services.register("personalized_recommendations_service", "services.personalized_recommendations_service:PersonalizedRecommendationsService", "db")
+personalizable_dashboard_service = services.register("personalizable_dashboard_service", "services.personalizable_dashboard_service:PersonalizableDashboardService", "db")
+cloud_integrations_service = services.register("cloud_integrations_service", "services.cloud_integrations_service:CloudIntegrationsService", "db")
+erp_crm_service = services.register("erp_crm_service", "services.erp_crm_connectors_service:ERPCRMConnectorsService", "db")
+compliance_service = services.register("compliance_service", "services.compliance_service:ComplianceService", "db")
+api_gateway_service = services.register("api_gateway_service", "services.api_gateway_service:APIGatewayService", "db")
+webhook_service = services.register("webhook_service", "services.webhook_service:WebhookService", "db")
 
 # Initialiser les nouveaux services
 services_dict = {
@@ -93,8 +87,19 @@ services_dict = {
     'x509_service': x509_service,
     'auth_service': auth_service
 }
+services.register_instance("graphql_services", services_dict)
+stats_cache = services.register("stats_cache", "services.stats_cache_service:StatsCache")
+graphql_service = services.register("graphql_service", "services.graphql_service:GraphQLService", "db", "graphql_services", "event_bus", "stats_cache")
+
+# Index MongoDB déclarés par chaque module de service (INDEXES / QUERY_PROBES)
+from services.index_registry import IndexRegistry
+
+index_registry = IndexRegistry(db)
 
-webhook_service = WebhookService(db)
+# Les passages hors ligne détectés par le registre de présence alimentent les webhooks
+async def _emit_device_offline(event):
+    from services.webhook_service import WebhookEvent
+    await webhook_service.emit_event(WebhookEvent.DEVICE_OFFLINE, event)
 
 # Include routers
 from routes.auth_routes import router as auth_router
@@ -142,12 +147,13 @@ import routes.api_gateway_routes
 routes.auth_routes.init_auth_service(auth_service)
 routes.auth_routes.init_security_service(security_service)
 routes.iot_protocol_routes.iot_protocol_service = iot_protocol_service
+routes.iot_protocol_routes.websocket_gateway_service = websocket_gateway_service
 routes.ota_routes.ota_service = ota_update_service
 routes.geolocation_routes.geolocation_service = geolocation_service
 routes.x509_routes.x509_service = x509_service
 routes.marketplace_routes.marketplace_service = marketplace_service
-routes.graphql_routes.init_graphql_service(db, services_dict)
-routes.webhook_routes.init_webhook_service(db)
+routes.graphql_routes.init_graphql_service(db, services_dict, graphql_service)
+routes.webhook_routes.init_webhook_service(db, webhook_service)
 routes.personalized_recommendations_routes.init_recommendations_service(personalized_recommendations_service)
 routes.personalizable_dashboard_routes.init_dashboard_service(personalizable_dashboard_service)
 routes.cloud_integrations_routes.init_cloud_integrations_service(cloud_integrations_service)
@@ -184,29 +190,32 @@ api_router.include_router(api_gateway_router, prefix="/api-gateway", tags=["api-
 # Health check endpoint
 @api_router.get("/health")
 async def health_check():
+    # Les services pas encore utilisés sont signalés "deferred" sans être construits
     return {
         "status": "healthy",
         "timestamp": datetime.utcnow(),
         "services": {
-            "ntru": ntru_service.is_ready(),
+            "ntru": services.status("ntru_service"),
             "blockchain": await blockchain_service.is_ready(),
             "advanced_blockchain": await advanced_blockchain_service.is_ready(),
-            "advanced_crypto": advanced_crypto_service.is_ready(),
-            "security": security_service.is_ready(),
-            "ai_analytics": ai_analytics_service.is_ready(),
-            "advanced_economy": advanced_economy_service.is_ready(),
+            "advanced_crypto": services.status("advanced_crypto_service"),
+            "security": services.status("security_service"),
+            "ai_analytics": services.status("ai_analytics_service"),
+            "advanced_economy": services.status("advanced_economy_service"),
             "iot_protocol": iot_protocol_service.is_ready(),
-            "ota_update": ota_update_service.is_ready(),
-            "geolocation": geolocation_service.is_ready(),
-            "x509": x509_service.is_ready(),
-            "marketplace": marketplace_service.is_ready(),
-            "hsm": hsm_service.is_ready(),
-            "webhook": webhook_service.is_ready(),
-            "recommendations": personalized_recommendations_service.is_ready(),
-            "custom_dashboards": personalizable_dashboard_service.is_ready(),
-            "cloud_integrations": cloud_integrations_service.is_ready(),
-            "erp_crm": erp_crm_service.is_ready(),
-            "compliance": compliance_service.is_ready(),
+            "device_presence": device_presence_service.is_ready(),
+            "websocket_gateway": websocket_gateway_service.is_ready(),
+            "ota_update": services.status("ota_update_service"),
+            "geolocation": services.status("geolocation_service"),
+            "x509": services.status("x509_service"),
+            "marketplace": services.status("marketplace_service"),
+            "hsm": services.status("hsm_service"),
+            "webhook": services.status("webhook_service"),
+            "recommendations": services.status("personalized_recommendations_service"),
+            "custom_dashboards": services.status("personalizable_dashboard_service"),
+            "cloud_integrations": services.status("cloud_integrations_service"),
+            "erp_crm": services.status("erp_crm_service"),
+            "compliance": services.status("compliance_service"),
             "api_gateway": api_gateway_service.is_ready(),
             "database": True
         }
@@ -215,9 +224,13 @@ async def health_check():
 # Include the router in the main app
 app.include_router(api_router)
 
+# Compression des réponses (au plus près des routes, sous la gateway)
+setup_response_pipeline(app, minimum_size=int(os.environ.get("RESPONSE_COMPRESSION_MIN_SIZE", "1024")))
+
 # Configure API Gateway middleware
 from middleware.api_gateway_middleware import setup_api_gateway_middleware
-setup_api_gateway_middleware(app, api_gateway_service)
+# Chemin critique de chaque requête : instance directe plutôt que le mandataire
+setup_api_gateway_middleware(app, services.get("api_gateway_service"))
 
 # Add CORS middleware
 app.add_middleware(
@@ -238,20 +251,77 @@ logger = logging.getLogger(__name__)
 @app.on_event("startup")
 async def startup_event():
     logger.info("Starting QuantumShield API...")
-    # Initialize token system
-    await token_service.initialize_token_system()
-    # Initialize blockchain if needed
-    await blockchain_service.initialize_genesis_block()
-    # Initialize advanced blockchain service
-    await advanced_blockchain_service.initialize()
+    started_at = time.perf_counter()
+    # Services portant des tâches de fond : construits maintenant, les autres au premier usage
+    services.build(
+        "token_service", "blockchain_service", "advanced_blockchain_service",
+        "device_presence_service", "device_service", "iot_protocol_service",
+        "websocket_gateway_service", "api_gateway_service", "auth_service", "mining_service",
+        "webhook_service"
+    )
+    device_presence_service.add_offline_listener(_emit_device_offline)
+
+    async def apply_indexes():
+        # Modules des services non construits importés hors de la boucle d'événements
+        await index_registry.declare_modules(services.module_names() + [
+            "services.session_store_service", "services.webhook_outbox_service", "services.graphql_execution",
+            "services.token_leaderboard_service"
+        ])
+        return await index_registry.apply()
+
+    async def start_device_presence():
+        # Load device presence registry and start deadline expiry
+        await device_presence_service.load_from_db()
+        await device_presence_service.start()
+
+    # Initialisations indépendantes (collections distinctes) : exécutées en parallèle
+    steps = {
+        # Index déclarés par les services (idempotent)
+        "indexes": apply_indexes(),
+        "token_system": token_service.initialize_token_system(),
+        # Materialized leaderboard and reputation scores (periodic resync)
+        "token_leaderboard": token_service.leaderboard.start(),
+        "genesis_block": blockchain_service.initialize_genesis_block(),
+        "advanced_blockchain": advanced_blockchain_service.initialize(),
+        "device_presence": start_device_presence(),
+        # Load anomaly rules and start batched anomaly writes
+        "device_anomalies": device_service.start(),
+        # Load negotiated payload codecs and binary schemas
+        "payload_codecs": iot_protocol_service.payload_codecs.load_device_codecs(),
+        # Start WebSocket device gateway background tasks
+        "websocket_gateway": websocket_gateway_service.start(),
+        # Start batched API key usage accounting
+        "api_gateway": api_gateway_service.start(),
+        # Session indexes (unique token hash, TTL expiry) and revocation filter
+        "session_store": auth_service.session_store.start(),
+        # Durable webhook outbox: reclaim pending and retrying deliveries after a restart
+        "webhooks": webhook_service.start(),
+    }
+    results = await asyncio.gather(*steps.values(), return_exceptions=True)
+    for step, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logger.error(f"Erreur au démarrage ({step}): {result}")
+
     # Start mining process
     asyncio.create_task(mining_service.start_mining())
+    logger.info(f"QuantumShield API démarrée en {(time.perf_counter() - started_at) * 1000:.0f} ms")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     await mining_service.stop_mining()
+    await websocket_gateway_service.stop()
+    await api_gateway_service.stop()
+    await auth_service.session_store.stop()
+    await device_presence_service.stop()
+    await device_service.stop()
+    await token_service.leaderboard.stop()
+    await webhook_service.shutdown()
+    if services.is_built("graphql_service"):
+        await graphql_service.subscriptions.stop()
+    await event_bus.stop()
     client.close()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    # Pings WebSocket gérés par la passerelle (un seul balayage), pas par connexion
+    uvicorn.run(app, host="0.0.0.0", port=8001, ws_ping_interval=None)
@@ -28,9 +28,27 @@ from models.blockchain_models import (
     BlockchainMetrics, NetworkHealth, SmartContractStatus
 )
 from models.quantum_models import Block, Transaction, User
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("validators", "address", unique=True),
+    IndexSpec("validators", "is_active"),
+    IndexSpec("governance_proposals", "id"),
+    IndexSpec("votes", [("proposal_id", 1), ("voter_address", 1)]),
+    IndexSpec("voting_powers", "address"),
+    IndexSpec("smart_contracts", "id"),
+    IndexSpec("stake_pools", "validator_address"),
+    IndexSpec("cross_chain_transactions", "id"),
+]
+
+QUERY_PROBES = [
+    QueryProbe("validators", {"address": "probe"}, description="validateur par adresse"),
+    QueryProbe("votes", {"proposal_id": "probe"}, description="votes d'une proposition"),
+    QueryProbe("smart_contracts", {"id": "probe"}, description="contrat par identifiant"),
+]
+
 class AdvancedBlockchainService:
     """Service avancé pour la blockchain améliorée"""
     
@@ -45,9 +45,22 @@ except ImportError:
     KYBER_AVAILABLE = False
     DILITHIUM_AVAILABLE = False
     logging.warning("pqcrypto not available, using fallback implementations")
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("advanced_keypairs", "id"),
+    IndexSpec("advanced_keypairs", "user_id"),
+    IndexSpec("crypto_audit_log", [("user_id", 1), ("timestamp", -1)]),
+    IndexSpec("zk_proofs", "proof_id"),
+    IndexSpec("threshold_schemes", "scheme_id"),
+]
+
+QUERY_PROBES = [
+    QueryProbe("advanced_keypairs", {"id": "probe"}, description="paire de clés par identifiant"),
+]
+
 class CryptoAlgorithm(str, Enum):
     NTRU_PLUS = "NTRU++"
     KYBER_512 = "Kyber-512"
@@ -12,9 +12,20 @@ from enum import Enum
 from decimal import Decimal
 import hashlib
 import asyncio
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("staking_positions", [("user_id", 1), ("active", 1)]),
+    IndexSpec("loan_requests", [("id", 1), ("status", 1)]),
+    IndexSpec("governance_proposals", [("status", 1), ("created_at", -1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe("staking_positions", {"user_id": "probe", "active": True}, description="positions de staking actives"),
+]
+
 class ServiceType(str, Enum):
     DEVICE_MONITORING = "device_monitoring"
     SECURITY_AUDIT = "security_audit"
@@ -1153,7 +1164,7 @@ class AdvancedEconomyService:
                 # Émettre les tokens
                 await self.db.token_balances.update_one(
                     {"user_id": recipient},
-                    {"$inc": {"balance": amount}},
+                    {"$inc": {"balance": amount}, "$set": {"last_updated": datetime.utcnow()}},
                     upsert=True
                 )
                 
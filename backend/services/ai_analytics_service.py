@@ -10,16 +10,29 @@ from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime, timedelta
 from enum import Enum
 import uuid
-from sklearn.ensemble import IsolationForest
-from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import DBSCAN
-from sklearn.linear_model import LinearRegression
-import joblib
 import os
 from pathlib import Path
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("device_metrics", [("device_id", 1), ("timestamp", -1)]),
+    IndexSpec("energy_metrics", [("timestamp", -1)]),
+    IndexSpec("network_metrics", [("timestamp", -1)]),
+    IndexSpec("anomaly_detections", [("resolved", 1), ("timestamp", -1)]),
+    IndexSpec("ml_predictions", [("created_at", -1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe(
+        "device_metrics", {"device_id": "probe", "timestamp": {"$gte": 0, "$lte": 1}},
+        description="métriques d'un dispositif sur une fenêtre"
+    ),
+    QueryProbe("energy_metrics", {}, sort=[("timestamp", -1)], description="dernières métriques énergétiques"),
+    QueryProbe("network_metrics", {"timestamp": {"$gte": 0}}, description="trafic réseau récent"),
+]
+
 class AnomalyType(str, Enum):
     DEVICE_BEHAVIOR = "device_behavior"
     NETWORK_TRAFFIC = "network_traffic"
@@ -74,6 +87,10 @@ class AIAnalyticsService:
     def _init_anomaly_detection_models(self):
         """Initialise les modèles de détection d'anomalies"""
         try:
+            # Import différé : scikit-learn n'est chargé qu'à la construction du service
+            from sklearn.ensemble import IsolationForest
+            from sklearn.cluster import DBSCAN
+
             # Modèle pour anomalies de dispositifs
             self.models["device_anomaly"] = IsolationForest(
                 contamination=0.1,
@@ -109,6 +126,9 @@ class AIAnalyticsService:
     def _init_prediction_models(self):
         """Initialise les modèles de prédiction"""
         try:
+            from sklearn.linear_model import LinearRegression
+            from sklearn.preprocessing import StandardScaler
+
             # Modèle de prédiction de pannes
             self.models["failure_prediction"] = LinearRegression()
             
@@ -263,6 +283,7 @@ class AIAnalyticsService:
             
             # Normaliser les features
             if "network_features" not in self.scalers:
+                from sklearn.preprocessing import StandardScaler
                 self.scalers["network_features"] = StandardScaler()
                 features_scaled = self.scalers["network_features"].fit_transform(features_array)
             else:
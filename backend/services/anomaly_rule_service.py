@@ -0,0 +1,385 @@
+"""
+Moteur de règles d'anomalies en streaming pour les heartbeats des devices
+Règles déclarées par type de device, compilées en fonctions, évaluées en O(règles)
+sur un état par device en mémoire (EWMA, fenêtres glissantes, compteurs de débit)
+"""
+
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DEVICE_TYPE = "default"
+
+# Règles par défaut : reprennent les seuils historiques de DeviceService.detect_anomalies
+DEFAULT_RULES = [
+    {
+        "name": "heartbeat_frequency_high", "kind": "rate", "event": "heartbeat",
+        "window_seconds": 3600, "max_count": 120,
+        "severity": "medium", "description": "Fréquence de heartbeat anormalement élevée"
+    },
+    {
+        "name": "temperature_out_of_range", "kind": "range", "metric": "temperature",
+        "min": -40, "max": 85,
+        "severity": "high", "description": "Température hors des limites normales"
+    },
+    {
+        "name": "cpu_usage_high", "kind": "threshold", "metric": "cpu_usage",
+        "op": ">", "value": 95,
+        "severity": "medium", "description": "Utilisation CPU excessive"
+    },
+    {
+        "name": "memory_usage_high", "kind": "threshold", "metric": "memory_usage",
+        "op": ">", "value": 90,
+        "severity": "medium", "description": "Utilisation mémoire excessive"
+    },
+    {
+        "name": "frequent_status_changes", "kind": "rate", "event": "status_change",
+        "window_seconds": 3600, "max_count": 5,
+        "severity": "high", "description": "Changements de status trop fréquents"
+    }
+]
+
+COMPARATORS = {
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b
+}
+
+
+class RingBuffer:
+    """Fenêtre glissante de taille fixe avec somme maintenue (moyenne en O(1))"""
+
+    __slots__ = ("values", "index", "count", "total")
+
+    def __init__(self, size: int):
+        self.values = [0.0] * size
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+
+    def push(self, value: float):
+        size = len(self.values)
+        if self.count == size:
+            self.total -= self.values[self.index]
+        else:
+            self.count += 1
+        self.values[self.index] = value
+        self.total += value
+        self.index = (self.index + 1) % size
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+
+class RateCounter:
+    """Compteur d'événements sur une fenêtre, découpée en seaux dans un anneau fixe"""
+
+    __slots__ = ("bucket_seconds", "buckets", "current_bucket", "total")
+
+    def __init__(self, window_seconds: float, bucket_count: int = 60):
+        self.bucket_seconds = window_seconds / bucket_count
+        self.buckets = [0] * bucket_count
+        self.current_bucket = None
+        self.total = 0
+
+    def _advance(self, now: float):
+        """Vide les seaux sortis de la fenêtre (O(1) amorti, borné par la taille de l'anneau)"""
+        bucket_id = int(now // self.bucket_seconds)
+        size = len(self.buckets)
+        if self.current_bucket is None or bucket_id - self.current_bucket >= size:
+            self.buckets = [0] * size
+            self.total = 0
+        elif bucket_id > self.current_bucket:
+            for stale in range(self.current_bucket + 1, bucket_id + 1):
+                slot = stale % size
+                self.total -= self.buckets[slot]
+                self.buckets[slot] = 0
+        else:
+            return
+        self.current_bucket = bucket_id
+
+    def increment(self, now: float) -> int:
+        """Compte un événement et retourne le total sur la fenêtre"""
+        self._advance(now)
+        self.buckets[self.current_bucket % len(self.buckets)] += 1
+        self.total += 1
+        return self.total
+
+    def count(self, now: float) -> int:
+        self._advance(now)
+        return self.total
+
+
+class DeviceStreamState:
+    """État de streaming d'un device, partagé par toutes ses règles"""
+
+    __slots__ = ("last_status", "ewma", "windows", "rates", "rules_key", "rules_version")
+
+    def __init__(self, rules_key: str, rules_version: int):
+        self.last_status = None
+        self.ewma: Dict[str, List[float]] = {}
+        self.windows: Dict[str, RingBuffer] = {}
+        self.rates: Dict[str, RateCounter] = {}
+        # Jeu de règles (type de device) et version ayant produit cet état
+        self.rules_key = rules_key
+        self.rules_version = rules_version
+
+
+class CompiledRule:
+    """Règle compilée : métadonnées + fonction d'évaluation"""
+
+    __slots__ = ("name", "severity", "description", "evaluate")
+
+    def __init__(self, name: str, severity: str, description: str, evaluate: Callable):
+        self.name = name
+        self.severity = severity
+        self.description = description
+        self.evaluate = evaluate
+
+
+class AnomalyRuleService:
+    """Moteur de règles d'anomalies compilées, rechargeables à chaud"""
+
+    def __init__(self, db):
+        self.db = db
+        self.rule_definitions: Dict[str, List[Dict[str, Any]]] = {DEFAULT_DEVICE_TYPE: DEFAULT_RULES}
+        self.compiled_rules: Dict[str, List[CompiledRule]] = {}
+        self.rule_metadata: Dict[str, CompiledRule] = {}
+        self.device_states: Dict[str, DeviceStreamState] = {}
+        # Version globale (nombre de recompilations) et version par type de device
+        self.rules_version = 0
+        self.rules_versions: Dict[str, int] = {}
+        self._active_definitions: Dict[str, List[Dict[str, Any]]] = {}
+        self.reload_interval = 30
+        self._last_reload_marker = None
+        self._reload_task: Optional[asyncio.Task] = None
+        self.is_initialized = False
+        self._initialize()
+
+    def _initialize(self):
+        """Compile les règles par défaut"""
+        try:
+            self._compile_all()
+            self.is_initialized = True
+            logger.info("Moteur de règles d'anomalies initialisé")
+        except Exception as e:
+            logger.error(f"Erreur initialisation moteur de règles: {str(e)}")
+            self.is_initialized = False
+
+    def is_ready(self) -> bool:
+        """Vérifie si le service est prêt"""
+        return self.is_initialized
+
+    # ====================
+    # Compilation des règles
+    # ====================
+
+    def compile_rule(self, definition: Dict[str, Any]) -> CompiledRule:
+        """Compile une définition de règle en fonction evaluate(state, sensor_data, events, now)"""
+        name = definition["name"]
+        kind = definition["kind"]
+        metric = definition.get("metric")
+        key = f"{name}:{metric}"
+
+        if kind == "threshold":
+            compare = COMPARATORS[definition.get("op", ">")]
+            limit = float(definition["value"])
+
+            def evaluate(state, sensor_data, events, now):
+                value = sensor_data.get(metric)
+                return isinstance(value, (int, float)) and compare(value, limit)
+
+        elif kind == "range":
+            low = float(definition.get("min", -math.inf))
+            high = float(definition.get("max", math.inf))
+
+            def evaluate(state, sensor_data, events, now):
+                value = sensor_data.get(metric)
+                return isinstance(value, (int, float)) and (value < low or value > high)
+
+        elif kind == "ewma_deviation":
+            alpha = float(definition.get("alpha", 0.1))
+            sigmas = float(definition.get("sigmas", 3.0))
+            warmup = int(definition.get("warmup", 10))
+
+            def evaluate(state, sensor_data, events, now):
+                value = sensor_data.get(metric)
+                if not isinstance(value, (int, float)):
+                    return False
+                ewma = state.ewma.get(key)
+                if ewma is None:
+                    state.ewma[key] = [float(value), 0.0, 1]
+                    return False
+                mean, variance, samples = ewma
+                deviation = value - mean
+                anomalous = samples >= warmup and abs(deviation) > sigmas * math.sqrt(variance)
+                # Mise à jour incrémentale de la moyenne et de la variance exponentielles
+                ewma[0] = mean + alpha * deviation
+                ewma[1] = (1 - alpha) * (variance + alpha * deviation * deviation)
+                ewma[2] = samples + 1
+                return anomalous
+
+        elif kind == "window_mean":
+            size = int(definition.get("window_size", 10))
+            compare = COMPARATORS[definition.get("op", ">")]
+            limit = float(definition["value"])
+
+            def evaluate(state, sensor_data, events, now):
+                value = sensor_data.get(metric)
+                if not isinstance(value, (int, float)):
+                    return False
+                window = state.windows.get(key)
+                if window is None:
+                    window = state.windows[key] = RingBuffer(size)
+                window.push(float(value))
+                return window.count == size and compare(window.mean(), limit)
+
+        elif kind == "rate":
+            event = definition["event"]
+            window_seconds = float(definition.get("window_seconds", 3600))
+            max_count = int(definition["max_count"])
+
+            def evaluate(state, sensor_data, events, now):
+                counter = state.rates.get(key)
+                if counter is None:
+                    counter = state.rates[key] = RateCounter(window_seconds)
+                if event in events:
+                    return counter.increment(now) > max_count
+                return counter.count(now) > max_count
+
+        else:
+            raise ValueError(f"Type de règle inconnu: {kind}")
+
+        return CompiledRule(
+            name=name,
+            severity=definition.get("severity", "low"),
+            description=definition.get("description", "Anomalie non spécifiée"),
+            evaluate=evaluate
+        )
+
+    def _compile_all(self):
+        """Compile toutes les définitions puis remplace atomiquement le jeu de règles"""
+        compiled = {
+            device_type: [self.compile_rule(definition) for definition in definitions]
+            for device_type, definitions in self.rule_definitions.items()
+        }
+        metadata = {rule.name: rule for rules in compiled.values() for rule in rules}
+        # Seuls les types dont les définitions ont changé changent de version :
+        # l'état de streaming des autres devices est conservé
+        versions = dict(self.rules_versions)
+        for device_type, definitions in self.rule_definitions.items():
+            if self._active_definitions.get(device_type) != definitions:
+                versions[device_type] = versions.get(device_type, 0) + 1
+        self.compiled_rules = compiled
+        self.rule_metadata = metadata
+        self.rules_versions = versions
+        self._active_definitions = dict(self.rule_definitions)
+        self.rules_version += 1
+
+    # ====================
+    # Évaluation
+    # ====================
+
+    def evaluate(self, device_id: str, device_type: Optional[str], sensor_data: Dict[str, Any],
+                 status: Optional[str] = None, now: Optional[float] = None) -> List[CompiledRule]:
+        """Évalue les règles du type de device sur un heartbeat, sans lecture en base"""
+        now = now or time.time()
+        rules_key = device_type if device_type in self.compiled_rules else DEFAULT_DEVICE_TYPE
+        rules = self.compiled_rules[rules_key]
+        rules_version = self.rules_versions[rules_key]
+
+        state = self.device_states.get(device_id)
+        if state is None or state.rules_key != rules_key or state.rules_version != rules_version:
+            # Nouvel état après modification des règles du type : les fenêtres d'une ancienne règle ne sont pas réutilisées
+            previous_status = state.last_status if state else None
+            state = self.device_states[device_id] = DeviceStreamState(rules_key, rules_version)
+            state.last_status = previous_status
+
+        events = {"heartbeat"}
+        if status is not None:
+            if state.last_status is not None and status != state.last_status:
+                events.add("status_change")
+            state.last_status = status
+
+        sensor_data = sensor_data or {}
+        return [rule for rule in rules if rule.evaluate(state, sensor_data, events, now)]
+
+    def forget_device(self, device_id: str):
+        self.device_states.pop(device_id, None)
+
+    # ====================
+    # Rechargement à chaud
+    # ====================
+
+    async def load_rules(self):
+        """Charge les règles persistées et recompile"""
+        definitions = {DEFAULT_DEVICE_TYPE: DEFAULT_RULES}
+        marker = None
+        async for document in self.db.anomaly_rules.find({}):
+            definitions[document["device_type"]] = document["rules"]
+            updated_at = document.get("updated_at")
+            if updated_at and (marker is None or updated_at > marker):
+                marker = updated_at
+
+        previous = self.rule_definitions
+        self.rule_definitions = definitions
+        try:
+            self._compile_all()
+        except Exception:
+            self.rule_definitions = previous
+            raise
+        self._last_reload_marker = marker
+
+    async def set_rules(self, device_type: str, rules: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Valide, persiste et active les règles d'un type de device"""
+        # Compiler avant de persister : une règle invalide ne doit jamais être activée
+        for definition in rules:
+            self.compile_rule(definition)
+
+        await self.db.anomaly_rules.update_one(
+            {"device_type": device_type},
+            {"$set": {"rules": rules, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        await self.load_rules()
+        return {"device_type": device_type, "rules": rules, "rules_version": self.rules_versions[device_type]}
+
+    async def start(self):
+        """Charge les règles et surveille les modifications (autres workers)"""
+        await self.load_rules()
+        if not self._reload_task:
+            self._reload_task = asyncio.create_task(self._reload_loop())
+
+    async def stop(self):
+        if self._reload_task:
+            self._reload_task.cancel()
+            self._reload_task = None
+
+    async def _reload_loop(self):
+        while True:
+            try:
+                await asyncio.sleep(self.reload_interval)
+                latest = await self.db.anomaly_rules.find_one(
+                    {}, {"updated_at": 1}, sort=[("updated_at", -1)]
+                )
+                marker = latest.get("updated_at") if latest else None
+                if marker != self._last_reload_marker:
+                    await self.load_rules()
+                    logger.info(f"Règles d'anomalies rechargées (version {self.rules_version})")
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur rechargement des règles d'anomalies: {str(e)}")
+
+    def get_rules(self) -> Dict[str, Any]:
+        return {
+            "rules": self.rule_definitions,
+            "rules_version": self.rules_version,
+            "rules_versions": self.rules_versions
+        }
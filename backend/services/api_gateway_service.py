@@ -14,10 +14,27 @@ from datetime import datetime, timedelta
 from enum import Enum
 from collections import defaultdict
 import aiohttp
+from pymongo import UpdateOne
 from fastapi import Request, HTTPException, status
 
+from services.rate_limiter_service import create_rate_limiter_backend
+from services.index_registry import IndexSpec, QueryProbe
+
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("api_keys", "api_key", unique=True),
+    IndexSpec("api_keys", "user_id"),
+    IndexSpec("blocked_ips", [("ip_address", 1), ("is_active", 1)]),
+    IndexSpec("blocked_ips", [("is_active", 1), ("unblock_at", 1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe("api_keys", {"api_key": "probe"}, description="validation de clé API"),
+    QueryProbe("api_keys", {"user_id": "probe"}, description="clés d'un utilisateur"),
+    QueryProbe("blocked_ips", {"is_active": True, "unblock_at": {"$gt": 0}}, description="IPs bloquées en cours"),
+]
+
 class RateLimitType(str, Enum):
     PER_MINUTE = "per_minute"
     PER_HOUR = "per_hour"
@@ -42,9 +59,21 @@ class APIGatewayService:
         self.db = db
         self.is_initialized = False
         self.rate_limits = {}
-        self.request_cache = defaultdict(list)
-        self.blocked_ips = set()
-        self.api_keys = {}
+        # Compteurs de fenêtre glissante, locaux ou partagés entre workers (RATE_LIMIT_BACKEND)
+        self.rate_limiter = create_rate_limiter_backend(db)
+        # Requêtes autorisées par minute sur les 5 dernières minutes (index de minute, compteur)
+        self._recent_requests = [[0, 0] for _ in range(5)]
+        # Cache des clés API : clé -> configuration (None = clé inconnue, cache négatif)
+        self.api_keys: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._api_key_expiry: Dict[str, float] = {}
+        self.api_key_cache_ttl = 60
+        self.api_key_negative_ttl = 10
+        self.max_cached_api_keys = 50000
+        # Compteurs d'usage agrégés en mémoire, écrits par lots ($inc groupés)
+        self._pending_usage: Dict[str, Dict[str, int]] = {}
+        self._pending_last_used: Dict[str, datetime] = {}
+        self.usage_flush_interval = 5
+        self._usage_flush_task: Optional[asyncio.Task] = None
         
         # Configuration par défaut des tiers
         self.tier_limits = {
@@ -97,6 +126,25 @@ class APIGatewayService:
         """Vérifie si le service est prêt"""
         return self.is_initialized
     
+    async def start(self):
+        """Démarre l'écriture périodique des compteurs d'usage et les tâches du rate limiter"""
+        if not self._usage_flush_task:
+            self._usage_flush_task = asyncio.create_task(self._usage_flush_loop())
+        await self.rate_limiter.start()
+    
+    async def stop(self):
+        """Arrête la tâche de fond et écrit les compteurs en attente"""
+        if self._usage_flush_task:
+            self._usage_flush_task.cancel()
+            self._usage_flush_task = None
+        await self.rate_limiter.stop()
+        await self.flush_usage_stats()
+    
+    @property
+    def blocked_ips(self) -> Dict[str, float]:
+        """IPs bloquées connues du backend de rate limiting (IP -> fin du blocage)"""
+        return self.rate_limiter.blocked_ips
+    
     # ===== GESTION DES API KEYS =====
     
     async def create_api_key(self, user_id: str, tier: APITier, 
@@ -130,7 +178,7 @@ class APIGatewayService:
             await self.db.api_keys.insert_one(key_config)
             
             # Mettre à jour le cache
-            self.api_keys[api_key] = key_config
+            self._cache_api_key(api_key, key_config)
             
             return {
                 "api_key": api_key,
@@ -144,17 +192,32 @@ class APIGatewayService:
             logger.error(f"Erreur création clé API: {e}")
             raise Exception(f"Impossible de créer la clé API: {e}")
     
+    def _cache_api_key(self, api_key: str, key_config: Optional[Dict[str, Any]]):
+        """Met une configuration (ou une absence) en cache avec sa durée de vie"""
+        if len(self.api_keys) >= self.max_cached_api_keys and api_key not in self.api_keys:
+            # Cache plein : retirer l'entrée la plus ancienne (ordre d'insertion)
+            oldest = next(iter(self.api_keys))
+            self.invalidate_api_key(oldest)
+        ttl = self.api_key_cache_ttl if key_config else self.api_key_negative_ttl
+        self.api_keys[api_key] = key_config
+        self._api_key_expiry[api_key] = time.time() + ttl
+    
+    def invalidate_api_key(self, api_key: str):
+        """Retire une clé du cache (révocation, changement de limites)"""
+        self.api_keys.pop(api_key, None)
+        self._api_key_expiry.pop(api_key, None)
+    
     async def validate_api_key(self, api_key: str, api_secret: str = None) -> Optional[Dict[str, Any]]:
         """Valide une clé API"""
         try:
             # Vérifier dans le cache d'abord
-            if api_key in self.api_keys:
+            if api_key in self.api_keys and self._api_key_expiry.get(api_key, 0) > time.time():
                 key_config = self.api_keys[api_key]
             else:
                 # Chercher en base
                 key_config = await self.db.api_keys.find_one({"api_key": api_key})
-                if key_config:
-                    self.api_keys[api_key] = key_config
+                self.invalidate_api_key(api_key)
+                self._cache_api_key(api_key, key_config)
             
             if not key_config or not key_config.get("is_active", False):
                 return None
@@ -163,11 +226,8 @@ class APIGatewayService:
             if api_secret and key_config.get("api_secret") != api_secret:
                 return None
             
-            # Mettre à jour la dernière utilisation
-            await self.db.api_keys.update_one(
-                {"api_key": api_key},
-                {"$set": {"last_used": datetime.utcnow()}}
-            )
+            # Dernière utilisation écrite avec le prochain lot de compteurs
+            self._pending_last_used[api_key] = datetime.utcnow()
             
             return key_config
             
@@ -188,9 +248,8 @@ class APIGatewayService:
                 }
             )
             
-            # Supprimer du cache
-            if api_key in self.api_keys:
-                del self.api_keys[api_key]
+            # Supprimer du cache (les autres workers la verront expirer sous api_key_cache_ttl)
+            self.invalidate_api_key(api_key)
             
             return result.modified_count > 0
             
@@ -234,7 +293,7 @@ class APIGatewayService:
                 user_limits = self.tier_limits[tier]
             
             # Vérifier si l'IP est bloquée
-            if identifier in self.blocked_ips:
+            if await self.rate_limiter.is_blocked(identifier):
                 return False, {"error": "IP bloquée", "status": RequestStatus.BLOCKED}
             
             endpoint = request.url.path
@@ -252,7 +311,8 @@ class APIGatewayService:
                 "reset_times": {}
             }
             
-            # Vérifier chaque type de limite
+            # Une clé par fenêtre, vérifiées et consommées en une seule opération
+            checks = []
             for limit_type in RateLimitType:
                 # Déterminer la limite
                 if limit_type in endpoint_limits:
@@ -260,49 +320,38 @@ class APIGatewayService:
                 else:
                     limit = user_limits.get(limit_type, self.tier_limits[tier][limit_type])
                 
-                # Calculer la fenêtre de temps
                 window = self._get_time_window(limit_type)
-                window_start = current_time - window
-                
-                # Clé de cache pour cette limite
                 cache_key = self._get_rate_limit_key(identifier, endpoint, limit_type)
+                checks.append((cache_key, limit, window))
                 
-                # Nettoyer les anciennes requêtes
-                if cache_key in self.request_cache:
-                    self.request_cache[cache_key] = [
-                        req_time for req_time in self.request_cache[cache_key]
-                        if req_time > window_start
-                    ]
-                
-                # Compter les requêtes actuelles
-                current_count = len(self.request_cache[cache_key])
-                
-                # Informations pour la réponse
                 rate_limit_info["limits"][limit_type.value] = limit
-                rate_limit_info["current_usage"][limit_type.value] = current_count
-                rate_limit_info["reset_times"][limit_type.value] = int(current_time + window)
+                rate_limit_info["reset_times"][limit_type.value] = int((current_time // window + 1) * window)
+            
+            allowed, result = await self.rate_limiter.acquire(checks, current_time)
+            
+            for limit_type, (cache_key, _, _) in zip(RateLimitType, checks):
+                if cache_key in result["usage"]:
+                    rate_limit_info["current_usage"][limit_type.value] = result["usage"][cache_key]
+            
+            if not allowed:
+                limit_type = RateLimitType(result["exceeded"].rsplit(":", 1)[1])
                 
-                # Vérifier si la limite est dépassée
-                if current_count >= limit:
-                    # Mettre à jour les statistiques d'erreur
-                    if api_key:
-                        await self._update_api_key_stats(api_key, "rate_limited")
-                    
-                    return False, {
-                        "error": f"Limite de taux dépassée pour {limit_type.value}",
-                        "status": RequestStatus.RATE_LIMITED,
-                        "rate_limit_info": rate_limit_info,
-                        "retry_after": window
-                    }
+                # Mettre à jour les statistiques d'erreur
+                if api_key:
+                    self._update_api_key_stats(api_key, "rate_limited")
+                
+                return False, {
+                    "error": f"Limite de taux dépassée pour {limit_type.value}",
+                    "status": RequestStatus.RATE_LIMITED,
+                    "rate_limit_info": rate_limit_info,
+                    "retry_after": result["retry_after"]
+                }
             
-            # Toutes les limites sont respectées, enregistrer la requête
-            for limit_type in RateLimitType:
-                cache_key = self._get_rate_limit_key(identifier, endpoint, limit_type)
-                self.request_cache[cache_key].append(current_time)
+            self._count_recent_request(current_time)
             
             # Mettre à jour les statistiques de succès
             if api_key:
-                await self._update_api_key_stats(api_key, "success")
+                self._update_api_key_stats(api_key, "success")
             
             return True, {
                 "status": RequestStatus.ALLOWED,
@@ -313,35 +362,80 @@ class APIGatewayService:
             logger.error(f"Erreur vérification rate limit: {e}")
             return False, {"error": "Erreur interne", "status": RequestStatus.BLOCKED}
     
-    async def _update_api_key_stats(self, api_key: str, result_type: str):
-        """Met à jour les statistiques d'utilisation d'une clé API"""
+    def _count_recent_request(self, current_time: float):
+        """Compte une requête autorisée dans le seau de la minute courante"""
+        minute = int(current_time // 60)
+        bucket = self._recent_requests[minute % 5]
+        if bucket[0] != minute:
+            bucket[0] = minute
+            bucket[1] = 0
+        bucket[1] += 1
+    
+    def _update_api_key_stats(self, api_key: str, result_type: str):
+        """Agrège en mémoire les statistiques d'utilisation d'une clé API"""
+        counters = self._pending_usage.get(api_key)
+        if counters is None:
+            counters = self._pending_usage[api_key] = {"usage_stats.total_requests": 0}
+        
+        counters["usage_stats.total_requests"] += 1
+        
+        if result_type == "success":
+            field = "usage_stats.successful_requests"
+        elif result_type == "error":
+            field = "usage_stats.failed_requests"
+        elif result_type == "rate_limited":
+            field = "usage_stats.rate_limited_requests"
+        else:
+            return
+        counters[field] = counters.get(field, 0) + 1
+    
+    async def flush_usage_stats(self) -> int:
+        """Écrit les compteurs agrégés en un seul bulk_write"""
+        if not self._pending_usage and not self._pending_last_used:
+            return 0
+        
+        usage, self._pending_usage = self._pending_usage, {}
+        last_used, self._pending_last_used = self._pending_last_used, {}
+        
+        operations = []
+        for api_key in set(usage) | set(last_used):
+            update = {}
+            if api_key in usage:
+                update["$inc"] = usage[api_key]
+            if api_key in last_used:
+                update["$set"] = {"last_used": last_used[api_key]}
+            operations.append(UpdateOne({"api_key": api_key}, update))
+        
         try:
-            update_fields = {
-                "usage_stats.total_requests": 1
-            }
-            
-            if result_type == "success":
-                update_fields["usage_stats.successful_requests"] = 1
-            elif result_type == "error":
-                update_fields["usage_stats.failed_requests"] = 1
-            elif result_type == "rate_limited":
-                update_fields["usage_stats.rate_limited_requests"] = 1
-            
-            await self.db.api_keys.update_one(
-                {"api_key": api_key},
-                {"$inc": update_fields}
-            )
-            
+            await self.db.api_keys.bulk_write(operations, ordered=False)
+            return len(operations)
         except Exception as e:
             logger.error(f"Erreur mise à jour stats API key: {e}")
+            # Réinjecter les compteurs pour le prochain lot
+            for api_key, counters in usage.items():
+                pending = self._pending_usage.setdefault(api_key, {})
+                for field, value in counters.items():
+                    pending[field] = pending.get(field, 0) + value
+            for api_key, value in last_used.items():
+                self._pending_last_used.setdefault(api_key, value)
+            return 0
+    
+    async def _usage_flush_loop(self):
+        """Écrit périodiquement les compteurs d'usage"""
+        while True:
+            try:
+                await asyncio.sleep(self.usage_flush_interval)
+                await self.flush_usage_stats()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur boucle d'écriture des stats API: {e}")
     
     # ===== GESTION DES BLOCAGES =====
     
     async def block_ip(self, ip_address: str, reason: str, duration_hours: int = 24) -> bool:
         """Bloque une adresse IP"""
         try:
-            self.blocked_ips.add(ip_address)
-            
             # Enregistrer en base
             block_record = {
                 "ip_address": ip_address,
@@ -353,6 +447,9 @@ class APIGatewayService:
             
             await self.db.blocked_ips.insert_one(block_record)
             
+            # Propager au backend (visible des autres workers pour les backends partagés)
+            await self.rate_limiter.block(ip_address, time.time() + duration_hours * 3600)
+            
             logger.warning(f"IP {ip_address} bloquée: {reason}")
             return True
             
@@ -363,7 +460,7 @@ class APIGatewayService:
     async def unblock_ip(self, ip_address: str) -> bool:
         """Débloque une adresse IP"""
         try:
-            self.blocked_ips.discard(ip_address)
+            await self.rate_limiter.unblock(ip_address)
             
             await self.db.blocked_ips.update_many(
                 {"ip_address": ip_address, "is_active": True},
@@ -456,11 +553,14 @@ class APIGatewayService:
             current_time = datetime.utcnow()
             
             # Compter les requêtes récentes
+            current_minute = int(time.time() // 60)
             recent_requests = sum(
-                len([req for req in requests if req > time.time() - 300])  # 5 minutes
-                for requests in self.request_cache.values()
+                count for minute, count in self._recent_requests
+                if minute > current_minute - 5  # 5 minutes
             )
             
+            limiter_stats = self.rate_limiter.get_statistics()
+            
             # Compter les IPs bloquées
             blocked_count = len(self.blocked_ips)
             
@@ -473,9 +573,11 @@ class APIGatewayService:
                 "recent_requests_5min": recent_requests,
                 "blocked_ips": blocked_count,
                 "active_api_keys": active_keys,
-                "cache_size": len(self.request_cache),
+                "cache_size": limiter_stats["tracked_keys"],
+                "rate_limit_backend": limiter_stats["backend"],
                 "memory_usage": {
-                    "request_cache_entries": sum(len(reqs) for reqs in self.request_cache.values()),
+                    "request_cache_entries": limiter_stats["tracked_keys"],
+                    "evicted_rate_limit_keys": limiter_stats.get("evicted_keys", 0),
                     "api_keys_cached": len(self.api_keys)
                 }
             }
@@ -506,6 +608,11 @@ class APIGatewayService:
                 {"$set": {f"rate_limits.{limit_type}": value for limit_type, value in new_limits.items()}}
             )
             
+            # Les configurations en cache de ce tier sont périmées
+            for api_key, key_config in list(self.api_keys.items()):
+                if key_config and key_config.get("tier") == tier.value:
+                    self.invalidate_api_key(api_key)
+            
             logger.info(f"Limites mises à jour pour tier {tier.value}: {new_limits}")
             return True
             
@@ -2,20 +2,44 @@
 Service d'authentification avec sécurité post-quantique
 """
 
+import asyncio
 import hashlib
 import jwt
 import bcrypt
-from typing import Optional, Dict, Any
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Set, Tuple
 from datetime import datetime, timedelta
 import logging
 from motor.motor_asyncio import AsyncIOMotorCollection
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519
 import os
 
 from models.quantum_models import User, UserCreate, UserLogin
 from services.ntru_service import NTRUService
+from services.session_store_service import SessionStoreService
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("users", "id", unique=True),
+    IndexSpec("users", "username", unique=True),
+    IndexSpec("users", "email", unique=True, partial={"email": {"$type": "string"}}),
+]
+
+QUERY_PROBES = [
+    QueryProbe("users", {"id": "probe"}, description="utilisateur par identifiant"),
+    QueryProbe("users", {"username": "probe"}, description="connexion"),
+    QueryProbe("users", {"$or": [{"email": "probe"}, {"username": "probe"}]}, description="unicité à l'inscription"),
+]
+
+class PasswordHashingBusyError(Exception):
+    """Trop de hachages de mots de passe en attente : la requête est rejetée immédiatement"""
+    pass
+
 class AuthService:
     """Service d'authentification avec sécurité post-quantique"""
     
@@ -23,9 +47,196 @@ class AuthService:
         self.db = db
         self.users: AsyncIOMotorCollection = db.users
         self.sessions: AsyncIOMotorCollection = db.sessions
+        self.session_store = SessionStoreService(db)
         self.ntru_service = NTRUService()
         self.secret_key = os.getenv("SECRET_KEY", "your-secret-key-here")
         self.token_expiry = timedelta(hours=24)
+        
+        # Signature des tokens : HS256 (secret partagé) ou EdDSA/ES256 (clé privée,
+        # vérifiable par d'autres services avec la seule clé publique)
+        self.jwt_algorithm = "HS256"
+        self.jwt_private_key = None
+        self.jwt_key_id: Optional[str] = None
+        self.jwt_public_keys: Dict[str, List[Tuple[Optional[str], Any]]] = {}
+        self._load_jwt_keys()
+        
+        # Cache des principaux authentifiés : hash du token -> (résultat, expiration epoch)
+        self._principal_cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
+        self._principal_tokens_by_user: Dict[str, Set[str]] = {}
+        self.principal_cache_ttl = 30
+        self.max_cached_principals = 100000
+        
+        # Hachage bcrypt hors de la boucle asyncio, dans un pool borné
+        self.bcrypt_rounds = int(os.getenv("BCRYPT_ROUNDS", "12"))
+        self.hash_workers = int(os.getenv("BCRYPT_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.max_pending_hashes = int(os.getenv("BCRYPT_MAX_PENDING", str(self.hash_workers * 8)))
+        self._hash_executor = ThreadPoolExecutor(max_workers=self.hash_workers, thread_name_prefix="bcrypt")
+        self._pending_hashes = 0
+        self.rejected_hashes = 0
+    
+    # ====================
+    # Hachage des mots de passe
+    # ====================
+    
+    async def _run_hash(self, func, *args):
+        """Exécute une opération bcrypt dans le pool, ou la rejette si la file est pleine"""
+        if self._pending_hashes >= self.max_pending_hashes:
+            self.rejected_hashes += 1
+            raise PasswordHashingBusyError("Service d'authentification saturé, réessayez plus tard")
+        
+        self._pending_hashes += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._hash_executor, func, *args)
+        finally:
+            self._pending_hashes -= 1
+    
+    async def hash_password(self, password: str) -> str:
+        """Hache un mot de passe avec le facteur de coût configuré"""
+        return await self._run_hash(self._hash_password_sync, password)
+    
+    def _hash_password_sync(self, password: str) -> str:
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=self.bcrypt_rounds)).decode('utf-8')
+    
+    async def verify_password(self, password: str, password_hash: str) -> bool:
+        """Vérifie un mot de passe contre son hash bcrypt"""
+        return await self._run_hash(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+    
+    def needs_rehash(self, password_hash: str) -> bool:
+        """Vrai si le hash a été produit avec un autre facteur de coût"""
+        try:
+            return int(password_hash.split("$")[2]) != self.bcrypt_rounds
+        except (IndexError, ValueError):
+            return True
+    
+    def get_hashing_stats(self) -> Dict[str, Any]:
+        return {
+            "bcrypt_rounds": self.bcrypt_rounds,
+            "workers": self.hash_workers,
+            "pending": self._pending_hashes,
+            "max_pending": self.max_pending_hashes,
+            "rejected": self.rejected_hashes
+        }
+    
+    # ====================
+    # Clés de signature JWT
+    # ====================
+    
+    def _read_pem(self, value: Optional[str]) -> Optional[bytes]:
+        """Accepte un PEM en clair ou un chemin de fichier"""
+        if not value:
+            return None
+        if "-----BEGIN" in value:
+            return value.replace("\\n", "\n").encode()
+        with open(value, "rb") as f:
+            return f.read()
+    
+    def _algorithm_for_key(self, key) -> Optional[str]:
+        if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+            return "EdDSA"
+        if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)) and key.curve.name == "secp256r1":
+            return "ES256"
+        return None
+    
+    def _register_public_key(self, public_key, key_id: Optional[str] = None):
+        algorithm = self._algorithm_for_key(public_key)
+        if not algorithm:
+            logger.warning("Clé publique JWT ignorée (seuls Ed25519 et P-256 sont acceptés)")
+            return
+        self.jwt_public_keys.setdefault(algorithm, []).append((key_id, public_key))
+    
+    def _load_jwt_keys(self):
+        """Charge la clé privée de signature (JWT_PRIVATE_KEY) et les clés publiques de confiance (JWT_PUBLIC_KEYS)"""
+        try:
+            private_pem = self._read_pem(os.getenv("JWT_PRIVATE_KEY"))
+            if private_pem:
+                private_key = serialization.load_pem_private_key(private_pem, password=None)
+                algorithm = self._algorithm_for_key(private_key)
+                if not algorithm:
+                    raise ValueError("JWT_PRIVATE_KEY doit être une clé Ed25519 ou EC P-256")
+                public_pem = private_key.public_key().public_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PublicFormat.SubjectPublicKeyInfo
+                )
+                self.jwt_private_key = private_key
+                self.jwt_algorithm = algorithm
+                self.jwt_key_id = hashlib.sha256(public_pem).hexdigest()[:16]
+                self._register_public_key(private_key.public_key(), self.jwt_key_id)
+                logger.info(f"Tokens JWT signés en {algorithm} (kid {self.jwt_key_id})")
+            
+            for entry in filter(None, (os.getenv("JWT_PUBLIC_KEYS") or "").split(",")):
+                public_pem = self._read_pem(entry.strip())
+                self._register_public_key(
+                    serialization.load_pem_public_key(public_pem),
+                    hashlib.sha256(public_pem).hexdigest()[:16]
+                )
+        except Exception as e:
+            logger.error(f"Erreur chargement des clés JWT: {e}")
+    
+    def get_public_key_pem(self) -> Optional[str]:
+        """Clé publique de vérification des tokens (None en HS256)"""
+        if not self.jwt_private_key:
+            return None
+        return self.jwt_private_key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()
+    
+    def _encode_token(self, payload: Dict[str, Any]) -> str:
+        if self.jwt_private_key:
+            return jwt.encode(payload, self.jwt_private_key, algorithm=self.jwt_algorithm,
+                              headers={"kid": self.jwt_key_id})
+        return jwt.encode(payload, self.secret_key, algorithm="HS256")
+    
+    def _decode_token(self, token: str) -> Dict[str, Any]:
+        """Décode un token HS256, EdDSA ou ES256 selon son en-tête"""
+        header = jwt.get_unverified_header(token)
+        algorithm = header.get("alg")
+        
+        if algorithm == "HS256":
+            return jwt.decode(token, self.secret_key, algorithms=["HS256"])
+        
+        if algorithm in ("EdDSA", "ES256"):
+            keys = self.jwt_public_keys.get(algorithm, [])
+            key_id = header.get("kid")
+            candidates = [key for kid, key in keys if key_id is None or kid == key_id] or [key for _, key in keys]
+            for key in candidates:
+                try:
+                    return jwt.decode(token, key, algorithms=[algorithm])
+                except jwt.InvalidSignatureError:
+                    continue
+            raise jwt.InvalidSignatureError("Aucune clé publique ne valide la signature")
+        
+        raise jwt.InvalidAlgorithmError(f"Algorithme non accepté: {algorithm}")
+    
+    # ====================
+    # Cache des principaux
+    # ====================
+    
+    @staticmethod
+    def hash_token(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+    
+    def _cache_principal(self, token_hash: str, result: Dict[str, Any]):
+        expires_at = min(time.time() + self.principal_cache_ttl, result["payload"].get("exp", 0))
+        if len(self._principal_cache) >= self.max_cached_principals:
+            oldest = next(iter(self._principal_cache))
+            self._evict_principal(oldest)
+        self._principal_cache[token_hash] = (result, expires_at)
+        self._principal_tokens_by_user.setdefault(result["user"].id, set()).add(token_hash)
+    
+    def _evict_principal(self, token_hash: str):
+        entry = self._principal_cache.pop(token_hash, None)
+        if entry:
+            tokens = self._principal_tokens_by_user.get(entry[0]["user"].id)
+            if tokens:
+                tokens.discard(token_hash)
+                if not tokens:
+                    del self._principal_tokens_by_user[entry[0]["user"].id]
+    
+    def invalidate_user_principals(self, user_id: str):
+        """Retire du cache tous les tokens d'un utilisateur (mot de passe, désactivation, profil)"""
+        for token_hash in list(self._principal_tokens_by_user.pop(user_id, ())):
+            self._principal_cache.pop(token_hash, None)
     
     async def register_user(self, user_data: UserCreate) -> User:
         """Enregistre un nouvel utilisateur"""
@@ -42,10 +253,7 @@ class AuthService:
                 raise Exception("Utilisateur déjà existant")
             
             # Hacher le mot de passe
-            password_hash = bcrypt.hashpw(
-                user_data.password.encode('utf-8'), 
-                bcrypt.gensalt()
-            ).decode('utf-8')
+            password_hash = await self.hash_password(user_data.password)
             
             # Générer une adresse de wallet (clé publique NTRU++)
             public_key, private_key = self.ntru_service.generate_keypair()
@@ -69,6 +277,8 @@ class AuthService:
             logger.info(f"Utilisateur {user.username} enregistré avec succès")
             return user
             
+        except PasswordHashingBusyError:
+            raise
         except Exception as e:
             logger.error(f"Erreur lors de l'enregistrement: {e}")
             raise Exception(f"Impossible d'enregistrer l'utilisateur: {e}")
@@ -84,33 +294,36 @@ class AuthService:
                 return None
             
             # Vérifier le mot de passe
-            if not bcrypt.checkpw(
-                login_data.password.encode('utf-8'),
-                user_doc["password_hash"].encode('utf-8')
-            ):
+            if not await self.verify_password(login_data.password, user_doc["password_hash"]):
                 logger.warning(f"Mot de passe incorrect pour: {login_data.username}")
                 return None
             
+            # Re-hacher de façon transparente si le facteur de coût a changé
+            if self.needs_rehash(user_doc["password_hash"]):
+                try:
+                    await self.users.update_one(
+                        {"id": user_doc["id"]},
+                        {"$set": {"password_hash": await self.hash_password(login_data.password)}}
+                    )
+                except PasswordHashingBusyError:
+                    pass
+            
             # Créer le token JWT
             token_payload = {
                 "user_id": user_doc["id"],
                 "username": user_doc["username"],
                 "wallet_address": user_doc["wallet_address"],
-                "exp": datetime.utcnow() + self.token_expiry
+                "exp": datetime.utcnow() + self.token_expiry,
+                # Identifiant unique : deux connexions dans la même seconde donnent deux sessions distinctes
+                "jti": uuid.uuid4().hex
             }
             
-            token = jwt.encode(token_payload, self.secret_key, algorithm="HS256")
-            
-            # Enregistrer la session
-            session_data = {
-                "user_id": user_doc["id"],
-                "token": token,
-                "created_at": datetime.utcnow(),
-                "expires_at": datetime.utcnow() + self.token_expiry,
-                "is_active": True
-            }
+            token = self._encode_token(token_payload)
             
-            await self.sessions.insert_one(session_data)
+            # Enregistrer la session (hash du token uniquement)
+            session_data = await self.session_store.create_session(
+                user_doc["id"], token, token_payload["exp"]
+            )
             
             # Mettre à jour la dernière connexion
             await self.users.update_one(
@@ -126,29 +339,42 @@ class AuthService:
                 "expires_at": session_data["expires_at"]
             }
             
+        except PasswordHashingBusyError:
+            raise
         except Exception as e:
             logger.error(f"Erreur lors de l'authentification: {e}")
             return None
     
     async def verify_token(self, token: str) -> Optional[Dict[str, Any]]:
-        """Vérifie un token JWT"""
+        """Vérifie un token JWT (résultat mis en cache jusqu'à expiration ou invalidation)"""
+        token_hash = self.hash_token(token)
+        now = time.time()
+        
+        cached = self._principal_cache.get(token_hash)
+        if cached:
+            if cached[1] > now:
+                return cached[0]
+            self._evict_principal(token_hash)
+        
         try:
+            if await self.session_store.is_revoked(token_hash):
+                return None
+            
             # Décoder le token
-            payload = jwt.decode(token, self.secret_key, algorithms=["HS256"])
-            logger.info(f"Token décodé avec succès pour user_id: {payload.get('user_id')}")
+            payload = self._decode_token(token)
             
-            # Récupérer l'utilisateur directement (bypass session pour debugging)
             user_doc = await self.users.find_one({"id": payload["user_id"]})
             
             if not user_doc or not user_doc.get("is_active", True):
                 logger.warning(f"Utilisateur inactif ou inexistant: {payload['user_id']}")
                 return None
             
-            logger.info(f"Utilisateur trouvé et actif: {user_doc['username']}")
-            return {
+            result = {
                 "user": User(**user_doc),
                 "payload": payload
             }
+            self._cache_principal(token_hash, result)
+            return result
             
         except jwt.ExpiredSignatureError:
             logger.warning("Token expiré")
@@ -163,13 +389,15 @@ class AuthService:
     async def logout_user(self, token: str) -> bool:
         """Déconnecte un utilisateur"""
         try:
-            # Désactiver la session
-            result = await self.sessions.update_one(
-                {"token": token},
-                {"$set": {"is_active": False}}
-            )
+            self._evict_principal(self.hash_token(token))
             
-            if result.modified_count > 0:
+            # Le token reste signé valide : il est refusé jusqu'à son expiration
+            try:
+                expires_at = jwt.decode(token, options={"verify_signature": False}).get("exp")
+            except jwt.InvalidTokenError:
+                expires_at = None
+            
+            if await self.session_store.revoke(token, expires_at):
                 logger.info("Utilisateur déconnecté avec succès")
                 return True
             
@@ -179,6 +407,28 @@ class AuthService:
             logger.error(f"Erreur lors de la déconnexion: {e}")
             return False
     
+    async def revoke_all_sessions(self, user_id: str) -> int:
+        """Révoque toutes les sessions d'un utilisateur et vide ses tokens du cache"""
+        count = await self.session_store.revoke_all_for_user(user_id)
+        self.invalidate_user_principals(user_id)
+        return count
+    
+    async def deactivate_user(self, user_id: str) -> bool:
+        """Désactive un compte, ses sessions et ses tokens en cache"""
+        try:
+            result = await self.users.update_one(
+                {"id": user_id},
+                {"$set": {"is_active": False, "deactivated_at": datetime.utcnow()}}
+            )
+            await self.revoke_all_sessions(user_id)
+            
+            logger.info(f"Utilisateur {user_id} désactivé")
+            return result.modified_count > 0
+            
+        except Exception as e:
+            logger.error(f"Erreur lors de la désactivation de l'utilisateur: {e}")
+            return False
+    
     async def get_user_by_id(self, user_id: str) -> Optional[User]:
         """Récupère un utilisateur par son ID"""
         try:
@@ -223,6 +473,7 @@ class AuthService:
             )
             
             if result.modified_count > 0:
+                self.invalidate_user_principals(user_id)
                 updated_user = await self.get_user_by_id(user_id)
                 logger.info(f"Profil mis à jour pour l'utilisateur {user_id}")
                 return updated_user
@@ -243,18 +494,12 @@ class AuthService:
                 return False
             
             # Vérifier l'ancien mot de passe
-            if not bcrypt.checkpw(
-                old_password.encode('utf-8'),
-                user_doc["password_hash"].encode('utf-8')
-            ):
+            if not await self.verify_password(old_password, user_doc["password_hash"]):
                 logger.warning(f"Ancien mot de passe incorrect pour l'utilisateur {user_id}")
                 return False
             
             # Hacher le nouveau mot de passe
-            new_password_hash = bcrypt.hashpw(
-                new_password.encode('utf-8'),
-                bcrypt.gensalt()
-            ).decode('utf-8')
+            new_password_hash = await self.hash_password(new_password)
             
             # Mettre à jour
             result = await self.users.update_one(
@@ -264,16 +509,15 @@ class AuthService:
             
             if result.modified_count > 0:
                 # Invalider toutes les sessions actives
-                await self.sessions.update_many(
-                    {"user_id": user_id, "is_active": True},
-                    {"$set": {"is_active": False}}
-                )
+                await self.revoke_all_sessions(user_id)
                 
                 logger.info(f"Mot de passe changé pour l'utilisateur {user_id}")
                 return True
             
             return False
             
+        except PasswordHashingBusyError:
+            raise
         except Exception as e:
             logger.error(f"Erreur lors du changement de mot de passe: {e}")
             return False
@@ -311,11 +555,7 @@ class AuthService:
             total_earned = total_rewards[0]["total"] if total_rewards else 0
             
             # Sessions actives
-            active_sessions = await self.sessions.count_documents({
-                "user_id": user_id,
-                "is_active": True,
-                "expires_at": {"$gt": datetime.utcnow()}
-            })
+            active_sessions = await self.session_store.count_active_sessions(user_id)
             
             # Récupérer les détails complets de l'utilisateur
             user_doc = await self.users.find_one({"id": user_id})
@@ -339,7 +579,7 @@ class AuthService:
             return {}
     
     async def cleanup_expired_sessions(self):
-        """Nettoie les sessions expirées"""
+        """Nettoie les sessions expirées (filet de sécurité : l'index TTL les supprime déjà)"""
         try:
             result = await self.sessions.delete_many({
                 "expires_at": {"$lt": datetime.utcnow()}
@@ -12,14 +12,30 @@ import logging
 from motor.motor_asyncio import AsyncIOMotorCollection
 
 from models.quantum_models import Block, Transaction, BlockchainStats, BlockType
+from services.index_registry import IndexSpec, QueryProbe
+from services.event_bus_service import BLOCK_MINED
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("blocks", "block_number", unique=True),
+    IndexSpec("blocks", "hash"),
+    IndexSpec("transactions", "hash"),
+    IndexSpec("pending_transactions", "id"),
+]
+
+QUERY_PROBES = [
+    QueryProbe("blocks", {"block_number": 0}, description="bloc par numéro"),
+    QueryProbe("blocks", {}, sort=[("block_number", -1)], description="dernier bloc"),
+    QueryProbe("transactions", {"hash": "probe"}, description="transaction par hash"),
+]
+
 class BlockchainService:
     """Service de blockchain privée pour la confiance matérielle"""
     
-    def __init__(self, db):
+    def __init__(self, db, event_bus=None):
         self.db = db
+        self.event_bus = event_bus
         self.blocks: AsyncIOMotorCollection = db.blocks
         self.transactions: AsyncIOMotorCollection = db.transactions
         self.pending_transactions: AsyncIOMotorCollection = db.pending_transactions
@@ -221,6 +237,7 @@ class BlockchainService:
             tx_ids = [tx.id for tx in pending_transactions]
             await self.pending_transactions.delete_many({"id": {"$in": tx_ids}})
             
+            self.publish_block(new_block)
             logger.info(f"Nouveau bloc miné: {new_block.block_number}")
             return new_block
             
@@ -228,6 +245,19 @@ class BlockchainService:
             logger.error(f"Erreur lors du mining: {e}")
             return None
     
+    def publish_block(self, block: Block):
+        """Publie un bloc ajouté à la chaîne sur le bus d'événements"""
+        if self.event_bus:
+            self.event_bus.publish(BLOCK_MINED, {
+                "block_number": block.block_number,
+                "block_hash": block.hash,
+                "previous_hash": block.previous_hash,
+                "miner_address": block.miner_address,
+                "transactions_count": len(block.transactions),
+                "difficulty": block.difficulty,
+                "timestamp": block.timestamp.isoformat()
+            })
+    
     async def get_blockchain_stats(self) -> BlockchainStats:
         """Récupère les statistiques de la blockchain"""
         try:
@@ -0,0 +1,237 @@
+"""
+Registre de présence des devices IoT
+Source unique de vérité en mémoire pour l'état online/offline : tas binaire
+indexé par la prochaine échéance de heartbeat, expiration en O(log n)
+"""
+
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Set, Callable, Awaitable
+
+from services.event_bus_service import DEVICE_STATUS
+
+logger = logging.getLogger(__name__)
+
+
+class DevicePresenceService:
+    """Registre de présence des devices (online / offline) en mémoire"""
+
+    def __init__(self, db, event_bus=None, heartbeat_timeout: int = 300):
+        self.db = db
+        # Transitions online/offline publiées sur le bus (subscriptions GraphQL)
+        self.event_bus = event_bus
+        self.heartbeat_timeout = heartbeat_timeout
+        # Échéances courantes ; le tas peut contenir des entrées périmées (suppression paresseuse)
+        self.deadlines: Dict[str, float] = {}
+        self.last_heartbeats: Dict[str, float] = {}
+        self._heap: List[tuple] = []
+        self.online: Set[str] = set()
+        self.offline: Set[str] = set()
+        self.known: Set[str] = set()
+        self.owners: Dict[str, str] = {}
+        self.devices_by_owner: Dict[str, Set[str]] = {}
+        self.offline_listeners: List[Callable[[Dict[str, Any]], Awaitable[Any]]] = []
+        self._wakeup = asyncio.Event()
+        self._expiry_task: Optional[asyncio.Task] = None
+        self.is_initialized = True
+        logger.info("Registre de présence des devices initialisé")
+
+    def is_ready(self) -> bool:
+        """Vérifie si le service est prêt"""
+        return self.is_initialized
+
+    def add_offline_listener(self, listener: Callable[[Dict[str, Any]], Awaitable[Any]]):
+        """Ajoute un callback appelé pour chaque device passant hors ligne"""
+        self.offline_listeners.append(listener)
+
+    # ====================
+    # Alimentation du registre
+    # ====================
+
+    def track_device(self, device_id: str, owner_id: Optional[str] = None):
+        """Déclare un device (sans heartbeat, il n'est ni online ni offline)"""
+        self.known.add(device_id)
+        if owner_id:
+            previous_owner = self.owners.get(device_id)
+            if previous_owner and previous_owner != owner_id:
+                self.devices_by_owner.get(previous_owner, set()).discard(device_id)
+            self.owners[device_id] = owner_id
+            self.devices_by_owner.setdefault(owner_id, set()).add(device_id)
+
+    def record_heartbeat(self, device_id: str, timestamp: Optional[float] = None, owner_id: Optional[str] = None):
+        """Enregistre un heartbeat et repousse l'échéance du device (O(log n))"""
+        timestamp = timestamp or time.time()
+        if timestamp < self.last_heartbeats.get(device_id, 0):
+            return
+
+        self.track_device(device_id, owner_id)
+        deadline = timestamp + self.heartbeat_timeout
+        self.deadlines[device_id] = deadline
+        self.last_heartbeats[device_id] = timestamp
+
+        if deadline <= time.time():
+            # Heartbeat déjà expiré (chargement initial)
+            self.online.discard(device_id)
+            self.offline.add(device_id)
+            return
+
+        self.offline.discard(device_id)
+        if device_id not in self.online:
+            self.online.add(device_id)
+            self._publish_status(device_id, "online", timestamp)
+        # Réveiller la boucle si cette échéance devient la plus proche (ou si elle dort sans échéance)
+        if not self._heap or deadline < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (deadline, device_id))
+
+        # Compacter le tas quand les entrées périmées dominent
+        if len(self._heap) > 2 * len(self.deadlines) + 1024:
+            self._heap = [(d, device) for device, d in self.deadlines.items() if device in self.online]
+            heapq.heapify(self._heap)
+
+    def remove_device(self, device_id: str):
+        """Retire un device du registre"""
+        self.deadlines.pop(device_id, None)
+        self.last_heartbeats.pop(device_id, None)
+        self.online.discard(device_id)
+        self.offline.discard(device_id)
+        self.known.discard(device_id)
+        owner_id = self.owners.pop(device_id, None)
+        if owner_id:
+            self.devices_by_owner.get(owner_id, set()).discard(device_id)
+
+    async def load_from_db(self):
+        """Initialise le registre depuis la collection devices (une seule lecture au démarrage)"""
+        cursor = self.db.devices.find({}, {"device_id": 1, "owner_id": 1, "last_heartbeat": 1})
+        count = 0
+        async for device in cursor:
+            self.track_device(device["device_id"], device.get("owner_id"))
+            last_heartbeat = self._to_epoch(device.get("last_heartbeat"))
+            if last_heartbeat:
+                self.record_heartbeat(device["device_id"], last_heartbeat)
+            count += 1
+        logger.info(f"Registre de présence chargé: {count} devices")
+
+    def _to_epoch(self, value) -> Optional[float]:
+        """Convertit un last_heartbeat (datetime UTC ou ISO) en timestamp epoch"""
+        if isinstance(value, str):
+            try:
+                value = datetime.fromisoformat(value)
+            except ValueError:
+                return None
+        if isinstance(value, datetime):
+            return (value - datetime(1970, 1, 1, tzinfo=value.tzinfo)).total_seconds()
+        return None
+
+    # ====================
+    # Expiration des échéances
+    # ====================
+
+    async def start(self):
+        """Démarre la boucle d'expiration"""
+        if not self._expiry_task:
+            self._expiry_task = asyncio.create_task(self._expiry_loop())
+
+    async def stop(self):
+        """Arrête la boucle d'expiration"""
+        if self._expiry_task:
+            self._expiry_task.cancel()
+            self._expiry_task = None
+
+    async def _expiry_loop(self):
+        """Dort jusqu'à la prochaine échéance puis marque les devices expirés hors ligne"""
+        while True:
+            try:
+                self._wakeup.clear()
+                timeout = self._heap[0][0] - time.time() if self._heap else None
+                if timeout is None or timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+
+                expired = self.expire_due()
+                for event in expired:
+                    await self._notify_offline(event)
+
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur boucle d'expiration de présence: {str(e)}")
+                await asyncio.sleep(1)
+
+    def expire_due(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Dépile les échéances passées et retourne les événements de passage hors ligne"""
+        now = now or time.time()
+        events = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, device_id = heapq.heappop(self._heap)
+            # Entrée périmée : le device a envoyé un heartbeat depuis
+            if self.deadlines.get(device_id) != deadline or device_id not in self.online:
+                continue
+            self.online.discard(device_id)
+            self.offline.add(device_id)
+            last_heartbeat = self.last_heartbeats.get(device_id, deadline - self.heartbeat_timeout)
+            events.append({
+                "device_id": device_id,
+                "owner_id": self.owners.get(device_id),
+                "last_heartbeat": datetime.utcfromtimestamp(last_heartbeat).isoformat(),
+                "offline_duration": now - last_heartbeat
+            })
+        return events
+
+    def _publish_status(self, device_id: str, status: str, timestamp: float):
+        if self.event_bus:
+            self.event_bus.publish(DEVICE_STATUS, {
+                "device_id": device_id,
+                "owner_id": self.owners.get(device_id),
+                "status": status,
+                "timestamp": datetime.utcfromtimestamp(timestamp).isoformat()
+            })
+
+    async def _notify_offline(self, event: Dict[str, Any]):
+        self._publish_status(event["device_id"], "offline", time.time())
+        for listener in self.offline_listeners:
+            try:
+                await listener(event)
+            except Exception as e:
+                logger.error(f"Erreur notification device hors ligne: {str(e)}")
+
+    # ====================
+    # Requêtes
+    # ====================
+
+    def is_online(self, device_id: str) -> bool:
+        return device_id in self.online
+
+    def get_online_device_ids(self, owner_id: Optional[str] = None) -> List[str]:
+        if owner_id:
+            return [d for d in self.devices_by_owner.get(owner_id, ()) if d in self.online]
+        return list(self.online)
+
+    def get_offline_device_ids(self, owner_id: Optional[str] = None) -> List[str]:
+        if owner_id:
+            return [d for d in self.devices_by_owner.get(owner_id, ()) if d in self.offline]
+        return list(self.offline)
+
+    def get_summary(self, owner_id: Optional[str] = None) -> Dict[str, Any]:
+        """Compteurs online/offline (O(1) global, O(devices du propriétaire) sinon)"""
+        if owner_id:
+            online = len(self.get_online_device_ids(owner_id))
+            offline = len(self.get_offline_device_ids(owner_id))
+            total = len(self.devices_by_owner.get(owner_id, ()))
+        else:
+            online = len(self.online)
+            offline = len(self.offline)
+            total = len(self.known)
+        return {
+            "total_devices": total,
+            "online_devices": online,
+            "offline_devices": offline,
+            "never_seen_devices": max(0, total - online - offline),
+            "heartbeat_timeout": self.heartbeat_timeout
+        }
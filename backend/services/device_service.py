@@ -4,28 +4,73 @@ Gestion des dispositifs connectés avec sécurité post-quantique
 """
 
 import asyncio
+import csv
 import hashlib
+import io
 import json
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, AsyncIterator
 from datetime import datetime, timedelta
 import logging
 from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import BulkWriteError
+from pydantic import ValidationError
 
 from models.quantum_models import Device, DeviceCreate, DeviceUpdate, DeviceHeartbeat, DeviceStatus, AnomalyDetection
 from services.ntru_service import NTRUService
+from services.anomaly_rule_service import AnomalyRuleService
+from services.index_registry import IndexSpec, QueryProbe
+from services.event_bus_service import DEVICE_ANOMALY
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("devices", "device_id", unique=True),
+    IndexSpec("devices", "owner_id"),
+    IndexSpec("devices", [("status", 1), ("last_heartbeat", -1)]),
+    IndexSpec("device_logs", [("device_id", 1), ("timestamp", -1)]),
+    IndexSpec("anomalies", [("device_id", 1), ("timestamp", -1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe("devices", {"device_id": "probe"}, description="dispositif par identifiant"),
+    QueryProbe("devices", {"owner_id": "probe"}, description="dispositifs d'un utilisateur"),
+    QueryProbe("device_logs", {"device_id": "probe"}, sort=[("timestamp", -1)], description="journaux récents"),
+    QueryProbe("anomalies", {"device_id": "probe"}, description="anomalies d'un dispositif"),
+]
+
 class DeviceService:
     """Service de gestion des devices IoT avec sécurité post-quantique"""
     
-    def __init__(self, db):
+    def __init__(self, db, presence_service=None, event_bus=None):
         self.db = db
+        self.presence = presence_service
+        self.event_bus = event_bus
         self.devices: AsyncIOMotorCollection = db.devices
         self.device_logs: AsyncIOMotorCollection = db.device_logs
         self.anomalies: AsyncIOMotorCollection = db.anomalies
         self.ntru_service = NTRUService()
+        self.anomaly_rules = AnomalyRuleService(db)
         self.heartbeat_timeout = 300  # 5 minutes
+        # Écritures d'anomalies regroupées et insérées par lots
+        self._pending_anomalies: List[Dict[str, Any]] = []
+        self._pending_anomaly_logs: List[Dict[str, Any]] = []
+        self.anomaly_flush_interval = 2
+        self.anomaly_flush_size = 500
+        self._anomaly_flush_task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Démarre le moteur de règles et le flush périodique des anomalies"""
+        await self.anomaly_rules.start()
+        if not self._anomaly_flush_task:
+            self._anomaly_flush_task = asyncio.create_task(self._anomaly_flush_loop())
+    
+    async def stop(self):
+        """Arrête les tâches de fond et écrit les anomalies en attente"""
+        await self.anomaly_rules.stop()
+        if self._anomaly_flush_task:
+            self._anomaly_flush_task.cancel()
+            self._anomaly_flush_task = None
+        await self.flush_anomalies()
     
     async def register_device(self, device_data: DeviceCreate, owner_id: str) -> Device:
         """Enregistre un nouveau device IoT"""
@@ -56,6 +101,9 @@ class DeviceService:
             # Sauvegarder dans la base de données
             await self.devices.insert_one(device.dict())
             
+            if self.presence:
+                self.presence.track_device(device.device_id, owner_id)
+            
             # Log de l'enregistrement
             await self.log_device_activity(device.id, "device_registered", {
                 "device_type": device.device_type,
@@ -70,6 +118,170 @@ class DeviceService:
             logger.error(f"Erreur lors de l'enregistrement du device: {e}")
             raise Exception(f"Impossible d'enregistrer le device: {e}")
     
+    def parse_device_manifest(self, content: str, content_type: str = "text/csv") -> List[Dict[str, Any]]:
+        """Lit un manifeste CSV ou NDJSON et retourne les lignes brutes (numérotées à partir de 1)"""
+        rows = []
+        if "ndjson" in content_type or "json" in content_type:
+            for line_number, line in enumerate(content.splitlines(), start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rows.append({"row": line_number, "data": json.loads(line)})
+                except json.JSONDecodeError as e:
+                    rows.append({"row": line_number, "data": None, "error": f"JSON invalide: {e}"})
+        else:
+            reader = csv.DictReader(io.StringIO(content))
+            # La ligne 1 est l'en-tête
+            for line_number, record in enumerate(reader, start=2):
+                data = {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in record.items() if k}
+                capabilities = data.get("capabilities")
+                data["capabilities"] = [c.strip() for c in capabilities.split(";") if c.strip()] if capabilities else []
+                if not data.get("location"):
+                    data["location"] = None
+                rows.append({"row": line_number, "data": data})
+        return rows
+    
+    async def bulk_register_devices(self,
+                                    rows: List[Dict[str, Any]],
+                                    owner_id: str,
+                                    x509_service=None,
+                                    issue_certificates: bool = False,
+                                    chunk_size: int = 500) -> AsyncIterator[Dict[str, Any]]:
+        """Enregistre un lot de devices et produit un résultat par ligne puis un résumé"""
+        summary = {"total": len(rows), "registered": 0, "failed": 0, "certificates_issued": 0}
+        
+        # Passe unique : validation et dédoublonnage dans le manifeste
+        valid: List[tuple] = []
+        seen = set()
+        for row in rows:
+            if row.get("error"):
+                summary["failed"] += 1
+                yield {"row": row["row"], "success": False, "error": row["error"]}
+                continue
+            try:
+                device_data = DeviceCreate(**row["data"])
+            except (ValidationError, TypeError) as e:
+                summary["failed"] += 1
+                yield {"row": row["row"], "success": False, "error": f"Ligne invalide: {e}"}
+                continue
+            if not device_data.device_id or not device_data.device_name or not device_data.device_type:
+                summary["failed"] += 1
+                yield {"row": row["row"], "success": False,
+                       "error": "device_id, device_name et device_type sont obligatoires"}
+                continue
+            if device_data.device_id in seen:
+                summary["failed"] += 1
+                yield {"row": row["row"], "device_id": device_data.device_id, "success": False,
+                       "error": "device_id dupliqué dans le manifeste"}
+                continue
+            seen.add(device_data.device_id)
+            valid.append((row["row"], device_data))
+        
+        for start in range(0, len(valid), chunk_size):
+            chunk = valid[start:start + chunk_size]
+            try:
+                results = await self._register_device_chunk(chunk, owner_id, x509_service, issue_certificates)
+            except Exception as e:
+                logger.error(f"Erreur lors de l'enregistrement en lot: {e}")
+                results = [{"row": row_number, "device_id": device_data.device_id, "success": False, "error": str(e)}
+                           for row_number, device_data in chunk]
+            
+            for result in results:
+                if result["success"]:
+                    summary["registered"] += 1
+                    if result.get("certificate_id"):
+                        summary["certificates_issued"] += 1
+                else:
+                    summary["failed"] += 1
+                yield result
+        
+        logger.info(f"Enregistrement en lot: {summary['registered']}/{summary['total']} devices enregistrés")
+        yield {"summary": summary}
+    
+    async def _register_device_chunk(self, chunk: List[tuple], owner_id: str,
+                                     x509_service=None, issue_certificates: bool = False) -> List[Dict[str, Any]]:
+        """Insère un bloc de devices déjà validés (une lecture, un insert_many)"""
+        results: Dict[str, Dict[str, Any]] = {}
+        
+        # Écarter les devices déjà présents en base en une seule requête
+        device_ids = [device_data.device_id for _, device_data in chunk]
+        existing = set()
+        async for doc in self.devices.find({"device_id": {"$in": device_ids}}, {"device_id": 1}):
+            existing.add(doc["device_id"])
+        
+        pending = []
+        for row_number, device_data in chunk:
+            if device_data.device_id in existing:
+                results[device_data.device_id] = {"row": row_number, "device_id": device_data.device_id,
+                                                  "success": False, "error": "Device déjà enregistré"}
+            else:
+                pending.append((row_number, device_data))
+        
+        keypairs = await self.ntru_service.generate_keypairs_pooled(len(pending))
+        
+        documents = []
+        for (row_number, device_data), (public_key, _private_key) in zip(pending, keypairs):
+            device = Device(
+                device_id=device_data.device_id,
+                device_name=device_data.device_name,
+                device_type=device_data.device_type,
+                owner_id=owner_id,
+                firmware_hash=self.calculate_firmware_hash(device_data.device_id, "1.0.0"),
+                public_key=public_key,
+                location=device_data.location,
+                capabilities=device_data.capabilities
+            )
+            documents.append(device.dict())
+            results[device.device_id] = {"row": row_number, "device_id": device.device_id,
+                                         "id": device.id, "success": True}
+        
+        if documents:
+            try:
+                await self.devices.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # Doublons concurrents (index unique) : seules ces lignes échouent
+                for error in e.details.get("writeErrors", []):
+                    device_id = documents[error["index"]]["device_id"]
+                    results[device_id].update({"success": False, "error": error.get("errmsg", "Erreur d'insertion")})
+                    results[device_id].pop("id", None)
+        
+        inserted = [doc for doc in documents if results[doc["device_id"]]["success"]]
+        
+        if inserted:
+            now = datetime.utcnow()
+            await self.device_logs.insert_many([{
+                "device_id": doc["id"],
+                "activity_type": "device_registered",
+                "timestamp": now,
+                "data": {
+                    "device_type": doc["device_type"],
+                    "capabilities": doc["capabilities"],
+                    "location": doc["location"],
+                    "bulk": True
+                }
+            } for doc in inserted], ordered=False)
+            
+            if self.presence:
+                for doc in inserted:
+                    self.presence.track_device(doc["device_id"], owner_id)
+        
+        if inserted and issue_certificates and x509_service:
+            from services.x509_service import CertificateType
+            certificates = await x509_service.issue_certificates_batch([{
+                "subject_name": doc["device_id"],
+                "certificate_type": CertificateType.DEVICE,
+                "device_id": doc["device_id"],
+                "user_id": owner_id
+            } for doc in inserted])
+            for doc, certificate in zip(inserted, certificates):
+                if certificate.get("success"):
+                    results[doc["device_id"]]["certificate_id"] = certificate["certificate_id"]
+                else:
+                    results[doc["device_id"]]["certificate_error"] = certificate.get("error")
+        
+        return [results[device_data.device_id] for _, device_data in chunk]
+    
     async def get_device(self, device_id: str) -> Optional[Device]:
         """Récupère un device par son ID"""
         try:
@@ -82,10 +294,12 @@ class DeviceService:
             logger.error(f"Erreur lors de la récupération du device: {e}")
             return None
     
-    async def get_user_devices(self, owner_id: str) -> List[Device]:
-        """Récupère tous les devices d'un utilisateur"""
+    async def get_user_devices(self, owner_id: str, skip: int = 0, limit: Optional[int] = None) -> List[Device]:
+        """Récupère les devices d'un utilisateur (tous, ou une page triée par device_id)"""
         try:
             cursor = self.devices.find({"owner_id": owner_id})
+            if limit is not None:
+                cursor = cursor.sort("device_id", 1).skip(skip).limit(limit)
             devices_data = await cursor.to_list(length=None)
             
             devices = []
@@ -156,6 +370,9 @@ class DeviceService:
                 }
             )
             
+            if self.presence:
+                self.presence.record_heartbeat(heartbeat.device_id, owner_id=device.owner_id)
+            
             # Vérifier l'intégrité du firmware
             firmware_valid = await self.verify_firmware_integrity(
                 heartbeat.device_id, 
@@ -163,7 +380,7 @@ class DeviceService:
             )
             
             # Détecter les anomalies
-            anomaly_detected = await self.detect_anomalies(heartbeat)
+            anomaly_detected = await self.detect_anomalies(heartbeat, device.device_type)
             
             # Log du heartbeat
             await self.log_device_activity(device.id, "heartbeat_received", {
@@ -211,43 +428,20 @@ class DeviceService:
             logger.error(f"Erreur lors de la vérification du firmware: {e}")
             return False
     
-    async def detect_anomalies(self, heartbeat: DeviceHeartbeat) -> bool:
-        """Détecte les anomalies dans un heartbeat"""
+    async def detect_anomalies(self, heartbeat: DeviceHeartbeat, device_type: Optional[str] = None) -> bool:
+        """Détecte les anomalies dans un heartbeat (règles compilées, sans lecture en base)"""
         try:
-            # Récupérer l'historique récent du device
-            recent_logs = await self.device_logs.find(
-                {
-                    "device_id": heartbeat.device_id,
-                    "timestamp": {"$gte": datetime.utcnow() - timedelta(hours=1)}
-                }
-            ).to_list(length=100)
-            
-            # Analyse des anomalies
-            anomalies_found = []
-            
-            # 1. Vérifier la fréquence des heartbeats
-            if len(recent_logs) > 120:  # Plus de 2 heartbeats par minute
-                anomalies_found.append("heartbeat_frequency_high")
-            
-            # 2. Vérifier les données des capteurs
-            if heartbeat.sensor_data:
-                for sensor, value in heartbeat.sensor_data.items():
-                    if isinstance(value, (int, float)):
-                        if sensor == "temperature" and (value < -40 or value > 85):
-                            anomalies_found.append("temperature_out_of_range")
-                        elif sensor == "cpu_usage" and value > 95:
-                            anomalies_found.append("cpu_usage_high")
-                        elif sensor == "memory_usage" and value > 90:
-                            anomalies_found.append("memory_usage_high")
-            
-            # 3. Vérifier les changements de status fréquents
-            status_changes = [log for log in recent_logs if log.get("activity_type") == "status_change"]
-            if len(status_changes) > 5:
-                anomalies_found.append("frequent_status_changes")
+            status = heartbeat.status.value if isinstance(heartbeat.status, DeviceStatus) else heartbeat.status
+            triggered = self.anomaly_rules.evaluate(
+                heartbeat.device_id,
+                device_type,
+                heartbeat.sensor_data,
+                status=status
+            )
             
             # Si anomalies détectées, les enregistrer
-            if anomalies_found:
-                await self.record_anomaly(heartbeat.device_id, anomalies_found, heartbeat.sensor_data)
+            if triggered:
+                await self.record_anomaly(heartbeat.device_id, [rule.name for rule in triggered], heartbeat.sensor_data)
                 return True
             
             return False
@@ -257,32 +451,80 @@ class DeviceService:
             return False
     
     async def record_anomaly(self, device_id: str, anomaly_types: List[str], sensor_data: Dict[str, Any]):
-        """Enregistre une anomalie détectée"""
+        """Enregistre une anomalie détectée (écriture différée par lot)"""
         try:
+            now = datetime.utcnow()
             for anomaly_type in anomaly_types:
                 anomaly = AnomalyDetection(
                     device_id=device_id,
                     anomaly_type=anomaly_type,
                     severity=self.get_anomaly_severity(anomaly_type),
                     description=self.get_anomaly_description(anomaly_type),
+                    detected_at=now
                 )
                 
-                await self.anomalies.insert_one(anomaly.dict())
+                self._pending_anomalies.append(anomaly.dict())
+                if self.event_bus:
+                    self.event_bus.publish(DEVICE_ANOMALY, {
+                        "device_id": device_id,
+                        "owner_id": self.presence.owners.get(device_id) if self.presence else None,
+                        "anomaly_type": anomaly_type,
+                        "severity": anomaly.severity,
+                        "description": anomaly.description,
+                        "timestamp": now.isoformat()
+                    })
                 
                 # Log de l'anomalie
-                await self.log_device_activity(device_id, "anomaly_detected", {
-                    "anomaly_type": anomaly_type,
-                    "severity": anomaly.severity,
-                    "sensor_data": sensor_data
+                self._pending_anomaly_logs.append({
+                    "device_id": device_id,
+                    "activity_type": "anomaly_detected",
+                    "timestamp": now,
+                    "data": {
+                        "anomaly_type": anomaly_type,
+                        "severity": anomaly.severity,
+                        "sensor_data": sensor_data
+                    }
                 })
             
+            if len(self._pending_anomalies) >= self.anomaly_flush_size:
+                await self.flush_anomalies()
+            
             logger.warning(f"Anomalies enregistrées pour device {device_id}: {anomaly_types}")
             
         except Exception as e:
             logger.error(f"Erreur lors de l'enregistrement d'anomalie: {e}")
     
+    async def flush_anomalies(self):
+        """Insère les anomalies et logs en attente avec insert_many"""
+        if not self._pending_anomalies and not self._pending_anomaly_logs:
+            return
+        
+        anomalies, self._pending_anomalies = self._pending_anomalies, []
+        logs, self._pending_anomaly_logs = self._pending_anomaly_logs, []
+        try:
+            if anomalies:
+                await self.anomalies.insert_many(anomalies, ordered=False)
+            if logs:
+                await self.device_logs.insert_many(logs, ordered=False)
+        except Exception as e:
+            logger.error(f"Erreur lors de l'écriture des anomalies: {e}")
+    
+    async def _anomaly_flush_loop(self):
+        """Écrit périodiquement les anomalies en attente"""
+        while True:
+            try:
+                await asyncio.sleep(self.anomaly_flush_interval)
+                await self.flush_anomalies()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur flush anomalies: {e}")
+    
     def get_anomaly_severity(self, anomaly_type: str) -> str:
         """Détermine la sévérité d'une anomalie"""
+        rule = self.anomaly_rules.rule_metadata.get(anomaly_type)
+        if rule:
+            return rule.severity
         severity_map = {
             "heartbeat_frequency_high": "medium",
             "temperature_out_of_range": "high",
@@ -296,6 +538,9 @@ class DeviceService:
     
     def get_anomaly_description(self, anomaly_type: str) -> str:
         """Retourne la description d'une anomalie"""
+        rule = self.anomaly_rules.rule_metadata.get(anomaly_type)
+        if rule:
+            return rule.description
         descriptions = {
             "heartbeat_frequency_high": "Fréquence de heartbeat anormalement élevée",
             "temperature_out_of_range": "Température hors des limites normales",
@@ -368,14 +613,95 @@ class DeviceService:
             logger.error(f"Erreur lors de la récupération des métriques: {e}")
             return {}
     
-    async def get_offline_devices(self) -> List[Device]:
-        """Récupère les devices hors ligne"""
+    async def get_devices_metrics(self, device_ids: List[str]) -> Optional[Dict[str, Dict[str, Any]]]:
+        """Métriques de plusieurs devices en deux requêtes, quel que soit leur nombre
+        
+        Mêmes calculs que get_device_metrics (heartbeats parmi les 100 derniers
+        logs, anomalies totales), sans recent_activity. None si la lecture
+        échoue, pour ne pas présenter l'erreur comme des compteurs à zéro.
+        """
         try:
-            cutoff_time = datetime.utcnow() - timedelta(seconds=self.heartbeat_timeout)
+            if not device_ids:
+                return {}
             
-            cursor = self.devices.find({
-                "last_heartbeat": {"$lt": cutoff_time}
-            })
+            # Heartbeats parmi les 100 derniers logs de chaque device : la sous-requête
+            # bornée par device suit l'index (device_id, timestamp) au lieu de parcourir
+            # tout l'historique des logs
+            devices_data = await self.devices.aggregate([
+                {"$match": {"device_id": {"$in": device_ids}}},
+                {"$project": {"_id": 0, "device_id": 1, "created_at": 1, "last_heartbeat": 1, "firmware_hash": 1, "status": 1}},
+                {"$lookup": {
+                    "from": "device_logs",
+                    "let": {"device_id": "$device_id"},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$device_id", "$$device_id"]}}},
+                        {"$sort": {"timestamp": -1}},
+                        {"$limit": 100},
+                        {"$project": {"_id": 0, "activity_type": 1}}
+                    ],
+                    "as": "recent_logs"
+                }},
+                {"$addFields": {"heartbeats": {"$size": {"$filter": {
+                    "input": "$recent_logs",
+                    "as": "log",
+                    "cond": {"$eq": ["$$log.activity_type", "heartbeat_received"]}
+                }}}}},
+                {"$project": {"recent_logs": 0}}
+            ]).to_list(length=None)
+            heartbeats = {row["device_id"]: row["heartbeats"] for row in devices_data}
+            
+            anomaly_rows = await self.anomalies.aggregate([
+                {"$match": {"device_id": {"$in": device_ids}}},
+                {"$group": {"_id": "$device_id", "count": {"$sum": 1}}}
+            ]).to_list(length=None)
+            anomalies = {row["_id"]: row["count"] for row in anomaly_rows}
+            
+            now = datetime.utcnow()
+            metrics = {}
+            for device_data in devices_data:
+                device_id = device_data["device_id"]
+                uptime_hours = (now - device_data["created_at"]).total_seconds() / 3600
+                actual_heartbeats = heartbeats.get(device_id, 0)
+                metrics[device_id] = {
+                    "device_id": device_id,
+                    "uptime_hours": uptime_hours,
+                    "uptime_percentage": min(100, (actual_heartbeats / max(1, uptime_hours * 60)) * 100),
+                    "total_heartbeats": actual_heartbeats,
+                    "anomalies_detected": anomalies.get(device_id, 0),
+                    "last_heartbeat": device_data.get("last_heartbeat"),
+                    "firmware_hash": device_data.get("firmware_hash"),
+                    "status": device_data.get("status")
+                }
+            return metrics
+        
+        except Exception as e:
+            logger.error(f"Erreur lors de la récupération groupée des métriques: {e}")
+            return None
+    
+    async def get_offline_devices(self,
+                                  owner_id: Optional[str] = None,
+                                  skip: int = 0,
+                                  limit: Optional[int] = None) -> List[Device]:
+        """Récupère les devices hors ligne (tous, ou une page triée par device_id)"""
+        try:
+            if self.presence:
+                # Liste issue du registre de présence, lecture ciblée par device_id
+                offline_ids = self.presence.get_offline_device_ids(owner_id)
+                if limit is not None:
+                    offline_ids = sorted(offline_ids)[skip:skip + limit]
+                if not offline_ids:
+                    return []
+                cursor = self.devices.find({"device_id": {"$in": offline_ids}})
+            else:
+                cutoff_time = datetime.utcnow() - timedelta(seconds=self.heartbeat_timeout)
+                query = {"last_heartbeat": {"$lt": cutoff_time}}
+                if owner_id:
+                    query["owner_id"] = owner_id
+                cursor = self.devices.find(query)
+            if limit is not None:
+                cursor = cursor.sort("device_id", 1)
+                if not self.presence:
+                    cursor = cursor.skip(skip).limit(limit)
             
             devices_data = await cursor.to_list(length=None)
             
@@ -0,0 +1,86 @@
+"""
+Bus d'événements interne de QuantumShield
+Publication non bloquante (file bornée) par les services producteurs
+(présence des devices, blockchain, anomalies, tokens) et distribution par une
+tâche unique aux abonnés d'un topic (subscriptions GraphQL, webhooks...).
+"""
+
+import asyncio
+import logging
+from typing import Dict, Any, Awaitable, Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Topics publiés par les services
+DEVICE_STATUS = "device.status"
+BLOCK_MINED = "block.mined"
+DEVICE_ANOMALY = "device.anomaly"
+TOKEN_TRANSFER = "token.transfer"
+
+Listener = Callable[[str, Dict[str, Any]], Awaitable[Any]]
+
+
+class EventBus:
+    """Pub/sub en mémoire : publish() ne bloque jamais le producteur"""
+
+    def __init__(self, max_pending: int = 10000):
+        self.max_pending = max_pending
+        self._listeners: Dict[str, List[Listener]] = {}
+        self._queue: Optional["asyncio.Queue[Tuple[str, Dict[str, Any]]]"] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0, "listener_errors": 0}
+
+    def subscribe(self, topic: str, listener: Listener):
+        self._listeners.setdefault(topic, []).append(listener)
+
+    def unsubscribe(self, topic: str, listener: Listener):
+        listeners = self._listeners.get(topic, [])
+        if listener in listeners:
+            listeners.remove(listener)
+        if not listeners:
+            self._listeners.pop(topic, None)
+
+    def has_listeners(self, topic: str) -> bool:
+        return bool(self._listeners.get(topic))
+
+    def publish(self, topic: str, payload: Dict[str, Any]) -> bool:
+        """Met l'événement en file ; ignoré sans abonné, abandonné si la file est pleine"""
+        if not self._listeners.get(topic):
+            return False
+        if self._dispatcher is None or self._dispatcher.done():
+            self._start()
+        try:
+            self._queue.put_nowait((topic, payload))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["published"] += 1
+        return True
+
+    def _start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    async def _dispatch_loop(self):
+        while True:
+            topic, payload = await self._queue.get()
+            for listener in list(self._listeners.get(topic, ())):
+                try:
+                    await listener(topic, payload)
+                    self.stats["delivered"] += 1
+                except Exception as e:
+                    self.stats["listener_errors"] += 1
+                    logger.error(f"Erreur abonné du bus ({topic}): {e}")
+
+    async def stop(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "topics": {topic: len(listeners) for topic, listeners in self._listeners.items()},
+            "pending": self._queue.qsize() if self._queue else 0,
+            **self.stats
+        }
@@ -11,9 +11,23 @@ import math
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any, Tuple
 from enum import Enum
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("device_locations", [("device_id", 1), ("timestamp", -1)]),
+    IndexSpec("geofences", [("active", 1), ("device_ids", 1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe("device_locations", {"device_id": "probe"}, sort=[("timestamp", -1)], description="dernière position"),
+    QueryProbe(
+        "device_locations", {"device_id": "probe", "timestamp": {"$gte": 0}},
+        sort=[("timestamp", 1)], description="trajet d'un dispositif"
+    ),
+]
+
 class LocationStatus(str, Enum):
     ACTIVE = "active"
     OFFLINE = "offline"
@@ -0,0 +1,368 @@
+"""
+Couche d'exécution GraphQL de QuantumShield
+- cache LRU des documents analysés et validés (une analyse par texte de query) ;
+- requêtes persistées : le client envoie le hash SHA-256 au lieu du texte
+  (protocole « automatic persisted queries ») ;
+- analyse statique avant exécution : profondeur maximale et coût calculé à
+  partir de poids par champ et de multiplicateurs de liste (first/limit) ;
+  appliquée aussi aux subscriptions (graphql_subscription_service).
+"""
+
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from inspect import isawaitable
+from typing import Dict, Any, List, Optional, Tuple
+
+from graphql import (
+    DocumentNode, FieldNode, FragmentDefinitionNode, FragmentSpreadNode, GraphQLError,
+    GraphQLList, GraphQLNonNull, GraphQLObjectType, GraphQLSchema, InlineFragmentNode,
+    OperationDefinitionNode, OperationType, VariableNode, execute, get_operation_ast, parse, validate,
+    value_from_ast_untyped
+)
+
+from services.index_registry import IndexSpec
+
+logger = logging.getLogger(__name__)
+
+INDEXES = [
+    IndexSpec("graphql_persisted_queries", "sha256", unique=True),
+]
+
+# Taille de page par défaut et maximale des champs de liste paginés
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Multiplicateur d'une liste sans argument first/limit
+DEFAULT_LIST_SIZE = DEFAULT_PAGE_SIZE
+
+# Poids des champs coûteux ("Type.champ", noms GraphQL) ; 1 par défaut pour les objets, 0 pour les scalaires
+FIELD_WEIGHTS: Dict[str, int] = {
+    "Query.systemOverview": 2,
+    "Query.userPortfolio": 2,
+    "Query.deviceAnalytics": 2,
+    "SecurityOverviewType.anomalies24h": 5,
+    "PortfolioDevicesType.devicesByType": 3,
+    "UserPortfolioType.staking": 3,
+    "UserPortfolioType.netWorth": 3,
+    "DeviceAnalyticsType.security": 3,
+    "Query.offlineDevices": 5,
+    "DeviceType.uptimePercentage": 1,
+    "DeviceType.totalHeartbeats": 1,
+    "DeviceType.anomaliesCount": 1,
+    "UserType.totalDevices": 1,
+    "UserType.activeStakes": 1,
+}
+
+PAGE_ARGUMENTS = ("first", "limit")
+
+
+class QueryRejected(Exception):
+    """Query refusée avant exécution (coût, profondeur, requête persistée inconnue)"""
+
+    def __init__(self, message: str, code: str):
+        super().__init__(message)
+        self.code = code
+
+
+@dataclass
+class PreparedDocument:
+    """Document analysé et validé, réutilisable entre les requêtes"""
+    document: Optional[DocumentNode]
+    errors: List[GraphQLError] = field(default_factory=list)
+    hits: int = 0
+
+
+def query_hash(query: str) -> str:
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+class DocumentCache:
+    """LRU des documents analysés et validés, indexé par hash du texte"""
+
+    def __init__(self, schema: GraphQLSchema, max_size: int = 512):
+        self.schema = schema
+        self.max_size = max_size
+        self._documents: "OrderedDict[str, PreparedDocument]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, query: str, digest: Optional[str] = None) -> PreparedDocument:
+        digest = digest or query_hash(query)
+        prepared = self._documents.get(digest)
+        if prepared is not None:
+            self._documents.move_to_end(digest)
+            prepared.hits += 1
+            self.stats["hits"] += 1
+            return prepared
+
+        self.stats["misses"] += 1
+        try:
+            document = parse(query)
+            prepared = PreparedDocument(document, validate(self.schema, document))
+        except GraphQLError as error:
+            prepared = PreparedDocument(None, [error])
+
+        self._documents[digest] = prepared
+        if len(self._documents) > self.max_size:
+            self._documents.popitem(last=False)
+            self.stats["evictions"] += 1
+        return prepared
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+
+class PersistedQueryStore:
+    """Textes de query par hash : mémoire locale, partagés entre workers via MongoDB"""
+
+    def __init__(self, db, max_size: int = 5000):
+        self.collection = db.graphql_persisted_queries if db is not None else None
+        self.max_size = max_size
+        self._queries: "OrderedDict[str, str]" = OrderedDict()
+
+    async def get(self, digest: str) -> Optional[str]:
+        query = self._queries.get(digest)
+        if query is not None:
+            self._queries.move_to_end(digest)
+            return query
+        if self.collection is None:
+            return None
+        document = await self.collection.find_one({"sha256": digest}, {"_id": 0, "query": 1})
+        if document:
+            self._remember(digest, document["query"])
+            return document["query"]
+        return None
+
+    async def register(self, digest: str, query: str):
+        if query_hash(query) != digest:
+            raise QueryRejected("Hash de requête persistée invalide", "PERSISTED_QUERY_HASH_MISMATCH")
+        if digest in self._queries:
+            return
+        self._remember(digest, query)
+        if self.collection is not None:
+            await self.collection.update_one(
+                {"sha256": digest},
+                {"$setOnInsert": {"sha256": digest, "query": query, "created_at": datetime.utcnow()}},
+                upsert=True
+            )
+
+    def _remember(self, digest: str, query: str):
+        self._queries[digest] = query
+        if len(self._queries) > self.max_size:
+            self._queries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._queries)
+
+
+class QueryCostAnalyzer:
+    """Coût et profondeur statiques d'une opération, calculés sur l'AST"""
+
+    def __init__(self, schema: GraphQLSchema, weights: Optional[Dict[str, int]] = None,
+                 default_list_size: int = DEFAULT_LIST_SIZE, max_page_size: int = MAX_PAGE_SIZE):
+        self.schema = schema
+        self.weights = weights if weights is not None else FIELD_WEIGHTS
+        self.default_list_size = default_list_size
+        self.max_page_size = max_page_size
+
+    def analyze(self, document: DocumentNode, operation_name: Optional[str] = None,
+                variables: Optional[Dict[str, Any]] = None) -> Tuple[int, int]:
+        """Retourne (coût, profondeur) de l'opération exécutée"""
+        fragments = {
+            definition.name.value: definition
+            for definition in document.definitions
+            if isinstance(definition, FragmentDefinitionNode)
+        }
+        operations = [
+            definition for definition in document.definitions
+            if isinstance(definition, OperationDefinitionNode)
+        ]
+        if operation_name:
+            operations = [op for op in operations if op.name and op.name.value == operation_name]
+        if not operations:
+            return 0, 0
+
+        operation = operations[0]
+        root_type = self.schema.get_root_type(operation.operation)
+        if root_type is None:
+            return 0, 0
+        return self._selection_cost(operation.selection_set, root_type, fragments, variables or {}, 1, set())
+
+    def _page_size(self, node: FieldNode, variables: Dict[str, Any]) -> int:
+        for argument in node.arguments or []:
+            if argument.name.value in PAGE_ARGUMENTS:
+                if isinstance(argument.value, VariableNode):
+                    value = variables.get(argument.value.name.value)
+                else:
+                    value = value_from_ast_untyped(argument.value, variables)
+                if isinstance(value, int) and value > 0:
+                    return min(value, self.max_page_size)
+        return self.default_list_size
+
+    def _selection_cost(self, selection_set, parent_type: GraphQLObjectType, fragments: Dict[str, Any],
+                        variables: Dict[str, Any], depth: int, visited: set) -> Tuple[int, int]:
+        if selection_set is None:
+            return 0, depth - 1
+        cost, max_depth = 0, depth
+        for selection in selection_set.selections:
+            if isinstance(selection, FieldNode):
+                field_cost, field_depth = self._field_cost(selection, parent_type, fragments, variables, depth, visited)
+            elif isinstance(selection, InlineFragmentNode):
+                fragment_type = parent_type
+                if selection.type_condition:
+                    fragment_type = self.schema.get_type(selection.type_condition.name.value) or parent_type
+                field_cost, field_depth = self._selection_cost(
+                    selection.selection_set, fragment_type, fragments, variables, depth, visited
+                )
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                fragment = fragments.get(name)
+                if fragment is None or name in visited:
+                    continue
+                fragment_type = self.schema.get_type(fragment.type_condition.name.value) or parent_type
+                field_cost, field_depth = self._selection_cost(
+                    fragment.selection_set, fragment_type, fragments, variables, depth, visited | {name}
+                )
+            else:
+                continue
+            cost += field_cost
+            max_depth = max(max_depth, field_depth)
+        return cost, max_depth
+
+    def _field_cost(self, node: FieldNode, parent_type, fragments: Dict[str, Any],
+                    variables: Dict[str, Any], depth: int, visited: set) -> Tuple[int, int]:
+        name = node.name.value
+        # Introspection : ni coût ni profondeur (les outils GraphiQL l'utilisent)
+        if name.startswith("__"):
+            return 0, depth
+
+        field_definition = getattr(parent_type, "fields", {}).get(name)
+        if field_definition is None:
+            return 0, depth
+
+        field_type = field_definition.type
+        is_list = False
+        while isinstance(field_type, (GraphQLNonNull, GraphQLList)):
+            if isinstance(field_type, GraphQLList):
+                is_list = True
+            field_type = field_type.of_type
+
+        is_object = node.selection_set is not None
+        weight = self.weights.get(f"{parent_type.name}.{name}", 1 if is_object else 0)
+        if not is_object:
+            return weight, depth
+
+        child_cost, child_depth = self._selection_cost(
+            node.selection_set, field_type, fragments, variables, depth + 1, visited
+        )
+        multiplier = self._page_size(node, variables) if is_list else 1
+        return weight + multiplier * (1 + child_cost), child_depth
+
+
+class GraphQLExecutor:
+    """Exécution GraphQL avec cache de documents, requêtes persistées et budget de coût"""
+
+    def __init__(self, schema: GraphQLSchema, db=None, max_cost: int = 5000, max_depth: int = 8,
+                 document_cache_size: int = 512):
+        self.schema = schema
+        self.max_cost = max_cost
+        self.max_depth = max_depth
+        self.documents = DocumentCache(schema, document_cache_size)
+        self.persisted = PersistedQueryStore(db)
+        self.analyzer = QueryCostAnalyzer(schema)
+        self.stats = {"executed": 0, "rejected": 0, "persisted_hits": 0}
+
+    async def resolve_query_text(self, query: Optional[str],
+                                 extensions: Optional[Dict[str, Any]]) -> Tuple[str, str, bool]:
+        """Texte et hash de la query (requête persistée ou texte fourni), et s'il faut
+        l'enregistrer comme requête persistée une fois validée"""
+        persisted = (extensions or {}).get("persistedQuery")
+        if persisted:
+            digest = persisted.get("sha256Hash")
+            if not digest:
+                raise QueryRejected("Hash de requête persistée manquant", "PERSISTED_QUERY_INVALID")
+            if query:
+                if query_hash(query) != digest:
+                    raise QueryRejected("Hash de requête persistée invalide", "PERSISTED_QUERY_HASH_MISMATCH")
+                return query, digest, True
+            stored = await self.persisted.get(digest)
+            if stored is None:
+                raise QueryRejected("PersistedQueryNotFound", "PERSISTED_QUERY_NOT_FOUND")
+            self.stats["persisted_hits"] += 1
+            return stored, digest, False
+
+        if not query:
+            raise QueryRejected("Query manquante", "QUERY_MISSING")
+        return query, query_hash(query), False
+
+    async def prepare(self,
+                      query: Optional[str],
+                      variables: Optional[Dict[str, Any]] = None,
+                      operation_name: Optional[str] = None,
+                      extensions: Optional[Dict[str, Any]] = None) -> Tuple[PreparedDocument, str, int, int]:
+        """Document validé, hash, coût et profondeur ; QueryRejected si les limites sont dépassées"""
+        text, digest, register = await self.resolve_query_text(query, extensions)
+        prepared = self.documents.get(text, digest)
+        if prepared.errors:
+            return prepared, digest, 0, 0
+
+        cost, depth = self.analyzer.analyze(prepared.document, operation_name, variables)
+        if depth > self.max_depth:
+            raise QueryRejected(f"Profondeur {depth} supérieure à la limite {self.max_depth}", "QUERY_TOO_DEEP")
+        if cost > self.max_cost:
+            raise QueryRejected(f"Coût estimé {cost} supérieur au budget {self.max_cost}", "QUERY_TOO_COSTLY")
+        # Seuls les documents valides et dans les limites deviennent des requêtes persistées
+        if register:
+            await self.persisted.register(digest, text)
+        return prepared, digest, cost, depth
+
+    @staticmethod
+    def operation_type(prepared: PreparedDocument, operation_name: Optional[str] = None) -> Optional[OperationType]:
+        operation = get_operation_ast(prepared.document, operation_name)
+        return operation.operation if operation else None
+
+    async def execute(self,
+                      query: Optional[str],
+                      variables: Optional[Dict[str, Any]] = None,
+                      operation_name: Optional[str] = None,
+                      extensions: Optional[Dict[str, Any]] = None,
+                      context: Any = None) -> Dict[str, Any]:
+        """Exécute une opération ; les refus sont rendus comme des erreurs GraphQL"""
+        try:
+            prepared, _, cost, depth = await self.prepare(query, variables, operation_name, extensions)
+            if prepared.errors:
+                return {"data": None, "errors": [error.message for error in prepared.errors]}
+            if self.operation_type(prepared, operation_name) == OperationType.SUBSCRIPTION:
+                raise QueryRejected("Les subscriptions passent par le WebSocket /graphql/ws", "SUBSCRIPTION_OVER_HTTP")
+
+            result = execute(
+                self.schema,
+                prepared.document,
+                context_value=context,
+                variable_values=variables,
+                operation_name=operation_name
+            )
+            if isawaitable(result):
+                result = await result
+            self.stats["executed"] += 1
+            return {
+                "data": result.data,
+                "errors": [str(error) for error in result.errors] if result.errors else None,
+                "extensions": {"cost": cost, "depth": depth}
+            }
+
+        except QueryRejected as e:
+            self.stats["rejected"] += 1
+            return {"data": None, "errors": [str(e)], "extensions": {"code": e.code}}
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "max_cost": self.max_cost,
+            "max_depth": self.max_depth,
+            "cached_documents": len(self.documents),
+            "persisted_queries": len(self.persisted),
+            "document_cache": dict(self.documents.stats),
+            **self.stats
+        }
@@ -0,0 +1,49 @@
+"""
+DataLoaders GraphQL de QuantumShield
+Un jeu de loaders par requête GraphQL : les champs calculés (métriques des
+devices, compteurs des utilisateurs) demandés pendant une même exécution sont
+regroupés en requêtes $in / $group au lieu d'une requête par élément de liste.
+"""
+
+import logging
+from typing import Dict, Any, List
+
+from graphene.utils.dataloader import DataLoader
+from graphql import GraphQLError
+
+logger = logging.getLogger(__name__)
+
+
+class GraphQLLoaders:
+    """Loaders d'une exécution GraphQL (cache limité à la requête)"""
+
+    def __init__(self, db, device_service=None):
+        self.db = db
+        self.device_service = device_service
+        self.device_metrics = DataLoader(batch_load_fn=self._load_device_metrics)
+        self.user_device_counts = DataLoader(batch_load_fn=self._load_user_device_counts)
+        self.user_active_stakes = DataLoader(batch_load_fn=self._load_user_active_stakes)
+
+    async def _load_device_metrics(self, device_ids: List[str]) -> List[Dict[str, Any]]:
+        if not self.device_service:
+            return [{} for _ in device_ids]
+        metrics = await self.device_service.get_devices_metrics(list(device_ids))
+        if metrics is None:
+            # Erreur GraphQL sur les champs concernés plutôt que des métriques à zéro
+            raise GraphQLError("Métriques des devices indisponibles")
+        return [metrics.get(device_id, {}) for device_id in device_ids]
+
+    async def _count_by(self, collection, field: str, keys: List[str], extra: Dict[str, Any] = None) -> List[int]:
+        match = {field: {"$in": list(keys)}, **(extra or {})}
+        rows = await collection.aggregate([
+            {"$match": match},
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}}
+        ]).to_list(length=None)
+        counts = {row["_id"]: row["count"] for row in rows}
+        return [counts.get(key, 0) for key in keys]
+
+    async def _load_user_device_counts(self, user_ids: List[str]) -> List[int]:
+        return await self._count_by(self.db.devices, "owner_id", user_ids)
+
+    async def _load_user_active_stakes(self, user_ids: List[str]) -> List[int]:
+        return await self._count_by(self.db.staking_positions, "user_id", user_ids, {"active": True})
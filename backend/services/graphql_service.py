@@ -7,8 +7,16 @@ import graphene
 from graphene import ObjectType, String, Int, Float, Boolean, List, Field, Mutation, Schema, DateTime
 from typing import Dict, Any, Optional, List as ListType
 import logging
+import os
 from datetime import datetime, timedelta
-import json
+
+from graphql_relay import offset_to_cursor, cursor_to_offset
+
+from services.graphql_execution import GraphQLExecutor, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from services.graphql_loaders import GraphQLLoaders
+from services.graphql_subscription_service import GraphQLSubscriptionManager, Subscription
+from services.event_bus_service import EventBus
+from services.stats_cache_service import StatsCache
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +26,7 @@ logger = logging.getLogger(__name__)
 
 class DeviceType(ObjectType):
     """Type GraphQL pour les devices"""
+    cursor = String()
     device_id = String()
     device_name = String()
     device_type = String()
@@ -31,9 +40,23 @@ class DeviceType(ObjectType):
     uptime_percentage = Float()
     total_heartbeats = Int()
     anomalies_count = Int()
+    
+    # Métriques calculées seulement si demandées, regroupées par le DataLoader de la requête
+    async def resolve_uptime_percentage(parent, info):
+        metrics = await info.context["loaders"].device_metrics.load(parent.device_id)
+        return metrics.get("uptime_percentage", 0)
+    
+    async def resolve_total_heartbeats(parent, info):
+        metrics = await info.context["loaders"].device_metrics.load(parent.device_id)
+        return metrics.get("total_heartbeats", 0)
+    
+    async def resolve_anomalies_count(parent, info):
+        metrics = await info.context["loaders"].device_metrics.load(parent.device_id)
+        return metrics.get("anomalies_detected", 0)
 
 class UserType(ObjectType):
     """Type GraphQL pour les utilisateurs"""
+    cursor = String()
     id = String()
     username = String()
     email = String()
@@ -43,6 +66,12 @@ class UserType(ObjectType):
     total_devices = Int()
     active_stakes = Int()
     total_earned = Float()
+    
+    async def resolve_total_devices(parent, info):
+        return await info.context["loaders"].user_device_counts.load(parent.id)
+    
+    async def resolve_active_stakes(parent, info):
+        return await info.context["loaders"].user_active_stakes.load(parent.id)
 
 class TransactionType(ObjectType):
     """Type GraphQL pour les transactions blockchain"""
@@ -57,6 +86,7 @@ class TransactionType(ObjectType):
 
 class ServiceType(ObjectType):
     """Type GraphQL pour les services marketplace"""
+    cursor = String()
     service_id = String()
     name = String()
     description = String()
@@ -70,103 +100,278 @@ class ServiceType(ObjectType):
     provider = String()
     created_at = DateTime()
 
+# ==============================
+# Agrégats typés : chaque champ est calculé seulement s'il est demandé,
+# à partir du cache de statistiques partagé (GraphQLService.stats_cache)
+# ==============================
+
+class DevicesOverviewType(ObjectType):
+    total_devices = Int()
+    active_devices = Int()
+    offline_devices = Int()
+    uptime_percentage = Float()
+    
+    async def resolve_total_devices(parent, info):
+        return await info.context["graphql_service"]._stat_total_devices()
+    
+    async def resolve_active_devices(parent, info):
+        return await info.context["graphql_service"]._stat_active_devices()
+    
+    async def resolve_offline_devices(parent, info):
+        service = info.context["graphql_service"]
+        return max(0, await service._stat_total_devices() - await service._stat_active_devices())
+    
+    async def resolve_uptime_percentage(parent, info):
+        service = info.context["graphql_service"]
+        total_devices = await service._stat_total_devices()
+        return (await service._stat_active_devices() / total_devices * 100) if total_devices > 0 else 0
+
+class UsersOverviewType(ObjectType):
+    total_users = Int()
+    
+    async def resolve_total_users(parent, info):
+        return await info.context["graphql_service"]._stat_total_users()
+
+class SecurityOverviewType(ObjectType):
+    anomalies_24h = Int()
+    
+    async def resolve_anomalies_24h(parent, info):
+        return await info.context["graphql_service"]._stat_recent_anomalies()
+
+class SystemOverviewType(ObjectType):
+    """Vue d'ensemble du système"""
+    devices = Field(DevicesOverviewType)
+    users = Field(UsersOverviewType)
+    security = Field(SecurityOverviewType)
+    
+    def resolve_devices(parent, info):
+        return DevicesOverviewType()
+    
+    def resolve_users(parent, info):
+        return UsersOverviewType()
+    
+    def resolve_security(parent, info):
+        return SecurityOverviewType()
+
+class DeviceTypeCountType(ObjectType):
+    device_type = String()
+    count = Int()
+
+class PortfolioDevicesType(ObjectType):
+    user_id = String()
+    total_devices = Int()
+    devices_by_type = List(DeviceTypeCountType)
+    
+    async def resolve_total_devices(parent, info):
+        return await info.context["loaders"].user_device_counts.load(parent.user_id)
+    
+    async def resolve_devices_by_type(parent, info):
+        counts = await info.context["graphql_service"]._stat_user_devices_by_type(parent.user_id)
+        return [DeviceTypeCountType(device_type=device_type, count=count) for device_type, count in counts.items()]
+
+class StakingSummaryType(ObjectType):
+    total_staked = Float()
+    total_rewards = Float()
+    active_positions = Int()
+
+class UserPortfolioType(ObjectType):
+    """Portfolio d'un utilisateur"""
+    user_id = String()
+    user_info = Field(UserType)
+    devices = Field(PortfolioDevicesType)
+    staking = Field(StakingSummaryType)
+    net_worth = Float()
+    
+    def resolve_devices(parent, info):
+        return PortfolioDevicesType(user_id=parent.user_id)
+    
+    async def resolve_staking(parent, info):
+        summary = await info.context["graphql_service"]._stat_user_staking(parent.user_id)
+        return StakingSummaryType(**summary)
+    
+    async def resolve_net_worth(parent, info):
+        summary = await info.context["graphql_service"]._stat_user_staking(parent.user_id)
+        return (parent.user_info.qs_balance or 0) + summary["total_staked"] + summary["total_rewards"]
+
+class DevicePerformanceType(ObjectType):
+    device_id = String()
+    uptime_percentage = Float()
+    total_heartbeats = Int()
+    uptime_hours = Float()
+    
+    async def resolve_uptime_percentage(parent, info):
+        metrics = await info.context["loaders"].device_metrics.load(parent.device_id)
+        return metrics.get("uptime_percentage", 0)
+    
+    async def resolve_total_heartbeats(parent, info):
+        metrics = await info.context["loaders"].device_metrics.load(parent.device_id)
+        return metrics.get("total_heartbeats", 0)
+    
+    async def resolve_uptime_hours(parent, info):
+        metrics = await info.context["loaders"].device_metrics.load(parent.device_id)
+        return metrics.get("uptime_hours", 0)
+
+class DeviceSecurityType(ObjectType):
+    anomalies_count = Int()
+    last_anomaly = DateTime()
+    anomaly_types = List(String)
+
+class DeviceAnalyticsType(ObjectType):
+    """Analytique d'un device"""
+    device_id = String()
+    device_info = Field(DeviceType)
+    performance = Field(DevicePerformanceType)
+    security = Field(DeviceSecurityType)
+    
+    def resolve_performance(parent, info):
+        return DevicePerformanceType(device_id=parent.device_id)
+    
+    async def resolve_security(parent, info):
+        summary = await info.context["graphql_service"]._stat_device_anomalies(parent.device_id)
+        return DeviceSecurityType(**summary)
+
 class Query(ObjectType):
     """Queries GraphQL principales"""
     
+    # Listes paginées : first (taille de page) et after (cursor du dernier élément reçu)
+    
     # Device queries
     device = Field(DeviceType, device_id=String(required=True))
-    devices_by_user = List(DeviceType, user_id=String(required=True))
-    devices_by_type = List(DeviceType, device_type=String(required=True))
-    offline_devices = List(DeviceType)
+    devices_by_user = List(DeviceType, user_id=String(required=True), first=Int(), after=String())
+    devices_by_type = List(DeviceType, device_type=String(required=True), first=Int(), after=String())
+    offline_devices = List(DeviceType, first=Int(), after=String())
     
     # User queries
     user = Field(UserType, user_id=String(required=True))
-    users_by_reputation = List(UserType, min_reputation=Float())
-    top_token_holders = List(UserType, limit=Int())
+    users_by_reputation = List(UserType, min_reputation=Float(), first=Int(), after=String())
+    top_token_holders = List(UserType, limit=Int(), first=Int(), after=String())
     
     # Marketplace queries
     service = Field(ServiceType, service_id=String(required=True))
-    services_by_category = List(ServiceType, category=String(required=True))
-    popular_services = List(ServiceType, limit=Int())
+    services_by_category = List(ServiceType, category=String(required=True), first=Int(), after=String())
+    popular_services = List(ServiceType, limit=Int(), first=Int(), after=String())
     
     # Complex aggregation queries
-    system_overview = Field(String)
-    user_portfolio = Field(String, user_id=String(required=True))
-    device_analytics = Field(String, device_id=String(required=True))
+    system_overview = Field(SystemOverviewType)
+    user_portfolio = Field(UserPortfolioType, user_id=String(required=True))
+    device_analytics = Field(DeviceAnalyticsType, device_id=String(required=True))
+    
+    # Les resolvers délèguent au GraphQLService de la requête (info.context)
+    async def resolve_device(root, info, device_id):
+        return await info.context["graphql_service"]._resolve_device(device_id)
+    
+    async def resolve_devices_by_user(root, info, user_id, first=None, after=None):
+        return await info.context["graphql_service"]._resolve_devices_by_user(user_id, first, after)
+    
+    async def resolve_devices_by_type(root, info, device_type, first=None, after=None):
+        return await info.context["graphql_service"]._resolve_devices_by_type(device_type, first, after)
+    
+    async def resolve_offline_devices(root, info, first=None, after=None):
+        return await info.context["graphql_service"]._resolve_offline_devices(first, after)
+    
+    async def resolve_user(root, info, user_id):
+        return await info.context["graphql_service"]._resolve_user(user_id)
+    
+    async def resolve_users_by_reputation(root, info, min_reputation=None, first=None, after=None):
+        return await info.context["graphql_service"]._resolve_users_by_reputation(min_reputation, first, after)
+    
+    async def resolve_top_token_holders(root, info, limit=None, first=None, after=None):
+        return await info.context["graphql_service"]._resolve_top_token_holders(limit, first, after)
+    
+    async def resolve_service(root, info, service_id):
+        return await info.context["graphql_service"]._resolve_service(service_id)
+    
+    async def resolve_services_by_category(root, info, category, first=None, after=None):
+        return await info.context["graphql_service"]._resolve_services_by_category(category, first, after)
+    
+    async def resolve_popular_services(root, info, limit=None, first=None, after=None):
+        return await info.context["graphql_service"]._resolve_popular_services(limit, first, after)
+    
+    def resolve_system_overview(root, info):
+        return SystemOverviewType()
+    
+    async def resolve_user_portfolio(root, info, user_id):
+        return await info.context["graphql_service"]._resolve_user_portfolio(user_id)
+    
+    async def resolve_device_analytics(root, info, device_id):
+        return await info.context["graphql_service"]._resolve_device_analytics(device_id)
 
 class GraphQLService:
     """Service GraphQL pour QuantumShield"""
     
-    def __init__(self, db, services_dict):
+    def __init__(self, db, services_dict, event_bus=None, stats_cache=None):
         self.db = db
         self.services = services_dict
-        self.schema = Schema(query=Query)
-        
-        # Enregistrer les resolvers
-        self._register_resolvers()
+        # Statistiques agrégées partagées entre les requêtes (durée de vie courte)
+        self.stats_cache = stats_cache or StatsCache()
+        self.schema = Schema(query=Query, subscription=Subscription)
+        # Cache de documents, requêtes persistées, limites de coût et de profondeur
+        self.executor = GraphQLExecutor(
+            self.schema.graphql_schema,
+            db,
+            max_cost=int(os.environ.get("GRAPHQL_MAX_COST", "5000")),
+            max_depth=int(os.environ.get("GRAPHQL_MAX_DEPTH", "8")),
+            document_cache_size=int(os.environ.get("GRAPHQL_DOCUMENT_CACHE_SIZE", "512"))
+        )
+        # Subscriptions WebSocket alimentées par le bus d'événements des services
+        self.subscriptions = GraphQLSubscriptionManager(
+            self.schema.graphql_schema,
+            self.executor,
+            event_bus or EventBus(),
+            context_factory=self.build_context
+        )
         
         logger.info("Service GraphQL initialisé")
     
-    def _register_resolvers(self):
-        """Enregistre les resolvers GraphQL"""
-        
-        # Device resolvers
-        async def resolve_device(root, info, device_id):
-            return await self._resolve_device(device_id)
-        
-        async def resolve_devices_by_user(root, info, user_id):
-            return await self._resolve_devices_by_user(user_id)
-        
-        async def resolve_devices_by_type(root, info, device_type):
-            return await self._resolve_devices_by_type(device_type)
-        
-        async def resolve_offline_devices(root, info):
-            return await self._resolve_offline_devices()
-        
-        # User resolvers
-        async def resolve_user(root, info, user_id):
-            return await self._resolve_user(user_id)
-        
-        async def resolve_users_by_reputation(root, info, min_reputation=None):
-            return await self._resolve_users_by_reputation(min_reputation)
-        
-        async def resolve_top_token_holders(root, info, limit=None):
-            return await self._resolve_top_token_holders(limit)
-        
-        # Service resolvers
-        async def resolve_service(root, info, service_id):
-            return await self._resolve_service(service_id)
-        
-        async def resolve_services_by_category(root, info, category):
-            return await self._resolve_services_by_category(category)
-        
-        async def resolve_popular_services(root, info, limit=None):
-            return await self._resolve_popular_services(limit)
-        
-        # Complex resolvers
-        async def resolve_system_overview(root, info):
-            return await self._resolve_system_overview()
-        
-        async def resolve_user_portfolio(root, info, user_id):
-            return await self._resolve_user_portfolio(user_id)
-        
-        async def resolve_device_analytics(root, info, device_id):
-            return await self._resolve_device_analytics(device_id)
-        
-        # Assigner les resolvers
-        Query.device = resolve_device
-        Query.devices_by_user = resolve_devices_by_user
-        Query.devices_by_type = resolve_devices_by_type
-        Query.offline_devices = resolve_offline_devices
-        Query.user = resolve_user
-        Query.users_by_reputation = resolve_users_by_reputation
-        Query.top_token_holders = resolve_top_token_holders
-        Query.service = resolve_service
-        Query.services_by_category = resolve_services_by_category
-        Query.popular_services = resolve_popular_services
-        Query.system_overview = resolve_system_overview
-        Query.user_portfolio = resolve_user_portfolio
-        Query.device_analytics = resolve_device_analytics
+    def build_context(self) -> Dict[str, Any]:
+        """Contexte d'une exécution : service et DataLoaders propres à la requête"""
+        return {
+            "graphql_service": self,
+            "loaders": GraphQLLoaders(self.db, self.services.get('device_service'))
+        }
+    
+    @staticmethod
+    def _page(first: Optional[int], after: Optional[str], default: int = DEFAULT_PAGE_SIZE) -> tuple:
+        """(skip, limit) d'une page : after est le cursor du dernier élément déjà reçu"""
+        limit = max(1, min(first or default, MAX_PAGE_SIZE))
+        offset = cursor_to_offset(after) if after else None
+        return (offset + 1 if offset is not None else 0), limit
+    
+    @staticmethod
+    def _with_cursors(items: list, skip: int) -> list:
+        for position, item in enumerate(items):
+            item.cursor = offset_to_cursor(skip + position)
+        return items
+    
+    @staticmethod
+    def _device_type(device) -> DeviceType:
+        """DeviceType depuis un modèle Device ou un document (métriques résolues à la demande)"""
+        data = device if isinstance(device, dict) else device.dict()
+        return DeviceType(
+            device_id=data["device_id"],
+            device_name=data["device_name"],
+            device_type=data["device_type"],
+            owner_id=data["owner_id"],
+            status=getattr(data["status"], "value", data["status"]),
+            last_heartbeat=data.get("last_heartbeat"),
+            firmware_hash=data["firmware_hash"],
+            location=data.get("location"),
+            capabilities=data.get("capabilities", []),
+            created_at=data["created_at"]
+        )
+    
+    @staticmethod
+    def _user_type(user_data: Dict[str, Any]) -> UserType:
+        """UserType depuis un document (compteurs résolus à la demande)"""
+        return UserType(
+            id=user_data["id"],
+            username=user_data["username"],
+            email=user_data.get("email"),
+            qs_balance=user_data.get("qs_balance", 0),
+            created_at=user_data["created_at"],
+            reputation_score=user_data.get("reputation_score", 0),
+            total_earned=user_data.get("total_earned", 0)
+        )
     
     # ==============================
     # Resolvers pour les devices
@@ -183,129 +388,53 @@ class GraphQLService:
             if not device:
                 return None
             
-            # Enrichir avec des métriques
-            metrics = await device_service.get_device_metrics(device_id)
-            
-            return DeviceType(
-                device_id=device.device_id,
-                device_name=device.device_name,
-                device_type=device.device_type,
-                owner_id=device.owner_id,
-                status=device.status,
-                last_heartbeat=device.last_heartbeat,
-                firmware_hash=device.firmware_hash,
-                location=device.location,
-                capabilities=device.capabilities,
-                created_at=device.created_at,
-                uptime_percentage=metrics.get("uptime_percentage", 0),
-                total_heartbeats=metrics.get("total_heartbeats", 0),
-                anomalies_count=metrics.get("anomalies_detected", 0)
-            )
+            return self._device_type(device)
             
         except Exception as e:
             logger.error(f"Erreur resolve_device: {e}")
             return None
     
-    async def _resolve_devices_by_user(self, user_id: str) -> ListType[DeviceType]:
+    async def _resolve_devices_by_user(self, user_id: str, first: Optional[int] = None,
+                                       after: Optional[str] = None) -> ListType[DeviceType]:
         """Résout une query pour les devices d'un utilisateur"""
         try:
             device_service = self.services.get('device_service')
             if not device_service:
                 return []
-                
-            devices = await device_service.get_user_devices(user_id)
             
-            result = []
-            for device in devices:
-                metrics = await device_service.get_device_metrics(device.device_id)
-                
-                result.append(DeviceType(
-                    device_id=device.device_id,
-                    device_name=device.device_name,
-                    device_type=device.device_type,
-                    owner_id=device.owner_id,
-                    status=device.status,
-                    last_heartbeat=device.last_heartbeat,
-                    firmware_hash=device.firmware_hash,
-                    location=device.location,
-                    capabilities=device.capabilities,
-                    created_at=device.created_at,
-                    uptime_percentage=metrics.get("uptime_percentage", 0),
-                    total_heartbeats=metrics.get("total_heartbeats", 0),
-                    anomalies_count=metrics.get("anomalies_detected", 0)
-                ))
-            
-            return result
+            skip, limit = self._page(first, after)
+            devices = await device_service.get_user_devices(user_id, skip=skip, limit=limit)
+            return self._with_cursors([self._device_type(device) for device in devices], skip)
             
         except Exception as e:
             logger.error(f"Erreur resolve_devices_by_user: {e}")
             return []
     
-    async def _resolve_devices_by_type(self, device_type: str) -> ListType[DeviceType]:
+    async def _resolve_devices_by_type(self, device_type: str, first: Optional[int] = None,
+                                       after: Optional[str] = None) -> ListType[DeviceType]:
         """Résout une query pour les devices d'un type spécifique"""
         try:
-            device_service = self.services.get('device_service')
-            if not device_service:
-                return []
-                
-            devices_data = await self.db.devices.find({"device_type": device_type}).to_list(None)
-            
-            result = []
-            for device_data in devices_data:
-                metrics = await device_service.get_device_metrics(device_data["device_id"])
-                
-                result.append(DeviceType(
-                    device_id=device_data["device_id"],
-                    device_name=device_data["device_name"],
-                    device_type=device_data["device_type"],
-                    owner_id=device_data["owner_id"],
-                    status=device_data["status"],
-                    last_heartbeat=device_data.get("last_heartbeat"),
-                    firmware_hash=device_data["firmware_hash"],
-                    location=device_data.get("location"),
-                    capabilities=device_data.get("capabilities", []),
-                    created_at=device_data["created_at"],
-                    uptime_percentage=metrics.get("uptime_percentage", 0),
-                    total_heartbeats=metrics.get("total_heartbeats", 0),
-                    anomalies_count=metrics.get("anomalies_detected", 0)
-                ))
-            
-            return result
+            skip, limit = self._page(first, after)
+            devices_data = await self.db.devices.find({"device_type": device_type}).sort(
+                "device_id", 1
+            ).skip(skip).limit(limit).to_list(None)
+            return self._with_cursors([self._device_type(device_data) for device_data in devices_data], skip)
             
         except Exception as e:
             logger.error(f"Erreur resolve_devices_by_type: {e}")
             return []
     
-    async def _resolve_offline_devices(self) -> ListType[DeviceType]:
+    async def _resolve_offline_devices(self, first: Optional[int] = None,
+                                       after: Optional[str] = None) -> ListType[DeviceType]:
         """Résout une query pour les devices hors ligne"""
         try:
             device_service = self.services.get('device_service')
             if not device_service:
                 return []
-                
-            devices = await device_service.get_offline_devices()
-            
-            result = []
-            for device in devices:
-                metrics = await device_service.get_device_metrics(device.device_id)
-                
-                result.append(DeviceType(
-                    device_id=device.device_id,
-                    device_name=device.device_name,
-                    device_type=device.device_type,
-                    owner_id=device.owner_id,
-                    status=device.status,
-                    last_heartbeat=device.last_heartbeat,
-                    firmware_hash=device.firmware_hash,
-                    location=device.location,
-                    capabilities=device.capabilities,
-                    created_at=device.created_at,
-                    uptime_percentage=metrics.get("uptime_percentage", 0),
-                    total_heartbeats=metrics.get("total_heartbeats", 0),
-                    anomalies_count=metrics.get("anomalies_detected", 0)
-                ))
             
-            return result
+            skip, limit = self._page(first, after)
+            devices = await device_service.get_offline_devices(skip=skip, limit=limit)
+            return self._with_cursors([self._device_type(device) for device in devices], skip)
             
         except Exception as e:
             logger.error(f"Erreur resolve_offline_devices: {e}")
@@ -318,82 +447,35 @@ class GraphQLService:
             if not user_data:
                 return None
             
-            # Enrichir avec des statistiques
-            device_count = await self.db.devices.count_documents({"owner_id": user_id})
-            active_stakes = await self.db.staking_positions.count_documents({"user_id": user_id, "active": True})
-            
-            return UserType(
-                id=user_data["id"],
-                username=user_data["username"],
-                email=user_data.get("email"),
-                qs_balance=user_data.get("qs_balance", 0),
-                created_at=user_data["created_at"],
-                reputation_score=user_data.get("reputation_score", 0),
-                total_devices=device_count,
-                active_stakes=active_stakes,
-                total_earned=user_data.get("total_earned", 0)
-            )
+            return self._user_type(user_data)
             
         except Exception as e:
             logger.error(f"Erreur resolve_user: {e}")
             return None
     
-    async def _resolve_users_by_reputation(self, min_reputation: Optional[float] = None) -> ListType[UserType]:
+    async def _resolve_users_by_reputation(self, min_reputation: Optional[float] = None, first: Optional[int] = None,
+                                           after: Optional[str] = None) -> ListType[UserType]:
         """Résout une query pour les utilisateurs par réputation"""
         try:
             query = {}
             if min_reputation is not None:
                 query["reputation_score"] = {"$gte": min_reputation}
             
-            users_data = await self.db.users.find(query).sort("reputation_score", -1).limit(50).to_list(None)
-            
-            result = []
-            for user_data in users_data:
-                device_count = await self.db.devices.count_documents({"owner_id": user_data["id"]})
-                active_stakes = await self.db.staking_positions.count_documents({"user_id": user_data["id"], "active": True})
-                
-                result.append(UserType(
-                    id=user_data["id"],
-                    username=user_data["username"],
-                    email=user_data.get("email"),
-                    qs_balance=user_data.get("qs_balance", 0),
-                    created_at=user_data["created_at"],
-                    reputation_score=user_data.get("reputation_score", 0),
-                    total_devices=device_count,
-                    active_stakes=active_stakes,
-                    total_earned=user_data.get("total_earned", 0)
-                ))
-            
-            return result
+            skip, limit = self._page(first, after)
+            users_data = await self.db.users.find(query).sort("reputation_score", -1).skip(skip).limit(limit).to_list(None)
+            return self._with_cursors([self._user_type(user_data) for user_data in users_data], skip)
             
         except Exception as e:
             logger.error(f"Erreur resolve_users_by_reputation: {e}")
             return []
     
-    async def _resolve_top_token_holders(self, limit: Optional[int] = None) -> ListType[UserType]:
+    async def _resolve_top_token_holders(self, limit: Optional[int] = None, first: Optional[int] = None,
+                                         after: Optional[str] = None) -> ListType[UserType]:
         """Résout une query pour les top holders de tokens"""
         try:
-            limit = limit or 20
-            users_data = await self.db.users.find({}).sort("qs_balance", -1).limit(limit).to_list(None)
-            
-            result = []
-            for user_data in users_data:
-                device_count = await self.db.devices.count_documents({"owner_id": user_data["id"]})
-                active_stakes = await self.db.staking_positions.count_documents({"user_id": user_data["id"], "active": True})
-                
-                result.append(UserType(
-                    id=user_data["id"],
-                    username=user_data["username"],
-                    email=user_data.get("email"),
-                    qs_balance=user_data.get("qs_balance", 0),
-                    created_at=user_data["created_at"],
-                    reputation_score=user_data.get("reputation_score", 0),
-                    total_devices=device_count,
-                    active_stakes=active_stakes,
-                    total_earned=user_data.get("total_earned", 0)
-                ))
-            
-            return result
+            skip, limit = self._page(first or limit, after, default=20)
+            users_data = await self.db.users.find({}).sort("qs_balance", -1).skip(skip).limit(limit).to_list(None)
+            return self._with_cursors([self._user_type(user_data) for user_data in users_data], skip)
             
         except Exception as e:
             logger.error(f"Erreur resolve_top_token_holders: {e}")
@@ -425,10 +507,14 @@ class GraphQLService:
             logger.error(f"Erreur resolve_service: {e}")
             return None
     
-    async def _resolve_services_by_category(self, category: str) -> ListType[ServiceType]:
+    async def _resolve_services_by_category(self, category: str, first: Optional[int] = None,
+                                            after: Optional[str] = None) -> ListType[ServiceType]:
         """Résout une query pour les services par catégorie"""
         try:
-            services_data = await self.db.marketplace_services.find({"category": category}).to_list(None)
+            skip, limit = self._page(first, after)
+            services_data = await self.db.marketplace_services.find({"category": category}).sort(
+                "service_id", 1
+            ).skip(skip).limit(limit).to_list(None)
             
             result = []
             for service_data in services_data:
@@ -447,17 +533,18 @@ class GraphQLService:
                     created_at=service_data["created_at"]
                 ))
             
-            return result
+            return self._with_cursors(result, skip)
             
         except Exception as e:
             logger.error(f"Erreur resolve_services_by_category: {e}")
             return []
     
-    async def _resolve_popular_services(self, limit: Optional[int] = None) -> ListType[ServiceType]:
+    async def _resolve_popular_services(self, limit: Optional[int] = None, first: Optional[int] = None,
+                                        after: Optional[str] = None) -> ListType[ServiceType]:
         """Résout une query pour les services populaires"""
         try:
-            limit = limit or 10
-            services_data = await self.db.marketplace_services.find({}).sort("downloads", -1).limit(limit).to_list(None)
+            skip, limit = self._page(first or limit, after, default=10)
+            services_data = await self.db.marketplace_services.find({}).sort("downloads", -1).skip(skip).limit(limit).to_list(None)
             
             result = []
             for service_data in services_data:
@@ -476,7 +563,7 @@ class GraphQLService:
                     created_at=service_data["created_at"]
                 ))
             
-            return result
+            return self._with_cursors(result, skip)
             
         except Exception as e:
             logger.error(f"Erreur resolve_popular_services: {e}")
@@ -486,156 +573,128 @@ class GraphQLService:
     # Resolvers complexes
     # ==============================
     
-    async def _resolve_system_overview(self) -> str:
-        """Résout une query pour un overview du système"""
-        try:
-            # Statistiques des devices
-            total_devices = await self.db.devices.count_documents({})
-            active_devices = await self.db.devices.count_documents({
-                "last_heartbeat": {"$gte": datetime.utcnow() - timedelta(minutes=5)}
-            })
-            
-            # Statistiques des utilisateurs
-            total_users = await self.db.users.count_documents({})
-            
-            # Statistiques des anomalies
-            recent_anomalies = await self.db.anomalies.count_documents({
-                "timestamp": {"$gte": datetime.utcnow() - timedelta(hours=24)}
-            })
-            
-            overview = {
-                "devices": {
-                    "total_devices": total_devices,
-                    "active_devices": active_devices,
-                    "offline_devices": total_devices - active_devices,
-                    "uptime_percentage": (active_devices / total_devices * 100) if total_devices > 0 else 0
-                },
-                "users": {
-                    "total_users": total_users
-                },
-                "security": {
-                    "anomalies_24h": recent_anomalies
-                }
-            }
-            
-            return json.dumps(overview, default=str)
-            
-        except Exception as e:
-            logger.error(f"Erreur resolve_system_overview: {e}")
-            return json.dumps({"error": str(e)})
-    
-    async def _resolve_user_portfolio(self, user_id: str) -> str:
-        """Résout une query pour le portfolio d'un utilisateur"""
+    async def _resolve_user_portfolio(self, user_id: str) -> Optional[UserPortfolioType]:
+        """Résout une query pour le portfolio d'un utilisateur (agrégats calculés à la demande)"""
         try:
-            # Récupérer les données utilisateur
             user_data = await self.db.users.find_one({"id": user_id})
             if not user_data:
-                return json.dumps({"error": "Utilisateur non trouvé"})
-            
-            # Devices de l'utilisateur
-            device_service = self.services.get('device_service')
-            user_devices = []
-            if device_service:
-                user_devices = await device_service.get_user_devices(user_id)
-            
-            # Positions de staking
-            staking_positions = await self.db.staking_positions.find({"user_id": user_id, "active": True}).to_list(None)
-            
-            # Calcul du portefeuille
-            total_staked = sum(pos.get("amount", 0) for pos in staking_positions)
-            total_rewards = sum(pos.get("rewards_earned", 0) for pos in staking_positions)
-            
-            portfolio = {
-                "user_info": {
-                    "id": user_data["id"],
-                    "username": user_data["username"],
-                    "qs_balance": user_data.get("qs_balance", 0),
-                    "reputation_score": user_data.get("reputation_score", 0)
-                },
-                "devices": {
-                    "total_devices": len(user_devices),
-                    "devices_by_type": {}
-                },
-                "staking": {
-                    "total_staked": total_staked,
-                    "total_rewards": total_rewards,
-                    "active_positions": len(staking_positions)
-                },
-                "net_worth": user_data.get("qs_balance", 0) + total_staked + total_rewards
-            }
-            
-            # Grouper devices par type
-            for device in user_devices:
-                device_type = device.device_type
-                if device_type not in portfolio["devices"]["devices_by_type"]:
-                    portfolio["devices"]["devices_by_type"][device_type] = 0
-                portfolio["devices"]["devices_by_type"][device_type] += 1
-            
-            return json.dumps(portfolio, default=str)
+                return None
+            return UserPortfolioType(user_id=user_id, user_info=self._user_type(user_data))
             
         except Exception as e:
             logger.error(f"Erreur resolve_user_portfolio: {e}")
-            return json.dumps({"error": str(e)})
+            return None
     
-    async def _resolve_device_analytics(self, device_id: str) -> str:
-        """Résout une query pour l'analytique d'un device"""
+    async def _resolve_device_analytics(self, device_id: str) -> Optional[DeviceAnalyticsType]:
+        """Résout une query pour l'analytique d'un device (agrégats calculés à la demande)"""
         try:
             device_service = self.services.get('device_service')
             if not device_service:
-                return json.dumps({"error": "Service device non disponible"})
+                return None
             
-            # Récupérer le device
             device = await device_service.get_device(device_id)
             if not device:
-                return json.dumps({"error": "Device non trouvé"})
-            
-            # Métriques du device
-            metrics = await device_service.get_device_metrics(device_id)
-            
-            # Anomalies récentes
-            recent_anomalies = await self.db.anomalies.find({
-                "device_id": device_id,
-                "timestamp": {"$gte": datetime.utcnow() - timedelta(days=7)}
-            }).sort("timestamp", -1).to_list(None)
-            
-            analytics = {
-                "device_info": {
-                    "device_id": device.device_id,
-                    "device_name": device.device_name,
-                    "device_type": device.device_type,
-                    "status": device.status,
-                    "firmware_hash": device.firmware_hash
-                },
-                "performance": {
-                    "uptime_percentage": metrics.get("uptime_percentage", 0),
-                    "total_heartbeats": metrics.get("total_heartbeats", 0),
-                    "uptime_hours": metrics.get("uptime_hours", 0)
-                },
-                "security": {
-                    "anomalies_count": len(recent_anomalies),
-                    "last_anomaly": recent_anomalies[0]["timestamp"] if recent_anomalies else None,
-                    "anomaly_types": list(set([a["anomaly_type"] for a in recent_anomalies]))
-                }
-            }
-            
-            return json.dumps(analytics, default=str)
+                return None
+            return DeviceAnalyticsType(device_id=device_id, device_info=self._device_type(device))
             
         except Exception as e:
             logger.error(f"Erreur resolve_device_analytics: {e}")
-            return json.dumps({"error": str(e)})
+            return None
+    
+    # ==============================
+    # Statistiques agrégées (cache partagé)
+    # ==============================
+    
+    def _presence(self):
+        device_service = self.services.get('device_service')
+        presence = getattr(device_service, "presence", None) if device_service else None
+        return presence if presence and presence.is_ready() else None
+    
+    async def _stat_total_devices(self) -> int:
+        return await self.stats_cache.get("system:total_devices", self.db.devices.estimated_document_count)
+    
+    async def _stat_active_devices(self) -> int:
+        # Registre de présence en mémoire : compteur O(1), sans requête
+        presence = self._presence()
+        if presence:
+            return len(presence.online)
+        return await self.stats_cache.get("system:active_devices", lambda: self.db.devices.count_documents({
+            "last_heartbeat": {"$gte": datetime.utcnow() - timedelta(minutes=5)}
+        }))
+    
+    async def _stat_total_users(self) -> int:
+        return await self.stats_cache.get("system:total_users", self.db.users.estimated_document_count)
+    
+    async def _stat_recent_anomalies(self) -> int:
+        return await self.stats_cache.get("system:anomalies_24h", lambda: self.db.anomalies.count_documents({
+            "timestamp": {"$gte": datetime.utcnow() - timedelta(hours=24)}
+        }))
+    
+    async def _stat_user_devices_by_type(self, user_id: str) -> Dict[str, int]:
+        async def compute():
+            rows = await self.db.devices.aggregate([
+                {"$match": {"owner_id": user_id}},
+                {"$group": {"_id": "$device_type", "count": {"$sum": 1}}}
+            ]).to_list(length=None)
+            return {row["_id"]: row["count"] for row in rows}
+        return await self.stats_cache.get(f"user:{user_id}:devices_by_type", compute)
+    
+    async def _stat_user_staking(self, user_id: str) -> Dict[str, Any]:
+        async def compute():
+            rows = await self.db.staking_positions.aggregate([
+                {"$match": {"user_id": user_id, "active": True}},
+                {"$group": {
+                    "_id": None,
+                    "total_staked": {"$sum": "$amount"},
+                    "total_rewards": {"$sum": "$rewards_earned"},
+                    "active_positions": {"$sum": 1}
+                }}
+            ]).to_list(length=None)
+            row = rows[0] if rows else {}
+            return {
+                "total_staked": row.get("total_staked", 0),
+                "total_rewards": row.get("total_rewards", 0),
+                "active_positions": row.get("active_positions", 0)
+            }
+        return await self.stats_cache.get(f"user:{user_id}:staking", compute)
+    
+    async def _stat_device_anomalies(self, device_id: str) -> Dict[str, Any]:
+        async def compute():
+            rows = await self.db.anomalies.aggregate([
+                {"$match": {"device_id": device_id, "timestamp": {"$gte": datetime.utcnow() - timedelta(days=7)}}},
+                {"$group": {
+                    "_id": None,
+                    "anomalies_count": {"$sum": 1},
+                    "last_anomaly": {"$max": "$timestamp"},
+                    "anomaly_types": {"$addToSet": "$anomaly_type"}
+                }}
+            ]).to_list(length=None)
+            row = rows[0] if rows else {}
+            return {
+                "anomalies_count": row.get("anomalies_count", 0),
+                "last_anomaly": row.get("last_anomaly"),
+                "anomaly_types": row.get("anomaly_types", [])
+            }
+        return await self.stats_cache.get(f"device:{device_id}:anomalies_7d", compute)
     
     def get_schema(self) -> Schema:
         """Retourne le schema GraphQL"""
         return self.schema
     
-    async def execute_query(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
-        """Exécute une query GraphQL"""
+    async def execute_query(self,
+                            query: Optional[str],
+                            variables: Optional[Dict[str, Any]] = None,
+                            operation_name: Optional[str] = None,
+                            extensions: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Exécute une query GraphQL (texte ou hash de requête persistée dans extensions)"""
         try:
-            result = await self.schema.execute_async(query, variable_values=variables)
-            return {
-                "data": result.data,
-                "errors": [str(error) for error in result.errors] if result.errors else None
-            }
+            return await self.executor.execute(
+                query,
+                variables=variables,
+                operation_name=operation_name,
+                extensions=extensions,
+                context=self.build_context()
+            )
         except Exception as e:
             logger.error(f"Erreur exécution query GraphQL: {e}")
             return {
@@ -0,0 +1,398 @@
+"""
+Subscriptions GraphQL de QuantumShield (WebSocket, protocole graphql-transport-ws)
+Les événements du bus interne (présence, blocs, anomalies, transferts) sont
+diffusés aux abonnés regroupés par sélection : pour un même document, une même
+opération et les mêmes variables, l'événement est filtré, exécuté et sérialisé
+une seule fois, puis la trame est préfixée de l'id de chaque abonné.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from inspect import isawaitable
+from typing import Dict, Any, Optional, Set, Tuple
+
+from graphene import ObjectType, String, Int, Float, Field
+from graphql import FieldNode, OperationType, execute, get_operation_ast
+from graphql.execution.values import get_argument_values
+
+from services.event_bus_service import DEVICE_STATUS, BLOCK_MINED, DEVICE_ANOMALY, TOKEN_TRANSFER
+from services.graphql_execution import QueryRejected
+
+logger = logging.getLogger(__name__)
+
+PROTOCOL = "graphql-transport-ws"
+
+# Codes de fermeture du protocole graphql-transport-ws
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_INIT_TIMEOUT = 4408
+CLOSE_DUPLICATE_SUBSCRIBER = 4409
+CLOSE_TOO_MANY_INIT = 4429
+CLOSE_BAD_MESSAGE = 4400
+
+
+class DeviceStatusEvent(ObjectType):
+    device_id = String()
+    owner_id = String()
+    status = String()
+    timestamp = String()
+
+
+class BlockEvent(ObjectType):
+    block_number = Int()
+    block_hash = String()
+    previous_hash = String()
+    miner_address = String()
+    transactions_count = Int()
+    difficulty = Int()
+    timestamp = String()
+
+
+class AnomalyEvent(ObjectType):
+    device_id = String()
+    owner_id = String()
+    anomaly_type = String()
+    severity = String()
+    description = String()
+    timestamp = String()
+
+
+class TokenTransferEvent(ObjectType):
+    transaction_id = String()
+    from_user = String()
+    to_user = String()
+    amount = Float()
+    transaction_type = String()
+    timestamp = String()
+
+
+def resolve_event(root, info, **filters):
+    """L'événement est passé en root_value, indexé par le nom du champ racine"""
+    return root[info.field_name]
+
+
+class Subscription(ObjectType):
+    device_status_changed = Field(DeviceStatusEvent, device_id=String(), owner_id=String(), resolver=resolve_event)
+    block_mined = Field(BlockEvent, miner_address=String(), resolver=resolve_event)
+    anomaly_detected = Field(AnomalyEvent, device_id=String(), owner_id=String(), severity=String(),
+                             resolver=resolve_event)
+    token_transferred = Field(TokenTransferEvent, user_id=String(), resolver=resolve_event)
+
+
+# Champ racine -> topic du bus
+SUBSCRIPTION_TOPICS = {
+    "deviceStatusChanged": DEVICE_STATUS,
+    "blockMined": BLOCK_MINED,
+    "anomalyDetected": DEVICE_ANOMALY,
+    "tokenTransferred": TOKEN_TRANSFER,
+}
+
+# Argument de filtrage -> champs de l'événement acceptés (un seul doit correspondre)
+FILTER_FIELDS = {
+    "device_id": ("device_id",),
+    "owner_id": ("owner_id",),
+    "severity": ("severity",),
+    "miner_address": ("miner_address",),
+    "user_id": ("from_user", "to_user"),
+}
+
+
+def event_matches(filters: Dict[str, Any], event: Dict[str, Any]) -> bool:
+    for argument, expected in filters.items():
+        if expected is None:
+            continue
+        if not any(event.get(name) == expected for name in FILTER_FIELDS.get(argument, (argument,))):
+            return False
+    return True
+
+
+@dataclass
+class SubscriptionGroup:
+    """Abonnés partageant document, opération et variables : une exécution par événement"""
+    key: Tuple[str, Optional[str], str]
+    document: Any
+    operation_name: Optional[str]
+    variables: Dict[str, Any]
+    field_name: str
+    topic: str
+    filters: Dict[str, Any]
+    subscribers: Dict[Tuple[int, str], "SubscriptionConnection"] = field(default_factory=dict)
+
+
+class SubscriptionConnection:
+    """État d'une connexion graphql-transport-ws"""
+
+    __slots__ = (
+        "websocket", "acknowledged", "init_received", "subscriptions",
+        "send_queue", "writer_task", "dropped_messages", "connected_at"
+    )
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.acknowledged = False
+        self.init_received = False
+        # id de l'abonnement -> clé du groupe
+        self.subscriptions: Dict[str, Tuple] = {}
+        self.send_queue: Optional[deque] = None
+        self.writer_task: Optional[asyncio.Task] = None
+        self.dropped_messages = 0
+        self.connected_at = time.time()
+
+
+class GraphQLSubscriptionManager:
+    """Abonnements GraphQL alimentés par le bus d'événements"""
+
+    def __init__(self, schema, executor, event_bus, context_factory=None, send_queue_size: int = 256,
+                 max_dropped_before_close: int = 1024, init_timeout: float = 10):
+        self.schema = schema
+        self.executor = executor
+        self.event_bus = event_bus
+        # Contexte des queries et mutations envoyées sur le WebSocket
+        self.context_factory = context_factory
+        self.send_queue_size = send_queue_size
+        self.max_dropped_before_close = max_dropped_before_close
+        self.init_timeout = init_timeout
+        self.connections: Set[SubscriptionConnection] = set()
+        self.groups: Dict[Tuple, SubscriptionGroup] = {}
+        self.groups_by_topic: Dict[str, Set[Tuple]] = {}
+        self.stats = {
+            "events_received": 0,
+            "executions": 0,
+            "messages_sent": 0,
+            "messages_dropped": 0,
+            "subscriptions_started": 0,
+        }
+
+    # ====================
+    # Connexions
+    # ====================
+
+    def register_connection(self, websocket) -> SubscriptionConnection:
+        connection = SubscriptionConnection(websocket)
+        self.connections.add(connection)
+        return connection
+
+    def unregister_connection(self, connection: SubscriptionConnection):
+        for subscription_id in list(connection.subscriptions):
+            self._remove_subscriber(connection, subscription_id)
+        self.connections.discard(connection)
+
+    async def wait_for_init(self, connection: SubscriptionConnection):
+        """Ferme la connexion si connection_init n'arrive pas à temps"""
+        await asyncio.sleep(self.init_timeout)
+        if not connection.init_received:
+            await self._close(connection, CLOSE_INIT_TIMEOUT, "Connection initialisation timeout")
+
+    async def _close(self, connection: SubscriptionConnection, code: int, reason: str = ""):
+        try:
+            await connection.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    async def handle_message(self, connection: SubscriptionConnection, data: str):
+        """Traite une trame cliente du protocole graphql-transport-ws"""
+        try:
+            message = json.loads(data)
+            message_type = message["type"]
+        except (ValueError, TypeError, KeyError):
+            await self._close(connection, CLOSE_BAD_MESSAGE, "Invalid message received")
+            return
+
+        if message_type == "connection_init":
+            if connection.init_received:
+                await self._close(connection, CLOSE_TOO_MANY_INIT, "Too many initialisation requests")
+                return
+            connection.init_received = True
+            connection.acknowledged = True
+            self._send(connection, {"type": "connection_ack"})
+        elif message_type == "ping":
+            self._send(connection, {"type": "pong"})
+        elif message_type == "pong":
+            pass
+        elif message_type == "subscribe":
+            if not connection.acknowledged:
+                await self._close(connection, CLOSE_UNAUTHORIZED, "Unauthorized")
+                return
+            subscription_id = message.get("id")
+            if not isinstance(subscription_id, str) or not subscription_id:
+                await self._close(connection, CLOSE_BAD_MESSAGE, "Invalid message received")
+                return
+            if subscription_id in connection.subscriptions:
+                await self._close(connection, CLOSE_DUPLICATE_SUBSCRIBER, f"Subscriber for {subscription_id} already exists")
+                return
+            await self._subscribe(connection, subscription_id, message.get("payload") or {})
+        elif message_type == "complete":
+            self._remove_subscriber(connection, message.get("id"))
+        else:
+            await self._close(connection, CLOSE_BAD_MESSAGE, "Invalid message received")
+
+    # ====================
+    # Abonnements
+    # ====================
+
+    async def _subscribe(self, connection: SubscriptionConnection, subscription_id: str, payload: Dict[str, Any]):
+        variables = payload.get("variables") or {}
+        operation_name = payload.get("operationName")
+        try:
+            prepared, digest, _, _ = await self.executor.prepare(
+                payload.get("query"), variables, operation_name, payload.get("extensions")
+            )
+        except QueryRejected as e:
+            self._send_error(connection, subscription_id, str(e), e.code)
+            return
+        if prepared.errors:
+            self._send(connection, {
+                "id": subscription_id,
+                "type": "error",
+                "payload": [{"message": error.message} for error in prepared.errors]
+            })
+            return
+
+        operation = get_operation_ast(prepared.document, operation_name)
+        if operation is None:
+            self._send_error(connection, subscription_id, "Opération introuvable", "OPERATION_NOT_FOUND")
+            return
+
+        # Query ou mutation sur le WebSocket : résultat unique puis complete
+        if operation.operation != OperationType.SUBSCRIPTION:
+            result = await self.executor.execute(
+                payload.get("query"), variables, operation_name, payload.get("extensions"),
+                context=self.context_factory() if self.context_factory else None
+            )
+            self._send(connection, {"id": subscription_id, "type": "next", "payload": result})
+            self._send(connection, {"id": subscription_id, "type": "complete"})
+            return
+
+        # Une subscription n'a qu'un champ racine (règle de validation SingleFieldSubscriptions)
+        root_field = next(node for node in operation.selection_set.selections if isinstance(node, FieldNode))
+        field_name = root_field.name.value
+        field_definition = self.schema.subscription_type.fields[field_name]
+        try:
+            filters = get_argument_values(field_definition, root_field, variables)
+        except Exception as e:
+            self._send_error(connection, subscription_id, str(e), "BAD_USER_INPUT")
+            return
+
+        key = (digest, operation_name, json.dumps(variables, sort_keys=True, default=str))
+        group = self.groups.get(key)
+        if group is None:
+            topic = SUBSCRIPTION_TOPICS[field_name]
+            group = SubscriptionGroup(key, prepared.document, operation_name, variables, field_name, topic, filters)
+            self.groups[key] = group
+            topic_groups = self.groups_by_topic.setdefault(topic, set())
+            if not topic_groups:
+                self.event_bus.subscribe(topic, self._on_event)
+            topic_groups.add(key)
+
+        group.subscribers[(id(connection), subscription_id)] = connection
+        connection.subscriptions[subscription_id] = key
+        self.stats["subscriptions_started"] += 1
+
+    def _remove_subscriber(self, connection: SubscriptionConnection, subscription_id: Optional[str]):
+        key = connection.subscriptions.pop(subscription_id, None)
+        group = self.groups.get(key) if key else None
+        if group is None:
+            return
+        group.subscribers.pop((id(connection), subscription_id), None)
+        if group.subscribers:
+            return
+        del self.groups[key]
+        topic_groups = self.groups_by_topic.get(group.topic, set())
+        topic_groups.discard(key)
+        if not topic_groups:
+            self.groups_by_topic.pop(group.topic, None)
+            self.event_bus.unsubscribe(group.topic, self._on_event)
+
+    # ====================
+    # Diffusion
+    # ====================
+
+    async def _on_event(self, topic: str, event: Dict[str, Any]):
+        self.stats["events_received"] += 1
+        for key in list(self.groups_by_topic.get(topic, ())):
+            group = self.groups.get(key)
+            if group is None or not event_matches(group.filters, event):
+                continue
+            body = await self._execute_group(group, event)
+            if body is None:
+                continue
+            for (_, subscription_id), connection in list(group.subscribers.items()):
+                self._enqueue(connection, '{"id":' + json.dumps(subscription_id) + ',"type":"next","payload":' + body + '}')
+
+    async def _execute_group(self, group: SubscriptionGroup, event: Dict[str, Any]) -> Optional[str]:
+        """Exécute la sélection du groupe sur l'événement et retourne le payload sérialisé"""
+        try:
+            result = execute(
+                self.schema,
+                group.document,
+                root_value={group.field_name: event},
+                variable_values=group.variables,
+                operation_name=group.operation_name
+            )
+            if isawaitable(result):
+                result = await result
+            self.stats["executions"] += 1
+            payload = {"data": result.data}
+            if result.errors:
+                payload["errors"] = [{"message": str(error)} for error in result.errors]
+            return json.dumps(payload, default=str)
+        except Exception as e:
+            logger.error(f"Erreur exécution subscription GraphQL: {e}")
+            return None
+
+    def _send(self, connection: SubscriptionConnection, message: Dict[str, Any]) -> bool:
+        return self._enqueue(connection, json.dumps(message, default=str))
+
+    def _send_error(self, connection: SubscriptionConnection, subscription_id: str, message: str, code: str):
+        self._send(connection, {
+            "id": subscription_id,
+            "type": "error",
+            "payload": [{"message": message, "extensions": {"code": code}}]
+        })
+
+    def _enqueue(self, connection: SubscriptionConnection, frame: str) -> bool:
+        """Ajoute une trame à la file bornée d'une connexion"""
+        if connection.send_queue is None:
+            connection.send_queue = deque()
+
+        if len(connection.send_queue) >= self.send_queue_size:
+            connection.dropped_messages += 1
+            self.stats["messages_dropped"] += 1
+            if connection.dropped_messages == self.max_dropped_before_close:
+                logger.warning("Client de subscriptions GraphQL trop lent, fermeture de la connexion")
+                asyncio.create_task(self._close(connection, 1008, "Client too slow"))
+            return False
+
+        connection.send_queue.append(frame)
+        if connection.writer_task is None or connection.writer_task.done():
+            connection.writer_task = asyncio.create_task(self._drain_queue(connection))
+        return True
+
+    async def _drain_queue(self, connection: SubscriptionConnection):
+        """Vide la file d'envoi puis libère la tâche et la file"""
+        try:
+            while connection.send_queue:
+                frame = connection.send_queue.popleft()
+                await connection.websocket.send_text(frame)
+                self.stats["messages_sent"] += 1
+            connection.send_queue = None
+        except Exception as e:
+            logger.debug(f"Envoi interrompu vers un client de subscriptions: {str(e)}")
+            connection.send_queue = None
+
+    async def stop(self):
+        for connection in list(self.connections):
+            await self._close(connection, 1001)
+            self.unregister_connection(connection)
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "connections": len(self.connections),
+            "groups": len(self.groups),
+            "subscribers": sum(len(group.subscribers) for group in self.groups.values()),
+            "topics": {topic: len(keys) for topic, keys in self.groups_by_topic.items()},
+            **self.stats
+        }
@@ -12,9 +12,19 @@ from typing import Dict, Any, List, Optional
 from datetime import datetime
 from enum import Enum
 import logging
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("hsm_keys", [("user_id", 1), ("key_id", 1)]),
+    IndexSpec("hsm_operations", "user_id"),
+]
+
+QUERY_PROBES = [
+    QueryProbe("hsm_keys", {"key_id": "probe", "user_id": "probe"}, description="clé HSM d'un utilisateur"),
+]
+
 class HSMType(str, Enum):
     THALES = "thales"
     UTIMACO = "utimaco"
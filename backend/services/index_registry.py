@@ -0,0 +1,220 @@
+"""
+Registre des index MongoDB de QuantumShield
+Chaque module de service déclare ses index (INDEXES) et ses requêtes
+représentatives (QUERY_PROBES) ; le registre applique les index de façon
+idempotente au démarrage et vérifie par explain() qu'aucune requête
+représentative ne parcourt toute une collection
+"""
+
+import asyncio
+import importlib
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Sequence, Tuple, Union
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# Codes MongoDB : index existant avec d'autres options / même nom mais autres clés
+INDEX_CONFLICT_CODES = {85, 86}
+
+IndexKeys = Union[str, Sequence[Tuple[str, int]]]
+
+
+@dataclass
+class IndexSpec:
+    """Déclaration d'un index (simple, composé, unique, TTL ou partiel)"""
+    collection: str
+    keys: IndexKeys
+    unique: bool = False
+    ttl_seconds: Optional[int] = None
+    partial: Optional[Dict[str, Any]] = None
+    sparse: bool = False
+    name: Optional[str] = None
+
+    @property
+    def key_list(self) -> List[Tuple[str, int]]:
+        return [(self.keys, 1)] if isinstance(self.keys, str) else list(self.keys)
+
+    @property
+    def index_name(self) -> str:
+        return self.name or "_".join(f"{key}_{direction}" for key, direction in self.key_list)
+
+    def to_model(self) -> IndexModel:
+        options: Dict[str, Any] = {"name": self.index_name}
+        if self.unique:
+            options["unique"] = True
+        if self.ttl_seconds is not None:
+            options["expireAfterSeconds"] = self.ttl_seconds
+        if self.partial:
+            options["partialFilterExpression"] = self.partial
+        if self.sparse:
+            options["sparse"] = True
+        return IndexModel(self.key_list, **options)
+
+
+@dataclass
+class QueryProbe:
+    """Requête représentative d'un service, vérifiée par explain()"""
+    collection: str
+    filter: Dict[str, Any]
+    sort: Optional[List[Tuple[str, int]]] = None
+    description: str = ""
+    owner: str = field(default="", compare=False)
+
+
+def _plan_stages(plan: Dict[str, Any]) -> List[str]:
+    """Étapes d'un plan d'exécution (inputStage / inputStages, queryPlan en 7.x+)"""
+    stages = []
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        if not isinstance(node, dict):
+            continue
+        if "stage" in node:
+            stages.append(node["stage"])
+        if "queryPlan" in node:
+            pending.append(node["queryPlan"])
+        if "inputStage" in node:
+            pending.append(node["inputStage"])
+        pending.extend(node.get("inputStages", []))
+    return stages
+
+
+class IndexRegistry:
+    """Collecte les déclarations des services, applique les index et audite les plans"""
+
+    def __init__(self, db):
+        self.db = db
+        self.indexes: Dict[str, List[IndexSpec]] = {}
+        self.probes: List[QueryProbe] = []
+        self.owners: Dict[str, str] = {}
+        self.is_initialized = True
+
+    def is_ready(self) -> bool:
+        """Vérifie si le service est prêt"""
+        return self.is_initialized
+
+    def declare(self, owner: str, indexes: Sequence[IndexSpec] = (), probes: Sequence[QueryProbe] = ()):
+        """Ajoute les index et requêtes d'un service (un index déclaré deux fois n'est gardé qu'une fois)"""
+        for spec in indexes:
+            declared = self.indexes.setdefault(spec.collection, [])
+            if all(existing.index_name != spec.index_name for existing in declared):
+                declared.append(spec)
+                self.owners[f"{spec.collection}.{spec.index_name}"] = owner
+        for probe in probes:
+            probe.owner = owner
+            self.probes.append(probe)
+
+    def declare_module(self, module_name: str):
+        """Lit INDEXES et QUERY_PROBES d'un module de service (sans construire le service)"""
+        module = self._import(module_name)
+        if module is not None:
+            self._declare_from(module_name, module)
+
+    async def declare_modules(self, module_names: Sequence[str]):
+        """Comme declare_module, mais les imports (coûteux au premier chargement) sont
+        faits dans un thread pour ne pas bloquer la boucle d'événements"""
+        loop = asyncio.get_running_loop()
+        modules = await loop.run_in_executor(
+            None, lambda: [(name, self._import(name)) for name in module_names]
+        )
+        for module_name, module in modules:
+            if module is not None:
+                self._declare_from(module_name, module)
+
+    @staticmethod
+    def _import(module_name: str):
+        try:
+            return importlib.import_module(module_name)
+        except Exception as e:
+            logger.error(f"Erreur import de {module_name} pour ses index: {e}")
+            return None
+
+    def _declare_from(self, module_name: str, module):
+        self.declare(
+            module_name.rsplit(".", 1)[-1],
+            getattr(module, "INDEXES", ()),
+            getattr(module, "QUERY_PROBES", ())
+        )
+
+    async def apply(self) -> Dict[str, Any]:
+        """Crée les index déclarés ; sans effet si déjà présents avec les mêmes options"""
+        created, conflicts = 0, []
+        for collection, specs in self.indexes.items():
+            try:
+                await self.db[collection].create_indexes([spec.to_model() for spec in specs])
+                created += len(specs)
+            except OperationFailure as e:
+                # Un index du lot est refusé (conflit, options invalides...) : on crée les autres un par un
+                logger.warning(f"Création groupée des index de {collection} refusée, création index par index: {e}")
+                for spec in specs:
+                    try:
+                        await self.db[collection].create_indexes([spec.to_model()])
+                        created += 1
+                    except OperationFailure as failure:
+                        if failure.code in INDEX_CONFLICT_CODES:
+                            conflicts.append(f"{collection}.{spec.index_name}")
+                            logger.error(f"Index {collection}.{spec.index_name} en conflit avec l'existant: {failure}")
+                        else:
+                            logger.error(f"Erreur création de l'index {collection}.{spec.index_name}: {failure}")
+            except Exception as e:
+                logger.error(f"Erreur création des index de {collection}: {e}")
+
+        logger.info(f"{created} index MongoDB vérifiés sur {len(self.indexes)} collections")
+        return {"indexes": created, "collections": len(self.indexes), "conflicts": conflicts}
+
+    async def explain(self, probe: QueryProbe) -> Dict[str, Any]:
+        """Plan retenu par MongoDB pour une requête représentative"""
+        command: Dict[str, Any] = {"find": probe.collection, "filter": probe.filter}
+        if probe.sort:
+            command["sort"] = dict(probe.sort)
+        result = await self.db.command({"explain": command, "verbosity": "queryPlanner"})
+        winning_plan = result.get("queryPlanner", {}).get("winningPlan", {})
+        stages = _plan_stages(winning_plan)
+        return {
+            "owner": probe.owner,
+            "collection": probe.collection,
+            "description": probe.description,
+            "filter": probe.filter,
+            "stages": stages,
+            "collection_scan": "COLLSCAN" in stages,
+            "in_memory_sort": "SORT" in stages
+        }
+
+    async def audit(self) -> Dict[str, Any]:
+        """Passe toutes les requêtes déclarées à explain() et signale les parcours de collection"""
+        reports = []
+        for probe in self.probes:
+            try:
+                reports.append(await self.explain(probe))
+            except Exception as e:
+                reports.append({
+                    "owner": probe.owner,
+                    "collection": probe.collection,
+                    "description": probe.description,
+                    "error": str(e)
+                })
+        return {
+            "probes": len(reports),
+            "collection_scans": [report for report in reports if report.get("collection_scan")],
+            "in_memory_sorts": [report for report in reports if report.get("in_memory_sort")],
+            "errors": [report for report in reports if "error" in report],
+            "reports": reports
+        }
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "collections": len(self.indexes),
+            "indexes": sum(len(specs) for specs in self.indexes.values()),
+            "probes": len(self.probes)
+        }
+
+
+async def apply_indexes(db, indexes: Sequence[IndexSpec]):
+    """Applique directement une liste d'index (services hors registre, tests)"""
+    registry = IndexRegistry(db)
+    registry.declare("direct", indexes)
+    return await registry.apply()
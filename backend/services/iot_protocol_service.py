@@ -5,7 +5,6 @@ Support pour MQTT, CoAP, LoRaWAN et autres protocoles IoT
 
 import asyncio
 import logging
-import json
 import uuid
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any, Union
@@ -27,6 +26,8 @@ except ImportError:
     WEBSOCKETS_AVAILABLE = False
     logging.warning("websockets not available, WebSocket support limited")
 
+from services.payload_codec_service import PayloadCodecService, COAP_CONTENT_FORMATS
+
 logger = logging.getLogger(__name__)
 
 class IoTProtocol(str, Enum):
@@ -55,14 +56,16 @@ class QoSLevel(int, Enum):
 class IoTProtocolService:
     """Service de gestion des protocoles IoT avancés"""
     
-    def __init__(self, db):
+    def __init__(self, db, presence_service=None):
         self.db = db
+        self.presence = presence_service
         self.mqtt_client = None
         self.coap_server = None
         self.lorawan_gateway = None
         self.connected_devices = {}
         self.message_handlers = {}
         self.protocol_configs = {}
+        self.payload_codecs = PayloadCodecService(db)
         self.is_initialized = False
         self._initialize()
     
@@ -105,9 +108,10 @@ class IoTProtocolService:
                     "enabled": WEBSOCKETS_AVAILABLE,
                     "host": "localhost",
                     "port": 8765,
-                    "max_connections": 1000,
+                    "max_connections": 50000,
                     "ping_interval": 20,
-                    "ping_timeout": 10
+                    "ping_timeout": 10,
+                    "send_queue_size": 64
                 }
             }
             
@@ -193,8 +197,11 @@ class IoTProtocolService:
     async def _process_mqtt_message(self, message):
         """Traite un message MQTT reçu"""
         try:
-            topic = message.topic
-            payload = json.loads(message.payload.decode())
+            topic = str(message.topic)
+            payload = self.payload_codecs.decode(
+                message.payload,
+                device_id=self._device_id_from_topic(topic)
+            )
             
             # Identifier le type de message
             message_type = self._identify_message_type(topic, payload)
@@ -209,14 +216,21 @@ class IoTProtocolService:
         except Exception as e:
             logger.error(f"Erreur traitement message MQTT: {str(e)}")
     
-    async def publish_mqtt_message(self, topic: str, payload: dict, qos: int = 1):
+    def _device_id_from_topic(self, topic: str) -> Optional[str]:
+        """Extrait le device_id d'un topic de la forme <topic configuré>/<device_id>"""
+        for base_topic in self.protocol_configs[IoTProtocol.MQTT]["topics"].values():
+            if topic.startswith(base_topic + "/"):
+                return topic[len(base_topic) + 1:]
+        return None
+    
+    async def publish_mqtt_message(self, topic: str, payload: dict, qos: int = 1, codec: str = "json"):
         """Publie un message MQTT"""
         try:
             if not self.mqtt_client:
                 return {"success": False, "error": "Client MQTT non connecté"}
             
-            message_json = json.dumps(payload)
-            await self.mqtt_client.publish(topic, message_json, qos=qos)
+            message_bytes = self.payload_codecs.encode(payload, codec_name=codec)
+            await self.mqtt_client.publish(topic, message_bytes, qos=qos)
             
             return {"success": True, "topic": topic, "message_id": str(uuid.uuid4())}
             
@@ -267,9 +281,15 @@ class IoTProtocolService:
                 "handler": self._handle_coap_request
             }
     
-    async def _handle_coap_request(self, resource: str, method: str, payload: dict):
+    async def _handle_coap_request(self, resource: str, method: str, payload, content_format: Optional[int] = None):
         """Traite une requête CoAP"""
         try:
+            # Décoder le payload selon l'option Content-Format (détection si absente)
+            payload = self.payload_codecs.decode(
+                payload,
+                codec_name=COAP_CONTENT_FORMATS.get(content_format)
+            )
+            
             # Router selon la ressource
             if resource == "/heartbeat":
                 return await self._handle_heartbeat(payload, IoTProtocol.COAP)
@@ -324,8 +344,22 @@ class IoTProtocolService:
                 # Simuler la réception de messages
                 await asyncio.sleep(5)
                 
+                # Décoder en un seul lot les payloads binaires en attente
+                messages = self.lorawan_gateway.get("uplink_messages", [])
+                binary_messages = [m for m in messages if isinstance(m.get("payload"), (bytes, bytearray))]
+                if binary_messages:
+                    try:
+                        decoded = self.payload_codecs.decode_batch(
+                            [bytes(m["payload"]) for m in binary_messages],
+                            [m.get("device_id") for m in binary_messages]
+                        )
+                        for message, payload in zip(binary_messages, decoded):
+                            message["payload"] = payload
+                    except Exception as e:
+                        logger.error(f"Erreur décodage lot LoRaWAN: {str(e)}")
+                
                 # Traiter les messages en attente
-                for message in self.lorawan_gateway.get("uplink_messages", []):
+                for message in messages:
                     await self._process_lorawan_message(message)
                 
                 # Nettoyer les messages traités
@@ -338,7 +372,7 @@ class IoTProtocolService:
         """Traite un message LoRaWAN reçu"""
         try:
             device_id = message.get("device_id")
-            payload = message.get("payload", {})
+            payload = self.payload_codecs.decode(message.get("payload", {}), device_id=device_id)
             
             # Identifier le type de message
             message_type = self._identify_message_type("lorawan", payload)
@@ -357,10 +391,21 @@ class IoTProtocolService:
             if not self.lorawan_gateway:
                 return {"success": False, "error": "Passerelle LoRaWAN non démarrée"}
             
+            # Encoder avec le codec négocié pour le device
+            encoded_payload = self.payload_codecs.encode(payload, device_id=device_id)
+            max_payload = self.protocol_configs[IoTProtocol.LORAWAN]["max_payload"]
+            if len(encoded_payload) > max_payload:
+                logger.warning(
+                    f"Downlink LoRaWAN pour {device_id} de {len(encoded_payload)} octets "
+                    f"(max {max_payload})"
+                )
+            
             downlink_message = {
                 "message_id": str(uuid.uuid4()),
                 "device_id": device_id,
                 "payload": payload,
+                "encoded_payload": encoded_payload,
+                "payload_size": len(encoded_payload),
                 "timestamp": datetime.utcnow().isoformat(),
                 "frequency": self.lorawan_gateway["frequency"],
                 "spreading_factor": self.lorawan_gateway["spreading_factor"]
@@ -368,7 +413,11 @@ class IoTProtocolService:
             
             self.lorawan_gateway["downlink_messages"].append(downlink_message)
             
-            return {"success": True, "message_id": downlink_message["message_id"]}
+            return {
+                "success": True,
+                "message_id": downlink_message["message_id"],
+                "payload_size": len(encoded_payload)
+            }
             
         except Exception as e:
             logger.error(f"Erreur envoi downlink LoRaWAN: {str(e)}")
@@ -418,6 +467,9 @@ class IoTProtocolService:
                 {"$set": {"last_heartbeat": timestamp, "status": "online"}}
             )
             
+            if self.presence and device_id:
+                self.presence.record_heartbeat(device_id)
+            
             logger.info(f"Heartbeat reçu de {device_id} via {protocol.value}")
             
         except Exception as e:
@@ -619,6 +671,16 @@ class IoTProtocolService:
     async def get_connected_devices(self) -> List[Dict[str, Any]]:
         """Retourne la liste des devices connectés"""
         try:
+            if self.presence:
+                # Devices en ligne selon le registre de présence
+                online_ids = self.presence.get_online_device_ids()
+                if not online_ids:
+                    return []
+                return await self.db.devices.find(
+                    {"device_id": {"$in": online_ids}},
+                    {"_id": 0}
+                ).to_list(None)
+            
             # Récupérer les devices avec heartbeat récent (dernières 5 minutes)
             recent_time = datetime.utcnow() - timedelta(minutes=5)
             
@@ -12,9 +12,23 @@ from typing import Dict, List, Optional, Any, Union
 from enum import Enum
 import hashlib
 import secrets
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("marketplace_services", "service_id", unique=True),
+    IndexSpec("marketplace_services", "provider_id"),
+    IndexSpec("marketplace_services", [("category", 1), ("status", 1)]),
+    IndexSpec("service_subscriptions", [("user_id", 1), ("created_at", -1)]),
+    IndexSpec("provider_earnings", "provider_id"),
+]
+
+QUERY_PROBES = [
+    QueryProbe("marketplace_services", {"service_id": "probe"}, description="service par identifiant"),
+    QueryProbe("service_subscriptions", {"user_id": "probe"}, sort=[("created_at", -1)], description="abonnements"),
+]
+
 class ServiceCategory(str, Enum):
     IOT_MANAGEMENT = "iot_management"
     SECURITY = "security"
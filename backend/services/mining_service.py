@@ -15,9 +15,21 @@ from motor.motor_asyncio import AsyncIOMotorCollection
 from models.quantum_models import MiningTask, MiningResult, Block
 from services.blockchain_service import BlockchainService
 from services.token_service import TokenService
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("miners", "address", unique=True),
+    IndexSpec("mining_tasks", "id"),
+    IndexSpec("mining_results", "task_id"),
+]
+
+QUERY_PROBES = [
+    QueryProbe("miners", {"address": "probe"}, description="mineur par adresse"),
+    QueryProbe("mining_results", {"task_id": "probe"}, description="résultat d'une tâche"),
+]
+
 class MiningService:
     """Service de mining distribué pour la blockchain QuantumShield"""
     
@@ -181,6 +193,7 @@ class MiningService:
             
             # Sauvegarder le bloc via le service blockchain
             await self.blockchain_service.blocks.insert_one(block.dict())
+            self.blockchain_service.publish_block(block)
             
             # Récompenser le mineur
             await self.reward_miner(result["miner_address"], self.mining_reward)
@@ -384,13 +397,11 @@ class MiningService:
                 
                 token_service = TokenService(self.db)
                 
-                for miner in active_miners:
-                    # Récompense basée sur l'activité
-                    await token_service.reward_user(
-                        user_id=miner["address"],
-                        reward_type="network_participation",
-                        multiplier=0.5
-                    )
+                # Récompense basée sur l'activité (un seul règlement groupé)
+                await token_service.reward_users_batch([
+                    {"user_id": miner["address"], "reward_type": "network_participation", "multiplier": 0.5}
+                    for miner in active_miners
+                ])
                 
                 logger.info(f"Récompenses distribuées à {len(active_miners)} mineurs")
                 
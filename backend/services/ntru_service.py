@@ -3,15 +3,32 @@ Service de cryptographie post-quantique NTRU++
 Implémentation optimisée pour les devices IoT à faible puissance
 """
 
+import asyncio
 import hashlib
+import os
 import random
 import numpy as np
-from typing import Tuple, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple, Dict, Any, List, Optional
 from datetime import datetime
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Pool de processus partagé pour la génération de clés en masse (créé à la demande)
+_keygen_pool: Optional[ProcessPoolExecutor] = None
+
+def _get_keygen_pool() -> ProcessPoolExecutor:
+    global _keygen_pool
+    if _keygen_pool is None:
+        _keygen_pool = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) - 1))
+    return _keygen_pool
+
+def _generate_keypairs_worker(n: int, q: int, count: int) -> List[Tuple[str, str]]:
+    """Génère count paires de clés dans un processus du pool"""
+    service = NTRUService(n=n, q=q)
+    return [service.generate_keypair() for _ in range(count)]
+
 class NTRUService:
     """Service de cryptographie NTRU++ optimisé pour l'IoT"""
     
@@ -52,7 +69,8 @@ class NTRUService:
             poly[pos] = 1
         
         # Positions pour -1
-        remaining_positions = [i for i in range(self.n) if i not in pos_positions]
+        taken = set(pos_positions)
+        remaining_positions = [i for i in range(self.n) if i not in taken]
         neg_positions = random.sample(remaining_positions, d_neg)
         for pos in neg_positions:
             poly[pos] = -1
@@ -63,13 +81,11 @@ class NTRUService:
         """Multiplication de polynômes modulo x^n - 1"""
         result = np.zeros(self.n, dtype=int)
         
-        for i in range(self.n):
-            for j in range(self.n):
-                if a[i] != 0 and b[j] != 0:
-                    pos = (i + j) % self.n
-                    result[pos] = (result[pos] + a[i] * b[j]) % self.q
+        # Convolution cyclique : une rotation de b par coefficient non nul de a
+        for i in np.flatnonzero(a):
+            result += int(a[i]) * np.roll(b, i).astype(int)
         
-        return result
+        return result % self.q
     
     def polynomial_inverse(self, poly: np.ndarray) -> np.ndarray:
         """Calcule l'inverse d'un polynôme modulo q"""
@@ -112,6 +128,26 @@ class NTRUService:
             logger.error(f"Erreur génération clés: {e}")
             raise Exception(f"Impossible de générer les clés: {e}")
     
+    async def generate_keypairs_pooled(self, count: int) -> List[Tuple[str, str]]:
+        """Génère count paires de clés en parallèle dans le pool de processus"""
+        if count <= 0:
+            return []
+        
+        pool = _get_keygen_pool()
+        workers = min(pool._max_workers, count)
+        share, remainder = divmod(count, workers)
+        sizes = [share + (1 if i < remainder else 0) for i in range(workers)]
+        
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(pool, _generate_keypairs_worker, self.n, self.q, size)
+            for size in sizes
+        ])
+        
+        keypairs = [keypair for batch in results for keypair in batch]
+        logger.info(f"{len(keypairs)} paires de clés NTRU++ générées via le pool")
+        return keypairs
+    
     def encrypt(self, message: str, public_key: str) -> str:
         """Chiffre un message avec la clé publique"""
         try:
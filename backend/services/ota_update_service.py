@@ -15,9 +15,22 @@ from enum import Enum
 import io
 import zipfile
 from pathlib import Path
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("ota_updates", "update_id", unique=True),
+    IndexSpec("ota_updates", [("device_id", 1), ("created_at", -1)]),
+    IndexSpec("ota_updates", "status"),
+    IndexSpec("firmware_repository", "firmware_id", unique=True),
+]
+
+QUERY_PROBES = [
+    QueryProbe("ota_updates", {"update_id": "probe"}, description="mise à jour par identifiant"),
+    QueryProbe("ota_updates", {"device_id": "probe"}, sort=[("created_at", -1)], description="historique OTA"),
+]
+
 class UpdateStatus(str, Enum):
     PENDING = "pending"
     DOWNLOADING = "downloading"
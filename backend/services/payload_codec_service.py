@@ -0,0 +1,397 @@
+"""
+Service de codecs de payload pour les devices IoT
+Support JSON, MessagePack, CBOR et d'un format binaire à disposition fixe
+(table d'identifiants capteurs, timestamps et valeurs encodés en delta)
+"""
+
+import json
+import logging
+import struct
+from datetime import datetime
+from typing import Dict, List, Optional, Any
+
+import numpy as np
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+    logging.warning("msgpack not available, MessagePack codec disabled")
+
+try:
+    import cbor2
+    CBOR_AVAILABLE = True
+except ImportError:
+    CBOR_AVAILABLE = False
+    logging.warning("cbor2 not available, CBOR codec disabled")
+
+logger = logging.getLogger(__name__)
+
+# Octet magique des trames à disposition fixe (ni une map MessagePack ni une map CBOR)
+FIXED_LAYOUT_MAGIC = 0xF5
+
+# En-tête : magic (u8), schema_id (u8), timestamp de base (u32, secondes epoch), nb d'échantillons (u8)
+FIXED_LAYOUT_HEADER = struct.Struct("<BBIB")
+FIXED_LAYOUT_HEADER_DTYPE = np.dtype([
+    ("magic", "u1"), ("schema_id", "u1"), ("base_timestamp", "<u4"), ("sample_count", "u1")
+])
+
+# Content-Format CoAP (RFC 7252 / registre IANA)
+COAP_CONTENT_FORMATS = {
+    50: "json",
+    60: "cbor",
+    42: "fixed_layout"  # application/octet-stream
+}
+
+
+class PayloadCodec:
+    """Codec de base : un message = un dict"""
+
+    name = "base"
+    content_type = "application/octet-stream"
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def decode_batch(self, frames: List[bytes]) -> List[Dict[str, Any]]:
+        """Décode un lot de trames (à surcharger pour une version vectorisée)"""
+        return [self.decode(frame) for frame in frames]
+
+
+class JSONCodec(PayloadCodec):
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        return json.dumps(message, default=str, separators=(",", ":")).encode()
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        return json.loads(data)
+
+
+class MessagePackCodec(PayloadCodec):
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        return msgpack.packb(message, use_bin_type=True, default=str)
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        return msgpack.unpackb(data, raw=False)
+
+    def decode_batch(self, frames: List[bytes]) -> List[Dict[str, Any]]:
+        # Un seul Unpacker réutilisé pour tout le lot
+        unpacker = msgpack.Unpacker(raw=False)
+        messages = []
+        for frame in frames:
+            unpacker.feed(frame)
+            messages.extend(unpacker)
+        return messages
+
+
+class CBORCodec(PayloadCodec):
+    name = "cbor"
+    content_type = "application/cbor"
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        return cbor2.dumps(message, default=lambda encoder, value: encoder.encode(str(value)))
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        return cbor2.loads(data)
+
+
+class FixedLayoutSchema:
+    """Schéma d'une trame à disposition fixe : table ordonnée des capteurs"""
+
+    def __init__(self, schema_id: int, sensors: List[Dict[str, Any]]):
+        if not 0 <= schema_id <= 255:
+            raise ValueError("schema_id doit tenir sur un octet")
+        self.schema_id = schema_id
+        self.sensors = [
+            {
+                "id": sensor.get("id", index),
+                "name": sensor["name"],
+                "dtype": sensor.get("dtype", "i2"),
+                "scale": float(sensor.get("scale", 1.0))
+            }
+            for index, sensor in enumerate(sensors)
+        ]
+        self.sensor_names = [sensor["name"] for sensor in self.sensors]
+        self.scales = np.array([sensor["scale"] for sensor in self.sensors])
+        # Décimales significatives par capteur, pour éviter les artefacts flottants au décodage
+        self.decimals = [max(0, int(np.ceil(-np.log10(scale)))) for scale in self.scales]
+        # Échantillon : delta de timestamp (u16) puis un delta par capteur
+        self.sample_dtype = np.dtype(
+            [("dt", "<u2")] + [(sensor["name"], "<" + sensor["dtype"]) for sensor in self.sensors]
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"schema_id": self.schema_id, "sensors": self.sensors}
+
+    def max_samples(self, max_payload: int) -> int:
+        """Nombre d'échantillons maximum dans une trame de max_payload octets"""
+        return max(0, (max_payload - FIXED_LAYOUT_HEADER.size) // self.sample_dtype.itemsize)
+
+
+class FixedLayoutCodec(PayloadCodec):
+    """Codec binaire piloté par schéma, adapté aux payloads LoRaWAN (51 octets)"""
+
+    name = "fixed_layout"
+    content_type = "application/octet-stream"
+
+    def __init__(self):
+        self.schemas: Dict[int, FixedLayoutSchema] = {}
+
+    def register_schema(self, schema: FixedLayoutSchema):
+        self.schemas[schema.schema_id] = schema
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        """Encode {"schema_id", "samples": [{"timestamp": epoch, <capteur>: valeur}]}"""
+        schema = self.schemas[message["schema_id"]]
+        samples = message["samples"]
+        if not samples or len(samples) > 255:
+            raise ValueError("Une trame contient entre 1 et 255 échantillons")
+
+        timestamps = np.array([int(sample["timestamp"]) for sample in samples], dtype=np.int64)
+        base_timestamp = int(timestamps[0])
+
+        body = np.zeros(len(samples), dtype=schema.sample_dtype)
+        body["dt"] = self._checked(schema, "dt", np.diff(timestamps, prepend=base_timestamp))
+        for index, name in enumerate(schema.sensor_names):
+            values = np.array([sample.get(name, 0) for sample in samples], dtype=np.float64)
+            scaled = np.rint(values / schema.scales[index]).astype(np.int64)
+            body[name] = self._checked(schema, name, np.diff(scaled, prepend=0))
+
+        header = FIXED_LAYOUT_HEADER.pack(FIXED_LAYOUT_MAGIC, schema.schema_id, base_timestamp, len(samples))
+        return header + body.tobytes()
+
+    @staticmethod
+    def _checked(schema: FixedLayoutSchema, field_name: str, deltas: np.ndarray) -> np.ndarray:
+        """Refuse les deltas hors de la plage du champ (sinon débordement silencieux)"""
+        limits = np.iinfo(schema.sample_dtype[field_name])
+        if deltas.min() < limits.min or deltas.max() > limits.max:
+            raise ValueError(
+                f"Delta hors plage pour {field_name} (schéma {schema.schema_id}): "
+                f"[{int(deltas.min())}, {int(deltas.max())}] hors de [{limits.min}, {limits.max}]"
+            )
+        return deltas
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        return self.decode_batch([data])[0]
+
+    def decode_batch(self, frames: List[bytes]) -> List[Dict[str, Any]]:
+        """Décode un lot de trames : un seul frombuffer + cumsum par (schéma, nb d'échantillons)"""
+        results: List[Optional[Dict[str, Any]]] = [None] * len(frames)
+        headers = np.frombuffer(
+            b"".join(frame[:FIXED_LAYOUT_HEADER.size] for frame in frames),
+            dtype=FIXED_LAYOUT_HEADER_DTYPE
+        )
+        if np.any(headers["magic"] != FIXED_LAYOUT_MAGIC):
+            raise ValueError("Trame à disposition fixe invalide")
+
+        groups: Dict[tuple, List[int]] = {}
+        for index, (schema_id, sample_count) in enumerate(zip(headers["schema_id"], headers["sample_count"])):
+            groups.setdefault((int(schema_id), int(sample_count)), []).append(index)
+
+        for (schema_id, sample_count), indices in groups.items():
+            schema = self.schemas.get(schema_id)
+            if not schema:
+                raise ValueError(f"Schéma de payload inconnu: {schema_id}")
+            expected_size = FIXED_LAYOUT_HEADER.size + sample_count * schema.sample_dtype.itemsize
+            if any(len(frames[i]) != expected_size for i in indices):
+                raise ValueError(f"Taille de trame incohérente pour le schéma {schema_id}")
+
+            body = np.frombuffer(
+                b"".join(frames[i][FIXED_LAYOUT_HEADER.size:] for i in indices),
+                dtype=schema.sample_dtype
+            ).reshape(len(indices), sample_count)
+
+            timestamps = headers["base_timestamp"][indices].astype(np.int64)[:, None] + np.cumsum(body["dt"], axis=1)
+            values = {
+                name: np.round(
+                    np.cumsum(body[name].astype(np.int64), axis=1) * schema.scales[position],
+                    schema.decimals[position]
+                )
+                for position, name in enumerate(schema.sensor_names)
+            }
+
+            for row, frame_index in enumerate(indices):
+                samples = [
+                    dict(
+                        {"timestamp": int(timestamps[row, column])},
+                        **{name: float(values[name][row, column]) for name in schema.sensor_names}
+                    )
+                    for column in range(sample_count)
+                ]
+                results[frame_index] = {"schema_id": schema_id, "samples": samples}
+
+        return results
+
+
+class PayloadCodecService:
+    """Registre des codecs et négociation par device"""
+
+    def __init__(self, db):
+        self.db = db
+        self.codecs: Dict[str, PayloadCodec] = {}
+        self.fixed_layout = FixedLayoutCodec()
+        self.device_codecs: Dict[str, str] = {}
+        self.preference_order = ["fixed_layout", "cbor", "msgpack", "json"]
+        self.is_initialized = False
+        self._initialize()
+
+    def _initialize(self):
+        """Enregistre les codecs disponibles et le schéma par défaut"""
+        try:
+            self.codecs[JSONCodec.name] = JSONCodec()
+            if MSGPACK_AVAILABLE:
+                self.codecs[MessagePackCodec.name] = MessagePackCodec()
+            if CBOR_AVAILABLE:
+                self.codecs[CBORCodec.name] = CBORCodec()
+            self.codecs[FixedLayoutCodec.name] = self.fixed_layout
+
+            # Schéma par défaut : capteur environnemental
+            self.fixed_layout.register_schema(FixedLayoutSchema(1, [
+                {"id": 1, "name": "temperature", "dtype": "i2", "scale": 0.01},
+                {"id": 2, "name": "humidity", "dtype": "i2", "scale": 0.01},
+                {"id": 3, "name": "battery", "dtype": "i2", "scale": 0.001}
+            ]))
+
+            self.is_initialized = True
+            logger.info("Service de codecs de payload initialisé avec succès")
+
+        except Exception as e:
+            logger.error(f"Erreur initialisation codecs de payload: {str(e)}")
+            self.is_initialized = False
+
+    def is_ready(self) -> bool:
+        """Vérifie si le service est prêt"""
+        return self.is_initialized
+
+    def get_codec(self, name: str) -> PayloadCodec:
+        codec = self.codecs.get(name)
+        if not codec:
+            raise ValueError(f"Codec non supporté: {name}")
+        return codec
+
+    def available_codecs(self) -> List[str]:
+        return [name for name in self.preference_order if name in self.codecs]
+
+    # ====================
+    # Négociation par device
+    # ====================
+
+    async def negotiate(self, device_id: str, accepted: List[str]) -> str:
+        """Choisit le codec préféré parmi ceux acceptés par le device et le mémorise"""
+        codec_name = next((name for name in self.available_codecs() if name in accepted), JSONCodec.name)
+        self.device_codecs[device_id] = codec_name
+        await self.db.devices.update_one(
+            {"device_id": device_id},
+            {"$set": {"payload_codec": codec_name}}
+        )
+        return codec_name
+
+    async def load_device_codecs(self):
+        """Charge les codecs négociés et les schémas persistés"""
+        cursor = self.db.devices.find(
+            {"payload_codec": {"$exists": True}},
+            {"device_id": 1, "payload_codec": 1}
+        )
+        async for device in cursor:
+            self.device_codecs[device["device_id"]] = device["payload_codec"]
+
+        async for schema in self.db.payload_schemas.find({}):
+            self.fixed_layout.register_schema(FixedLayoutSchema(schema["schema_id"], schema["sensors"]))
+
+    async def register_schema(self, schema_id: int, sensors: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Enregistre un schéma de trame à disposition fixe"""
+        schema = FixedLayoutSchema(schema_id, sensors)
+        self.fixed_layout.register_schema(schema)
+        await self.db.payload_schemas.update_one(
+            {"schema_id": schema_id},
+            {"$set": {"sensors": schema.sensors, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+        return schema.to_dict()
+
+    def codec_for_device(self, device_id: Optional[str]) -> PayloadCodec:
+        return self.codecs.get(self.device_codecs.get(device_id), self.codecs[JSONCodec.name])
+
+    # ====================
+    # Encodage / décodage
+    # ====================
+
+    def detect_codec(self, data: bytes) -> PayloadCodec:
+        """Identifie le codec d'une trame d'après son premier octet"""
+        if not data:
+            raise ValueError("Format de payload non reconnu")
+        first = data[0]
+        if first == FIXED_LAYOUT_MAGIC:
+            return self.fixed_layout
+        if first in (0x7B, 0x20, 0x0A, 0x0D, 0x09):  # '{' ou espace
+            return self.codecs[JSONCodec.name]
+        if (0x80 <= first <= 0x8F or first in (0xDE, 0xDF)) and MSGPACK_AVAILABLE:
+            return self.codecs[MessagePackCodec.name]
+        if (0xA0 <= first <= 0xBB or first == 0xBF) and CBOR_AVAILABLE:
+            return self.codecs[CBORCodec.name]
+        raise ValueError("Format de payload non reconnu")
+
+    def decode(self, data, device_id: Optional[str] = None, codec_name: Optional[str] = None) -> Dict[str, Any]:
+        """Décode un payload et le normalise pour les handlers de messages"""
+        if isinstance(data, dict):
+            return data
+        if isinstance(data, str):
+            data = data.encode()
+        codec = self.get_codec(codec_name) if codec_name else self.detect_codec(data)
+        return self._normalize(codec.decode(data), device_id)
+
+    def decode_batch(self, frames: List[bytes], device_ids: Optional[List[Optional[str]]] = None) -> List[Dict[str, Any]]:
+        """Décode un lot de trames en regroupant par codec détecté"""
+        device_ids = device_ids or [None] * len(frames)
+        results: List[Optional[Dict[str, Any]]] = [None] * len(frames)
+
+        groups: Dict[str, List[int]] = {}
+        for index, frame in enumerate(frames):
+            groups.setdefault(self.detect_codec(frame).name, []).append(index)
+
+        for codec_name, indices in groups.items():
+            decoded = self.codecs[codec_name].decode_batch([frames[i] for i in indices])
+            for index, message in zip(indices, decoded):
+                results[index] = self._normalize(message, device_ids[index])
+
+        return results
+
+    def encode(self, message: Dict[str, Any], codec_name: Optional[str] = None, device_id: Optional[str] = None) -> bytes:
+        """Encode un message avec le codec demandé ou celui négocié pour le device"""
+        codec = self.get_codec(codec_name) if codec_name else self.codec_for_device(device_id)
+        generic = self.codecs.get(MessagePackCodec.name, self.codecs[JSONCodec.name])
+        if codec is self.fixed_layout and "schema_id" not in message:
+            # Les commandes et messages libres ne suivent pas un schéma capteur
+            codec = generic
+        if codec is self.fixed_layout and not codec_name:
+            try:
+                return codec.encode(message)
+            except ValueError as e:
+                # Valeurs non représentables dans le schéma : codec générique
+                logger.warning(f"Trame à disposition fixe impossible pour {device_id}, codec générique utilisé: {e}")
+                codec = generic
+        return codec.encode(message)
+
+    def _normalize(self, message: Dict[str, Any], device_id: Optional[str]) -> Dict[str, Any]:
+        """Convertit une trame à disposition fixe au format attendu par les handlers"""
+        if "samples" in message and "schema_id" in message:
+            samples = message["samples"]
+            latest = samples[-1] if samples else {}
+            message = {
+                "data": {key: value for key, value in latest.items() if key != "timestamp"},
+                "samples": samples,
+                "schema_id": message["schema_id"],
+                "timestamp": datetime.utcfromtimestamp(latest.get("timestamp", 0)).isoformat()
+            }
+        if device_id and "device_id" not in message:
+            message["device_id"] = device_id
+        return message
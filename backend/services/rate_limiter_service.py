@@ -0,0 +1,525 @@
+"""
+Moteur de rate limiting à compteurs de fenêtre glissante
+Deux entiers par clé et par fenêtre (fenêtre courante + précédente), vérification en O(1)
+
+Backends interchangeables : en mémoire (un processus) ou partagés entre workers
+et nœuds (MongoDB via $inc, serveur parlant le protocole Redis), avec
+pré-allocation locale de jetons pour ne pas solliciter le store à chaque requête.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlparse
+
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+class SlidingWindowRateLimiter:
+    """Rate limiter en mémoire à compteurs de fenêtre glissante
+
+    L'usage sur la fenêtre glissante est estimé par
+    précédent * (1 - écoulé / fenêtre) + courant, ce qui borne la mémoire à
+    trois valeurs par clé quel que soit le débit.
+    """
+
+    def __init__(self, max_keys: int = 100000, sweep_interval: int = 60):
+        # clé -> [index de fenêtre, compteur courant, compteur précédent, taille de fenêtre]
+        self._counters: "OrderedDict[str, list]" = OrderedDict()
+        self.max_keys = max_keys
+        # Intervalle du balayage des clés inactives (tâche de fond du backend, hors requêtes)
+        self.sweep_interval = sweep_interval
+        self.evicted_keys = 0
+
+    def _usage(self, key: str, window: int, now: float) -> Tuple[float, Optional[list]]:
+        """Estime l'usage de la clé sur la fenêtre glissante (sans le modifier)"""
+        entry = self._counters.get(key)
+        if entry is None:
+            return 0.0, None
+
+        index = int(now // window)
+        if entry[0] == index:
+            current, previous = entry[1], entry[2]
+        elif entry[0] == index - 1:
+            current, previous = 0, entry[1]
+        else:
+            return 0.0, entry
+
+        elapsed = now - index * window
+        return previous * (1 - elapsed / window) + current, entry
+
+    def acquire(self, checks: List[Tuple[str, int, int]], now: Optional[float] = None) -> Tuple[bool, Dict[str, Any]]:
+        """Vérifie puis consomme une requête sur toutes les fenêtres (tout ou rien)
+
+        checks: liste de (clé, limite, fenêtre en secondes).
+        Retourne (autorisé, détails) avec l'usage par clé et, en cas de refus,
+        la clé en dépassement et le délai avant nouvel essai.
+        """
+        now = now or time.time()
+        usage = {}
+        entries = []
+        for key, limit, window in checks:
+            count, entry = self._usage(key, window, now)
+            usage[key] = int(count)
+            entries.append(entry)
+            if count >= limit:
+                index = int(now // window)
+                return False, {
+                    "usage": usage,
+                    "exceeded": key,
+                    "retry_after": max(1, int((index + 1) * window - now))
+                }
+
+        # Clés existantes de la requête marquées récentes avant toute éviction :
+        # l'insertion d'une clé ne peut pas évincer une autre clé de la même requête
+        for (key, _, _), entry in zip(checks, entries):
+            if entry is not None:
+                self._counters.move_to_end(key)
+
+        for (key, limit, window), entry in zip(checks, entries):
+            index = int(now // window)
+            if entry is None:
+                while len(self._counters) >= self.max_keys:
+                    # Plafond atteint : éviction de la clé la moins récemment utilisée
+                    oldest = next(iter(self._counters))
+                    if any(oldest == request_key for request_key, _, _ in checks):
+                        break
+                    del self._counters[oldest]
+                    self.evicted_keys += 1
+                self._counters[key] = [index, 1, 0, window]
+            else:
+                if entry[0] != index:
+                    entry[2] = entry[1] if entry[0] == index - 1 else 0
+                    entry[1] = 0
+                    entry[0] = index
+                entry[1] += 1
+            usage[key] += 1
+
+        return True, {"usage": usage}
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """Supprime les clés sans activité sur leurs deux dernières fenêtres"""
+        now = now or time.time()
+        idle = [
+            key for key, (index, _, _, window) in self._counters.items()
+            if index < int(now // window) - 1
+        ]
+        for key in idle:
+            del self._counters[key]
+        self.evicted_keys += len(idle)
+        return len(idle)
+
+    def get_usage(self, key: str, window: int, now: Optional[float] = None) -> int:
+        """Usage estimé d'une clé sur sa fenêtre glissante"""
+        count, _ = self._usage(key, window, now or time.time())
+        return int(count)
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "tracked_keys": len(self._counters),
+            "max_keys": self.max_keys,
+            "evicted_keys": self.evicted_keys
+        }
+
+
+# ====================
+# Backends
+# ====================
+
+class RateLimiterBackend:
+    """Interface commune des backends de rate limiting"""
+
+    name = "base"
+
+    def __init__(self):
+        # Vue locale des identifiants bloqués : identifiant -> échéance (epoch)
+        self.blocked_ips: Dict[str, float] = {}
+
+    async def acquire(self, checks: List[Tuple[str, int, int]], now: Optional[float] = None) -> Tuple[bool, Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def start(self):
+        """Démarre les tâches de fond du backend (aucune par défaut)"""
+
+    async def stop(self):
+        """Arrête les tâches de fond du backend"""
+
+    async def block(self, identifier: str, until: float):
+        self.blocked_ips[identifier] = until
+
+    async def unblock(self, identifier: str):
+        self.blocked_ips.pop(identifier, None)
+
+    async def is_blocked(self, identifier: str, now: Optional[float] = None) -> bool:
+        until = self.blocked_ips.get(identifier)
+        if until is None:
+            return False
+        if until <= (now or time.time()):
+            del self.blocked_ips[identifier]
+            return False
+        return True
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {"backend": self.name, "blocked_ips": len(self.blocked_ips)}
+
+
+class InMemoryRateLimiterBackend(RateLimiterBackend):
+    """Backend local au processus (limites multipliées par le nombre de workers)"""
+
+    name = "memory"
+
+    def __init__(self, max_keys: int = 100000):
+        super().__init__()
+        self.limiter = SlidingWindowRateLimiter(max_keys=max_keys)
+        self._sweep_task: Optional[asyncio.Task] = None
+
+    async def acquire(self, checks: List[Tuple[str, int, int]], now: Optional[float] = None) -> Tuple[bool, Dict[str, Any]]:
+        return self.limiter.acquire(checks, now)
+
+    async def start(self):
+        """Balayage périodique des clés inactives, hors du chemin des requêtes"""
+        if not self._sweep_task:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweep_task:
+            self._sweep_task.cancel()
+            self._sweep_task = None
+
+    async def _sweep_loop(self):
+        while True:
+            try:
+                await asyncio.sleep(self.limiter.sweep_interval)
+                self.limiter.evict_idle()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur balayage du rate limiter: {str(e)}")
+
+    def get_statistics(self) -> Dict[str, Any]:
+        stats = super().get_statistics()
+        stats.update(self.limiter.get_statistics())
+        return stats
+
+
+class SharedRateLimiterBackend(RateLimiterBackend):
+    """Base des backends partagés : compteurs par seau de fenêtre dans un store commun
+
+    Chaque processus loue des jetons par lots (lease_size, au plus 10 % de la
+    limite) en incrémentant le seau courant du store, puis les consomme
+    localement. Les jetons loués non utilisés sont perdus à la fin de la
+    fenêtre, ce qui rend la limite conservatrice, jamais permissive.
+    """
+
+    def __init__(self, lease_size: int = 10, blocked_refresh_interval: int = 5, max_keys: int = 100000):
+        super().__init__()
+        self.lease_size = max(1, lease_size)
+        self.blocked_refresh_interval = blocked_refresh_interval
+        self.max_keys = max_keys
+        # clé -> [index de fenêtre, jetons restants, usage partagé observé, prochain essai si refusé]
+        self._leases: "OrderedDict[str, list]" = OrderedDict()
+        # Un seul aller-retour store par clé à la fois : les requêtes concurrentes attendent le lot en cours
+        self._lease_locks: Dict[str, asyncio.Lock] = {}
+        # clé -> (index de fenêtre, compteur) du seau précédent, figé une fois la fenêtre passée
+        self._previous_counts: Dict[str, Tuple[int, int]] = {}
+        self._blocked_refresh_at = 0.0
+        self.store_calls = 0
+
+    # Primitives du store
+    async def _increment(self, bucket: str, amount: int, ttl: int) -> int:
+        raise NotImplementedError
+
+    async def _get_count(self, bucket: str) -> int:
+        raise NotImplementedError
+
+    async def _load_blocked(self) -> Dict[str, float]:
+        raise NotImplementedError
+
+    async def acquire(self, checks: List[Tuple[str, int, int]], now: Optional[float] = None) -> Tuple[bool, Dict[str, Any]]:
+        now = now or time.time()
+        usage = {}
+        leases = []
+        for key, limit, window in checks:
+            index = int(now // window)
+            lease = self._leases.get(key)
+            if self._needs_lease(lease, index, now):
+                lock = self._lease_locks.setdefault(key, asyncio.Lock())
+                async with lock:
+                    # Un autre appel a pu renouveler le lot pendant l'attente
+                    lease = self._leases.get(key)
+                    if self._needs_lease(lease, index, now):
+                        lease = await self._lease(key, limit, window, index, now)
+            leases.append(lease)
+            usage[key] = max(0, int(lease[2] - lease[1]))
+            if lease[1] <= 0:
+                return False, {
+                    "usage": usage,
+                    "exceeded": key,
+                    "retry_after": max(1, int((index + 1) * window - now))
+                }
+
+        # Les jetons d'un lot vérifié plus haut ont pu être consommés pendant un await
+        for (key, _, window), lease in zip(checks, leases):
+            if lease[1] <= 0:
+                return False, {
+                    "usage": usage,
+                    "exceeded": key,
+                    "retry_after": max(1, int((lease[0] + 1) * window - now))
+                }
+
+        for key, lease in zip((c[0] for c in checks), leases):
+            lease[1] -= 1
+            usage[key] += 1
+        return True, {"usage": usage}
+
+    @staticmethod
+    def _needs_lease(lease: Optional[list], index: int, now: float) -> bool:
+        return lease is None or lease[0] != index or (lease[1] <= 0 and now >= lease[3])
+
+    async def _lease(self, key: str, limit: int, window: int, index: int, now: float) -> list:
+        """Réserve un lot de jetons dans le seau courant du store (ajoutés au lot en cours)"""
+        previous = self._previous_counts.get(key)
+        if not previous or previous[0] != index - 1:
+            previous = (index - 1, await self._get_count(f"{key}:{index - 1}"))
+            self._previous_counts[key] = previous
+
+        weighted_previous = previous[1] * (1 - (now - index * window) / window)
+        amount = max(1, min(self.lease_size, limit // 10))
+        bucket = f"{key}:{index}"
+        count = await self._increment(bucket, amount, 2 * window)
+
+        granted = max(0, min(amount, int(limit - weighted_previous - (count - amount))))
+        if granted < amount:
+            # Restituer la part non accordée
+            count = await self._increment(bucket, granted - amount, 2 * window)
+
+        # Après un refus, ne pas réinterroger le store avant une courte pause
+        retry_at = now if granted else now + min(1.0, window / 60)
+        lease = self._leases.get(key)
+        if lease is not None and lease[0] == index:
+            # Même fenêtre : cumuler avec les jetons restants au lieu de les perdre
+            lease[1] += granted
+            lease[2] = count + weighted_previous
+            lease[3] = retry_at
+        else:
+            lease = [index, granted, count + weighted_previous, retry_at]
+            self._leases[key] = lease
+        self._leases.move_to_end(key)
+        if len(self._leases) > self.max_keys:
+            evicted, _ = self._leases.popitem(last=False)
+            self._previous_counts.pop(evicted, None)
+            self._lease_locks.pop(evicted, None)
+        return lease
+
+    async def is_blocked(self, identifier: str, now: Optional[float] = None) -> bool:
+        now = now or time.time()
+        if now >= self._blocked_refresh_at:
+            self._blocked_refresh_at = now + self.blocked_refresh_interval
+            try:
+                self.blocked_ips = await self._load_blocked()
+            except Exception as e:
+                logger.error(f"Erreur synchronisation des IPs bloquées: {str(e)}")
+        return await super().is_blocked(identifier, now)
+
+    def get_statistics(self) -> Dict[str, Any]:
+        stats = super().get_statistics()
+        stats.update({
+            "tracked_keys": len(self._leases),
+            "lease_size": self.lease_size,
+            "store_calls": self.store_calls
+        })
+        return stats
+
+
+class MongoRateLimiterBackend(SharedRateLimiterBackend):
+    """Backend partagé sur MongoDB : un document par clé et par seau, incrémenté avec $inc"""
+
+    name = "mongo"
+
+    def __init__(self, db, **kwargs):
+        super().__init__(**kwargs)
+        self.db = db
+        self.buckets = db.rate_limit_buckets
+        self._index_created = False
+
+    async def _ensure_index(self):
+        if not self._index_created:
+            self._index_created = True
+            await self.buckets.create_index("expires_at", expireAfterSeconds=0)
+
+    async def _increment(self, bucket: str, amount: int, ttl: int) -> int:
+        await self._ensure_index()
+        self.store_calls += 1
+        document = await self.buckets.find_one_and_update(
+            {"_id": bucket},
+            {
+                "$inc": {"count": amount},
+                "$setOnInsert": {"expires_at": datetime.utcnow() + timedelta(seconds=ttl)}
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return document["count"]
+
+    async def _get_count(self, bucket: str) -> int:
+        self.store_calls += 1
+        document = await self.buckets.find_one({"_id": bucket}, {"count": 1})
+        return document["count"] if document else 0
+
+    async def _load_blocked(self) -> Dict[str, float]:
+        # Les blocages sont enregistrés par APIGatewayService.block_ip dans blocked_ips
+        self.store_calls += 1
+        blocked = {}
+        cursor = self.db.blocked_ips.find(
+            {"is_active": True, "unblock_at": {"$gt": datetime.utcnow()}},
+            {"ip_address": 1, "unblock_at": 1}
+        )
+        async for record in cursor:
+            blocked[record["ip_address"]] = (record["unblock_at"] - datetime(1970, 1, 1)).total_seconds()
+        return blocked
+
+
+class RESPClient:
+    """Client minimal du protocole Redis (RESP2) sur une connexion asyncio"""
+
+    def __init__(self, url: str = "redis://127.0.0.1:6379/0"):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._send([("AUTH", self.password)])
+        if self.database:
+            await self._send([("SELECT", self.database)])
+
+    @staticmethod
+    def _encode(command: tuple) -> bytes:
+        parts = [f"*{len(command)}\r\n".encode()]
+        for argument in command:
+            data = argument if isinstance(argument, bytes) else str(argument).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Connexion RESP fermée")
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b"+":
+            return payload.decode()
+        if prefix == b"-":
+            raise RuntimeError(payload.decode())
+        if prefix == b":":
+            return int(payload)
+        if prefix == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if prefix == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"Réponse RESP inattendue: {line!r}")
+
+    async def _send(self, commands: List[tuple]) -> List[Any]:
+        self._writer.write(b"".join(self._encode(command) for command in commands))
+        await self._writer.drain()
+        return [await self._read_reply() for _ in commands]
+
+    async def pipeline(self, commands: List[tuple]) -> List[Any]:
+        """Envoie plusieurs commandes en un aller-retour"""
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    await self._connect()
+                return await self._send(commands)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                # Une reconnexion puis nouvel essai
+                self._writer = None
+                await self._connect()
+                return await self._send(commands)
+
+    async def execute(self, *command) -> Any:
+        return (await self.pipeline([command]))[0]
+
+    async def close(self):
+        if self._writer:
+            self._writer.close()
+            await self._writer.wait_closed()
+            self._writer = None
+
+
+class RedisRateLimiterBackend(SharedRateLimiterBackend):
+    """Backend partagé sur un serveur parlant le protocole Redis (INCRBY + EXPIRE)"""
+
+    name = "redis"
+    BLOCKED_KEY = "qs:blocked_ips"
+
+    def __init__(self, url: str = "redis://127.0.0.1:6379/0", prefix: str = "qs:rl:", **kwargs):
+        super().__init__(**kwargs)
+        self.client = RESPClient(url)
+        self.prefix = prefix
+
+    async def _increment(self, bucket: str, amount: int, ttl: int) -> int:
+        self.store_calls += 1
+        count, _ = await self.client.pipeline([
+            ("INCRBY", self.prefix + bucket, amount),
+            ("EXPIRE", self.prefix + bucket, ttl)
+        ])
+        return count
+
+    async def _get_count(self, bucket: str) -> int:
+        self.store_calls += 1
+        value = await self.client.execute("GET", self.prefix + bucket)
+        return int(value) if value else 0
+
+    async def block(self, identifier: str, until: float):
+        await super().block(identifier, until)
+        await self.client.execute("HSET", self.BLOCKED_KEY, identifier, until)
+
+    async def unblock(self, identifier: str):
+        await super().unblock(identifier)
+        await self.client.execute("HDEL", self.BLOCKED_KEY, identifier)
+
+    async def _load_blocked(self) -> Dict[str, float]:
+        self.store_calls += 1
+        flat = await self.client.execute("HGETALL", self.BLOCKED_KEY) or []
+        now = time.time()
+        return {
+            identifier: float(until)
+            for identifier, until in zip(flat[::2], flat[1::2])
+            if float(until) > now
+        }
+
+
+def create_rate_limiter_backend(db=None) -> RateLimiterBackend:
+    """Construit le backend configuré par RATE_LIMIT_BACKEND (memory, mongo ou redis)"""
+    backend = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+    lease_size = int(os.getenv("RATE_LIMIT_LEASE_SIZE", "10"))
+
+    if backend == "mongo" and db is not None:
+        logger.info("Rate limiting partagé via MongoDB")
+        return MongoRateLimiterBackend(db, lease_size=lease_size)
+    if backend == "redis":
+        url = os.getenv("RATE_LIMIT_REDIS_URL", "redis://127.0.0.1:6379/0")
+        logger.info(f"Rate limiting partagé via le protocole Redis ({url})")
+        return RedisRateLimiterBackend(url, lease_size=lease_size)
+    if backend != "memory":
+        logger.warning(f"Backend de rate limiting inconnu ou indisponible: {backend}, utilisation de la mémoire locale")
+    return InMemoryRateLimiterBackend()
@@ -19,9 +19,22 @@ from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import secrets
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("mfa_configs", [("user_id", 1), ("method", 1)]),
+    IndexSpec("security_events", [("user_id", 1), ("timestamp", -1)]),
+    IndexSpec("security_events", [("timestamp", -1)]),
+    IndexSpec("user_behavior", [("user_id", 1), ("timestamp", -1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe("mfa_configs", {"user_id": "probe", "method": "totp"}, description="configuration MFA"),
+    QueryProbe("user_behavior", {"user_id": "probe"}, sort=[("timestamp", -1)], description="historique comportemental"),
+]
+
 class SecurityEventType(str, Enum):
     LOGIN_SUCCESS = "login_success"
     LOGIN_FAILURE = "login_failure"
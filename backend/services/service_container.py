@@ -0,0 +1,114 @@
+"""
+Conteneur de services QuantumShield
+Construction paresseuse : le module d'un service n'est importé et sa classe
+instanciée qu'au premier usage (ou au démarrage pour les services qui ont des
+tâches de fond)
+"""
+
+import importlib
+import logging
+import threading
+import time
+from typing import Dict, Any, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LazyService:
+    """Mandataire d'un service : toute lecture d'attribut construit le service
+
+    Permet de conserver `from server import x_service` et l'injection par
+    variables de module dans les routes sans forcer la construction à l'import.
+    """
+
+    __slots__ = ("_container", "_name")
+
+    def __init__(self, container: "ServiceContainer", name: str):
+        object.__setattr__(self, "_container", container)
+        object.__setattr__(self, "_name", name)
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._container.get(self._name), attribute)
+
+    def __setattr__(self, attribute: str, value: Any):
+        setattr(self._container.get(self._name), attribute, value)
+
+    def __repr__(self) -> str:
+        state = "construit" if self._container.is_built(self._name) else "différé"
+        return f"<LazyService {self._name} ({state})>"
+
+
+class ServiceContainer:
+    """Registre des services et de leurs dépendances, construits à la demande"""
+
+    def __init__(self):
+        # nom -> (chemin "module:Classe", noms des dépendances)
+        self._providers: Dict[str, Tuple[str, Tuple[str, ...]]] = {}
+        self._instances: Dict[str, Any] = {}
+        self._proxies: Dict[str, LazyService] = {}
+        self._build_times: Dict[str, float] = {}
+        # Construction depuis plusieurs threads (pools de hachage, exécuteurs)
+        self._lock = threading.RLock()
+
+    def register_instance(self, name: str, instance: Any):
+        """Enregistre une valeur déjà construite (base de données, configuration)"""
+        self._instances[name] = instance
+
+    def register(self, name: str, target: str, *dependencies: str) -> LazyService:
+        """Déclare un service construit par `module:Classe(*dépendances)` et retourne son mandataire"""
+        self._providers[name] = (target, dependencies)
+        return self.proxy(name)
+
+    def proxy(self, name: str) -> LazyService:
+        if name not in self._proxies:
+            self._proxies[name] = LazyService(self, name)
+        return self._proxies[name]
+
+    def is_built(self, name: str) -> bool:
+        return name in self._instances
+
+    def get(self, name: str) -> Any:
+        """Retourne le service, en le construisant (avec ses dépendances) au premier appel"""
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        with self._lock:
+            if name in self._instances:
+                return self._instances[name]
+            if name not in self._providers:
+                raise KeyError(f"Service inconnu: {name}")
+
+            target, dependencies = self._providers[name]
+            arguments = [self.get(dependency) for dependency in dependencies]
+
+            start = time.perf_counter()
+            module_name, class_name = target.split(":")
+            service_class = getattr(importlib.import_module(module_name), class_name)
+            instance = service_class(*arguments)
+            self._build_times[name] = time.perf_counter() - start
+
+            self._instances[name] = instance
+            logger.info(f"Service {name} construit en {self._build_times[name] * 1000:.0f} ms")
+            return instance
+
+    def module_names(self) -> List[str]:
+        """Modules des services déclarés (sans les importer)"""
+        return sorted({target.split(":")[0] for target, _ in self._providers.values()})
+
+    def build(self, *names: str) -> List[Any]:
+        """Construit explicitement des services (ceux qui démarrent des tâches de fond)"""
+        return [self.get(name) for name in names]
+
+    def status(self, name: str) -> Any:
+        """État pour le health check : is_ready() si construit, sinon "deferred" (sans le construire)"""
+        if not self.is_built(name):
+            return "deferred"
+        return self._instances[name].is_ready()
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "registered": len(self._providers),
+            "built": sorted(name for name in self._providers if self.is_built(name)),
+            "deferred": sorted(name for name in self._providers if not self.is_built(name)),
+            "build_times_ms": {name: round(seconds * 1000, 1) for name, seconds in self._build_times.items()}
+        }
@@ -0,0 +1,227 @@
+"""
+Stockage des sessions d'authentification
+Hash du token indexé (unique), expiration par index TTL MongoDB et filtre de
+Bloom en mémoire pour répondre à « ce token est-il révoqué ? » sans requête
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+from services.index_registry import IndexSpec, QueryProbe, apply_indexes
+
+logger = logging.getLogger(__name__)
+
+INDEXES = [
+    # Partiel : les sessions antérieures (champ token brut) n'ont pas de token_hash
+    IndexSpec("sessions", "token_hash", unique=True, partial={"token_hash": {"$exists": True}}),
+    IndexSpec("sessions", "expires_at", ttl_seconds=0),
+    IndexSpec("sessions", [("user_id", 1), ("is_active", 1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe("sessions", {"token_hash": "probe"}, description="session par hash de token"),
+    QueryProbe("sessions", {"user_id": "probe", "is_active": True}, description="sessions actives d'un utilisateur"),
+]
+
+
+class BloomFilter:
+    """Filtre de Bloom sur des hash hexadécimaux (double hachage)"""
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.sha256(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def is_saturated(self) -> bool:
+        return self.count >= self.capacity
+
+
+class SessionStoreService:
+    """Sessions indexées par hash de token, expirées par MongoDB (index TTL)"""
+
+    def __init__(self, db, bloom_capacity: int = 100000, refresh_interval: int = 30):
+        self.db = db
+        self.sessions = db.sessions
+        self.bloom_capacity = bloom_capacity
+        self.refresh_interval = refresh_interval
+        self.revoked_filter = BloomFilter(bloom_capacity)
+        # Révocations connues localement : hash -> expiration epoch (réponse exacte sans requête)
+        self._revoked: Dict[str, float] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.is_initialized = True
+        self.stats = {"bloom_negative": 0, "local_hits": 0, "db_lookups": 0}
+
+    def is_ready(self) -> bool:
+        """Vérifie si le service est prêt"""
+        return self.is_initialized
+
+    @staticmethod
+    def hash_token(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    async def ensure_indexes(self):
+        """Index unique sur token_hash, TTL sur expires_at, recherche par utilisateur"""
+        await apply_indexes(self.db, INDEXES)
+
+    async def start(self):
+        """Crée les index, charge les révocations et démarre leur rafraîchissement"""
+        await self.ensure_indexes()
+        await self.load_revoked()
+        if not self._refresh_task:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+    # ====================
+    # Sessions
+    # ====================
+
+    async def create_session(self, user_id: str, token: str, expires_at: datetime) -> Dict[str, Any]:
+        """Enregistre une session (seul le hash du token est stocké)"""
+        session_data = {
+            "user_id": user_id,
+            "token_hash": self.hash_token(token),
+            "created_at": datetime.utcnow(),
+            "expires_at": expires_at,
+            "is_active": True
+        }
+        await self.sessions.insert_one(session_data)
+        return session_data
+
+    def _mark_revoked(self, token_hash: str, expires_at: float):
+        if expires_at <= time.time():
+            return
+        self._revoked[token_hash] = expires_at
+        self.revoked_filter.add(token_hash)
+        if self.revoked_filter.is_saturated:
+            self._rebuild_filter()
+
+    def _rebuild_filter(self):
+        """Reconstruit le filtre à partir des révocations non expirées"""
+        now = time.time()
+        self._revoked = {h: exp for h, exp in self._revoked.items() if exp > now}
+        capacity = max(self.bloom_capacity, len(self._revoked) * 2)
+        self.revoked_filter = BloomFilter(capacity)
+        for token_hash in self._revoked:
+            self.revoked_filter.add(token_hash)
+
+    async def revoke(self, token: str, expires_at: Optional[float] = None) -> bool:
+        """Révoque une session par son token"""
+        token_hash = self.hash_token(token)
+        session = await self.sessions.find_one_and_update(
+            {"token_hash": token_hash, "is_active": True},
+            {"$set": {"is_active": False, "revoked_at": datetime.utcnow()}},
+            projection={"expires_at": 1}
+        )
+        if session and session.get("expires_at"):
+            expires_at = (session["expires_at"] - datetime(1970, 1, 1)).total_seconds()
+        self._mark_revoked(token_hash, expires_at or time.time() + 86400)
+        return session is not None
+
+    async def revoke_all_for_user(self, user_id: str) -> int:
+        """Révoque en une fois toutes les sessions actives d'un utilisateur"""
+        cursor = self.sessions.find(
+            {"user_id": user_id, "is_active": True, "token_hash": {"$exists": True}},
+            {"token_hash": 1, "expires_at": 1}
+        )
+        sessions = await cursor.to_list(length=None)
+        await self.sessions.update_many(
+            {"user_id": user_id, "is_active": True},
+            {"$set": {"is_active": False, "revoked_at": datetime.utcnow()}}
+        )
+        for session in sessions:
+            self._mark_revoked(
+                session["token_hash"],
+                (session["expires_at"] - datetime(1970, 1, 1)).total_seconds()
+            )
+        logger.info(f"{len(sessions)} sessions révoquées pour l'utilisateur {user_id}")
+        return len(sessions)
+
+    async def is_revoked(self, token_hash: str) -> bool:
+        """Réponse immédiate si le filtre est négatif ; requête seulement en cas de faux positif possible"""
+        if token_hash not in self.revoked_filter:
+            self.stats["bloom_negative"] += 1
+            return False
+
+        expires_at = self._revoked.get(token_hash)
+        if expires_at is not None:
+            self.stats["local_hits"] += 1
+            return expires_at > time.time()
+
+        self.stats["db_lookups"] += 1
+        session = await self.sessions.find_one({"token_hash": token_hash}, {"is_active": 1})
+        return bool(session) and not session.get("is_active", True)
+
+    async def count_active_sessions(self, user_id: str) -> int:
+        return await self.sessions.count_documents({
+            "user_id": user_id,
+            "is_active": True,
+            "expires_at": {"$gt": datetime.utcnow()}
+        })
+
+    # ====================
+    # Synchronisation entre workers
+    # ====================
+
+    async def load_revoked(self, since: Optional[datetime] = None):
+        """Ajoute au filtre les sessions révoquées non expirées (toutes, ou depuis une date)"""
+        query = {"is_active": False, "token_hash": {"$exists": True}, "expires_at": {"$gt": datetime.utcnow()}}
+        if since:
+            query["revoked_at"] = {"$gte": since}
+        count = 0
+        async for session in self.sessions.find(query, {"token_hash": 1, "expires_at": 1}):
+            self._mark_revoked(
+                session["token_hash"],
+                (session["expires_at"] - datetime(1970, 1, 1)).total_seconds()
+            )
+            count += 1
+        return count
+
+    async def _refresh_loop(self):
+        """Récupère périodiquement les révocations faites par les autres workers"""
+        since = datetime.utcnow()
+        while True:
+            try:
+                await asyncio.sleep(self.refresh_interval)
+                next_since = datetime.utcnow()
+                await self.load_revoked(since)
+                since = next_since
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur rafraîchissement des révocations: {e}")
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "revoked_tracked": len(self._revoked),
+            "bloom_size_bits": self.revoked_filter.size,
+            "bloom_hash_count": self.revoked_filter.hash_count,
+            "bloom_entries": self.revoked_filter.count,
+            **self.stats
+        }
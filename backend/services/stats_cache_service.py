@@ -0,0 +1,84 @@
+"""
+Cache partagé des statistiques agrégées de QuantumShield
+Chaque statistique (compteur global, résumé par utilisateur ou par device) est
+calculée au plus une fois par durée de vie : les lectures concurrentes d'une
+même clé attendent le calcul en cours au lieu de relancer la requête MongoDB.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Any, Awaitable, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StatsCache:
+    """Valeurs calculées par clé avec durée de vie et calcul unique en vol"""
+
+    def __init__(self, default_ttl: float = 10, max_entries: int = 10000):
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        # clé -> (valeur, expiration monotonic)
+        self._values: Dict[str, Tuple[Any, float]] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+    async def get(self, key: str, compute: Callable[[], Awaitable[Any]], ttl: Optional[float] = None) -> Any:
+        """Retourne la valeur en cache ou la calcule (un seul calcul par clé à la fois)"""
+        entry = self._values.get(key)
+        now = time.monotonic()
+        if entry is not None and entry[1] > now:
+            self.stats["hits"] += 1
+            return entry[0]
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled():
+                    raise
+                # Le calcul partagé a été annulé avec sa requête d'origine : on le relance
+                return await self.get(key, compute, ttl)
+
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+        except Exception as e:
+            self.stats["errors"] += 1
+            future.set_exception(e)
+            # Exception déjà relevée par l'appelant : éviter l'avertissement si personne n'attend
+            future.exception()
+            raise
+        else:
+            self._store(key, value, ttl if ttl is not None else self.default_ttl)
+            future.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+            if not future.done():
+                # Calcul annulé (CancelledError) : libérer les requêtes en attente
+                future.cancel()
+
+    def _store(self, key: str, value: Any, ttl: float):
+        if len(self._values) >= self.max_entries and key not in self._values:
+            # Cache plein : retirer l'entrée la plus ancienne (ordre d'insertion)
+            self._values.pop(next(iter(self._values)))
+        self._values[key] = (value, time.monotonic() + ttl)
+
+    def invalidate(self, prefix: str):
+        """Retire les clés commençant par prefix (ex. "user:42:")"""
+        for key in [key for key in self._values if key.startswith(prefix)]:
+            del self._values[key]
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._values),
+            "inflight": len(self._inflight),
+            "default_ttl": self.default_ttl,
+            **self.stats
+        }
@@ -0,0 +1,401 @@
+"""
+Classement et scores de réputation matérialisés du système de tokens $QS
+- scores mis à jour par incrément à chaque récompense : la décroissance
+  temporelle est exprimée en forme close (points ancrés sur une époque fixe),
+  rien n'est recalculé depuis l'historique des récompenses ;
+- classement par solde tenu en mémoire dans une liste triée, mis à jour à
+  chaque transfert et resynchronisé périodiquement depuis MongoDB (écritures
+  des autres workers et des autres services) : seuls les soldes et scores
+  modifiés depuis la resynchronisation précédente sont relus.
+"""
+
+import asyncio
+import logging
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from services.index_registry import IndexSpec, QueryProbe, apply_indexes
+
+logger = logging.getLogger(__name__)
+
+INDEXES = [
+    IndexSpec("user_scores", "user_id", unique=True),
+    IndexSpec("user_scores", "updated_at"),
+    IndexSpec("token_balances", "last_updated"),
+]
+
+QUERY_PROBES = [
+    QueryProbe("user_scores", {"user_id": "probe"}, description="score de réputation d'un utilisateur"),
+    QueryProbe("user_scores", {"updated_at": {"$gte": 0}}, description="scores modifiés depuis la dernière resynchronisation"),
+    QueryProbe("token_balances", {"last_updated": {"$gte": 0}}, description="soldes modifiés depuis la dernière resynchronisation"),
+]
+
+# Époque d'ancrage des points décroissants
+SCORE_EPOCH = datetime(2024, 1, 1)
+
+# Part de chaque récompense conservée sans décroissance (plancher du score)
+SCORE_FLOOR = 0.1
+
+# Comptes exclus du classement
+EXCLUDED_ACCOUNTS = ("system", "genesis")
+
+# Recouvrement des resynchronisations incrémentales (écritures en vol, horloges des workers)
+RESYNC_OVERLAP = timedelta(seconds=30)
+
+# Marqueur (system_config) de la matérialisation initiale des scores
+BACKFILL_MARKER = {"type": "user_scores_backfill"}
+
+DUPLICATE_KEY = 11000
+
+
+def score_level(total_score: float) -> int:
+    return min(10, max(1, int(total_score / 100) + 1))
+
+
+class BalanceRanking:
+    """Soldes triés en mémoire : top-K en O(K), mise à jour en O(log n) + décalage"""
+
+    def __init__(self):
+        # (-solde, user_id) croissant = solde décroissant, départage par user_id
+        self._keys: List[Tuple[float, str]] = []
+        self._balances: Dict[str, float] = {}
+        self._last_updated: Dict[str, datetime] = {}
+
+    def update(self, user_id: str, balance: float, last_updated: Optional[datetime] = None):
+        if user_id in EXCLUDED_ACCOUNTS:
+            return
+        previous = self._balances.get(user_id)
+        if previous is not None:
+            index = bisect_left(self._keys, (-previous, user_id))
+            if index < len(self._keys) and self._keys[index] == (-previous, user_id):
+                del self._keys[index]
+        if balance > 0:
+            insort(self._keys, (-balance, user_id))
+            self._balances[user_id] = balance
+        else:
+            self._balances.pop(user_id, None)
+        if last_updated:
+            self._last_updated[user_id] = last_updated
+
+    def rebuild(self, entries: List[Dict[str, Any]]):
+        self._balances = {
+            entry["user_id"]: entry["balance"] for entry in entries
+            if entry.get("balance", 0) > 0 and entry["user_id"] not in EXCLUDED_ACCOUNTS
+        }
+        self._last_updated = {entry["user_id"]: entry.get("last_updated") for entry in entries}
+        self._keys = sorted((-balance, user_id) for user_id, balance in self._balances.items())
+
+    def top(self, limit: int) -> List[Tuple[str, float]]:
+        return [(user_id, -negative) for negative, user_id in self._keys[:limit]]
+
+    def rank(self, user_id: str) -> Optional[int]:
+        balance = self._balances.get(user_id)
+        if balance is None:
+            return None
+        return bisect_left(self._keys, (-balance, user_id)) + 1
+
+    def balance(self, user_id: str) -> Optional[float]:
+        return self._balances.get(user_id)
+
+    def last_updated(self, user_id: str) -> Optional[datetime]:
+        return self._last_updated.get(user_id)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class UserScoreStore:
+    """Scores de réputation par incrément, décroissance exponentielle en forme close
+
+    Une récompense de montant a reçue à t vaut, à l'instant n :
+        a * (SCORE_FLOOR + (1 - SCORE_FLOOR) * 2^(-(n - t) / demi-vie))
+    On stocke donc par utilisateur (et par catégorie) la somme des montants et
+    la somme des montants ancrés a * 2^((t - époque) / demi-vie) : deux $inc par
+    récompense, et le score courant se lit sans parcourir l'historique.
+    """
+
+    def __init__(self, db, half_life_days: float = 180):
+        self.db = db
+        self.collection = db.user_scores
+        self.rewards = db.reward_claims
+        self.system_config = db.system_config
+        self.half_life = half_life_days * 86400
+        self._scores: Dict[str, Dict[str, Any]] = {}
+        self._backfill_checked = False
+
+    def _anchor(self, timestamp: datetime) -> float:
+        return 2 ** ((timestamp - SCORE_EPOCH).total_seconds() / self.half_life)
+
+    def _decay(self, now: datetime) -> float:
+        return 2 ** (-(now - SCORE_EPOCH).total_seconds() / self.half_life)
+
+    def _points(self, lifetime: float, anchored: float, decay: float) -> float:
+        return SCORE_FLOOR * lifetime + (1 - SCORE_FLOOR) * anchored * decay
+
+    @staticmethod
+    def _accumulate(scores: Dict[str, Dict[str, Any]], user_id: str, reward_type: str, amount: float, anchored: float):
+        entry = scores.setdefault(user_id, {"lifetime": 0.0, "anchored": 0.0, "categories": {}, "total_rewards": 0})
+        entry["lifetime"] += amount
+        entry["anchored"] += anchored
+        entry["total_rewards"] += 1
+        category = entry["categories"].setdefault(reward_type, {"lifetime": 0.0, "anchored": 0.0})
+        category["lifetime"] += amount
+        category["anchored"] += anchored
+
+    async def record_reward(self, user_id: str, reward_type: str, amount: float, timestamp: datetime):
+        await self.record_rewards([(user_id, reward_type, amount, timestamp)])
+
+    async def record_rewards(self, rewards: List[Tuple[str, str, float, datetime]]):
+        """Applique des récompenses (user_id, type, montant, date) : un $inc par utilisateur
+
+        recorded_since garde la date de la plus ancienne récompense appliquée par
+        incrément : la matérialisation initiale ne compte que l'historique antérieur.
+        """
+        increments: Dict[str, Dict[str, float]] = {}
+        recorded_since: Dict[str, datetime] = {}
+        for user_id, reward_type, amount, timestamp in rewards:
+            anchored = amount * self._anchor(timestamp)
+            user_increments = increments.setdefault(user_id, {})
+            for key, value in (
+                ("lifetime", amount),
+                ("anchored", anchored),
+                (f"categories.{reward_type}.lifetime", amount),
+                (f"categories.{reward_type}.anchored", anchored),
+                ("total_rewards", 1)
+            ):
+                user_increments[key] = user_increments.get(key, 0) + value
+            recorded_since[user_id] = min(timestamp, recorded_since.get(user_id, timestamp))
+            self._accumulate(self._scores, user_id, reward_type, amount, anchored)
+
+        if increments:
+            now = datetime.utcnow()
+            await self.collection.bulk_write([
+                UpdateOne(
+                    {"user_id": user_id},
+                    {"$inc": values, "$set": {"updated_at": now}, "$min": {"recorded_since": recorded_since[user_id]}},
+                    upsert=True
+                )
+                for user_id, values in increments.items()
+            ], ordered=False)
+
+    async def load(self, since: Optional[datetime] = None):
+        """Charge les scores (seulement ceux modifiés depuis since s'il est donné) ;
+        les matérialise depuis reward_claims au premier démarrage"""
+        if not self._backfill_checked:
+            if await self.system_config.find_one(BACKFILL_MARKER) is None:
+                await self.backfill()
+            self._backfill_checked = True
+        query = {"updated_at": {"$gte": since}} if since else {}
+        scores = dict(self._scores) if since else {}
+        async for document in self.collection.find(query, {"_id": 0}):
+            scores[document["user_id"]] = {
+                "lifetime": document.get("lifetime", 0.0),
+                "anchored": document.get("anchored", 0.0),
+                "categories": document.get("categories", {}),
+                "total_rewards": document.get("total_rewards", 0)
+            }
+        self._scores = scores
+
+    async def backfill(self):
+        """Matérialise les scores depuis l'historique des récompenses (une seule fois)
+
+        Fusion par $inc avec les récompenses déjà appliquées par record_rewards :
+        pour chaque utilisateur, seules les récompenses antérieures à recorded_since
+        sont ajoutées, une seule fois (champ backfilled). La mise à jour est
+        conditionnée à la valeur de recorded_since lue : si une récompense plus
+        ancienne a été appliquée entre-temps, l'utilisateur est recalculé.
+        """
+        # Index unique sur user_id requis : un upsert qui ne correspond plus échoue au lieu de dupliquer
+        await apply_indexes(self.db, INDEXES)
+        history: Dict[str, List[Tuple[str, float, datetime]]] = {}
+        cursor = self.rewards.find({}, {"_id": 0, "user_id": 1, "reward_type": 1, "amount": 1, "timestamp": 1})
+        async for reward in cursor:
+            history.setdefault(reward["user_id"], []).append(
+                (reward["reward_type"], reward.get("amount", 0), reward["timestamp"])
+            )
+
+        pending = list(history)
+        for _ in range(3):
+            if not pending:
+                break
+            pending = await self._merge_history(history, pending)
+        if pending:
+            logger.error(f"Erreur matérialisation des scores: {len(pending)} utilisateurs non fusionnés")
+            return
+
+        await self.system_config.update_one(
+            BACKFILL_MARKER, {"$set": {"completed_at": datetime.utcnow()}}, upsert=True
+        )
+        logger.info(f"Scores de réputation matérialisés pour {len(history)} utilisateurs")
+
+    async def _merge_history(self, history: Dict[str, List[Tuple[str, float, datetime]]],
+                             user_ids: List[str]) -> List[str]:
+        """Fusionne l'historique de user_ids ; renvoie les utilisateurs à recalculer"""
+        current = {
+            document["user_id"]: document
+            for document in await self.collection.find(
+                {"user_id": {"$in": user_ids}}, {"_id": 0, "user_id": 1, "recorded_since": 1, "backfilled": 1}
+            ).to_list(length=None)
+        }
+        now = datetime.utcnow()
+        operations, targets = [], []
+        for user_id in user_ids:
+            document = current.get(user_id, {})
+            if document.get("backfilled"):
+                continue
+            recorded_since = document.get("recorded_since")
+            totals: Dict[str, Dict[str, Any]] = {}
+            for reward_type, amount, timestamp in history[user_id]:
+                if recorded_since is None or timestamp < recorded_since:
+                    self._accumulate(totals, user_id, reward_type, amount, amount * self._anchor(timestamp))
+            increments: Dict[str, float] = {}
+            entry = totals.get(user_id)
+            if entry:
+                increments = {
+                    "lifetime": entry["lifetime"],
+                    "anchored": entry["anchored"],
+                    "total_rewards": entry["total_rewards"]
+                }
+                for category, values in entry["categories"].items():
+                    increments[f"categories.{category}.lifetime"] = values["lifetime"]
+                    increments[f"categories.{category}.anchored"] = values["anchored"]
+            update: Dict[str, Any] = {"$set": {"backfilled": True, "updated_at": now}}
+            if increments:
+                update["$inc"] = increments
+            operations.append(UpdateOne(
+                {
+                    "user_id": user_id,
+                    "backfilled": {"$exists": False},
+                    "recorded_since": recorded_since if recorded_since is not None else {"$exists": False}
+                },
+                update,
+                upsert=True
+            ))
+            targets.append(user_id)
+
+        if not operations:
+            return []
+        try:
+            await self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            unexpected = [error for error in errors if error.get("code") != DUPLICATE_KEY]
+            if unexpected:
+                raise
+            # Document modifié depuis la lecture : l'upsert a heurté l'index unique, on recommence
+            return [targets[error["index"]] for error in errors]
+        return []
+
+    def score(self, user_id: str, now: Optional[datetime] = None) -> Dict[str, Any]:
+        """Score courant (décroissance appliquée à la lecture)"""
+        decay = self._decay(now or datetime.utcnow())
+        entry = self._scores.get(user_id)
+        if entry is None:
+            return {"total_score": 0.0, "level": 1, "category_scores": {}, "total_rewards": 0}
+        total_score = self._points(entry["lifetime"], entry["anchored"], decay)
+        return {
+            "total_score": total_score,
+            "level": score_level(total_score),
+            "category_scores": {
+                category: self._points(values["lifetime"], values["anchored"], decay)
+                for category, values in entry["categories"].items()
+            },
+            "total_rewards": entry["total_rewards"]
+        }
+
+    def __len__(self) -> int:
+        return len(self._scores)
+
+
+class TokenLeaderboard:
+    """Classement matérialisé : soldes triés en mémoire et scores incrémentaux"""
+
+    def __init__(self, db, refresh_interval: float = 60, half_life_days: float = 180):
+        self.db = db
+        self.balances = db.token_balances
+        self.ranking = BalanceRanking()
+        self.scores = UserScoreStore(db, half_life_days)
+        self.refresh_interval = refresh_interval
+        self.is_loaded = False
+        self._refresh_task: Optional[asyncio.Task] = None
+        # Début de la dernière resynchronisation réussie (soldes et scores)
+        self._synced_at: Optional[datetime] = None
+
+    async def start(self):
+        await self.refresh()
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+
+    async def refresh(self):
+        """Recharge soldes et scores depuis MongoDB (complet au premier chargement, puis
+        seulement les documents modifiés depuis la resynchronisation précédente)"""
+        started_at = datetime.utcnow()
+        projection = {"_id": 0, "user_id": 1, "balance": 1, "last_updated": 1}
+        if self._synced_at is None:
+            entries = await self.balances.find(
+                {"user_id": {"$nin": list(EXCLUDED_ACCOUNTS)}, "balance": {"$gt": 0}}, projection
+            ).to_list(length=None)
+            self.ranking.rebuild(entries)
+            await self.scores.load()
+        else:
+            since = self._synced_at - RESYNC_OVERLAP
+            # Soldes tombés à zéro inclus : ils sortent du classement
+            async for entry in self.balances.find({"last_updated": {"$gte": since}}, projection):
+                self.ranking.update(entry["user_id"], entry.get("balance", 0), entry.get("last_updated"))
+            await self.scores.load(since)
+        self._synced_at = started_at
+        self.is_loaded = True
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Erreur resynchronisation du classement: {e}")
+
+    def update_balance(self, user_id: str, balance: float, last_updated: Optional[datetime] = None):
+        self.ranking.update(user_id, balance, last_updated)
+
+    async def top(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """Top-K par solde : une seule requête (nombre de devices des K utilisateurs)"""
+        top = self.ranking.top(limit)
+        user_ids = [user_id for user_id, _ in top]
+        rows = await self.db.devices.aggregate([
+            {"$match": {"owner_id": {"$in": user_ids}}},
+            {"$group": {"_id": "$owner_id", "count": {"$sum": 1}}}
+        ]).to_list(length=None)
+        device_counts = {row["_id"]: row["count"] for row in rows}
+
+        now = datetime.utcnow()
+        leaderboard = []
+        for rank, (user_id, balance) in enumerate(top, start=1):
+            score = self.scores.score(user_id, now)
+            leaderboard.append({
+                "rank": rank,
+                "user_id": user_id,
+                "balance": balance,
+                "reputation_score": score["total_score"],
+                "level": score["level"],
+                "device_count": device_counts.get(user_id, 0),
+                "last_activity": self.ranking.last_updated(user_id)
+            })
+        return leaderboard
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "loaded": self.is_loaded,
+            "ranked_users": len(self.ranking),
+            "scored_users": len(self.scores),
+            "refresh_interval": self.refresh_interval,
+            "half_life_days": self.scores.half_life / 86400
+        }
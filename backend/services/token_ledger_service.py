@@ -0,0 +1,250 @@
+"""
+Registre des soldes $QS : transferts atomiques et paiements groupés
+- le débit est une mise à jour conditionnelle ({"balance": {"$gte": montant}})
+  : deux transferts concurrents ne peuvent pas mettre un compte à découvert ;
+- le crédit est un $inc avec upsert, sans lecture préalable du destinataire ;
+- un paiement multi-destinataires débite le total une seule fois puis crédite
+  tous les destinataires en un bulk_write et écrit les transactions en un
+  insert_many.
+Si un crédit échoue après le débit, le débit est compensé ; pour un paiement
+groupé, seules les jambes non appliquées sont remboursées et le résultat est
+partiel.
+"""
+
+import logging
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from models.quantum_models import TokenTransaction, TransactionType
+
+logger = logging.getLogger(__name__)
+
+BALANCE_PROJECTION = {"_id": 0, "user_id": 1, "balance": 1, "last_updated": 1}
+
+
+class InsufficientBalance(Exception):
+    """Solde de l'expéditeur inférieur au montant à débiter"""
+
+
+@dataclass
+class Payout:
+    """Jambe d'un paiement groupé"""
+    to_user: str
+    amount: float
+    description: str = ""
+
+
+@dataclass
+class SettlementResult:
+    """Résultat d'un transfert ou d'un paiement groupé"""
+    transactions: List[TokenTransaction] = field(default_factory=list)
+    # Soldes après opération (expéditeur et destinataires)
+    balances: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+    # Paiement groupé partiel : jambes remboursées / jambes à réconcilier
+    failed: List[Payout] = field(default_factory=list)
+    unresolved: List[Payout] = field(default_factory=list)
+
+    @property
+    def is_complete(self) -> bool:
+        return not self.failed and not self.unresolved
+
+    @property
+    def total_amount(self) -> float:
+        return sum(transaction.amount for transaction in self.transactions)
+
+
+class TokenLedger:
+    """Transferts de tokens sans lecture-puis-écriture"""
+
+    def __init__(self, db):
+        self.balances = db.token_balances
+        self.transactions = db.token_transactions
+        self.stats = {
+            "transfers": 0, "batches": 0, "legs": 0, "failed_legs": 0, "unresolved_legs": 0,
+            "unrecorded_legs": 0, "rejected": 0, "compensations": 0
+        }
+
+    async def debit(self, user_id: str, amount: float) -> Dict[str, Any]:
+        """Débite si le solde suffit (atomique) ; InsufficientBalance sinon"""
+        now = datetime.utcnow()
+        # Image avant mise à jour : le document ne correspond plus au filtre après le débit
+        previous = await self.balances.find_one_and_update(
+            {"user_id": user_id, "balance": {"$gte": amount}},
+            {"$inc": {"balance": -amount}, "$set": {"last_updated": now}},
+            projection=BALANCE_PROJECTION,
+            return_document=ReturnDocument.BEFORE
+        )
+        if previous is None:
+            self.stats["rejected"] += 1
+            raise InsufficientBalance(f"Solde insuffisant pour {user_id}: {amount} QS demandés")
+        return {**previous, "balance": previous["balance"] - amount, "last_updated": now}
+
+    async def credit(self, user_id: str, amount: float) -> Dict[str, Any]:
+        """Crédite (le compte est créé s'il n'existe pas)"""
+        return await self.balances.find_one_and_update(
+            {"user_id": user_id},
+            {"$inc": {"balance": amount}, "$set": {"last_updated": datetime.utcnow()}},
+            projection=BALANCE_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _compensate(self, user_id: str, amount: float) -> Optional[Dict[str, Any]]:
+        self.stats["compensations"] += 1
+        try:
+            return await self.credit(user_id, amount)
+        except Exception as e:
+            # Incohérence à corriger manuellement : le montant est tracé dans les logs
+            logger.error(f"Erreur compensation du débit de {amount} QS pour {user_id}: {e}")
+            return None
+
+    async def transfer(self, from_user: str, to_user: str, amount: float,
+                       transaction_type: TransactionType = TransactionType.REWARD,
+                       description: str = "") -> SettlementResult:
+        """Transfert simple : débit conditionnel, crédit, transaction"""
+        if amount <= 0:
+            raise ValueError("Le montant d'un transfert doit être positif")
+
+        debited = await self.debit(from_user, amount)
+        try:
+            credited = await self.credit(to_user, amount)
+        except Exception:
+            await self._compensate(from_user, amount)
+            raise
+
+        transaction = TokenTransaction(
+            from_user=from_user,
+            to_user=to_user,
+            amount=amount,
+            transaction_type=transaction_type,
+            description=description
+        )
+        await self.transactions.insert_one(transaction.dict())
+        self.stats["transfers"] += 1
+        return SettlementResult([transaction], {from_user: debited, to_user: credited})
+
+    async def transfer_batch(self, from_user: str, payouts: List[Payout],
+                             transaction_type: TransactionType = TransactionType.REWARD) -> SettlementResult:
+        """Paiement multi-destinataires : un débit, un bulk_write de crédits, un insert_many
+
+        Si le total dépasse le solde, aucune jambe n'est réglée. Après le débit,
+        une erreur ne fait jamais perdre le montant : les jambes créditées sont
+        enregistrées, celles dont le crédit n'a certainement pas eu lieu sont
+        remboursées, les autres sont journalisées pour réconciliation (résultat
+        partiel).
+        """
+        payouts = [payout for payout in payouts if payout.amount > 0]
+        if not payouts:
+            return SettlementResult()
+
+        total = sum(payout.amount for payout in payouts)
+        debited = await self.debit(from_user, total)
+
+        settlement_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        credits: Dict[str, float] = {}
+        for payout in payouts:
+            credits[payout.to_user] = credits.get(payout.to_user, 0) + payout.amount
+        recipients = list(credits)
+        applied, failed = set(recipients), set()
+        try:
+            await self.balances.bulk_write([
+                UpdateOne(
+                    {"user_id": user_id},
+                    # last_settlement : permet de vérifier quels crédits ont été appliqués après une erreur
+                    {"$inc": {"balance": credits[user_id]}, "$set": {"last_updated": now, "last_settlement": settlement_id}},
+                    upsert=True
+                )
+                for user_id in recipients
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Écriture non ordonnée : seules les opérations en erreur n'ont pas été appliquées
+            failed = {recipients[error["index"]] for error in e.details.get("writeErrors", [])}
+            applied -= failed
+        except Exception as e:
+            logger.error(f"Erreur crédits du paiement groupé {settlement_id}: {e}")
+            applied, failed = await self._applied_credits(settlement_id, recipients)
+
+        if failed:
+            refunded = await self._compensate(from_user, sum(credits[user_id] for user_id in failed))
+            if refunded:
+                debited = refunded
+        unresolved = [user_id for user_id in recipients if user_id not in applied and user_id not in failed]
+        if unresolved:
+            logger.error(
+                f"Paiement groupé {settlement_id} à réconcilier: {from_user} débité, crédits incertains "
+                f"{ {user_id: credits[user_id] for user_id in unresolved} }"
+            )
+
+        transactions = [
+            TokenTransaction(
+                from_user=from_user,
+                to_user=payout.to_user,
+                amount=payout.amount,
+                transaction_type=transaction_type,
+                description=payout.description,
+                timestamp=now
+            )
+            for payout in payouts if payout.to_user in applied
+        ]
+        if transactions:
+            try:
+                await self.transactions.insert_many([transaction.dict() for transaction in transactions], ordered=False)
+            except Exception as e:
+                # Soldes déjà à jour : seul l'historique manque, à réconcilier
+                self.stats["unrecorded_legs"] += len(transactions)
+                logger.error(
+                    f"Erreur enregistrement des transactions du paiement groupé {settlement_id} "
+                    f"({len(transactions)} jambes créditées, à réconcilier): {e}"
+                )
+
+        balances: Dict[str, Dict[str, Any]] = {}
+        if applied:
+            try:
+                balances = {
+                    document["user_id"]: document
+                    for document in await self.balances.find(
+                        {"user_id": {"$in": list(applied)}}, BALANCE_PROJECTION
+                    ).to_list(length=None)
+                }
+            except Exception as e:
+                logger.error(f"Erreur lecture des soldes du paiement groupé {settlement_id}: {e}")
+        balances.setdefault(from_user, debited)
+
+        self.stats["batches"] += 1
+        self.stats["legs"] += len(transactions)
+        self.stats["failed_legs"] += sum(1 for payout in payouts if payout.to_user in failed)
+        self.stats["unresolved_legs"] += sum(1 for payout in payouts if payout.to_user in unresolved)
+        return SettlementResult(
+            transactions,
+            balances,
+            failed=[payout for payout in payouts if payout.to_user in failed],
+            unresolved=[payout for payout in payouts if payout.to_user in unresolved]
+        )
+
+    async def _applied_credits(self, settlement_id: str, recipients: List[str]) -> Tuple[Set[str], Set[str]]:
+        """Après une erreur d'issue inconnue : (crédits appliqués, crédits certainement non appliqués)
+
+        Appliqué : le solde porte ce règlement. Non appliqué : le compte n'existe
+        pas (l'upsert l'aurait créé). Le reste est indéterminé (un autre crédit a
+        pu passer depuis).
+        """
+        try:
+            documents = await self.balances.find(
+                {"user_id": {"$in": recipients}}, {"_id": 0, "user_id": 1, "last_settlement": 1}
+            ).to_list(length=None)
+        except Exception as e:
+            logger.error(f"Erreur vérification des crédits du paiement groupé {settlement_id}: {e}")
+            return set(), set()
+        settlements = {document["user_id"]: document.get("last_settlement") for document in documents}
+        applied = {user_id for user_id in recipients if settlements.get(user_id) == settlement_id}
+        missing = {user_id for user_id in recipients if user_id not in settlements}
+        return applied, missing
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return dict(self.stats)
@@ -10,14 +10,41 @@ from motor.motor_asyncio import AsyncIOMotorCollection
 import asyncio
 
 from models.quantum_models import TokenBalance, TokenTransaction, RewardClaim, TransactionType
+from services.index_registry import IndexSpec, QueryProbe
+from services.event_bus_service import TOKEN_TRANSFER
+from services.token_leaderboard_service import TokenLeaderboard
+from services.token_ledger_service import TokenLedger, InsufficientBalance, Payout, SettlementResult
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("token_balances", "user_id", unique=True),
+    IndexSpec("token_balances", [("balance", -1)]),
+    IndexSpec("token_transactions", [("from_user", 1), ("timestamp", -1)]),
+    IndexSpec("token_transactions", [("to_user", 1), ("timestamp", -1)]),
+    IndexSpec("reward_claims", [("user_id", 1), ("reward_type", 1), ("timestamp", -1)]),
+    IndexSpec("reward_claims", [("user_id", 1), ("timestamp", -1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe("token_balances", {"user_id": "probe"}, description="solde d'un utilisateur"),
+    QueryProbe("token_balances", {"user_id": {"$ne": "system"}}, sort=[("balance", -1)], description="plus gros détenteurs"),
+    QueryProbe(
+        "token_transactions", {"$or": [{"from_user": "probe"}, {"to_user": "probe"}]},
+        sort=[("timestamp", -1)], description="historique des transactions"
+    ),
+    QueryProbe(
+        "reward_claims", {"user_id": "probe", "reward_type": "device_heartbeat", "timestamp": {"$gte": 0}},
+        description="dernière réclamation de récompense"
+    ),
+]
+
 class TokenService:
     """Service de gestion des tokens $QS et système de récompenses"""
     
-    def __init__(self, db):
+    def __init__(self, db, event_bus=None):
         self.db = db
+        self.event_bus = event_bus
         self.balances: AsyncIOMotorCollection = db.token_balances
         self.transactions: AsyncIOMotorCollection = db.token_transactions
         self.rewards: AsyncIOMotorCollection = db.reward_claims
@@ -29,8 +56,21 @@ class TokenService:
             "data_sharing": 15.0,
             "mining_participation": 100.0
         }
+        # Délai minimal entre deux réclamations d'un même type
+        self.reward_cooldowns = {
+            "device_registration": timedelta(hours=24),
+            "anomaly_detection": timedelta(hours=1),
+            "firmware_validation": timedelta(hours=6),
+            "network_participation": timedelta(hours=24),
+            "data_sharing": timedelta(hours=12),
+            "mining_participation": timedelta(minutes=30)
+        }
         self.initial_supply = 1000000  # 1M tokens
         self.max_supply = 10000000    # 10M tokens
+        # Débits conditionnels atomiques et paiements groupés
+        self.ledger = TokenLedger(db)
+        # Classement et scores matérialisés, mis à jour à chaque transfert / récompense
+        self.leaderboard = TokenLeaderboard(db)
     
     async def initialize_token_system(self):
         """Initialise le système de tokens"""
@@ -83,47 +123,71 @@ class TokenService:
     async def transfer_tokens(self, from_user: str, to_user: str, amount: float, 
                              transaction_type: TransactionType = TransactionType.REWARD,
                              description: str = "") -> bool:
-        """Transfère des tokens entre utilisateurs"""
+        """Transfère des tokens entre utilisateurs (débit conditionnel atomique)"""
         try:
-            # Vérifier le solde de l'expéditeur
-            from_balance = await self.get_balance(from_user)
-            
-            if from_balance < amount:
-                logger.warning(f"Solde insuffisant pour {from_user}: {from_balance} < {amount}")
-                return False
-            
-            # Débiter l'expéditeur
-            await self.balances.update_one(
-                {"user_id": from_user},
-                {"$inc": {"balance": -amount}, "$set": {"last_updated": datetime.utcnow()}}
-            )
-            
-            # Créditer le destinataire
-            to_balance = await self.get_balance(to_user)
-            await self.balances.update_one(
-                {"user_id": to_user},
-                {"$inc": {"balance": amount}, "$set": {"last_updated": datetime.utcnow()}},
-                upsert=True
-            )
-            
-            # Enregistrer la transaction
-            transaction = TokenTransaction(
-                from_user=from_user,
-                to_user=to_user,
-                amount=amount,
-                transaction_type=transaction_type,
-                description=description
-            )
-            
-            await self.transactions.insert_one(transaction.dict())
+            result = await self.ledger.transfer(from_user, to_user, amount, transaction_type, description)
+            self._settled(result)
             
             logger.info(f"Transfert de {amount} QS: {from_user} -> {to_user}")
             return True
             
+        except InsufficientBalance as e:
+            logger.warning(str(e))
+            return False
         except Exception as e:
             logger.error(f"Erreur lors du transfert: {e}")
             return False
     
+    async def transfer_batch(self, from_user: str, payouts: List[Payout],
+                             transaction_type: TransactionType = TransactionType.REWARD) -> Dict[str, Any]:
+        """Règle un paiement multi-destinataires en une opération (tout ou rien côté expéditeur)"""
+        try:
+            result = await self.ledger.transfer_batch(from_user, payouts, transaction_type)
+            self._settled(result)
+            
+            logger.info(f"Paiement groupé de {result.total_amount} QS: {from_user} -> {len(result.transactions)} jambes")
+            response = {
+                "success": result.is_complete,
+                "transactions": len(result.transactions),
+                "total_amount": result.total_amount
+            }
+            if not result.is_complete:
+                response.update(self._partial_settlement(result))
+            return response
+            
+        except InsufficientBalance as e:
+            logger.warning(str(e))
+            return {"success": False, "error": "insufficient_balance"}
+        except Exception as e:
+            logger.error(f"Erreur lors du paiement groupé: {e}")
+            return {"success": False, "error": str(e)}
+    
+    @staticmethod
+    def _partial_settlement(result: SettlementResult) -> Dict[str, Any]:
+        """Détail d'un paiement groupé partiel : jambes remboursées et jambes à réconcilier"""
+        return {
+            "error": "partial_settlement",
+            "failed": [payout.to_user for payout in result.failed],
+            "unresolved": [payout.to_user for payout in result.unresolved]
+        }
+    
+    def _settled(self, result: SettlementResult):
+        """Reporte un règlement dans le classement et sur le bus d'événements"""
+        for user_id, balance_doc in result.balances.items():
+            if balance_doc:
+                self.leaderboard.update_balance(user_id, balance_doc["balance"], balance_doc.get("last_updated"))
+        
+        if self.event_bus and self.event_bus.has_listeners(TOKEN_TRANSFER):
+            for transaction in result.transactions:
+                self.event_bus.publish(TOKEN_TRANSFER, {
+                    "transaction_id": transaction.id,
+                    "from_user": transaction.from_user,
+                    "to_user": transaction.to_user,
+                    "amount": transaction.amount,
+                    "transaction_type": transaction.transaction_type.value,
+                    "timestamp": transaction.timestamp.isoformat()
+                })
+    
     async def reward_user(self, user_id: str, reward_type: str, device_id: str = None, 
                          multiplier: float = 1.0) -> bool:
         """Récompense un utilisateur avec des tokens $QS"""
@@ -161,6 +225,9 @@ class TokenService:
                 )
                 
                 await self.rewards.insert_one(reward_claim.dict())
+                await self.leaderboard.scores.record_reward(
+                    user_id, reward_type, reward_amount, reward_claim.timestamp
+                )
                 
                 logger.info(f"Récompense accordée: {reward_amount} QS à {user_id} pour {reward_type}")
                 return True
@@ -171,20 +238,98 @@ class TokenService:
             logger.error(f"Erreur lors de la récompense: {e}")
             return False
     
-    async def can_claim_reward(self, user_id: str, reward_type: str, device_id: str = None) -> bool:
-        """Vérifie si un utilisateur peut réclamer une récompense"""
+    async def reward_users_batch(self, rewards: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Récompense de nombreux utilisateurs en une opération
+        
+        rewards : dicts user_id, reward_type, device_id (optionnel), multiplier
+        (optionnel). Même règles que reward_user (types connus, délai entre
+        réclamations), vérifiées en une requête pour tout le lot ; les tokens sont
+        réglés par un seul paiement groupé depuis le compte système.
+        """
         try:
-            # Définir les limites de temps pour chaque type de récompense
-            time_limits = {
-                "device_registration": timedelta(hours=24),
-                "anomaly_detection": timedelta(hours=1),
-                "firmware_validation": timedelta(hours=6),
-                "network_participation": timedelta(hours=24),
-                "data_sharing": timedelta(hours=12),
-                "mining_participation": timedelta(minutes=30)
+            now = datetime.utcnow()
+            candidates = [reward for reward in rewards if reward["reward_type"] in self.reward_rates]
+            
+            # Réclamations récentes de tout le lot (une requête)
+            users_by_type: Dict[str, set] = {}
+            for reward in candidates:
+                users_by_type.setdefault(reward["reward_type"], set()).add(reward["user_id"])
+            clauses = [
+                {
+                    "reward_type": reward_type,
+                    "user_id": {"$in": list(user_ids)},
+                    "timestamp": {"$gte": now - self.reward_cooldowns.get(reward_type, timedelta(hours=1))}
+                }
+                for reward_type, user_ids in users_by_type.items()
+            ]
+            claimed, claimed_by_device = set(), set()
+            if clauses:
+                cursor = self.rewards.find({"$or": clauses}, {"_id": 0, "user_id": 1, "reward_type": 1, "device_id": 1})
+                async for claim in cursor:
+                    claimed.add((claim["user_id"], claim["reward_type"]))
+                    claimed_by_device.add((claim["user_id"], claim["reward_type"], claim.get("device_id")))
+            
+            payouts, claims = [], []
+            for reward in candidates:
+                user_id, reward_type, device_id = reward["user_id"], reward["reward_type"], reward.get("device_id")
+                if device_id:
+                    recent = (user_id, reward_type, device_id) in claimed_by_device
+                else:
+                    recent = (user_id, reward_type) in claimed
+                if recent:
+                    continue
+                claimed.add((user_id, reward_type))
+                claimed_by_device.add((user_id, reward_type, device_id))
+                
+                amount = self.reward_rates[reward_type] * reward.get("multiplier", 1.0)
+                payouts.append(Payout(user_id, amount, f"Récompense pour {reward_type}"))
+                claims.append(RewardClaim(
+                    user_id=user_id,
+                    device_id=device_id or "system",
+                    reward_type=reward_type,
+                    amount=amount,
+                    timestamp=now
+                ))
+            
+            if not payouts:
+                return {"success": True, "rewarded": 0, "skipped": len(rewards), "total_amount": 0}
+            
+            result = await self.ledger.transfer_batch("system", payouts, TransactionType.REWARD)
+            self._settled(result)
+            # Jambes remboursées : pas de réclamation (la récompense pourra être redemandée) ;
+            # jambes à réconcilier : réclamation conservée pour ne pas payer deux fois
+            refunded = {payout.to_user for payout in result.failed}
+            unresolved = {payout.to_user for payout in result.unresolved}
+            claims = [claim for claim in claims if claim.user_id not in refunded]
+            if claims:
+                await self.rewards.insert_many([claim.dict() for claim in claims], ordered=False)
+            await self.leaderboard.scores.record_rewards([
+                (claim.user_id, claim.reward_type, claim.amount, claim.timestamp)
+                for claim in claims if claim.user_id not in unresolved
+            ])
+            
+            logger.info(f"Récompenses groupées: {result.total_amount} QS pour {len(result.transactions)} réclamations")
+            response = {
+                "success": result.is_complete,
+                "rewarded": len(result.transactions),
+                "skipped": len(rewards) - len(payouts),
+                "total_amount": result.total_amount
             }
+            if not result.is_complete:
+                response.update(self._partial_settlement(result))
+            return response
             
-            time_limit = time_limits.get(reward_type, timedelta(hours=1))
+        except InsufficientBalance as e:
+            logger.warning(str(e))
+            return {"success": False, "error": "insufficient_balance"}
+        except Exception as e:
+            logger.error(f"Erreur lors des récompenses groupées: {e}")
+            return {"success": False, "error": str(e)}
+    
+    async def can_claim_reward(self, user_id: str, reward_type: str, device_id: str = None) -> bool:
+        """Vérifie si un utilisateur peut réclamer une récompense"""
+        try:
+            time_limit = self.reward_cooldowns.get(reward_type, timedelta(hours=1))
             cutoff_time = datetime.utcnow() - time_limit
             
             # Vérifier les réclamations récentes
@@ -330,38 +475,15 @@ class TokenService:
             }
     
     async def calculate_user_score(self, user_id: str) -> Dict[str, Any]:
-        """Calcule le score de réputation d'un utilisateur"""
+        """Calcule le score de réputation d'un utilisateur (score matérialisé, sans historique)"""
         try:
-            # Récupérer les récompenses de l'utilisateur
-            rewards = await self.get_user_rewards(user_id)
-            
-            # Calculer les points par catégorie
-            category_scores = {}
-            total_score = 0
-            
-            for reward in rewards:
-                category = reward.reward_type
-                if category not in category_scores:
-                    category_scores[category] = 0
-                
-                # Points basés sur le montant et l'ancienneté
-                days_old = (datetime.utcnow() - reward.timestamp).days
-                decay_factor = max(0.1, 1 - (days_old / 365))  # Décroissance annuelle
-                
-                points = reward.amount * decay_factor
-                category_scores[category] += points
-                total_score += points
-            
-            # Calculer le niveau basé sur le score total
-            level = min(10, max(1, int(total_score / 100) + 1))
+            score = self.leaderboard.scores.score(user_id)
+            balance = self.leaderboard.ranking.balance(user_id)
             
             return {
                 "user_id": user_id,
-                "total_score": total_score,
-                "level": level,
-                "category_scores": category_scores,
-                "total_rewards": len(rewards),
-                "current_balance": await self.get_balance(user_id)
+                **score,
+                "current_balance": balance if balance is not None else await self.get_balance(user_id)
             }
             
         except Exception as e:
@@ -369,37 +491,11 @@ class TokenService:
             return {}
     
     async def get_leaderboard(self, limit: int = 50) -> List[Dict[str, Any]]:
-        """Récupère le classement des utilisateurs"""
+        """Récupère le classement des utilisateurs (classement matérialisé en mémoire)"""
         try:
-            # Récupérer tous les utilisateurs avec un solde
-            cursor = self.balances.find({
-                "user_id": {"$ne": "system"},
-                "balance": {"$gt": 0}
-            }).sort("balance", -1).limit(limit)
-            
-            balances = await cursor.to_list(length=limit)
-            
-            leaderboard = []
-            for i, balance in enumerate(balances):
-                user_id = balance["user_id"]
-                
-                # Calculer le score de réputation
-                score_data = await self.calculate_user_score(user_id)
-                
-                # Compter les devices de l'utilisateur
-                device_count = await self.db.devices.count_documents({"owner_id": user_id})
-                
-                leaderboard.append({
-                    "rank": i + 1,
-                    "user_id": user_id,
-                    "balance": balance["balance"],
-                    "reputation_score": score_data.get("total_score", 0),
-                    "level": score_data.get("level", 1),
-                    "device_count": device_count,
-                    "last_activity": balance["last_updated"]
-                })
-            
-            return leaderboard
+            if not self.leaderboard.is_loaded:
+                await self.leaderboard.refresh()
+            return await self.leaderboard.top(limit)
             
         except Exception as e:
             logger.error(f"Erreur lors de la récupération du classement: {e}")
@@ -425,15 +521,15 @@ class TokenService:
                     user_activity[owner_id] = 0
                 user_activity[owner_id] += 1
             
-            # Récompenser basé sur l'activité
-            for user_id, device_count in user_activity.items():
-                reward_multiplier = min(2.0, 1.0 + (device_count / 10))
-                
-                await self.reward_user(
-                    user_id=user_id,
-                    reward_type="network_participation",
-                    multiplier=reward_multiplier
-                )
+            # Récompenser basé sur l'activité (un seul règlement groupé)
+            await self.reward_users_batch([
+                {
+                    "user_id": user_id,
+                    "reward_type": "network_participation",
+                    "multiplier": min(2.0, 1.0 + (device_count / 10))
+                }
+                for user_id, device_count in user_activity.items()
+            ])
             
             logger.info(f"Récompenses quotidiennes traitées pour {len(user_activity)} utilisateurs")
             
@@ -0,0 +1,158 @@
+"""
+Regroupement des événements webhooks QuantumShield
+Les abonnés qui l'activent reçoivent leurs événements par lots : une fenêtre
+par webhook, vidée dès qu'elle atteint max_batch événements ou window_ms
+millisecondes. Chaque lot part comme une seule livraison signée contenant la
+liste des événements.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Any, Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Valeur du champ "event" d'une livraison groupée
+BATCH_EVENT = "batch"
+
+DEFAULT_BATCHING = {
+    "enabled": False,
+    "max_batch": 100,
+    "window_ms": 1000,
+    "gzip": False,
+    # None : tous les événements souscrits sont regroupés
+    "events": None
+}
+
+MAX_BATCH_LIMIT = 1000
+WINDOW_MS_LIMITS = (10, 60000)
+
+# (webhook, payload du lot) -> None : mise en livraison d'un lot
+FlushHandler = Callable[[Dict[str, Any], Dict[str, Any]], Awaitable[Any]]
+
+
+def normalize_batching(settings: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Complète et borne les paramètres de regroupement d'un webhook (None si désactivé)"""
+    if not settings or not settings.get("enabled", True):
+        return None
+    batching = {**DEFAULT_BATCHING, **{key: value for key, value in settings.items() if value is not None}}
+    batching["enabled"] = True
+    batching["max_batch"] = max(1, min(int(batching["max_batch"]), MAX_BATCH_LIMIT))
+    batching["window_ms"] = max(WINDOW_MS_LIMITS[0], min(int(batching["window_ms"]), WINDOW_MS_LIMITS[1]))
+    batching["gzip"] = bool(batching["gzip"])
+    if batching["events"]:
+        batching["events"] = [getattr(event, "value", event) for event in batching["events"]]
+    return batching
+
+
+class _Window:
+    """Événements en attente pour un webhook"""
+
+    __slots__ = ("webhook", "events", "opened_at", "timer")
+
+    def __init__(self, webhook: Dict[str, Any]):
+        self.webhook = webhook
+        self.events: List[Dict[str, Any]] = []
+        self.opened_at = time.monotonic()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class WebhookBatcher:
+    """Fenêtres de regroupement par webhook, vidées par nombre ou par durée"""
+
+    def __init__(self, flush: FlushHandler):
+        self.flush_handler = flush
+        self._windows: Dict[str, _Window] = {}
+        # Références des vidages déclenchés par minuterie (sinon collectables en cours d'exécution)
+        self._expiring = set()
+        self.stats = {"events_batched": 0, "batches_flushed": 0, "requests_saved": 0}
+
+    @staticmethod
+    def settings_for(webhook: Dict[str, Any], event_type: str) -> Optional[Dict[str, Any]]:
+        """Paramètres de regroupement applicables à cet événement (None : livraison directe)"""
+        batching = webhook.get("batching")
+        if not batching or not batching.get("enabled"):
+            return None
+        if batching.get("events") and event_type not in batching["events"]:
+            return None
+        return batching
+
+    async def add(self, webhook: Dict[str, Any], event_payload: Dict[str, Any]) -> bool:
+        """Ajoute l'événement à la fenêtre du webhook ; False si le webhook n'est pas en mode lot"""
+        batching = self.settings_for(webhook, event_payload["event"])
+        if batching is None:
+            return False
+
+        webhook_id = webhook["webhook_id"]
+        window = self._windows.get(webhook_id)
+        if window is None:
+            window = self._windows[webhook_id] = _Window(webhook)
+            # Minuterie de boucle (pas de tâche par fenêtre) ; la tâche de vidage n'est créée qu'à l'échéance
+            window.timer = asyncio.get_running_loop().call_later(
+                batching["window_ms"] / 1000,
+                self._schedule_expire, webhook_id, window
+            )
+
+        window.events.append(event_payload)
+        self.stats["events_batched"] += 1
+        if len(window.events) >= batching["max_batch"]:
+            await self.flush(webhook_id)
+        return True
+
+    def _schedule_expire(self, webhook_id: str, window: _Window):
+        task = asyncio.create_task(self._expire(webhook_id, window))
+        self._expiring.add(task)
+        task.add_done_callback(self._expiring.discard)
+
+    async def _expire(self, webhook_id: str, window: _Window):
+        try:
+            # La fenêtre a pu être vidée (max_batch atteint) et remplacée entre-temps
+            if self._windows.get(webhook_id) is window:
+                await self.flush(webhook_id)
+        except Exception as e:
+            logger.error(f"Erreur vidage lot webhook {webhook_id}: {e}")
+
+    async def flush(self, webhook_id: str) -> int:
+        """Vide la fenêtre d'un webhook en une seule livraison ; retourne le nombre d'événements"""
+        window = self._windows.pop(webhook_id, None)
+        if window is None or not window.events:
+            return 0
+        if window.timer:
+            window.timer.cancel()
+
+        batch_payload = {
+            "event": BATCH_EVENT,
+            "timestamp": datetime.utcnow(),
+            "count": len(window.events),
+            "window_ms": round((time.monotonic() - window.opened_at) * 1000),
+            "events": window.events
+        }
+        self.stats["batches_flushed"] += 1
+        self.stats["requests_saved"] += len(window.events) - 1
+        await self.flush_handler(window.webhook, batch_payload)
+        return len(window.events)
+
+    async def flush_all(self) -> int:
+        """Vide toutes les fenêtres (arrêt du service)"""
+        flushed = 0
+        for webhook_id in list(self._windows):
+            flushed += await self.flush(webhook_id)
+        return flushed
+
+    def discard(self, webhook_id: str) -> int:
+        """Abandonne la fenêtre d'un webhook supprimé"""
+        window = self._windows.pop(webhook_id, None)
+        if window is None:
+            return 0
+        if window.timer:
+            window.timer.cancel()
+        return len(window.events)
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "open_windows": len(self._windows),
+            "buffered_events": sum(len(window.events) for window in self._windows.values()),
+            **self.stats
+        }
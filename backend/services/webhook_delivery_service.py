@@ -0,0 +1,256 @@
+"""
+Moteur de livraison des webhooks QuantumShield
+Session HTTP partagée (pool de connexions keep-alive, cache DNS), pool borné
+de workers alimenté par une file, plafond de livraisons simultanées par
+endpoint et contre-pression sur les émetteurs quand la file est pleine.
+Les corps peuvent être compressés (gzip) pour les webhooks qui l'activent.
+"""
+
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Dict, Any, Awaitable, Callable, Deque, Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# (webhook, payload, résultat, contexte) -> None : persistance du résultat d'une livraison
+ResultHandler = Callable[[Dict[str, Any], Dict[str, Any], Dict[str, Any], Any], Awaitable[None]]
+# (webhook, payload, contexte) -> bool : appelé juste avant l'envoi, False pour l'abandonner
+DispatchHandler = Callable[[Dict[str, Any], Dict[str, Any], Any], Awaitable[bool]]
+Job = Tuple[Dict[str, Any], Dict[str, Any], Any]
+
+
+class WebhookDeliveryEngine:
+    """Livraison HTTP des webhooks par un pool borné de workers"""
+
+    def __init__(self,
+                 workers: int = 32,
+                 max_pending: int = 10000,
+                 per_endpoint_concurrency: int = 4,
+                 per_host_connections: int = 16,
+                 total_connections: int = 256,
+                 timeout: float = 30,
+                 gzip_min_size: int = 1024,
+                 on_result: Optional[ResultHandler] = None,
+                 on_dispatch: Optional[DispatchHandler] = None):
+        self.worker_count = workers
+        self.max_pending = max_pending
+        self.per_endpoint_concurrency = per_endpoint_concurrency
+        self.per_host_connections = per_host_connections
+        self.total_connections = total_connections
+        self.timeout = timeout
+        self.gzip_min_size = gzip_min_size
+        self.on_result = on_result
+        self.on_dispatch = on_dispatch
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._queue: "asyncio.Queue[Job]" = None
+        self._workers = []
+        # Livraisons en file ou en cours : submit() attend quand max_pending est atteint
+        self._pending = 0
+        self._space: Optional[asyncio.Event] = None
+        # Positionné quand plus aucune livraison n'est en file, en attente d'endpoint ou en cours
+        self._drained: Optional[asyncio.Event] = None
+        # Endpoint au plafond : les livraisons suivantes attendent ici sans bloquer de worker
+        self._inflight: Dict[str, int] = defaultdict(int)
+        self._parked: Dict[str, Deque[Job]] = defaultdict(deque)
+        self.stats = {"submitted": 0, "delivered": 0, "failed": 0, "parked_total": 0, "abandoned": 0}
+
+    @property
+    def is_running(self) -> bool:
+        return self._session is not None
+
+    async def start(self):
+        """Crée la session partagée et démarre les workers"""
+        if self._session:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.total_connections,
+            limit_per_host=self.per_host_connections,
+            ttl_dns_cache=300,
+            keepalive_timeout=30
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout)
+        )
+        self._queue = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+        logger.info(f"Moteur de livraison webhooks démarré ({self.worker_count} workers)")
+
+    async def join(self):
+        """Attend que toutes les livraisons en file (y compris en attente d'endpoint) soient traitées
+
+        Les livraisons en attente d'endpoint ont déjà quitté la file : l'attente
+        porte sur le compteur _pending, décrémenté seulement après l'envoi.
+        """
+        if self._drained:
+            await self._drained.wait()
+
+    async def stop(self, drain_timeout: float = 10):
+        """Laisse la file se vider (borné dans le temps), puis ferme la session"""
+        if not self._session:
+            return
+        try:
+            await asyncio.wait_for(self.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Arrêt des webhooks: {self.pending} livraisons non envoyées")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        await self._session.close()
+        self._session = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @staticmethod
+    def endpoint_key(webhook: Dict[str, Any]) -> str:
+        return webhook.get("url", "")
+
+    async def submit(self, webhook: Dict[str, Any], event_payload: Dict[str, Any], context: Any = None):
+        """Met une livraison en file ; attend une place libre si la file est pleine
+
+        `context` est rendu tel quel à on_result (document de l'outbox par exemple).
+        """
+        if not self._session:
+            await self.start()
+        while self._pending >= self.max_pending:
+            self._space.clear()
+            await self._space.wait()
+        self._enqueue(webhook, event_payload, context)
+
+    def try_submit(self, webhook: Dict[str, Any], event_payload: Dict[str, Any], context: Any = None) -> bool:
+        """Variante sans attente : False si la file est pleine (à l'appelant de décider)"""
+        if not self._session or self._pending >= self.max_pending:
+            return False
+        self._enqueue(webhook, event_payload, context)
+        return True
+
+    def _enqueue(self, webhook: Dict[str, Any], event_payload: Dict[str, Any], context: Any):
+        self._pending += 1
+        self._drained.clear()
+        self.stats["submitted"] += 1
+        self._queue.put_nowait((webhook, event_payload, context))
+
+    def _release(self):
+        self._pending -= 1
+        self._space.set()
+        if not self._pending:
+            self._drained.set()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                while job is not None:
+                    webhook, event_payload, context = job
+                    endpoint = self.endpoint_key(webhook)
+                    if self._inflight[endpoint] >= self.per_endpoint_concurrency:
+                        self._parked[endpoint].append(job)
+                        self.stats["parked_total"] += 1
+                        break
+
+                    self._inflight[endpoint] += 1
+                    try:
+                        # Une livraison restée longtemps en file peut ne plus appartenir à ce worker
+                        if self.on_dispatch and not await self.on_dispatch(webhook, event_payload, context):
+                            self.stats["abandoned"] += 1
+                        else:
+                            result = await self.deliver(webhook, event_payload)
+                            self.stats["delivered" if result["success"] else "failed"] += 1
+                            if self.on_result:
+                                await self.on_result(webhook, event_payload, result, context)
+                    except Exception as e:
+                        logger.error(f"Erreur worker webhooks: {e}")
+                    finally:
+                        self._inflight[endpoint] -= 1
+                        self._release()
+
+                    # L'endpoint libère une place : on enchaîne sur sa prochaine livraison en attente
+                    parked = self._parked.get(endpoint)
+                    job = parked.popleft() if parked else None
+                    if parked is not None and not parked:
+                        del self._parked[endpoint]
+                    if not self._inflight[endpoint]:
+                        del self._inflight[endpoint]
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def sign(secret: str, body: bytes) -> str:
+        return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+    def build_request(self, webhook: Dict[str, Any], event_payload: Dict[str, Any]) -> Tuple[bytes, Dict[str, str]]:
+        """Corps JSON et en-têtes signés d'une livraison"""
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "QuantumShield-Webhook/1.0",
+            "X-Webhook-Event": event_payload["event"],
+            "X-Webhook-Delivery": str(uuid.uuid4()),
+            "X-Webhook-Timestamp": str(int(datetime.utcnow().timestamp()))
+        }
+        if webhook.get("headers"):
+            headers.update(webhook["headers"])
+
+        body = json.dumps(event_payload, default=str).encode()
+        if webhook.get("secret"):
+            # Signature du JSON non compressé : le destinataire vérifie après décodage
+            headers["X-Webhook-Signature"] = self.sign(webhook["secret"], body)
+        if "events" in event_payload:
+            headers["X-Webhook-Batch-Size"] = str(len(event_payload["events"]))
+
+        batching = webhook.get("batching") or {}
+        if batching.get("gzip") and len(body) >= self.gzip_min_size:
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    async def deliver(self, webhook: Dict[str, Any], event_payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Envoie une livraison sur la session partagée"""
+        if not self._session:
+            await self.start()
+        try:
+            body, headers = self.build_request(webhook, event_payload)
+            start_time = time.perf_counter()
+            async with self._session.post(webhook["url"], data=body, headers=headers) as response:
+                # Corps lu pour rendre la connexion au pool
+                await response.read()
+                response_time = time.perf_counter() - start_time
+                if 200 <= response.status < 300:
+                    return {"success": True, "status_code": response.status, "response_time": response_time}
+                return {
+                    "success": False,
+                    "status_code": response.status,
+                    "response_time": response_time,
+                    "error": f"HTTP {response.status}"
+                }
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "Timeout"}
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "workers": self.worker_count,
+            "pending": self.pending,
+            "max_pending": self.max_pending,
+            "endpoints_in_flight": len(self._inflight),
+            "parked": sum(len(jobs) for jobs in self._parked.values()),
+            **self.stats
+        }
@@ -0,0 +1,399 @@
+"""
+Outbox durable des webhooks QuantumShield
+Chaque livraison est écrite dans webhook_deliveries avant l'envoi, puis
+réclamée par un worker via un bail atomique (find_one_and_update), ce qui
+permet plusieurs workers sans double envoi. Les nouvelles tentatives sont
+planifiées en mémoire dans un tas de minuteries ; les livraisons épuisées
+ou orphelines partent explicitement en lettres mortes.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Any, Awaitable, Callable, List, Optional, Sequence, Tuple
+
+from pymongo import ReturnDocument
+
+from services.index_registry import IndexSpec, QueryProbe
+
+logger = logging.getLogger(__name__)
+
+INDEXES = [
+    IndexSpec("webhook_deliveries", "delivery_id", unique=True),
+    IndexSpec("webhook_dead_letters", "delivery_id", unique=True),
+    IndexSpec("webhook_dead_letters", [("webhook_id", 1), ("dead_lettered_at", -1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe(
+        "webhook_deliveries",
+        {"status": {"$in": ["pending", "retrying"]}, "next_retry": {"$lte": 0},
+         "$or": [{"lease_until": None}, {"lease_until": {"$lt": 0}}]},
+        sort=[("next_retry", 1)], description="réclamation des livraisons dues"
+    ),
+    QueryProbe("webhook_dead_letters", {"webhook_id": "probe"}, sort=[("dead_lettered_at", -1)], description="lettres mortes"),
+]
+
+# Statuts stockés (mêmes valeurs que WebhookDeliveryStatus)
+PENDING = "pending"
+DELIVERED = "delivered"
+FAILED = "failed"
+RETRYING = "retrying"
+
+
+def _epoch(value: datetime) -> float:
+    return (value - datetime(1970, 1, 1)).total_seconds()
+
+
+class WebhookOutbox:
+    """Livraisons persistées, bails de traitement et planification des nouvelles tentatives"""
+
+    def __init__(self,
+                 db,
+                 engine,
+                 resolve_webhook: Callable[[str], Awaitable[Optional[Dict[str, Any]]]],
+                 max_retries: int = 3,
+                 retry_delays: Sequence[int] = (5, 30, 300),
+                 lease_seconds: int = 60,
+                 claim_batch: int = 100,
+                 poll_interval: float = 5):
+        self.db = db
+        self.deliveries = db.webhook_deliveries
+        self.dead_letters = db.webhook_dead_letters
+        self.engine = engine
+        self.engine.on_result = self.complete
+        self.engine.on_dispatch = self.renew_lease
+        self.resolve_webhook = resolve_webhook
+        self.max_retries = max_retries
+        self.retry_delays = list(retry_delays)
+        self.lease_seconds = lease_seconds
+        self.claim_batch = claim_batch
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        # Tas de minuteries : (échéance epoch, séquence, document de livraison)
+        self._timers: List[Tuple[float, int, Dict[str, Any]]] = []
+        self._sequence = itertools.count()
+        self._scheduled = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"enqueued": 0, "claimed": 0, "retried": 0, "delivered": 0, "dead_lettered": 0, "leases_lost": 0}
+
+    # ====================
+    # Cycle de vie
+    # ====================
+
+    async def start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._timer_loop()),
+            asyncio.create_task(self._claim_loop())
+        ]
+        logger.info(f"Outbox webhooks démarrée (worker {self.worker_id})")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Les bails non rendus expirent : les autres workers reprennent ces livraisons
+
+    # ====================
+    # Mise en file
+    # ====================
+
+    def _lease_until(self, from_time: datetime) -> datetime:
+        return from_time + timedelta(seconds=self.lease_seconds)
+
+    async def renew_lease(self, webhook: Dict[str, Any], event_payload: Dict[str, Any],
+                          delivery: Optional[Dict[str, Any]]) -> bool:
+        """Appelé par le moteur quand une livraison quitte la file, juste avant l'envoi
+
+        Sous contre-pression, l'attente en file peut dépasser le bail : un autre
+        worker a alors pu réclamer la livraison. Le bail est prolongé s'il ne
+        couvre plus l'envoi (délai du moteur), à condition d'en être toujours le
+        détenteur ; sinon la livraison est abandonnée ici.
+        """
+        if delivery is None:
+            return True
+        now = datetime.utcnow()
+        lease_until = delivery.get("lease_until")
+        if lease_until and (lease_until - now).total_seconds() > self.engine.timeout + 5:
+            return True
+
+        lease_until = self._lease_until(now)
+        result = await self.deliveries.update_one(
+            {"delivery_id": delivery["delivery_id"], "lease_owner": self.worker_id,
+             "status": {"$in": [PENDING, RETRYING]}},
+            {"$set": {"lease_until": lease_until}}
+        )
+        if not result.matched_count:
+            self._lease_lost(delivery)
+            return False
+        delivery["lease_until"] = lease_until
+        return True
+
+    def _lease_lost(self, delivery: Dict[str, Any]):
+        self.stats["leases_lost"] += 1
+        self._scheduled.discard(delivery["delivery_id"])
+        logger.warning(f"Bail perdu pour la livraison {delivery['delivery_id']} : reprise par un autre worker")
+
+    async def enqueue(self, webhooks: List[Dict[str, Any]], event_payload: Dict[str, Any]) -> int:
+        """Persiste une livraison par webhook (un seul insert_many), puis la soumet au moteur"""
+        if not webhooks:
+            return 0
+        now = datetime.utcnow()
+        documents = [{
+            "delivery_id": str(uuid.uuid4()),
+            "webhook_id": webhook["webhook_id"],
+            "event": event_payload["event"],
+            "payload": event_payload,
+            "status": PENDING,
+            "created_at": now,
+            "retry_count": 0,
+            "next_retry": now,
+            "last_error": None,
+            # Bail pris dès l'écriture : ce worker envoie lui-même la première tentative
+            "lease_owner": self.worker_id,
+            "lease_until": self._lease_until(now)
+        } for webhook in webhooks]
+
+        await self.deliveries.insert_many(documents, ordered=False)
+        self.stats["enqueued"] += len(documents)
+
+        for webhook, document in zip(webhooks, documents):
+            self._scheduled.add(document["delivery_id"])
+            await self.engine.submit(webhook, event_payload, document)
+        return len(documents)
+
+    # ====================
+    # Résultat d'une tentative
+    # ====================
+
+    async def complete(self, webhook: Dict[str, Any], event_payload: Dict[str, Any],
+                       result: Dict[str, Any], delivery: Optional[Dict[str, Any]]):
+        """Appelé par le moteur après chaque tentative"""
+        if delivery is None:
+            return
+        try:
+            if result["success"]:
+                await self._mark_delivered(delivery, result)
+                return
+
+            attempts = delivery["retry_count"] + 1
+            if attempts > self.max_retries:
+                await self.dead_letter(delivery, "max_retries_exceeded", result.get("error"))
+                return
+
+            delay = self.retry_delays[min(attempts - 1, len(self.retry_delays) - 1)]
+            next_retry = datetime.utcnow() + timedelta(seconds=delay)
+            lease_until = self._lease_until(next_retry)
+            # Le bail couvre l'attente : la tentative reste à ce worker tant qu'il est vivant
+            updated = await self.deliveries.update_one(
+                {"delivery_id": delivery["delivery_id"], "lease_owner": self.worker_id},
+                {"$set": {
+                    "status": RETRYING,
+                    "retry_count": attempts,
+                    "next_retry": next_retry,
+                    "last_error": result.get("error"),
+                    "response_status": result.get("status_code"),
+                    "lease_until": lease_until
+                }}
+            )
+            if not updated.matched_count:
+                # Bail repris par un autre worker : c'est lui qui planifie la prochaine tentative
+                self._lease_lost(delivery)
+                return
+            delivery.update({
+                "status": RETRYING,
+                "retry_count": attempts,
+                "next_retry": next_retry,
+                "last_error": result.get("error"),
+                "lease_until": lease_until
+            })
+            self._schedule(delivery, _epoch(next_retry))
+        except Exception as e:
+            logger.error(f"Erreur mise à jour de l'outbox webhooks: {e}")
+        finally:
+            if delivery.get("status") != RETRYING:
+                self._scheduled.discard(delivery["delivery_id"])
+
+    async def _mark_delivered(self, delivery: Dict[str, Any], result: Dict[str, Any]):
+        delivery["status"] = DELIVERED
+        updated = await self.deliveries.update_one(
+            {"delivery_id": delivery["delivery_id"], "lease_owner": self.worker_id},
+            {"$set": {
+                "status": DELIVERED,
+                "delivered_at": datetime.utcnow(),
+                "retry_count": delivery["retry_count"],
+                "response_status": result.get("status_code"),
+                "response_time": result.get("response_time"),
+                "last_error": None
+            }, "$unset": {"lease_owner": "", "lease_until": ""}}
+        )
+        if not updated.matched_count:
+            # Bail repris entre-temps : l'état appartient au nouveau détenteur
+            self._lease_lost(delivery)
+            return
+        await self.db.webhooks.update_one(
+            {"webhook_id": delivery["webhook_id"]},
+            {"$inc": {"success_count": 1, "total_deliveries": 1}}
+        )
+        self.stats["delivered"] += 1
+
+    async def dead_letter(self, delivery: Dict[str, Any], reason: str, error: Optional[str] = None):
+        """Sort explicitement une livraison du circuit : copie en lettres mortes, statut failed"""
+        now = datetime.utcnow()
+        delivery["status"] = FAILED
+        updated = await self.deliveries.update_one(
+            {"delivery_id": delivery["delivery_id"], "lease_owner": self.worker_id},
+            {"$set": {
+                "status": FAILED,
+                "failed_at": now,
+                "dead_lettered": True,
+                "dead_letter_reason": reason,
+                "last_error": error or delivery.get("last_error")
+            }, "$unset": {"lease_owner": "", "lease_until": ""}}
+        )
+        if not updated.matched_count:
+            self._lease_lost(delivery)
+            return
+        await self.dead_letters.update_one(
+            {"delivery_id": delivery["delivery_id"]},
+            {"$set": {
+                "delivery_id": delivery["delivery_id"],
+                "webhook_id": delivery["webhook_id"],
+                "event": delivery["event"],
+                "payload": delivery["payload"],
+                "reason": reason,
+                "last_error": error or delivery.get("last_error"),
+                "attempts": delivery["retry_count"] + (1 if reason == "max_retries_exceeded" else 0),
+                "dead_lettered_at": now
+            }},
+            upsert=True
+        )
+        await self.db.webhooks.update_one(
+            {"webhook_id": delivery["webhook_id"]},
+            {"$inc": {"failure_count": 1, "total_deliveries": 1}}
+        )
+        self.stats["dead_lettered"] += 1
+        logger.warning(f"Livraison {delivery['delivery_id']} en lettres mortes ({reason})")
+
+    # ====================
+    # Planification
+    # ====================
+
+    def _schedule(self, delivery: Dict[str, Any], due: float):
+        self._scheduled.add(delivery["delivery_id"])
+        heapq.heappush(self._timers, (due, next(self._sequence), delivery))
+        # Réveille la boucle si cette échéance devient la plus proche
+        if self._wakeup and self._timers[0][2] is delivery:
+            self._wakeup.set()
+
+    async def _timer_loop(self):
+        """Dort jusqu'à l'échéance la plus proche puis soumet les tentatives dues"""
+        while True:
+            try:
+                timeout = self.poll_interval
+                if self._timers:
+                    timeout = max(0.0, self._timers[0][0] - time.time())
+                if timeout > 0:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                _, _, delivery = heapq.heappop(self._timers)
+                webhook = await self.resolve_webhook(delivery["webhook_id"])
+                if not webhook:
+                    self._scheduled.discard(delivery["delivery_id"])
+                    await self.dead_letter(delivery, "webhook_inactive")
+                    continue
+                self.stats["retried"] += 1
+                await self.engine.submit(webhook, delivery["payload"], delivery)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur planification des webhooks: {e}")
+
+    async def claim_due(self) -> int:
+        """Réclame (bail atomique) les livraisons dues non tenues par un autre worker"""
+        claimed = 0
+        while claimed < self.claim_batch:
+            now = datetime.utcnow()
+            delivery = await self.deliveries.find_one_and_update(
+                {
+                    "status": {"$in": [PENDING, RETRYING]},
+                    "next_retry": {"$lte": now},
+                    "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]
+                },
+                {"$set": {"lease_owner": self.worker_id, "lease_until": self._lease_until(now)}},
+                sort=[("next_retry", 1)],
+                return_document=ReturnDocument.AFTER
+            )
+            if not delivery:
+                break
+            claimed += 1
+            if delivery["delivery_id"] not in self._scheduled:
+                self._schedule(delivery, time.time())
+        self.stats["claimed"] += claimed
+        return claimed
+
+    async def _claim_loop(self):
+        while True:
+            try:
+                claimed = await self.claim_due()
+                # Lot plein : il reste probablement des livraisons dues, on enchaîne
+                if claimed < self.claim_batch:
+                    await asyncio.sleep(self.poll_interval)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur réclamation des livraisons webhooks: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    # ====================
+    # Lettres mortes
+    # ====================
+
+    async def list_dead_letters(self, webhook_id: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        query = {"webhook_id": webhook_id} if webhook_id else {}
+        cursor = self.dead_letters.find(query, {"_id": 0}).sort("dead_lettered_at", -1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def replay_dead_letter(self, delivery_id: str) -> bool:
+        """Remet une lettre morte dans l'outbox (nouveau cycle de tentatives)"""
+        dead_letter = await self.dead_letters.find_one_and_delete({"delivery_id": delivery_id})
+        if not dead_letter:
+            return False
+        await self.deliveries.update_one(
+            {"delivery_id": delivery_id},
+            {"$set": {
+                "status": RETRYING,
+                "retry_count": 0,
+                "next_retry": datetime.utcnow(),
+                "dead_lettered": False,
+                "replayed_at": datetime.utcnow()
+            }, "$unset": {"lease_owner": "", "lease_until": ""}}
+        )
+        if self._wakeup:
+            # Réclamée au prochain passage de la boucle de réclamation
+            asyncio.create_task(self.claim_due())
+        return True
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "scheduled": len(self._timers),
+            **self.stats
+        }
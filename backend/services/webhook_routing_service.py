@@ -0,0 +1,146 @@
+"""
+Routage des événements webhooks QuantumShield
+Index des abonnements : pour chaque événement, les webhooks sans filtre et,
+pour les webhooks filtrés, un accès direct par (champ, valeur). Les filtres
+(device_id, user_id, severity) sont compilés une fois à l'indexation ; le
+coût d'un routage est proportionnel au nombre de webhooks concernés.
+"""
+
+import logging
+from typing import Dict, Any, Callable, FrozenSet, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Champ de filtre -> clés lues dans les données de l'événement (la première présente)
+FILTER_FIELDS: Dict[str, Tuple[str, ...]] = {
+    "device_id": ("device_id",),
+    "user_id": ("user_id", "owner_id"),
+    "severity": ("severity",),
+}
+
+Predicate = Callable[[Dict[str, Any]], bool]
+
+
+def normalize_filters(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, List[str]]]:
+    """Ne garde que les champs supportés, valeurs en listes de chaînes (None si aucun filtre)"""
+    if not filters:
+        return None
+    normalized = {}
+    for field, values in filters.items():
+        if field not in FILTER_FIELDS or values is None:
+            continue
+        if isinstance(values, (str, int)):
+            values = [values]
+        values = sorted({str(value) for value in values})
+        if values:
+            normalized[field] = values
+    return normalized or None
+
+
+def field_value(data: Dict[str, Any], field: str) -> Optional[str]:
+    for key in FILTER_FIELDS[field]:
+        value = data.get(key)
+        if value is not None:
+            return str(value)
+    return None
+
+
+def compile_filters(filters: Dict[str, List[str]]) -> Predicate:
+    """Prédicat ET entre champs, OU entre les valeurs d'un même champ"""
+    checks: List[Tuple[str, FrozenSet[str]]] = [
+        (field, frozenset(values)) for field, values in filters.items()
+    ]
+
+    def predicate(data: Dict[str, Any]) -> bool:
+        return all(field_value(data, field) in allowed for field, allowed in checks)
+
+    return predicate
+
+
+class WebhookSubscriptionIndex:
+    """Index événement -> abonnés, maintenu à chaque création, mise à jour ou suppression"""
+
+    def __init__(self):
+        # événement -> {webhook_id: webhook}
+        self._unfiltered: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        # événement -> {(champ, valeur): {webhook_id: (webhook, prédicat)}}
+        self._filtered: Dict[str, Dict[Tuple[str, str], Dict[str, Tuple[Dict[str, Any], Predicate]]]] = {}
+        # webhook_id -> emplacements occupés, pour un retrait sans parcours
+        self._entries: Dict[str, List[Tuple[str, Optional[Tuple[str, str]]]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, webhook_id: str) -> bool:
+        return webhook_id in self._entries
+
+    def add(self, webhook: Dict[str, Any]):
+        """Indexe (ou réindexe) un webhook actif"""
+        webhook_id = webhook["webhook_id"]
+        self.remove(webhook_id)
+
+        filters = webhook.get("filters")
+        entries = []
+        if filters:
+            predicate = compile_filters(filters)
+            # Une seule clé d'accès par webhook : le champ le plus sélectif (le moins de valeurs)
+            anchor_field = min(filters, key=lambda field: len(filters[field]))
+            for event in webhook["events"]:
+                buckets = self._filtered.setdefault(event, {})
+                for value in filters[anchor_field]:
+                    key = (anchor_field, value)
+                    buckets.setdefault(key, {})[webhook_id] = (webhook, predicate)
+                    entries.append((event, key))
+        else:
+            for event in webhook["events"]:
+                self._unfiltered.setdefault(event, {})[webhook_id] = webhook
+                entries.append((event, None))
+        self._entries[webhook_id] = entries
+
+    def remove(self, webhook_id: str) -> bool:
+        entries = self._entries.pop(webhook_id, None)
+        if entries is None:
+            return False
+        for event, key in entries:
+            if key is None:
+                subscribers = self._unfiltered.get(event, {})
+                subscribers.pop(webhook_id, None)
+                if not subscribers:
+                    self._unfiltered.pop(event, None)
+            else:
+                buckets = self._filtered.get(event, {})
+                bucket = buckets.get(key, {})
+                bucket.pop(webhook_id, None)
+                if not bucket:
+                    buckets.pop(key, None)
+                if not buckets:
+                    self._filtered.pop(event, None)
+        return True
+
+    def rebuild(self, webhooks: List[Dict[str, Any]]):
+        self._unfiltered.clear()
+        self._filtered.clear()
+        self._entries.clear()
+        for webhook in webhooks:
+            self.add(webhook)
+
+    def route(self, event: str, data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Webhooks à notifier pour cet événement et ces données"""
+        matches = list(self._unfiltered.get(event, {}).values())
+        buckets = self._filtered.get(event)
+        if buckets:
+            for field in FILTER_FIELDS:
+                value = field_value(data, field)
+                if value is None:
+                    continue
+                for webhook, predicate in buckets.get((field, value), {}).values():
+                    if predicate(data):
+                        matches.append(webhook)
+        return matches
+
+    def get_statistics(self) -> Dict[str, Any]:
+        return {
+            "indexed_webhooks": len(self._entries),
+            "events": len(set(self._unfiltered) | set(self._filtered)),
+            "filter_keys": sum(len(buckets) for buckets in self._filtered.values())
+        }
@@ -4,20 +4,38 @@ Gère les notifications en temps réel et les intégrations externes
 """
 
 import asyncio
-import aiohttp
-import json
 import logging
-import hashlib
-import hmac
+import os
 import uuid
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Callable
+from typing import Dict, Any, List, Optional
 from enum import Enum
 import secrets
 from urllib.parse import urlparse
+from services.index_registry import IndexSpec, QueryProbe
+from services.webhook_delivery_service import WebhookDeliveryEngine
+from services.webhook_outbox_service import WebhookOutbox
+from services.webhook_batch_service import WebhookBatcher, normalize_batching
+from services.webhook_routing_service import WebhookSubscriptionIndex, normalize_filters
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("webhooks", "webhook_id", unique=True),
+    IndexSpec("webhooks", [("user_id", 1), ("created_at", -1)]),
+    IndexSpec("webhooks", "status"),
+    IndexSpec("webhook_deliveries", [("status", 1), ("next_retry", 1)]),
+    IndexSpec("webhook_deliveries", [("webhook_id", 1), ("created_at", -1)]),
+    # Expiration des livraisons après 30 jours (même seuil que la purge périodique)
+    IndexSpec("webhook_deliveries", "created_at", ttl_seconds=30 * 86400),
+]
+
+QUERY_PROBES = [
+    QueryProbe("webhooks", {"webhook_id": "probe"}, description="webhook par identifiant"),
+    QueryProbe("webhooks", {"status": "active"}, description="webhooks actifs (émission)"),
+    QueryProbe("webhook_deliveries", {"webhook_id": "probe"}, sort=[("created_at", -1)], description="historique de livraison"),
+]
+
 class WebhookStatus(str, Enum):
     ACTIVE = "active"
     INACTIVE = "inactive"
@@ -51,13 +69,34 @@ class WebhookService:
     def __init__(self, db):
         self.db = db
         self.active_webhooks = {}
+        # Événement -> abonnés (et filtres compilés), synchronisé avec active_webhooks
+        self.subscriptions = WebhookSubscriptionIndex()
         self.event_handlers = {}
         self.retry_config = {
             "max_retries": 3,
             "retry_delays": [5, 30, 300],  # 5s, 30s, 5min
             "timeout": 30
         }
+        # Session HTTP partagée et pool borné de workers (démarré à la première livraison)
+        self.delivery_engine = WebhookDeliveryEngine(
+            workers=int(os.environ.get("WEBHOOK_DELIVERY_WORKERS", "32")),
+            max_pending=int(os.environ.get("WEBHOOK_MAX_PENDING", "10000")),
+            per_endpoint_concurrency=int(os.environ.get("WEBHOOK_ENDPOINT_CONCURRENCY", "4")),
+            timeout=self.retry_config["timeout"]
+        )
+        # Outbox durable : persistance, bails, nouvelles tentatives et lettres mortes
+        self.outbox = WebhookOutbox(
+            db,
+            self.delivery_engine,
+            resolve_webhook=self.resolve_webhook,
+            max_retries=self.retry_config["max_retries"],
+            retry_delays=self.retry_config["retry_delays"],
+            lease_seconds=int(os.environ.get("WEBHOOK_LEASE_SECONDS", "60"))
+        )
+        # Regroupement des événements pour les webhooks en mode lot
+        self.batcher = WebhookBatcher(flush=lambda webhook, payload: self.outbox.enqueue([webhook], payload))
         self.is_initialized = False
+        self._workers_started = False
         self._initialize()
     
     def _initialize(self):
@@ -66,12 +105,6 @@ class WebhookService:
             # Enregistrer les handlers d'événements
             self._register_event_handlers()
             
-            # Charger les webhooks actifs
-            asyncio.create_task(self._load_active_webhooks())
-            
-            # Démarrer les workers de retry
-            asyncio.create_task(self._start_retry_workers())
-            
             self.is_initialized = True
             logger.info("Service Webhooks initialisé")
             
@@ -115,17 +148,45 @@ class WebhookService:
             
             for webhook in webhooks:
                 self.active_webhooks[webhook["webhook_id"]] = webhook
+            self.subscriptions.rebuild(webhooks)
             
             logger.info(f"Chargé {len(webhooks)} webhooks actifs")
             
         except Exception as e:
             logger.error(f"Erreur chargement webhooks: {str(e)}")
     
+    async def resolve_webhook(self, webhook_id: str) -> Optional[Dict[str, Any]]:
+        """Webhook actif depuis le cache, ou depuis la base en cas d'absence
+
+        Le cache est propre au processus : une livraison réclamée par ce worker
+        peut viser un webhook enregistré ou réactivé sur un autre worker.
+        """
+        webhook = self.active_webhooks.get(webhook_id)
+        if webhook:
+            return webhook
+        webhook = await self.db.webhooks.find_one({"webhook_id": webhook_id, "status": WebhookStatus.ACTIVE.value})
+        if webhook:
+            self.active_webhooks[webhook_id] = webhook
+            self.subscriptions.add(webhook)
+        return webhook
+    
+    async def start(self):
+        """Charge les webhooks actifs et démarre l'outbox (appelé au démarrage de l'API)
+
+        L'outbox reprend alors les livraisons en attente ou en nouvelle tentative
+        laissées par un arrêt précédent.
+        """
+        await self._start_retry_workers()
+    
     async def _start_retry_workers(self):
         """Démarre les workers de retry"""
+        if self._workers_started:
+            return
+        self._workers_started = True
         try:
-            # Worker pour les retries
-            asyncio.create_task(self._retry_worker())
+            # L'outbox résout les webhooks depuis le cache : il doit être chargé avant
+            await self._load_active_webhooks()
+            await self.outbox.start()
             
             # Worker pour nettoyer les anciens logs
             asyncio.create_task(self._cleanup_worker())
@@ -145,8 +206,15 @@ class WebhookService:
                              user_id: str,
                              secret: Optional[str] = None,
                              headers: Optional[Dict[str, str]] = None,
-                             name: Optional[str] = None) -> Dict[str, Any]:
-        """Enregistre un nouveau webhook"""
+                             name: Optional[str] = None,
+                             batching: Optional[Dict[str, Any]] = None,
+                             filters: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+        """Enregistre un nouveau webhook
+
+        `batching` (enabled, max_batch, window_ms, gzip, events) active la
+        livraison groupée : un POST signé contenant la liste des événements.
+        `filters` restreint les événements reçus (device_id, user_id, severity).
+        """
         try:
             # Valider l'URL
             parsed_url = urlparse(url)
@@ -169,6 +237,8 @@ class WebhookService:
                 "user_id": user_id,
                 "secret": secret,
                 "headers": headers or {},
+                "batching": normalize_batching(batching),
+                "filters": normalize_filters(filters),
                 "name": name or f"Webhook {webhook_id[:8]}",
                 "status": WebhookStatus.ACTIVE.value,
                 "created_at": datetime.utcnow(),
@@ -184,6 +254,7 @@ class WebhookService:
             
             # Ajouter aux webhooks actifs
             self.active_webhooks[webhook_id] = webhook_data
+            self.subscriptions.add(webhook_data)
             
             logger.info(f"Webhook enregistré: {webhook_id} pour {user_id}")
             
@@ -192,7 +263,9 @@ class WebhookService:
                 "webhook_id": webhook_id,
                 "url": url,
                 "events": [event.value for event in events],
-                "secret": secret
+                "secret": secret,
+                "batching": webhook_data["batching"],
+                "filters": webhook_data["filters"]
             }
             
         except Exception as e:
@@ -208,7 +281,9 @@ class WebhookService:
                            events: Optional[List[WebhookEvent]] = None,
                            status: Optional[WebhookStatus] = None,
                            headers: Optional[Dict[str, str]] = None,
-                           name: Optional[str] = None) -> Dict[str, Any]:
+                           name: Optional[str] = None,
+                           batching: Optional[Dict[str, Any]] = None,
+                           filters: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
         """Met à jour un webhook"""
         try:
             # Récupérer le webhook
@@ -243,6 +318,14 @@ class WebhookService:
             if name:
                 updates["name"] = name
             
+            if batching is not None:
+                updates["batching"] = normalize_batching(batching)
+                # Les événements déjà regroupés partent avec les anciens paramètres
+                await self.batcher.flush(webhook_id)
+            
+            if filters is not None:
+                updates["filters"] = normalize_filters(filters)
+            
             # Mettre à jour en base
             await self.db.webhooks.update_one(
                 {"webhook_id": webhook_id},
@@ -253,13 +336,19 @@ class WebhookService:
             if webhook_id in self.active_webhooks:
                 self.active_webhooks[webhook_id].update(updates)
             
-            # Si le webhook est désactivé, le retirer du cache
-            if status == WebhookStatus.INACTIVE:
+            # Si le webhook n'est plus actif, le retirer du cache
+            if status and status != WebhookStatus.ACTIVE:
                 self.active_webhooks.pop(webhook_id, None)
             elif status == WebhookStatus.ACTIVE:
                 updated_webhook = await self.db.webhooks.find_one({"webhook_id": webhook_id})
                 self.active_webhooks[webhook_id] = updated_webhook
             
+            # Réindexer les abonnements (événements, filtres ou statut ont pu changer)
+            if webhook_id in self.active_webhooks:
+                self.subscriptions.add(self.active_webhooks[webhook_id])
+            else:
+                self.subscriptions.remove(webhook_id)
+            
             logger.info(f"Webhook mis à jour: {webhook_id}")
             
             return {
@@ -287,8 +376,10 @@ class WebhookService:
                     "error": "Webhook non trouvé"
                 }
             
-            # Supprimer du cache
+            # Supprimer du cache (et les événements en attente de regroupement)
             self.active_webhooks.pop(webhook_id, None)
+            self.subscriptions.remove(webhook_id)
+            self.batcher.discard(webhook_id)
             
             logger.info(f"Webhook supprimé: {webhook_id}")
             
@@ -373,7 +464,12 @@ class WebhookService:
     # ==============================
     
     async def emit_event(self, event_type: WebhookEvent, data: Dict[str, Any]):
-        """Émet un événement vers tous les webhooks concernés"""
+        """Émet un événement vers tous les webhooks concernés
+
+        Les livraisons sont d'abord persistées dans l'outbox, puis passent par
+        la file du moteur : si elle est pleine, l'appel attend qu'une place se
+        libère (contre-pression).
+        """
         try:
             # Traiter l'événement avec le handler approprié
             if event_type in self.event_handlers:
@@ -388,141 +484,27 @@ class WebhookService:
                 "data": processed_data
             }
             
-            # Trouver les webhooks concernés
-            relevant_webhooks = [
-                webhook for webhook in self.active_webhooks.values()
-                if event_type.value in webhook["events"]
+            # Trouver les webhooks concernés (index des abonnements, filtres sur les
+            # données brutes complétées par les données traitées)
+            relevant_webhooks = self.subscriptions.route(event_type.value, {**data, **processed_data})
+            
+            # Webhooks en mode lot : l'événement rejoint leur fenêtre de regroupement
+            direct_webhooks = [
+                webhook for webhook in relevant_webhooks
+                if not await self.batcher.add(webhook, event_payload)
             ]
             
-            # Envoyer à chaque webhook
-            for webhook in relevant_webhooks:
-                asyncio.create_task(
-                    self._deliver_webhook_with_retry(webhook, event_payload)
-                )
+            # Persister puis mettre en file une livraison par webhook restant
+            await self.outbox.enqueue(direct_webhooks, event_payload)
             
             logger.info(f"Événement émis: {event_type.value} vers {len(relevant_webhooks)} webhooks")
             
         except Exception as e:
             logger.error(f"Erreur émission événement: {str(e)}")
     
-    async def _deliver_webhook_with_retry(self, webhook: Dict[str, Any], event_payload: Dict[str, Any]):
-        """Délivre un webhook avec système de retry"""
-        try:
-            # Créer l'entrée de livraison
-            delivery_id = str(uuid.uuid4())
-            delivery_data = {
-                "delivery_id": delivery_id,
-                "webhook_id": webhook["webhook_id"],
-                "event": event_payload["event"],
-                "payload": event_payload,
-                "status": WebhookDeliveryStatus.PENDING.value,
-                "created_at": datetime.utcnow(),
-                "retry_count": 0,
-                "next_retry": datetime.utcnow(),
-                "last_error": None
-            }
-            
-            await self.db.webhook_deliveries.insert_one(delivery_data)
-            
-            # Tenter la livraison
-            delivery_result = await self._deliver_webhook(webhook, event_payload)
-            
-            # Mettre à jour le statut
-            if delivery_result["success"]:
-                await self.db.webhook_deliveries.update_one(
-                    {"delivery_id": delivery_id},
-                    {"$set": {
-                        "status": WebhookDeliveryStatus.DELIVERED.value,
-                        "delivered_at": datetime.utcnow(),
-                        "response_status": delivery_result.get("status_code"),
-                        "response_time": delivery_result.get("response_time")
-                    }}
-                )
-                
-                # Incrémenter les compteurs de succès
-                await self.db.webhooks.update_one(
-                    {"webhook_id": webhook["webhook_id"]},
-                    {"$inc": {"success_count": 1, "total_deliveries": 1}}
-                )
-            else:
-                # Programmer le retry
-                await self.db.webhook_deliveries.update_one(
-                    {"delivery_id": delivery_id},
-                    {"$set": {
-                        "status": WebhookDeliveryStatus.RETRYING.value,
-                        "last_error": delivery_result.get("error"),
-                        "next_retry": datetime.utcnow() + timedelta(seconds=self.retry_config["retry_delays"][0])
-                    }}
-                )
-            
-        except Exception as e:
-            logger.error(f"Erreur livraison webhook: {str(e)}")
-    
     async def _deliver_webhook(self, webhook: Dict[str, Any], event_payload: Dict[str, Any]) -> Dict[str, Any]:
-        """Délivre un webhook à une URL"""
-        try:
-            # Préparer les headers
-            headers = {
-                "Content-Type": "application/json",
-                "User-Agent": "QuantumShield-Webhook/1.0",
-                "X-Webhook-Event": event_payload["event"],
-                "X-Webhook-Delivery": str(uuid.uuid4()),
-                "X-Webhook-Timestamp": str(int(datetime.utcnow().timestamp()))
-            }
-            
-            # Ajouter les headers personnalisés
-            if webhook.get("headers"):
-                headers.update(webhook["headers"])
-            
-            # Préparer le payload
-            payload = json.dumps(event_payload, default=str)
-            
-            # Générer la signature
-            if webhook.get("secret"):
-                signature = hmac.new(
-                    webhook["secret"].encode(),
-                    payload.encode(),
-                    hashlib.sha256
-                ).hexdigest()
-                headers["X-Webhook-Signature"] = f"sha256={signature}"
-            
-            # Envoyer la requête
-            start_time = datetime.utcnow()
-            
-            timeout = aiohttp.ClientTimeout(total=self.retry_config["timeout"])
-            
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(
-                    webhook["url"],
-                    data=payload,
-                    headers=headers
-                ) as response:
-                    response_time = (datetime.utcnow() - start_time).total_seconds()
-                    
-                    if response.status >= 200 and response.status < 300:
-                        return {
-                            "success": True,
-                            "status_code": response.status,
-                            "response_time": response_time
-                        }
-                    else:
-                        return {
-                            "success": False,
-                            "status_code": response.status,
-                            "response_time": response_time,
-                            "error": f"HTTP {response.status}"
-                        }
-            
-        except asyncio.TimeoutError:
-            return {
-                "success": False,
-                "error": "Timeout"
-            }
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e)
-            }
+        """Délivre un webhook à une URL (session HTTP partagée du moteur)"""
+        return await self.delivery_engine.deliver(webhook, event_payload)
     
     # ==============================
     # Handlers d'événements
@@ -668,88 +650,6 @@ class WebhookService:
     # Workers
     # ==============================
     
-    async def _retry_worker(self):
-        """Worker pour retry les webhooks échoués"""
-        try:
-            while True:
-                # Attendre 30 secondes entre les cycles
-                await asyncio.sleep(30)
-                
-                # Récupérer les livraisons à retry
-                now = datetime.utcnow()
-                deliveries = await self.db.webhook_deliveries.find({
-                    "status": WebhookDeliveryStatus.RETRYING.value,
-                    "next_retry": {"$lte": now},
-                    "retry_count": {"$lt": self.retry_config["max_retries"]}
-                }).to_list(None)
-                
-                for delivery in deliveries:
-                    try:
-                        # Récupérer le webhook
-                        webhook = await self.db.webhooks.find_one({"webhook_id": delivery["webhook_id"]})
-                        if not webhook or webhook["status"] != WebhookStatus.ACTIVE.value:
-                            continue
-                        
-                        # Retry la livraison
-                        result = await self._deliver_webhook(webhook, delivery["payload"])
-                        
-                        if result["success"]:
-                            # Succès - marquer comme livré
-                            await self.db.webhook_deliveries.update_one(
-                                {"delivery_id": delivery["delivery_id"]},
-                                {"$set": {
-                                    "status": WebhookDeliveryStatus.DELIVERED.value,
-                                    "delivered_at": datetime.utcnow(),
-                                    "response_status": result.get("status_code"),
-                                    "response_time": result.get("response_time")
-                                }}
-                            )
-                            
-                            # Incrémenter les compteurs
-                            await self.db.webhooks.update_one(
-                                {"webhook_id": webhook["webhook_id"]},
-                                {"$inc": {"success_count": 1, "total_deliveries": 1}}
-                            )
-                        else:
-                            # Échec - programmer le prochain retry
-                            retry_count = delivery["retry_count"] + 1
-                            
-                            if retry_count >= self.retry_config["max_retries"]:
-                                # Abandon après max retries
-                                await self.db.webhook_deliveries.update_one(
-                                    {"delivery_id": delivery["delivery_id"]},
-                                    {"$set": {
-                                        "status": WebhookDeliveryStatus.FAILED.value,
-                                        "last_error": result.get("error"),
-                                        "failed_at": datetime.utcnow()
-                                    }}
-                                )
-                                
-                                # Incrémenter les compteurs d'échec
-                                await self.db.webhooks.update_one(
-                                    {"webhook_id": webhook["webhook_id"]},
-                                    {"$inc": {"failure_count": 1, "total_deliveries": 1}}
-                                )
-                            else:
-                                # Programmer le prochain retry
-                                delay = self.retry_config["retry_delays"][min(retry_count - 1, len(self.retry_config["retry_delays"]) - 1)]
-                                
-                                await self.db.webhook_deliveries.update_one(
-                                    {"delivery_id": delivery["delivery_id"]},
-                                    {"$set": {
-                                        "retry_count": retry_count,
-                                        "last_error": result.get("error"),
-                                        "next_retry": datetime.utcnow() + timedelta(seconds=delay)
-                                    }}
-                                )
-                    
-                    except Exception as e:
-                        logger.error(f"Erreur retry webhook: {str(e)}")
-                        continue
-                
-        except Exception as e:
-            logger.error(f"Erreur retry worker: {str(e)}")
-    
     async def _cleanup_worker(self):
         """Worker pour nettoyer les anciens logs"""
         try:
@@ -821,17 +721,43 @@ class WebhookService:
                     "total_deliveries": total_deliveries,
                     "successful_deliveries": successful_deliveries,
                     "success_rate": (successful_deliveries / max(1, total_deliveries)) * 100,
-                    "supported_events": [event.value for event in WebhookEvent]
+                    "supported_events": [event.value for event in WebhookEvent],
+                    "delivery_engine": self.delivery_engine.get_statistics(),
+                    "outbox": self.outbox.get_statistics(),
+                    "batching": self.batcher.get_statistics(),
+                    "subscriptions": self.subscriptions.get_statistics()
                 }
                 
         except Exception as e:
             logger.error(f"Erreur récupération stats webhooks: {str(e)}")
             return {"error": str(e)}
     
+    async def list_dead_letters(self, webhook_id: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Liste les livraisons abandonnées (lettres mortes)"""
+        try:
+            return await self.outbox.list_dead_letters(webhook_id, limit)
+        except Exception as e:
+            logger.error(f"Erreur récupération lettres mortes: {str(e)}")
+            return []
+    
+    async def replay_dead_letter(self, delivery_id: str) -> Dict[str, Any]:
+        """Relance une livraison abandonnée"""
+        try:
+            if not await self.outbox.replay_dead_letter(delivery_id):
+                return {"success": False, "error": "Lettre morte non trouvée"}
+            return {"success": True, "delivery_id": delivery_id}
+        except Exception as e:
+            logger.error(f"Erreur relance lettre morte: {str(e)}")
+            return {"success": False, "error": str(e)}
+    
     async def shutdown(self):
         """Arrête le service de webhooks"""
         try:
+            await self.batcher.flush_all()
+            await self.outbox.stop()
+            await self.delivery_engine.stop()
             self.active_webhooks.clear()
+            self.subscriptions.rebuild([])
             self.event_handlers.clear()
             
             logger.info("Service Webhooks arrêté")
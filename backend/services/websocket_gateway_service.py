@@ -0,0 +1,447 @@
+"""
+Passerelle WebSocket pour les connexions persistantes des devices IoT
+Files d'envoi bornées, trames binaires (MessagePack/CBOR), heartbeats coalescés
+et routage des commandes par topic (équivalent de publish_mqtt_message)
+
+Budget mémoire par connexion inactive (estimation, à vérifier avec benchmarks/ws_load_generator.py):
+    - DeviceConnection (__slots__, sans deque allouée)     ~0.2 KiB
+    - Objet WebSocket Starlette + scope ASGI               ~3 KiB
+    - Protocole uvicorn/websockets (buffers de lecture)    ~12-20 KiB
+    - Tâche de réception (coroutine endpoint)              ~2 KiB
+    Total visé : <= 24 KiB par connexion, soit ~1.2 GiB pour 50 000 connexions.
+
+La file d'envoi et la tâche d'écriture ne sont allouées que lorsqu'un message
+est en attente : une connexion inactive ne coûte qu'une tâche (la réception).
+Les pings de keepalive sont gérés par un seul balayage périodique et non par
+un timer par connexion ; lancer uvicorn avec --ws-ping-interval 0 pour
+désactiver les pings par connexion de la bibliothèque websockets.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional, Any, Set
+
+try:
+    from pymongo import UpdateOne
+except ImportError:
+    UpdateOne = None
+
+from services.iot_protocol_service import IoTProtocol, MessageType
+from services.payload_codec_service import PayloadCodecService, FIXED_LAYOUT_MAGIC
+
+logger = logging.getLogger(__name__)
+
+# Sous-protocoles WebSocket négociés à la connexion
+SUBPROTOCOL_MSGPACK = "qs.msgpack"
+SUBPROTOCOL_CBOR = "qs.cbor"
+SUBPROTOCOL_JSON = "qs.json"
+
+SUBPROTOCOL_CODECS = {
+    SUBPROTOCOL_MSGPACK: "msgpack",
+    SUBPROTOCOL_CBOR: "cbor",
+    SUBPROTOCOL_JSON: "json"
+}
+
+
+class DeviceConnection:
+    """État minimal d'une connexion device (slots pour limiter la mémoire)"""
+
+    __slots__ = (
+        "device_id", "websocket", "encoding", "topics", "last_seen",
+        "send_queue", "writer_task", "dropped_messages", "connected_at"
+    )
+
+    def __init__(self, device_id: str, websocket, encoding: str):
+        self.device_id = device_id
+        self.websocket = websocket
+        self.encoding = encoding
+        self.topics: Optional[Set[str]] = None
+        self.last_seen = time.monotonic()
+        self.send_queue: Optional[deque] = None
+        self.writer_task: Optional[asyncio.Task] = None
+        self.dropped_messages = 0
+        self.connected_at = time.time()
+
+
+class WebSocketGatewayService:
+    """Passerelle WebSocket haute concurrence pour les devices IoT"""
+
+    def __init__(self, db, iot_protocol_service=None):
+        self.db = db
+        self.iot_protocol_service = iot_protocol_service
+        self.payload_codecs = (
+            iot_protocol_service.payload_codecs if iot_protocol_service else PayloadCodecService(db)
+        )
+        self.connections: Dict[str, DeviceConnection] = {}
+        self.topic_subscribers: Dict[str, Set[str]] = {}
+        self.pending_heartbeats: Dict[str, datetime] = {}
+        self.max_connections = 50000
+        self.send_queue_size = 64
+        self.max_dropped_before_close = 256
+        self.ping_interval = 20
+        self.ping_timeout = 10
+        self.heartbeat_flush_interval = 5
+        self.stats = {
+            "total_connections": 0,
+            "rejected_connections": 0,
+            "messages_received": 0,
+            "messages_sent": 0,
+            "messages_dropped": 0,
+            "heartbeats_received": 0,
+            "heartbeat_flushes": 0
+        }
+        self._flush_task: Optional[asyncio.Task] = None
+        self._sweep_task: Optional[asyncio.Task] = None
+        self.is_initialized = False
+        self._initialize()
+
+    def _initialize(self):
+        """Initialise la passerelle depuis la configuration du protocole WebSocket"""
+        try:
+            if self.iot_protocol_service:
+                config = self.iot_protocol_service.protocol_configs.get(IoTProtocol.WEBSOCKET, {})
+                self.max_connections = config.get("max_connections", self.max_connections)
+                self.ping_interval = config.get("ping_interval", self.ping_interval)
+                self.ping_timeout = config.get("ping_timeout", self.ping_timeout)
+                self.send_queue_size = config.get("send_queue_size", self.send_queue_size)
+
+            self.is_initialized = True
+            logger.info("Passerelle WebSocket initialisée avec succès")
+
+        except Exception as e:
+            logger.error(f"Erreur initialisation passerelle WebSocket: {str(e)}")
+            self.is_initialized = False
+
+    def is_ready(self) -> bool:
+        """Vérifie si le service est prêt"""
+        return self.is_initialized
+
+    async def start(self):
+        """Démarre les tâches de fond (flush des heartbeats, balayage keepalive)"""
+        if not self._flush_task:
+            self._flush_task = asyncio.create_task(self._heartbeat_flush_loop())
+        if not self._sweep_task:
+            self._sweep_task = asyncio.create_task(self._keepalive_sweep_loop())
+
+    async def stop(self):
+        """Arrête les tâches de fond et ferme toutes les connexions"""
+        for task in (self._flush_task, self._sweep_task):
+            if task:
+                task.cancel()
+        self._flush_task = None
+        self._sweep_task = None
+
+        for connection in list(self.connections.values()):
+            await self._close_connection(connection, code=1001)
+
+        await self._flush_heartbeats()
+
+    # ====================
+    # Encodage des trames
+    # ====================
+
+    def supported_subprotocols(self) -> List[str]:
+        """Retourne les sous-protocoles supportés par ordre de préférence"""
+        available = self.payload_codecs.codecs
+        return [
+            subprotocol for subprotocol, codec_name in SUBPROTOCOL_CODECS.items()
+            if codec_name in available
+        ]
+
+    def negotiate_subprotocol(self, requested: List[str]) -> Optional[str]:
+        """Choisit le premier sous-protocole demandé par le client que l'on supporte"""
+        supported = self.supported_subprotocols()
+        for subprotocol in requested:
+            if subprotocol in supported:
+                return subprotocol
+        return None
+
+    def encode_frame(self, encoding: str, message: Dict[str, Any]):
+        """Encode un message selon l'encodage de la connexion (texte pour JSON)"""
+        frame = self.payload_codecs.get_codec(SUBPROTOCOL_CODECS[encoding]).encode(message)
+        if encoding == SUBPROTOCOL_JSON:
+            return frame.decode()
+        return frame
+
+    def decode_frame(self, encoding: str, data) -> Dict[str, Any]:
+        """Décode une trame reçue selon l'encodage de la connexion"""
+        if isinstance(data, str):
+            data = data.encode()
+        # Les trames binaires à disposition fixe sont acceptées quel que soit le sous-protocole
+        if data[:1] == bytes([FIXED_LAYOUT_MAGIC]):
+            return {
+                "type": MessageType.SENSOR_DATA.value,
+                "payload": self.payload_codecs.decode(data, codec_name="fixed_layout")
+            }
+        return self.payload_codecs.decode(data, codec_name=SUBPROTOCOL_CODECS[encoding])
+
+    # ====================
+    # Cycle de vie des connexions
+    # ====================
+
+    def can_accept(self) -> bool:
+        """Vérifie si une nouvelle connexion peut être acceptée"""
+        return len(self.connections) < self.max_connections
+
+    def register_connection(self, device_id: str, websocket, encoding: str) -> DeviceConnection:
+        """Enregistre une connexion acceptée (remplace une éventuelle connexion précédente)"""
+        previous = self.connections.get(device_id)
+        if previous:
+            self._unsubscribe_all(previous)
+            asyncio.create_task(self._close_connection(previous, code=4000))
+
+        connection = DeviceConnection(device_id, websocket, encoding)
+        self.connections[device_id] = connection
+        # Un codec négocié (ex. fixed_layout) prime sur celui du sous-protocole
+        self.payload_codecs.device_codecs.setdefault(device_id, SUBPROTOCOL_CODECS[encoding])
+        self.stats["total_connections"] += 1
+        return connection
+
+    def unregister_connection(self, connection: DeviceConnection):
+        """Retire une connexion fermée"""
+        if self.connections.get(connection.device_id) is connection:
+            del self.connections[connection.device_id]
+        self._unsubscribe_all(connection)
+        if connection.writer_task and not connection.writer_task.done():
+            connection.writer_task.cancel()
+
+    async def _close_connection(self, connection: DeviceConnection, code: int = 1000):
+        """Ferme une connexion sans lever d'exception"""
+        try:
+            await connection.websocket.close(code=code)
+        except Exception:
+            pass
+        self.unregister_connection(connection)
+
+    async def handle_frame(self, connection: DeviceConnection, data) -> Optional[Dict[str, Any]]:
+        """Traite une trame reçue d'un device et retourne une éventuelle réponse"""
+        connection.last_seen = time.monotonic()
+        self.stats["messages_received"] += 1
+
+        try:
+            message = self.decode_frame(connection.encoding, data)
+        except Exception as e:
+            logger.warning(f"Trame invalide de {connection.device_id}: {str(e)}")
+            return {"type": "error", "error": "invalid_frame"}
+
+        if not isinstance(message, dict):
+            return {"type": "error", "error": "invalid_frame"}
+
+        message_type = message.get("type", MessageType.SENSOR_DATA.value)
+
+        if message_type == MessageType.HEARTBEAT.value:
+            # Coalescer : seul le dernier heartbeat par device est écrit au prochain flush
+            self.pending_heartbeats[connection.device_id] = datetime.utcnow()
+            presence = getattr(self.iot_protocol_service, "presence", None)
+            if presence:
+                presence.record_heartbeat(connection.device_id)
+            self.stats["heartbeats_received"] += 1
+            return None
+
+        if message_type == "ping":
+            return {"type": "pong"}
+
+        if message_type == "subscribe":
+            topic = message.get("topic")
+            if topic:
+                self._subscribe(connection, topic)
+            return {"type": "subscribed", "topic": topic}
+
+        if message_type == "unsubscribe":
+            topic = message.get("topic")
+            if topic:
+                self._unsubscribe(connection, topic)
+            return {"type": "unsubscribed", "topic": topic}
+
+        await self._dispatch_to_protocol_handler(connection, message_type, message)
+        return None
+
+    async def _dispatch_to_protocol_handler(self, connection: DeviceConnection, message_type: str, message: Dict[str, Any]):
+        """Transmet un message aux handlers du service de protocoles IoT"""
+        if not self.iot_protocol_service:
+            return
+
+        try:
+            handler = self.iot_protocol_service.message_handlers.get(MessageType(message_type))
+        except ValueError:
+            logger.warning(f"Type de message inconnu de {connection.device_id}: {message_type}")
+            return
+
+        payload = message.get("payload")
+        if not isinstance(payload, dict):
+            payload = {}
+        payload.setdefault("device_id", connection.device_id)
+        await handler(payload, IoTProtocol.WEBSOCKET)
+
+    # ====================
+    # Routage des messages sortants
+    # ====================
+
+    def _subscribe(self, connection: DeviceConnection, topic: str):
+        if connection.topics is None:
+            connection.topics = set()
+        connection.topics.add(topic)
+        self.topic_subscribers.setdefault(topic, set()).add(connection.device_id)
+
+    def _unsubscribe(self, connection: DeviceConnection, topic: str):
+        if connection.topics:
+            connection.topics.discard(topic)
+        subscribers = self.topic_subscribers.get(topic)
+        if subscribers:
+            subscribers.discard(connection.device_id)
+            if not subscribers:
+                del self.topic_subscribers[topic]
+
+    def _unsubscribe_all(self, connection: DeviceConnection):
+        for topic in list(connection.topics or ()):
+            self._unsubscribe(connection, topic)
+
+    def _enqueue(self, connection: DeviceConnection, frame) -> bool:
+        """Ajoute une trame à la file bornée d'une connexion"""
+        if connection.send_queue is None:
+            connection.send_queue = deque()
+
+        if len(connection.send_queue) >= self.send_queue_size:
+            connection.dropped_messages += 1
+            self.stats["messages_dropped"] += 1
+            if connection.dropped_messages >= self.max_dropped_before_close:
+                logger.warning(f"Device {connection.device_id} trop lent, fermeture de la connexion")
+                asyncio.create_task(self._close_connection(connection, code=1008))
+            return False
+
+        connection.send_queue.append(frame)
+        if connection.writer_task is None or connection.writer_task.done():
+            connection.writer_task = asyncio.create_task(self._drain_queue(connection))
+        return True
+
+    async def _drain_queue(self, connection: DeviceConnection):
+        """Vide la file d'envoi puis libère la tâche et la file"""
+        try:
+            while connection.send_queue:
+                frame = connection.send_queue.popleft()
+                if isinstance(frame, bytes):
+                    await connection.websocket.send_bytes(frame)
+                else:
+                    await connection.websocket.send_text(frame)
+                self.stats["messages_sent"] += 1
+            connection.send_queue = None
+        except Exception as e:
+            logger.debug(f"Envoi interrompu vers {connection.device_id}: {str(e)}")
+            connection.send_queue = None
+
+    def send_to_device(self, device_id: str, message: Dict[str, Any]) -> bool:
+        """Envoie un message à un device connecté"""
+        connection = self.connections.get(device_id)
+        if not connection:
+            return False
+        return self._enqueue(connection, self.encode_frame(connection.encoding, message))
+
+    async def publish_message(self, topic: str, payload: dict) -> Dict[str, Any]:
+        """Publie un message à tous les abonnés d'un topic (équivalent de publish_mqtt_message)"""
+        try:
+            subscribers = self.topic_subscribers.get(topic, ())
+            message = {"type": "message", "topic": topic, "payload": payload}
+
+            # Encoder une seule fois par encodage, pas une fois par abonné
+            frames = {}
+            delivered = 0
+            dropped = 0
+            for device_id in list(subscribers):
+                connection = self.connections.get(device_id)
+                if not connection:
+                    continue
+                frame = frames.get(connection.encoding)
+                if frame is None:
+                    frame = self.encode_frame(connection.encoding, message)
+                    frames[connection.encoding] = frame
+                if self._enqueue(connection, frame):
+                    delivered += 1
+                else:
+                    dropped += 1
+
+            return {"success": True, "topic": topic, "delivered": delivered, "dropped": dropped}
+
+        except Exception as e:
+            logger.error(f"Erreur publication WebSocket: {str(e)}")
+            return {"success": False, "error": str(e)}
+
+    # ====================
+    # Tâches de fond
+    # ====================
+
+    async def _heartbeat_flush_loop(self):
+        """Écrit périodiquement les heartbeats coalescés en une seule opération"""
+        while True:
+            try:
+                await asyncio.sleep(self.heartbeat_flush_interval)
+                await self._flush_heartbeats()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur flush heartbeats WebSocket: {str(e)}")
+
+    async def _flush_heartbeats(self):
+        """Écrit les heartbeats en attente avec un bulk_write"""
+        if not self.pending_heartbeats or UpdateOne is None:
+            return
+
+        pending, self.pending_heartbeats = self.pending_heartbeats, {}
+        operations = [
+            UpdateOne(
+                {"device_id": device_id},
+                {"$set": {"last_heartbeat": timestamp}}
+            )
+            for device_id, timestamp in pending.items()
+        ]
+        await self.db.devices.bulk_write(operations, ordered=False)
+        self.stats["heartbeat_flushes"] += 1
+
+    async def _keepalive_sweep_loop(self):
+        """Balayage unique : ping des connexions silencieuses, fermeture des connexions mortes"""
+        while True:
+            try:
+                await asyncio.sleep(self.ping_interval)
+                now = time.monotonic()
+                ping_frames = {}
+                for connection in list(self.connections.values()):
+                    idle = now - connection.last_seen
+                    if idle > self.ping_interval + self.ping_timeout:
+                        await self._close_connection(connection, code=1001)
+                    elif idle > self.ping_interval:
+                        frame = ping_frames.get(connection.encoding)
+                        if frame is None:
+                            frame = self.encode_frame(connection.encoding, {"type": "ping"})
+                            ping_frames[connection.encoding] = frame
+                        self._enqueue(connection, frame)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"Erreur balayage keepalive WebSocket: {str(e)}")
+
+    # ====================
+    # Statistiques
+    # ====================
+
+    def get_statistics(self) -> Dict[str, Any]:
+        """Retourne les statistiques de la passerelle"""
+        stats = dict(self.stats)
+        stats.update({
+            "active_connections": len(self.connections),
+            "max_connections": self.max_connections,
+            "topics": len(self.topic_subscribers),
+            "pending_heartbeats": len(self.pending_heartbeats),
+            "busy_connections": sum(1 for c in self.connections.values() if c.send_queue),
+            "subprotocols": self.supported_subprotocols()
+        })
+
+        try:
+            import resource
+            # ru_maxrss est en KiB sous Linux
+            stats["process_max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            pass
+
+        return stats
@@ -17,9 +17,28 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.primitives.serialization import pkcs12
 import secrets
+from concurrent.futures import ThreadPoolExecutor
+from services.index_registry import IndexSpec, QueryProbe
 
 logger = logging.getLogger(__name__)
 
+INDEXES = [
+    IndexSpec("certificates", "certificate_id", unique=True),
+    IndexSpec("certificates", "serial_number"),
+    IndexSpec("certificates", [("certificate_type", 1), ("status", 1)]),
+    IndexSpec("certificates", [("device_id", 1), ("created_at", -1)], sparse=True),
+    IndexSpec("certificates", [("status", 1), ("not_valid_after", 1)]),
+]
+
+QUERY_PROBES = [
+    QueryProbe("certificates", {"certificate_id": "probe"}, description="certificat par identifiant"),
+    QueryProbe("certificates", {"certificate_type": "root_ca", "status": "active"}, description="CA racine active"),
+    QueryProbe(
+        "certificates", {"status": "active", "not_valid_after": {"$lte": 0}},
+        sort=[("not_valid_after", 1)], description="certificats arrivant à expiration"
+    ),
+]
+
 class CertificateStatus(str, Enum):
     ACTIVE = "active"
     EXPIRED = "expired"
@@ -356,134 +375,16 @@ class X509Service:
                               user_id: Optional[str] = None) -> Dict[str, Any]:
         """Émet un nouveau certificat"""
         try:
-            if not self.intermediate_ca_cert or not self.intermediate_ca_key:
-                raise Exception("CA intermédiaire non disponible")
-            
-            # Générer la clé privée
-            private_key = rsa.generate_private_key(
-                public_exponent=65537,
-                key_size=self.config["key_size"]
+            cert_data, result = self._build_certificate(
+                subject_name, certificate_type, key_usage,
+                subject_alt_names, validity_days, device_id, user_id
             )
             
-            # Créer le sujet
-            subject = x509.Name([
-                x509.NameAttribute(NameOID.COMMON_NAME, subject_name),
-                x509.NameAttribute(NameOID.ORGANIZATION_NAME, "QuantumShield"),
-                x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Devices" if certificate_type == CertificateType.DEVICE else "Users"),
-            ])
-            
-            # Créer le certificat
-            cert_builder = x509.CertificateBuilder().subject_name(
-                subject
-            ).issuer_name(
-                self.intermediate_ca_cert.subject
-            ).public_key(
-                private_key.public_key()
-            ).serial_number(
-                x509.random_serial_number()
-            ).not_valid_before(
-                datetime.utcnow()
-            ).not_valid_after(
-                datetime.utcnow() + timedelta(days=validity_days or self.config["default_validity_days"])
-            )
-            
-            # Ajouter les extensions
-            if subject_alt_names:
-                san_list = []
-                for san in subject_alt_names:
-                    if san.startswith("DNS:"):
-                        san_list.append(x509.DNSName(san[4:]))
-                    elif san.startswith("IP:"):
-                        san_list.append(x509.IPAddress(san[3:]))
-                    else:
-                        san_list.append(x509.DNSName(san))
-                
-                cert_builder = cert_builder.add_extension(
-                    x509.SubjectAlternativeName(san_list),
-                    critical=False,
-                )
-            
-            # Ajouter les contraintes de base
-            cert_builder = cert_builder.add_extension(
-                x509.BasicConstraints(ca=False, path_length=None),
-                critical=True,
-            )
-            
-            # Ajouter l'utilisation de la clé
-            key_usage_obj = x509.KeyUsage(
-                digital_signature=KeyUsage.DIGITAL_SIGNATURE in key_usage,
-                key_encipherment=KeyUsage.KEY_ENCIPHERMENT in key_usage,
-                data_encipherment=KeyUsage.DATA_ENCIPHERMENT in key_usage,
-                key_agreement=KeyUsage.KEY_AGREEMENT in key_usage,
-                key_cert_sign=KeyUsage.CERTIFICATE_SIGN in key_usage,
-                crl_sign=KeyUsage.CRL_SIGN in key_usage,
-                content_commitment=False,
-                encipher_only=False,
-                decipher_only=False
-            )
-            
-            cert_builder = cert_builder.add_extension(
-                key_usage_obj,
-                critical=True,
-            )
-            
-            # Signer le certificat
-            cert = cert_builder.sign(self.intermediate_ca_key, self.config["hash_algorithm"])
-            
-            # Générer un mot de passe pour le PKCS#12
-            p12_password = secrets.token_urlsafe(16)
-            
-            # Créer le fichier PKCS#12
-            p12_data = pkcs12.serialize_key_and_certificates(
-                name=subject_name.encode(),
-                key=private_key,
-                cert=cert,
-                cas=[self.intermediate_ca_cert, self.root_ca_cert],
-                encryption_algorithm=serialization.BestAvailableEncryption(p12_password.encode())
-            )
-            
-            # Sauvegarder en base
-            cert_data = {
-                "certificate_id": str(uuid.uuid4()),
-                "certificate_type": certificate_type.value,
-                "subject": self._get_subject_string(cert.subject),
-                "issuer": self._get_subject_string(cert.issuer),
-                "serial_number": str(cert.serial_number),
-                "not_valid_before": cert.not_valid_before,
-                "not_valid_after": cert.not_valid_after,
-                "status": CertificateStatus.ACTIVE.value,
-                "certificate_pem": cert.public_bytes(serialization.Encoding.PEM).decode(),
-                "private_key_pem": private_key.private_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PrivateFormat.PKCS8,
-                    encryption_algorithm=serialization.NoEncryption()
-                ).decode(),
-                "pkcs12_data": base64.b64encode(p12_data).decode(),
-                "pkcs12_password": p12_password,
-                "fingerprint": hashlib.sha256(cert.public_bytes(serialization.Encoding.DER)).hexdigest(),
-                "key_usage": [ku.value for ku in key_usage],
-                "subject_alt_names": subject_alt_names or [],
-                "device_id": device_id,
-                "user_id": user_id,
-                "created_at": datetime.utcnow(),
-                "created_by": user_id or "system"
-            }
-            
             await self.db.certificates.insert_one(cert_data)
             
             logger.info(f"Certificat émis pour {subject_name}")
             
-            return {
-                "success": True,
-                "certificate_id": cert_data["certificate_id"],
-                "subject": subject_name,
-                "serial_number": cert_data["serial_number"],
-                "not_valid_before": cert.not_valid_before,
-                "not_valid_after": cert.not_valid_after,
-                "fingerprint": cert_data["fingerprint"],
-                "certificate_pem": cert_data["certificate_pem"],
-                "pkcs12_password": p12_password
-            }
+            return result
             
         except Exception as e:
             logger.error(f"Erreur émission certificat: {str(e)}")
@@ -492,6 +393,177 @@ class X509Service:
                 "error": str(e)
             }
     
+    async def issue_certificates_batch(self,
+                                     requests: List[Dict[str, Any]],
+                                     max_workers: int = 8) -> List[Dict[str, Any]]:
+        """Émet des certificats en parallèle (génération de clés hors de la boucle) et les insère en un lot"""
+        if not requests:
+            return []
+        
+        loop = asyncio.get_running_loop()
+        
+        def build(request: Dict[str, Any]):
+            try:
+                return self._build_certificate(
+                    request["subject_name"],
+                    request.get("certificate_type", CertificateType.DEVICE),
+                    request.get("key_usage", [KeyUsage.DIGITAL_SIGNATURE, KeyUsage.KEY_ENCIPHERMENT]),
+                    request.get("subject_alt_names"),
+                    request.get("validity_days"),
+                    request.get("device_id"),
+                    request.get("user_id")
+                )
+            except Exception as e:
+                return None, {"success": False, "error": str(e)}
+        
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            built = await asyncio.gather(*[
+                loop.run_in_executor(executor, build, request) for request in requests
+            ])
+        
+        documents = [cert_data for cert_data, _ in built if cert_data]
+        if documents:
+            await self.db.certificates.insert_many(documents, ordered=False)
+        
+        logger.info(f"{len(documents)} certificats émis en lot")
+        return [result for _, result in built]
+    
+    def _build_certificate(self,
+                           subject_name: str,
+                           certificate_type: CertificateType,
+                           key_usage: List[KeyUsage],
+                           subject_alt_names: Optional[List[str]] = None,
+                           validity_days: Optional[int] = None,
+                           device_id: Optional[str] = None,
+                           user_id: Optional[str] = None) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Génère la clé, signe le certificat et prépare le document (partie CPU, sans I/O)"""
+        if not self.intermediate_ca_cert or not self.intermediate_ca_key:
+            raise Exception("CA intermédiaire non disponible")
+        
+        # Générer la clé privée
+        private_key = rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=self.config["key_size"]
+        )
+        
+        # Créer le sujet
+        subject = x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, subject_name),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "QuantumShield"),
+            x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, "Devices" if certificate_type == CertificateType.DEVICE else "Users"),
+        ])
+        
+        # Créer le certificat
+        cert_builder = x509.CertificateBuilder().subject_name(
+            subject
+        ).issuer_name(
+            self.intermediate_ca_cert.subject
+        ).public_key(
+            private_key.public_key()
+        ).serial_number(
+            x509.random_serial_number()
+        ).not_valid_before(
+            datetime.utcnow()
+        ).not_valid_after(
+            datetime.utcnow() + timedelta(days=validity_days or self.config["default_validity_days"])
+        )
+        
+        # Ajouter les extensions
+        if subject_alt_names:
+            san_list = []
+            for san in subject_alt_names:
+                if san.startswith("DNS:"):
+                    san_list.append(x509.DNSName(san[4:]))
+                elif san.startswith("IP:"):
+                    san_list.append(x509.IPAddress(san[3:]))
+                else:
+                    san_list.append(x509.DNSName(san))
+            
+            cert_builder = cert_builder.add_extension(
+                x509.SubjectAlternativeName(san_list),
+                critical=False,
+            )
+        
+        # Ajouter les contraintes de base
+        cert_builder = cert_builder.add_extension(
+            x509.BasicConstraints(ca=False, path_length=None),
+            critical=True,
+        )
+        
+        # Ajouter l'utilisation de la clé
+        key_usage_obj = x509.KeyUsage(
+            digital_signature=KeyUsage.DIGITAL_SIGNATURE in key_usage,
+            key_encipherment=KeyUsage.KEY_ENCIPHERMENT in key_usage,
+            data_encipherment=KeyUsage.DATA_ENCIPHERMENT in key_usage,
+            key_agreement=KeyUsage.KEY_AGREEMENT in key_usage,
+            key_cert_sign=KeyUsage.CERTIFICATE_SIGN in key_usage,
+            crl_sign=KeyUsage.CRL_SIGN in key_usage,
+            content_commitment=False,
+            encipher_only=False,
+            decipher_only=False
+        )
+        
+        cert_builder = cert_builder.add_extension(
+            key_usage_obj,
+            critical=True,
+        )
+        
+        # Signer le certificat
+        cert = cert_builder.sign(self.intermediate_ca_key, self.config["hash_algorithm"])
+        
+        # Générer un mot de passe pour le PKCS#12
+        p12_password = secrets.token_urlsafe(16)
+        
+        # Créer le fichier PKCS#12
+        p12_data = pkcs12.serialize_key_and_certificates(
+            name=subject_name.encode(),
+            key=private_key,
+            cert=cert,
+            cas=[self.intermediate_ca_cert, self.root_ca_cert],
+            encryption_algorithm=serialization.BestAvailableEncryption(p12_password.encode())
+        )
+        
+        # Sauvegarder en base
+        cert_data = {
+            "certificate_id": str(uuid.uuid4()),
+            "certificate_type": certificate_type.value,
+            "subject": self._get_subject_string(cert.subject),
+            "issuer": self._get_subject_string(cert.issuer),
+            "serial_number": str(cert.serial_number),
+            "not_valid_before": cert.not_valid_before,
+            "not_valid_after": cert.not_valid_after,
+            "status": CertificateStatus.ACTIVE.value,
+            "certificate_pem": cert.public_bytes(serialization.Encoding.PEM).decode(),
+            "private_key_pem": private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            ).decode(),
+            "pkcs12_data": base64.b64encode(p12_data).decode(),
+            "pkcs12_password": p12_password,
+            "fingerprint": hashlib.sha256(cert.public_bytes(serialization.Encoding.DER)).hexdigest(),
+            "key_usage": [ku.value for ku in key_usage],
+            "subject_alt_names": subject_alt_names or [],
+            "device_id": device_id,
+            "user_id": user_id,
+            "created_at": datetime.utcnow(),
+            "created_by": user_id or "system"
+        }
+        
+        result = {
+            "success": True,
+            "certificate_id": cert_data["certificate_id"],
+            "subject": subject_name,
+            "serial_number": cert_data["serial_number"],
+            "not_valid_before": cert.not_valid_before,
+            "not_valid_after": cert.not_valid_after,
+            "fingerprint": cert_data["fingerprint"],
+            "certificate_pem": cert_data["certificate_pem"],
+            "pkcs12_password": p12_password
+        }
+        
+        return cert_data, result
+    
     async def revoke_certificate(self, certificate_id: str, reason: str = "unspecified") -> Dict[str, Any]:
         """Révoque un certificat"""
         try: